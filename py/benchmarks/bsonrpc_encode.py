@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Benchmark for encoding BSON RPC requests.
+
+Encodes a VTGate.ExecuteKeyspaceIds request with a few bind variables,
+and a VTGate.ExecuteBatchKeyspaceIds request, as built by
+vtgatev2.VTGateConnection._execute_batch, with the pure-python encoder
+(encoding the header and the body separately, then concatenating them)
+and with bsonrpc.encode_request, which uses cbson when it is available.
+It also compares bson.dumps and cbson.dumps on the converted bind
+variables alone.
+
+Usage:
+  PYTHONPATH=py python py/benchmarks/bsonrpc_encode.py [queries] [iterations]
+"""
+
+import sys
+import time
+
+import bson
+
+try:
+  import cbson
+except ImportError:
+  cbson = None
+
+from net import bsonrpc
+from net import gorpc
+from vtdb import field_types
+
+
+def make_bind_vars(i):
+  return field_types.convert_bind_vars({
+      'id': i,
+      'name': 'name_%d' % i,
+      'ids': [i, i + 1, i + 2],
+      'flag': True,
+      'score': i * 1.5,
+  })
+
+
+def make_single_request():
+  body = {
+      'Sql': 'update t set name=:name, score=:score where id=:id',
+      'BindVariables': make_bind_vars(1),
+      'Keyspace': 'test_keyspace',
+      'KeyspaceIds': ['\x80\x00\x00\x00\x00\x00\x00\x01'],
+      'TabletType': 'master',
+      'Session': None,
+  }
+  return gorpc.GoRpcRequest(
+      {'ServiceMethod': 'VTGate.ExecuteKeyspaceIds', 'Seq': 1}, body)
+
+
+def make_request(query_count):
+  queries = []
+  for i in xrange(query_count):
+    bind_vars = make_bind_vars(i)
+    queries.append({
+        'Sql': 'update t set name=:name, score=:score where id=:id',
+        'BindVariables': bind_vars,
+        'Keyspace': 'test_keyspace',
+        'KeyspaceIds': ['\x80\x00\x00\x00\x00\x00\x00%s' % chr(i % 256)],
+    })
+  body = {
+      'Queries': queries,
+      'TabletType': 'master',
+      'AsTransaction': True,
+      'Session': {'InTransaction': True, 'ShardSessions': []},
+  }
+  return gorpc.GoRpcRequest(
+      {'ServiceMethod': 'VTGate.ExecuteBatchKeyspaceIds', 'Seq': 1}, body)
+
+
+def encode_concat(req):
+  return bson.dumps(req.header) + bson.dumps(req.body)
+
+
+def bench(name, encode, req, iterations):
+  size = len(encode(req))
+  start = time.time()
+  for _ in xrange(iterations):
+    encode(req)
+  elapsed = time.time() - start
+  print '%-14s %8d bytes %8.1f us/request %8.1f MB/s' % (
+      name, size, elapsed / iterations * 1e6,
+      size * iterations / elapsed / 1024 / 1024)
+
+
+def bench_requests(title, req, iterations):
+  print title
+  bench('bson + concat', encode_concat, req, iterations)
+  bench('encode_request', bsonrpc.encode_request, req, iterations)
+
+
+def main():
+  query_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+  iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+  print 'cbson %s' % (
+      'enabled' if bsonrpc.encode_documents is not None else 'not available')
+  bench_requests('single query', make_single_request(), iterations * 100)
+  bench_requests('%d queries per batch' % query_count,
+                 make_request(query_count), iterations)
+  print 'bind variables'
+  bind_vars = make_bind_vars(1)
+  bench('bson.dumps', bson.dumps, bind_vars, iterations * 100)
+  if cbson is not None:
+    bench('cbson.dumps', cbson.dumps, bind_vars, iterations * 100)
+
+
+if __name__ == '__main__':
+  main()
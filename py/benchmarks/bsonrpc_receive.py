@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Benchmark for the GoRpcClient receive path.
+
+Streams large VTGate.StreamExecuteKeyRanges reply frames over a local
+socket pair, and compares the current receive buffer with the previous
+implementation, which grew a str with '+=' on every recv and sliced it
+after every frame. Reports the bytes copied per frame and the throughput.
+
+Usage: PYTHONPATH=py python py/benchmarks/bsonrpc_receive.py [rows] [frames]
+"""
+
+import select
+import socket
+import sys
+import threading
+import time
+
+import bson
+
+from net import bsonrpc
+from net import gorpc
+
+
+def make_frame(seq, row_count):
+  header = {'ServiceMethod': 'VTGate.StreamExecuteKeyRanges', 'Seq': seq,
+            'Error': ''}
+  reply = {
+      'Result': {
+          'Fields': [{'Name': 'id', 'Type': 8},
+                     {'Name': 'name', 'Type': 253},
+                     {'Name': 'payload', 'Type': 252}],
+          'Rows': [['%d' % i, 'name_%d' % i, 'x' * 200]
+                   for i in xrange(row_count)],
+          'RowsAffected': 0,
+          'InsertId': 0,
+      },
+      'Session': None,
+  }
+  return bson.dumps(header) + bson.dumps(reply)
+
+
+def send_frames(sock, frame, count):
+  for _ in xrange(count):
+    sock.sendall(frame)
+
+
+class LegacyReceiver(object):
+  """The previous receive loop, instrumented to count copied bytes."""
+
+  def __init__(self, sock, client):
+    self.sock = sock
+    self.client = client
+    self.data = None
+    self.copied = 0
+
+  def read_response(self, response):
+    if self.data is None:
+      self.data = self.sock.recv(gorpc.default_read_buffer_size)
+    while True:
+      consumed, extra_needed = self.client.decode_response(
+          response, self.data, 0, len(self.data))
+      if consumed:
+        if len(self.data) > consumed:
+          self.data = self.data[consumed:]
+          self.copied += len(self.data)
+        else:
+          self.data = None
+        return
+      more_data = self.sock.recv(
+          extra_needed or gorpc.default_read_buffer_size)
+      self.data += more_data
+      self.copied += len(self.data)
+
+
+def run_legacy(frame, count):
+  client_sock, server_sock = socket.socketpair()
+  sender = threading.Thread(target=send_frames,
+                            args=(server_sock, frame, count))
+  sender.daemon = True
+  sender.start()
+  receiver = LegacyReceiver(client_sock, bsonrpc.BsonRpcClient('bench', 30))
+  start = time.time()
+  for _ in xrange(count):
+    receiver.read_response(gorpc.GoRpcResponse())
+  elapsed = time.time() - start
+  sender.join()
+  client_sock.close()
+  server_sock.close()
+  return elapsed, receiver.copied
+
+
+def run_current(frame, count):
+  client_sock, server_sock = socket.socketpair()
+  sender = threading.Thread(target=send_frames,
+                            args=(server_sock, frame, count))
+  sender.daemon = True
+  sender.start()
+  client = bsonrpc.BsonRpcClient('bench', 30)
+  client.conn = gorpc._GoRpcConn(30)
+  client.conn.conn = client_sock
+  client_sock.setblocking(0)
+  client.conn.poll = select.poll()
+  client.conn.poll.register(client_sock.fileno(), select.POLLIN)
+  start = time.time()
+  for _ in xrange(count):
+    client._read_response(gorpc.GoRpcResponse(), start + 30)
+  elapsed = time.time() - start
+  sender.join()
+  copied = client.read_buffer.moved_bytes
+  client.close()
+  server_sock.close()
+  return elapsed, copied
+
+
+def main():
+  row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  frame_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+  frame = make_frame(1, row_count)
+  print 'frame size: %d bytes, %d rows, %d frames' % (
+      len(frame), row_count, frame_count)
+  for name, run in (('legacy str buffer', run_legacy),
+                    ('bytearray + recv_into', run_current)):
+    elapsed, copied = run(frame, frame_count)
+    print '%-22s %12d bytes copied/frame %8.1f MB/s' % (
+        name, copied / frame_count,
+        len(frame) * frame_count / elapsed / 1024 / 1024)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Benchmark for the row objects of db_object queries.
+
+Builds the rows of a result set as sql_builder.DBRow objects, and as
+instances of the sql_builder.row_class of its columns, and reports the
+memory they use, and the time to build them and to read a column.
+
+Usage:
+  PYTHONPATH=py python py/benchmarks/dbrow.py [rows]
+"""
+
+import sys
+import time
+
+from vtdb import sql_builder
+
+COLUMNS = ['id', 'user_id', 'status', 'name', 'created', 'comment']
+
+
+def row_size(row):
+  """Returns the bytes used by a row object, without its values."""
+  size = sys.getsizeof(row)
+  if isinstance(row, sql_builder.DBRow):
+    size += sys.getsizeof(row.__dict__)
+  return size
+
+
+def main():
+  row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+  rows = [(i, i * 7, i % 10, 'name_%d' % i, None, '') for i in
+          xrange(row_count)]
+
+  for name, make_rows in [
+      ('DBRow', lambda: [sql_builder.DBRow(COLUMNS, row) for row in rows]),
+      ('row_class', lambda: map(sql_builder.row_class(COLUMNS), rows)),
+  ]:
+    start = time.time()
+    objects = make_rows()
+    build = time.time() - start
+    start = time.time()
+    total = 0
+    for row in objects:
+      total += row.status
+    read = time.time() - start
+    print '%-9s: %d bytes/row, build %.0f ns/row, read %.0f ns/row' % (
+        name, row_size(objects[0]), build * 1e9 / row_count,
+        read * 1e9 / row_count)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Benchmark for decoding query result rows.
+
+Decodes a VTGate.ExecuteKeyspaceIds reply holding a big result, and
+converts its rows to tuples of Python values:
+- generic: cbson.decode_next builds a list per row, and a
+  row_converter.RowConverter converts the values in Python.
+- decode_rows: the client leaves the Rows encoded (raw_rows), and
+  cbson.decode_rows decodes and converts them in C.
+
+Usage:
+  PYTHONPATH=py python py/benchmarks/decode_rows.py [rows] [iterations]
+"""
+
+import sys
+import time
+
+import cbson
+
+from net import bsonrpc
+from vtdb import field_types
+from vtdb import vtgatev2
+
+FIELDS = [
+    ('id', field_types.VT_LONGLONG),
+    ('count', field_types.VT_LONG),
+    ('score', field_types.VT_DOUBLE),
+    ('name', field_types.VT_VAR_STRING),
+    ('created', field_types.VT_DATETIME),
+    ('day', field_types.VT_DATE),
+    ('price', field_types.VT_NEWDECIMAL),
+    ('comment', field_types.VT_BLOB),
+]
+
+
+def make_reply(row_count):
+  rows = []
+  for i in xrange(row_count):
+    rows.append([
+        str(1000000 + i), str(i % 1000), '%d.25' % i, 'name_%d' % i,
+        '2015-06-%02d 12:34:56' % (i % 28 + 1), '2015-06-%02d' % (i % 28 + 1),
+        '%d.99' % (i % 100), None if i % 3 else 'comment %d' % i])
+  return cbson.dumps({
+      'Result': {
+          'Fields': [{'Name': name, 'Type': t, 'Flags': 0}
+                     for name, t in FIELDS],
+          'RowsAffected': row_count,
+          'InsertId': 0,
+          'Rows': rows,
+      },
+      'Session': None,
+      'Error': '',
+  })
+
+
+def convert(reply, raw_keys):
+  _, reply = cbson.decode_next(reply, 0, raw_keys)
+  res = reply['Result']
+  fields = [(field['Name'], field['Type']) for field in res['Fields']]
+  return vtgatev2._make_rows(res['Rows'], fields)
+
+
+def bench(name, reply, raw_keys, row_count, iterations):
+  # one warm-up pass, and the rows we compare
+  rows = convert(reply, raw_keys)
+  start = time.time()
+  for _ in xrange(iterations):
+    convert(reply, raw_keys)
+  elapsed = (time.time() - start) / iterations
+  print '%-12s %8.3fs %10.0f rows/s' % (name, elapsed, row_count / elapsed)
+  return rows
+
+
+def main():
+  row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+  reply = make_reply(row_count)
+  print '%d rows, %d columns, %d bytes' % (row_count, len(FIELDS), len(reply))
+  generic = bench('generic', reply, None, row_count, iterations)
+  fast = bench('decode_rows', reply, bsonrpc.RAW_ROWS_KEYS, row_count,
+               iterations)
+  if generic != fast:
+    print 'MISMATCH between the two decoders'
+
+
+if __name__ == '__main__':
+  main()
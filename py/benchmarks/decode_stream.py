@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Benchmark for a long-running streaming consumer.
+
+Decodes a stream of VTGate.StreamExecuteKeyspaceIds response frames out
+of a receive buffer, the way BsonRpcClient does, and converts the rows
+like vtgatev2 does. Only a checksum of the rows is kept. Reports the
+decode rate, the peak RSS growth, the garbage collections and their
+pauses, and what the cbson key and small value caches saved.
+
+modes:
+  raw: the rows stay encoded in the reply and are decoded by
+    cbson.decode_rows (vtgatev2's default).
+  generic: the rows are decoded with the reply, and converted in Python.
+  lazy: the replies are cbson.LazyDocument views.
+
+Usage:
+  PYTHONPATH=py python py/benchmarks/decode_stream.py [mode] [rows]
+"""
+
+import gc
+import re
+import resource
+import StringIO
+import sys
+import time
+
+import cbson
+
+from net import bsonrpc
+from net import gorpc
+from vtdb import field_types
+from vtdb import vtgatev2
+
+ROWS_PER_PACKET = 1000
+
+FIELDS = [
+    ('id', field_types.VT_LONGLONG),
+    ('status', field_types.VT_LONGLONG),
+    ('count', field_types.VT_LONG),
+    ('name', field_types.VT_VAR_STRING),
+    ('created', field_types.VT_DATETIME),
+    ('comment', field_types.VT_BLOB),
+]
+
+
+def make_frames(packet_index):
+  """Returns the encoded frame of a stream packet."""
+  header = {'ServiceMethod': 'VTGate.StreamExecuteKeyspaceIds', 'Seq': 1,
+            'Error': ''}
+  rows = []
+  for i in xrange(ROWS_PER_PACKET):
+    n = packet_index * ROWS_PER_PACKET + i
+    rows.append([
+        str(1000000000 + n), str(n % 10), str(n % 1000), 'name_%d' % n,
+        '2015-06-%02d 12:34:56' % (n % 28 + 1), None])
+  return cbson.dumps(header, {
+      'Result': {'Fields': [], 'RowsAffected': ROWS_PER_PACKET,
+                 'InsertId': 0, 'Rows': rows},
+      'Session': None,
+      'Err': None,
+  })
+
+
+class GCPauses(object):
+  """Collects the garbage collector pauses, from its DEBUG_STATS output."""
+
+  elapsed_re = re.compile(r'gc: done.*?([\d.]+)s elapsed')
+
+  def __enter__(self):
+    self.stderr = sys.stderr
+    sys.stderr = self.output = StringIO.StringIO()
+    gc.set_debug(gc.DEBUG_STATS)
+    return self
+
+  def __exit__(self, *unused):
+    gc.set_debug(0)
+    sys.stderr = self.stderr
+    self.pauses = [float(p) for p in
+                   self.elapsed_re.findall(self.output.getvalue())]
+
+
+def main():
+  mode = sys.argv[1] if len(sys.argv) > 1 else 'raw'
+  row_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+  packet_count = row_count / ROWS_PER_PACKET
+  raw_keys = bsonrpc.RAW_ROWS_KEYS if mode == 'raw' else None
+  lazy = mode == 'lazy'
+
+  # a few distinct packets, received over and over into a bytearray
+  frames = [make_frames(i) for i in xrange(10)]
+  buf = bytearray(max(len(frame) for frame in frames))
+  gc.collect()
+  cbson.decode_stats(reset=True)
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  checksum = 0
+  start = time.time()
+  with GCPauses() as pauses:
+    for i in xrange(packet_count):
+      frame = frames[i % len(frames)]
+      buf[:len(frame)] = frame
+      response = gorpc.GoRpcResponse()
+      bsonrpc.decode_response(response, buf, 0, len(frame), raw_keys, lazy)
+      rows = vtgatev2._make_rows(response.reply['Result']['Rows'], FIELDS)
+      for row in rows:
+        checksum += row[1]
+  elapsed = time.time() - start
+
+  stats = cbson.decode_stats()
+  print 'mode %s: %d rows in %.2fs, %.0f rows/s' % (
+      mode, row_count, elapsed, row_count / elapsed)
+  print 'peak RSS growth: %d KB' % (
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss)
+  print 'gc: %d collections, %.3fs total pause, %.4fs max pause' % (
+      len(pauses.pauses), sum(pauses.pauses), max(pauses.pauses or [0]))
+  print 'cbson: %d allocations avoided, %d key hits, %d key misses' % (
+      stats['allocations_avoided'], stats['key_hits'], stats['key_misses'])
+  print 'checksum', checksum
+
+
+if __name__ == '__main__':
+  main()
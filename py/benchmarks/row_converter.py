@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Benchmark for converting decoded result rows to tuples.
+
+For a few mixes of column types, converts lists of decoded cells the
+way the vtdb clients used to (a loop over every cell, testing for None
+and for a conversion), and with row_converter.RowConverter. Reports
+the rows/second of each.
+
+Usage:
+  PYTHONPATH=py python py/benchmarks/row_converter.py [rows] [iterations]
+"""
+
+from itertools import izip
+import sys
+import time
+
+from vtdb import field_types
+from vtdb import row_converter
+
+# name, and (type, cell) of the columns
+MIXES = [
+    ('strings', [(field_types.VT_VAR_STRING, 'name'),
+                 (field_types.VT_VAR_STRING, 'value'),
+                 (field_types.VT_BLOB, 'some blob'),
+                 (field_types.VT_BLOB, None)]),
+    ('integers', [(field_types.VT_LONGLONG, '1234567890'),
+                  (field_types.VT_LONG, '12'),
+                  (field_types.VT_TINY, '1'),
+                  (field_types.VT_LONGLONG, None)]),
+    ('one id', [(field_types.VT_LONGLONG, '1234567890'),
+                (field_types.VT_VAR_STRING, 'name'),
+                (field_types.VT_VAR_STRING, 'value'),
+                (field_types.VT_BLOB, 'some blob'),
+                (field_types.VT_BLOB, None)]),
+    ('mixed', [(field_types.VT_LONGLONG, '1234567890'),
+               (field_types.VT_DOUBLE, '1.25'),
+               (field_types.VT_VAR_STRING, 'name'),
+               (field_types.VT_DATETIME, '2015-06-01 12:34:56'),
+               (field_types.VT_NEWDECIMAL, '9.99'),
+               (field_types.VT_BLOB, None)]),
+]
+
+
+def make_row(row, conversions):
+  """The conversion loop the vtdb clients used to have."""
+  converted_row = []
+  for conversion_func, field_data in izip(conversions, row):
+    if field_data is None:
+      v = None
+    elif conversion_func:
+      v = conversion_func(field_data)
+    else:
+      v = field_data
+    converted_row.append(v)
+  return converted_row
+
+
+def convert_loop(rows, types):
+  conversions = [field_types.conversions.get(t) for t in types]
+  return [tuple(make_row(row, conversions)) for row in rows]
+
+
+def convert_converter(rows, types):
+  return row_converter.get(types).convert_rows(rows)
+
+
+def bench(convert, rows, types, iterations):
+  start = time.time()
+  for _ in xrange(iterations):
+    convert(rows, types)
+  return len(rows) * iterations / (time.time() - start)
+
+
+def main():
+  row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+  print '%-10s %16s %16s' % ('columns', 'loop rows/s', 'converter rows/s')
+  for name, columns in MIXES:
+    types = [t for t, _ in columns]
+    rows = [[cell for _, cell in columns] for _ in xrange(row_count)]
+    if convert_loop(rows, types) != convert_converter(rows, types):
+      print 'MISMATCH for', name
+    print '%-10s %16.0f %16.0f' % (
+        name, bench(convert_loop, rows, types, iterations),
+        bench(convert_converter, rows, types, iterations))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Benchmark for prefetching streaming query packets.
+
+A child process plays the server: it streams VTGate.StreamExecuteKeyRanges
+reply frames over a socket pair with small socket buffers, at a limited
+bandwidth, so the server can't get far ahead of the client. The client
+spends CPU time on every row, as an export job would. Without prefetch
+the client alternates between reading a packet and processing its rows,
+with prefetch a reader thread receives the next packets meanwhile.
+
+The reader thread still needs the GIL to decode packets, so the gain is
+best when the frames are large compared to the socket buffers, and when
+the row processing itself releases the GIL (writing the rows out).
+
+Usage:
+  PYTHONPATH=py python py/benchmarks/stream_prefetch.py [frames] [mbps] [work]
+"""
+
+import os
+import select
+import socket
+import sys
+import time
+
+import bson
+
+from net import bsonrpc
+from net import gorpc
+
+ROWS_PER_FRAME = 5000
+SOCKET_BUFFER_SIZE = 32 * 1024
+CHUNK_SIZE = 16 * 1024
+
+
+def make_frame(seq, row_count, error=''):
+  header = {'ServiceMethod': 'VTGate.StreamExecuteKeyRanges', 'Seq': seq,
+            'Error': error}
+  reply = {
+      'Result': {
+          'Fields': [],
+          'Rows': [['%d' % i, 'name_%d' % i, 'x' * 200]
+                   for i in xrange(row_count)],
+          'RowsAffected': 0,
+          'InsertId': 0,
+      },
+  }
+  return bson.dumps(header) + bson.dumps(reply)
+
+
+def serve(sock, frame, count, bandwidth):
+  # sends count frames, then the end of stream, at bandwidth bytes/s
+  data = frame * count + make_frame(1, 0, gorpc._lastStreamResponseError)
+  # every chunk takes chunk_time on the link, once the socket buffer
+  # has room for it: a blocked sender doesn't catch up afterwards.
+  chunk_time = float(CHUNK_SIZE) / bandwidth
+  for offset in xrange(0, len(data), CHUNK_SIZE):
+    sock.sendall(data[offset:offset + CHUNK_SIZE])
+    time.sleep(chunk_time)
+
+
+def process(row, work):
+  total = 0
+  for i in xrange(work):
+    total += i
+  return total
+
+
+def run(frame, count, bandwidth, work, prefetch):
+  client_sock, server_sock = socket.socketpair()
+  for sock in (client_sock, server_sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+  pid = os.fork()
+  if pid == 0:
+    client_sock.close()
+    try:
+      serve(server_sock, frame, count, bandwidth)
+    finally:
+      os._exit(0)
+  server_sock.close()
+
+  client = bsonrpc.BsonRpcClient('bench', 30)
+  client.conn = gorpc._GoRpcConn(30)
+  client.conn.conn = client_sock
+  client_sock.setblocking(0)
+  client.conn.poll = select.poll()
+  client.conn.poll.register(client_sock.fileno(), select.POLLIN)
+
+  start = time.time()
+  client.stream_call('VTGate.StreamExecuteKeyRanges', {}, prefetch=prefetch)
+  rows = 0
+  while True:
+    response = client.stream_next()
+    if response is None:
+      break
+    for row in response.reply['Result']['Rows']:
+      process(row, work)
+      rows += 1
+  elapsed = time.time() - start
+  client.close()
+  os.waitpid(pid, 0)
+  return elapsed, rows
+
+
+def main():
+  frame_count = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+  mbps = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+  work = int(sys.argv[3]) if len(sys.argv) > 3 else 400
+  frame = make_frame(1, ROWS_PER_FRAME)
+  bandwidth = mbps * 1024 * 1024
+  print 'frame size: %d bytes, %d frames, %.0f MB/s link, %d work/row' % (
+      len(frame), frame_count, mbps, work)
+  print 'transfer time alone: %.2fs' % (len(frame) * frame_count / bandwidth)
+  for prefetch in (0, 1, 4):
+    elapsed, rows = run(frame, frame_count, bandwidth, work, prefetch)
+    print 'prefetch=%d %8d rows %6.2fs %10.0f rows/s' % (
+        prefetch, rows, elapsed, rows / elapsed)
+
+
+if __name__ == '__main__':
+  main()
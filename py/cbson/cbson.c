@@ -22,6 +22,7 @@
 
 /*#include <string.h>*/
 #include "Python.h"
+#include "datetime.h"
 
 #if PY_VERSION_HEX < 0x02020000
 #error Requires Python 2.2 or newer.
@@ -54,6 +55,7 @@ typedef struct _BufIter {
   const char* start; /* first byte of buffer */
   const char* end;   /* last byte of buffer */
   Slice slice; /* what we are currently looking at */
+  PyObject* raw_keys; /* set of names of documents not to decode, or NULL */
 } BufIter;
 
 /* current position within buffer */
@@ -120,16 +122,28 @@ static inline int next_cstring(BufIter* buf_iter, const char* tag) {
   return 1;
 }
 
-/* Initialize a BufIter and a Py_buffer from a Python buffer object */
+/* Initialize a BufIter and a Py_buffer from a Python buffer object.
+   Objects that only support the old buffer api (like mmap) are accepted
+   too. */
 static int buf_iter_from_buffer(PyObject* buffer_obj, BufIter* buf_iter, Py_buffer* pbuffer) {
- if (!PyObject_CheckBuffer(buffer_obj)) {
+ const void* data;
+ Py_ssize_t data_len;
+
+ if (PyObject_CheckBuffer(buffer_obj)) {
+   if (PyObject_GetBuffer(buffer_obj, pbuffer, PyBUF_SIMPLE) < 0)
+     return 0;
+ } else if (PyObject_CheckReadBuffer(buffer_obj)) {
+   /* the caller holds a reference to buffer_obj while we decode it */
+   if (PyObject_AsReadBuffer(buffer_obj, &data, &data_len) < 0)
+     return 0;
+   if (PyBuffer_FillInfo(pbuffer, NULL, (void*)data, data_len, 1,
+                         PyBUF_SIMPLE) < 0)
+     return 0;
+ } else {
    PyErr_SetString(BSONError, "argument must support buffer api");
    return 0;
  }
 
- if (PyObject_GetBuffer(buffer_obj, pbuffer, PyBUF_SIMPLE) < 0)
-   return 0;
-
  if (pbuffer->len == 0) {
    PyBuffer_Release(pbuffer);
    PyErr_SetString(BSONError, "empty buffer");
@@ -141,8 +155,48 @@ static int buf_iter_from_buffer(PyObject* buffer_obj, BufIter* buf_iter, Py_buff
 
  buf_iter->slice.start = buf_iter->start;
  buf_iter->slice.size = 0;
+ buf_iter->raw_keys = NULL;
+
+ return 1;
+}
+
+/* Initialize a BufIter and a Py_buffer from buffer[offset:end], where
+   end_obj is an int or NULL/None for the end of the buffer. Nothing is
+   copied: the iterator is only bounded by end, and positions are still
+   relative to the start of the buffer. */
+static int buf_iter_from_range(PyObject* buffer_obj, BufIter* buf_iter,
+                               Py_buffer* pbuffer, int offset,
+                               PyObject* end_obj) {
+ Py_ssize_t end;
+
+ if (!buf_iter_from_buffer(buffer_obj, buf_iter, pbuffer))
+   return 0;
 
+ if (offset < 0) {
+   PyErr_Format(BSONError, "invalid negative offset %i", offset);
+   goto error;
+ }
+
+ if (end_obj != NULL && end_obj != Py_None) {
+   end = PyNumber_AsSsize_t(end_obj, PyExc_OverflowError);
+   if (end == -1 && PyErr_Occurred())
+     goto error;
+   if (end < offset || end > pbuffer->len) {
+     PyErr_Format(BSONError, "invalid end %zd for offset %i in buffer of "
+                  "%zd bytes", end, offset, pbuffer->len);
+     goto error;
+   }
+   buf_iter->end = buf_iter->start + end - 1;
+ }
+
+ /* jump over offset bytes */
+ if (offset && !next(buf_iter, offset, "specified offset"))
+   goto error;
  return 1;
+
+error:
+ PyBuffer_Release(pbuffer);
+ return 0;
 }
 
 /* ------------------------------------------------------------------------ */
@@ -203,41 +257,162 @@ static PyObject* element_types[16] = {
 };
 
 
+/* ----------------------------------- caches ----------------------------------- */
+
+/* A stream of replies decodes the same few document keys ('Fields',
+ * 'Rows', 'Name', 'Type'...) and small numbers over and over. Keys go
+ * through a bounded direct-mapped cache of interned strings, and small
+ * ints and longs are shared objects, instead of fresh allocations. */
+#define KEY_CACHE_SIZE 1024 /* power of 2 */
+#define KEY_CACHE_MAX_LENGTH 64
+#define SMALL_VALUE_MIN (-5)
+#define SMALL_VALUE_MAX 1024 /* exclusive */
+/* CPython already shares the ints up to this one */
+#define PY_SMALL_INT_MAX 256
+
+static PyObject* key_cache[KEY_CACHE_SIZE];
+static PyObject* small_ints[SMALL_VALUE_MAX - SMALL_VALUE_MIN];
+static PyObject* small_longs[SMALL_VALUE_MAX - SMALL_VALUE_MIN];
+
+/* what the caches saved, for decode_stats() */
+static struct {
+  unsigned long key_hits;
+  unsigned long key_misses;
+  unsigned long int_hits;
+  unsigned long long_hits;
+} stats;
+
+/* Returns a document key, from the key cache when possible. */
+static PyObject* decode_key(const char* s, Py_ssize_t size) {
+  uint32_t hash = 2166136261u; /* FNV-1a */
+  Py_ssize_t i;
+  PyObject** slot;
+  PyObject* key;
+
+  if (size > KEY_CACHE_MAX_LENGTH) {
+    stats.key_misses++;
+    return PyString_FromStringAndSize(s, size);
+  }
+  for (i = 0; i < size; i++)
+    hash = (hash ^ (unsigned char)s[i]) * 16777619u;
+  slot = &key_cache[hash & (KEY_CACHE_SIZE - 1)];
+  key = *slot;
+  if (key != NULL && PyString_GET_SIZE(key) == size &&
+      memcmp(PyString_AS_STRING(key), s, size) == 0) {
+    stats.key_hits++;
+    Py_INCREF(key);
+    return key;
+  }
+
+  stats.key_misses++;
+  key = PyString_FromStringAndSize(s, size);
+  if (key == NULL)
+    return NULL;
+  PyString_InternInPlace(&key);
+  Py_INCREF(key);
+  Py_XDECREF(*slot);
+  *slot = key;
+  return key;
+}
+
+static PyObject* cached_int(long value) {
+  PyObject** slot;
+
+  if (value < SMALL_VALUE_MIN || value >= SMALL_VALUE_MAX ||
+      value <= PY_SMALL_INT_MAX)
+    return PyInt_FromLong(value);
+  slot = &small_ints[value - SMALL_VALUE_MIN];
+  if (*slot == NULL) {
+    *slot = PyInt_FromLong(value);
+    if (*slot == NULL)
+      return NULL;
+  } else {
+    stats.int_hits++;
+  }
+  Py_INCREF(*slot);
+  return *slot;
+}
+
+static PyObject* cached_long(PY_LONG_LONG value) {
+  PyObject** slot;
+
+  if (value < SMALL_VALUE_MIN || value >= SMALL_VALUE_MAX)
+    return PyLong_FromLongLong(value);
+  slot = &small_longs[value - SMALL_VALUE_MIN];
+  if (*slot == NULL) {
+    *slot = PyLong_FromLongLong(value);
+    if (*slot == NULL)
+      return NULL;
+  } else {
+    stats.long_hits++;
+  }
+  Py_INCREF(*slot);
+  return *slot;
+}
+
+static PyObject*
+decode_stats(PyObject *self, PyObject* args, PyObject* kwargs) {
+  static char* kwlist[] = {"reset", NULL};
+  int reset = 0;
+  PyObject* result;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|i:decode_stats", kwlist,
+                                   &reset))
+    return NULL;
+  result = Py_BuildValue(
+      "{sksksksksk}",
+      "key_hits", stats.key_hits,
+      "key_misses", stats.key_misses,
+      "small_int_hits", stats.int_hits,
+      "small_long_hits", stats.long_hits,
+      "allocations_avoided",
+      stats.key_hits + stats.int_hits + stats.long_hits);
+  if (result != NULL && reset)
+    memset(&stats, 0, sizeof(stats));
+  return result;
+}
+
 /* ----------------------------------- decoders ----------------------------------- */
 
 static PyObject* decode_document(BufIter* buf_iter);
 static PyObject* decode_uint64(BufIter* buf_iter);
+static PyObject* decode_lazy_document(PyObject* buffer_obj, BufIter* buf_iter);
 
 static PyObject*
-decode_next(PyObject *self, PyObject* args) {
+decode_next(PyObject *self, PyObject* args, PyObject* kwargs) {
+ static char* kwlist[] = {"buffer", "offset", "raw_keys", "end", "lazy",
+                          NULL};
  PyObject* buffer_obj;
+ PyObject* raw_keys = NULL;
+ PyObject* end_obj = NULL;
  Py_buffer buffer;
  BufIter mbuf_iter;
  int offset;
+ int lazy = 0;
  PyObject* decoded_obj;
 
  offset = 0;
 
- if (!PyArg_ParseTuple(args, "O|i:decode_next", &buffer_obj, &offset))
+ if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|iOOi:decode_next", kwlist,
+                                  &buffer_obj, &offset, &raw_keys, &end_obj,
+                                  &lazy))
    return NULL;
 
- if (!buf_iter_from_buffer(buffer_obj, &mbuf_iter, &buffer))
-     return NULL;
-
- if (offset < 0) {
-   PyErr_Format(BSONError, "invalid negative offset %i", offset);
-   PyBuffer_Release(&buffer);
-   return 0;
+ if (raw_keys == Py_None)
+   raw_keys = NULL;
+ if (raw_keys != NULL && !PyAnySet_Check(raw_keys)) {
+   PyErr_SetString(PyExc_TypeError, "raw_keys must be a set");
+   return NULL;
  }
 
- /* jump over offset bytes */
- if (offset)
-   if (!next(&mbuf_iter, offset, "specified offset")) {
-     PyBuffer_Release(&buffer);
-     return NULL;
-   }
+ if (!buf_iter_from_range(buffer_obj, &mbuf_iter, &buffer, offset, end_obj))
+   return NULL;
+ mbuf_iter.raw_keys = raw_keys;
 
- decoded_obj = decode_document(&mbuf_iter);
+ if (lazy)
+   decoded_obj = decode_lazy_document(buffer_obj, &mbuf_iter);
+ else
+   decoded_obj = decode_document(&mbuf_iter);
  if (!decoded_obj) {
    PyBuffer_Release(&buffer);
    return NULL;
@@ -252,16 +427,20 @@ decode_next(PyObject *self, PyObject* args) {
 }
 
 static PyObject*
-loads(PyObject *self, PyObject* args) {
+loads(PyObject *self, PyObject* args, PyObject* kwargs) {
+ static char* kwlist[] = {"buffer", "offset", "end", NULL};
  PyObject* buffer_obj;
+ PyObject* end_obj = NULL;
  PyObject* result;
  Py_buffer buffer;
  BufIter mbuf_iter;
+ int offset = 0;
 
- if (!PyArg_ParseTuple(args, "O:load", &buffer_obj))
+ if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|iO:loads", kwlist,
+                                  &buffer_obj, &offset, &end_obj))
    return NULL;
 
- if (!buf_iter_from_buffer(buffer_obj, &mbuf_iter, &buffer))
+ if (!buf_iter_from_range(buffer_obj, &mbuf_iter, &buffer, offset, end_obj))
      return NULL;
 
  result = decode_document(&mbuf_iter);
@@ -276,6 +455,66 @@ static inline int scan_int32(BufIter* buf_iter, uint32_t* result,
   return 1;
 }
 
+/* Go RPC frames are a header document followed by a body document. */
+static PyObject*
+frame_length(PyObject *self, PyObject* args, PyObject* kwargs) {
+ static char* kwlist[] = {"buffer", "offset", "end", NULL};
+ PyObject* buffer_obj;
+ PyObject* end_obj = NULL;
+ PyObject* header_size = NULL;
+ PyObject* body_size = NULL;
+ Py_buffer buffer;
+ BufIter mbuf_iter;
+ int offset = 0;
+ uint32_t size;
+
+ if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|iO:frame_length", kwlist,
+                                  &buffer_obj, &offset, &end_obj))
+   return NULL;
+
+ if (!buf_iter_from_range(buffer_obj, &mbuf_iter, &buffer, offset, end_obj))
+   return NULL;
+
+ /* each size is only known once its 4 bytes are there */
+ if (!too_short(&mbuf_iter, 4)) {
+   scan_int32(&mbuf_iter, &size, "header-length");
+   if (size < 5 || size > INT_MAX) {
+     PyErr_Format(BSONError, "invalid header size: %u", size);
+     goto error;
+   }
+   header_size = PyInt_FromLong(size);
+   if (header_size == NULL)
+     goto error;
+   if (!too_short(&mbuf_iter, size)) {
+     next(&mbuf_iter, size - 4, "header");
+     scan_int32(&mbuf_iter, &size, "body-length");
+     if (size < 5 || size > INT_MAX) {
+       PyErr_Format(BSONError, "invalid body size: %u", size);
+       goto error;
+     }
+     body_size = PyInt_FromLong(size);
+     if (body_size == NULL)
+       goto error;
+   }
+ }
+ PyBuffer_Release(&buffer);
+
+ if (header_size == NULL) {
+   Py_INCREF(Py_None);
+   header_size = Py_None;
+ }
+ if (body_size == NULL) {
+   Py_INCREF(Py_None);
+   body_size = Py_None;
+ }
+ return Py_BuildValue("NN", header_size, body_size);
+
+error:
+ Py_XDECREF(header_size);
+ PyBuffer_Release(&buffer);
+ return NULL;
+}
+
 static inline int scan_int64(BufIter* buf_iter, uint64_t* result,
                              const char* tag) {
   if (!next(buf_iter, 4, tag)) return 0;
@@ -283,6 +522,54 @@ static inline int scan_int64(BufIter* buf_iter, uint64_t* result,
   return 1;
 }
 
+/* Returns the encoded document or array at the current position, as a
+   str, without decoding it. */
+static PyObject* decode_raw_document(BufIter* buf_iter) {
+  uint32_t doc_size;
+  const char* doc_start;
+
+  if (!scan_int32(buf_iter, &doc_size, "document-length"))
+    return NULL;
+  if (doc_size < 5) {
+    PyErr_Format(BSONError, "invalid document size: %u", doc_size);
+    return NULL;
+  }
+  doc_start = PTR_AT(buf_iter, const char*);
+  if (!next(buf_iter, doc_size - 4, "raw-document"))
+    return NULL;
+  return PyString_FromStringAndSize(doc_start, doc_size);
+}
+
+/* Checks the size of the document whose length was just scanned, returns
+   0 and raises BSONBufferTooShort if the buffer is too short for it. */
+static int check_document_size(BufIter* buf_iter, uint32_t doc_size) {
+  uint32_t bytes_short;
+  PyObject* error_obj;
+
+  bytes_short = too_short(buf_iter, doc_size-4);
+  if (bytes_short) {
+    error_obj = Py_BuildValue(
+        "Nk",
+        PyString_FromFormat("buffer too short: "                        \
+                            "buffer[%d:] does not contain %d bytes for document",
+                            INDEX_OF(buf_iter), doc_size-4),
+        bytes_short);
+    if (!error_obj)
+      return 0;
+    PyErr_SetObject(BSONBufferTooShort, error_obj);
+    Py_DECREF(error_obj);
+    return 0;
+  }
+
+  if (doc_size < 5) {
+    /* This is invalid because doc_size includes the int32 size
+     * (i.e. itself) and the trailing \x00 */
+    PyErr_Format(BSONError, "invalid document size: %u", doc_size);
+    return 0;
+  }
+  return 1;
+}
+
 static inline PyObject*
 _decode_document(BufIter* buf_iter, int is_array) {
   uint32_t doc_size, element_idx;
@@ -293,9 +580,7 @@ _decode_document(BufIter* buf_iter, int is_array) {
   PyObject* element_value;
 
   decode_element decoder_func;
-
-  uint32_t bytes_short;
-  PyObject* error_obj;
+  int raw;
 
   doc_obj = NULL;
   element_name = NULL;
@@ -304,19 +589,8 @@ _decode_document(BufIter* buf_iter, int is_array) {
   if (!scan_int32(buf_iter, &doc_size, "document-length"))
     return NULL;
 
-  bytes_short = too_short(buf_iter, doc_size-4);
-  if (bytes_short) {
-    error_obj = Py_BuildValue(
-        "Nk",
-        PyString_FromFormat("buffer too short: "                        \
-                            "buffer[%d:] does not contain %d bytes for document",
-                            INDEX_OF(buf_iter), doc_size-4),
-        bytes_short);
-    if (!error_obj)
-      return NULL;
-    PyErr_SetObject(BSONBufferTooShort, error_obj);
+  if (!check_document_size(buf_iter, doc_size))
     return NULL;
-  }
 
   if (is_array)
     doc_obj = PyList_New(0);
@@ -325,13 +599,6 @@ _decode_document(BufIter* buf_iter, int is_array) {
 
   if (!doc_obj) return NULL;
 
-  if (doc_size < 5) {
-    /* This is invalid because doc_size includes the int32 size
-     * (i.e. itself) and the trailing \x00 */
-    PyErr_Format(BSONError, "invalid document size: %u", doc_size);
-    goto error;
-  }
-
   element_idx = 0;
   while (1) {
     if (!next(buf_iter, 1, "tag-id"))
@@ -346,15 +613,26 @@ _decode_document(BufIter* buf_iter, int is_array) {
     if (!next_cstring(buf_iter, "element-name"))
       goto error;
 
+    raw = 0;
     if (!is_array) {
-      element_name = PyString_FromString(PTR_AT(buf_iter, const char*));
+      element_name = decode_key(PTR_AT(buf_iter, const char*),
+                                buf_iter->slice.size - 1);
       if (!element_name) {
         goto error;
       }
+      if (buf_iter->raw_keys != NULL && (type_id == 0x03 || type_id == 0x04)) {
+        raw = PySet_Contains(buf_iter->raw_keys, element_name);
+        if (raw < 0)
+          goto error;
+      }
     }
 
+    /* documents and arrays named in raw_keys are kept encoded */
+    if (raw) {
+      element_value = decode_raw_document(buf_iter);
+    }
     /* type_ids from 0x01 thru 0x12 */
-    if (type_id > 0 && type_id <= 0x12) {
+    else if (type_id > 0 && type_id <= 0x12) {
       decoder_func = decoders[(int)type_id];
       element_value = decoder_func(buf_iter);
     }
@@ -662,21 +940,32 @@ static PyObject* decode_int32(BufIter* buf_iter) {
   if (!scan_int32(buf_iter, &val, "int32-val"))
     return NULL;
 
-  return PyInt_FromLong(val);
+  /* int32 is signed */
+  return cached_int((int32_t)val);
 }
 
 static PyObject* decode_int64(BufIter* buf_iter) {
+  int64_t val;
+
   if (!next(buf_iter, 8, "int64-val"))
     return NULL;
 
+  val = VAL_AT(buf_iter, int64_t);
+  if (val >= SMALL_VALUE_MIN && val < SMALL_VALUE_MAX)
+    return cached_long(val);
   return _PyLong_FromByteArray(PTR_AT(buf_iter, unsigned char*),
                                8, 1, 1);
 }
 
 static PyObject* decode_uint64(BufIter* buf_iter) {
+  uint64_t val;
+
   if (!next(buf_iter, 8, "uint64-val"))
     return NULL;
 
+  val = VAL_AT(buf_iter, uint64_t);
+  if (val < SMALL_VALUE_MAX)
+    return cached_long(val);
   return _PyLong_FromByteArray(PTR_AT(buf_iter, unsigned char*),
                                8, 1, 0);
 }
@@ -783,105 +1072,1214 @@ static decode_element decoders[] = {
   decode_int64,            /* 0x12 */
 };
 
-/* ----------------------------------- encoders ----------------------------------- */
-/* TODO(kgm): Be more paranoid about overflow. */
-/* TODO(kgm): Code will work by coincidence on 64-bit when e.g. memcpy-ing sizes. */
-/* Code will fail horribly on big-endian architecture; probably not a problem. */
+/* ----------------------------------- rows ----------------------------------- */
+
+/* decode_rows() decodes the Rows array of a query result straight into
+ * tuples, converting the values with the conversion functions of the
+ * columns. */
+
+/* how the values of a column are converted */
+enum CellKinds {
+  CELL_STR,       /* no conversion */
+  CELL_INT,       /* conversion is int */
+  CELL_LONG,      /* conversion is long */
+  CELL_FLOAT,     /* conversion is float */
+  CELL_DATE,      /* conversion is date_conversion, 'YYYY-MM-DD' parsed in
+                     C */
+  CELL_DATETIME,  /* conversion is datetime_conversion, 'YYYY-MM-DD
+                     HH:MM:SS' parsed in C */
+  CELL_CALL,      /* any other conversion function */
+};
 
-#define MAX_BSON_DEPTH 1000
+typedef struct _Column {
+  int kind;
+  PyObject* conversion; /* borrowed */
+} Column;
 
-static PyObject* _encode_element(PyObject* key, PyObject* value, int depth);
-static PyObject* encode_document(PyObject* doc, int depth);
+/* parses size decimal digits at s into *result, returns 0 if s holds
+   anything else */
+static inline int parse_digits(const char* s, int size, int* result) {
+  int value = 0;
+  int i;
+  for (i = 0; i < size; i++) {
+    if (s[i] < '0' || s[i] > '9')
+      return 0;
+    value = value * 10 + (s[i] - '0');
+  }
+  *result = value;
+  return 1;
+}
 
-static PyObject*
-_encode_key(PyObject* key, char** remaining, char first, Py_ssize_t extra) {
-  PyObject *ret;
-  Py_ssize_t key_len;
-  char *s, *key_str;
+/* returns 1 if the date is valid. The datetime C API constructors don't
+   check it. */
+static inline int valid_date(int year, int month, int day) {
+  static const int days_in_month[] = {
+    0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31
+  };
+  int leap;
+  if (year < 1 || year > 9999 || month < 1 || month > 12 || day < 1)
+    return 0;
+  leap = month == 2 &&
+      year % 4 == 0 && (year % 100 != 0 || year % 400 == 0);
+  return day <= days_in_month[month] + leap;
+}
 
-  key_len = PyString_GET_SIZE(key);
-  ret = PyString_FromStringAndSize(NULL, key_len + extra + 2);
-  if (ret == NULL) {
-    return NULL;
+/* Converts the value with C code for the common canonical forms. Returns
+   NULL without an exception set if the value has to go through the
+   conversion function, which keeps its exact behavior (and errors) for
+   everything else. */
+static PyObject* fast_convert(Column* column, const char* s, uint32_t size) {
+  PY_LONG_LONG value;
+  int year, month, day, hour, minute, second;
+  char buf[64];
+  char* end;
+  double d;
+  PyObject* result;
+  uint32_t i, negative;
+
+  switch (column->kind) {
+    case CELL_INT:
+    case CELL_LONG:
+      /* up to 18 digits can't overflow a long long */
+      negative = size > 0 && s[0] == '-';
+      if (size == negative || size - negative > 18)
+        return NULL;
+      value = 0;
+      for (i = negative; i < size; i++) {
+        if (s[i] < '0' || s[i] > '9')
+          return NULL;
+        value = value * 10 + (s[i] - '0');
+      }
+      if (negative)
+        value = -value;
+      if (column->kind == CELL_LONG)
+        return cached_long(value);
+      if (value >= LONG_MIN && value <= LONG_MAX)
+        return cached_int((long)value);
+      return PyLong_FromLongLong(value);
+    case CELL_FLOAT:
+      if (size == 0 || size >= sizeof(buf))
+        return NULL;
+      memcpy(buf, s, size);
+      buf[size] = 0;
+      d = PyOS_string_to_double(buf, &end, NULL);
+      if (d == -1.0 && PyErr_Occurred()) {
+        PyErr_Clear();
+        return NULL;
+      }
+      if (end != buf + size)
+        return NULL;
+      return PyFloat_FromDouble(d);
+    case CELL_DATE:
+    case CELL_DATETIME:
+      if (size == 10) {
+        if (s[4] != '-' || s[7] != '-' ||
+            !parse_digits(s, 4, &year) || !parse_digits(s + 5, 2, &month) ||
+            !parse_digits(s + 8, 2, &day) || !valid_date(year, month, day))
+          return NULL;
+        result = PyDate_FromDate(year, month, day);
+      } else if (size == 19 && column->kind == CELL_DATETIME) {
+        if (s[4] != '-' || s[7] != '-' || s[10] != ' ' || s[13] != ':' ||
+            s[16] != ':' ||
+            !parse_digits(s, 4, &year) || !parse_digits(s + 5, 2, &month) ||
+            !parse_digits(s + 8, 2, &day) || !parse_digits(s + 11, 2, &hour) ||
+            !parse_digits(s + 14, 2, &minute) ||
+            !parse_digits(s + 17, 2, &second) ||
+            !valid_date(year, month, day) || hour > 23 || minute > 59 ||
+            second > 59)
+          return NULL;
+        result = PyDateTime_FromDateAndTime(year, month, day, hour, minute,
+                                            second, 0);
+      } else {
+        return NULL;
+      }
+      return result;
   }
-  s = PyString_AS_STRING(ret);
-  key_str = PyString_AS_STRING(key);
-  s[0] = first;
-  memcpy(s + 1, key_str, key_len);
-  s[key_len + 1] = 0;
-  *remaining = s + key_len + 2;
-  return ret;
+  return NULL;
 }
 
-static PyObject*
-encode_double(PyObject* key, PyObject* value) {
-  PyObject *ret;
-  char *s;
-  double d;
+/* Returns the converted value of a binary cell. */
+static PyObject* convert_cell(Column* column, const char* s, uint32_t size) {
+  PyObject* str;
+  PyObject* result;
 
-  ret = _encode_key(key, &s, '\x01', 8);
-  if (ret == NULL) {
-    return NULL;
+  if (column->kind != CELL_STR && column->kind != CELL_CALL) {
+    result = fast_convert(column, s, size);
+    if (result != NULL || PyErr_Occurred())
+      return result;
   }
-  d = PyFloat_AS_DOUBLE(value);
-  memcpy(s, &d, 8);
-  return ret;
+  str = PyString_FromStringAndSize(s, size);
+  if (str == NULL || column->kind == CELL_STR)
+    return str;
+  result = PyObject_CallFunctionObjArgs(column->conversion, str, NULL);
+  Py_DECREF(str);
+  return result;
 }
 
-static PyObject*
-encode_string(PyObject* key, PyObject* value) {
-  PyObject *utf8_str;
-  Py_ssize_t utf8_len;
-  PyObject *ret = NULL;
-  char *s, *utf8;
+/* Decodes one row (a BSON array) into a tuple of at most column_count
+   values. Like izip(conversions, row), extra values are ignored and a
+   short row makes a short tuple.
+   With column_lists, a list of column_count lists, the values are
+   appended to the list of their column instead, and None is returned.
+   A short row is then an error, the columns would be misaligned. */
+static PyObject* decode_row(BufIter* buf_iter, Column* columns,
+                            Py_ssize_t column_count, PyObject* column_lists) {
+  uint32_t doc_size, binary_size;
+  unsigned char type_id;
+  Py_ssize_t i;
+  PyObject* row = NULL;
+  PyObject* value;
+  PyObject* converted;
+  int appended;
 
-  utf8_str = PyUnicode_AsUTF8String(value);
-  if (utf8_str == NULL) {
+  if (!scan_int32(buf_iter, &doc_size, "row-length"))
+    return NULL;
+  if (doc_size < 5) {
+    PyErr_Format(BSONError, "invalid row size: %u", doc_size);
     return NULL;
   }
-  utf8_len = PyString_GET_SIZE(utf8_str) + 1;
-  utf8 = PyString_AS_STRING(utf8_str);
-  ret = _encode_key(key, &s, '\x02', utf8_len + 4);
-  if (ret == NULL) {
-    goto Done;
+  if (column_lists == NULL) {
+    row = PyTuple_New(column_count);
+    if (row == NULL)
+      return NULL;
   }
-  /* BSON is little-endian, we rely on the native endianness matching */
-  memcpy(s, &utf8_len, 4);
-  memcpy(s + 4, utf8, utf8_len - 1);
-  s[utf8_len + 3] = 0;
 
-Done:
-  Py_DECREF(utf8_str);
-  return ret;
-}
+  i = 0;
+  while (1) {
+    if (!next(buf_iter, 1, "tag-id"))
+      goto error;
+    type_id = VAL_AT(buf_iter, unsigned char);
+    if (type_id == 0)
+      break;
+    if (!next_cstring(buf_iter, "element-name"))
+      goto error;
 
-static PyObject*
-encode_subdocument(PyObject* key, PyObject* value, int depth) {
-  PyObject *ret, *subdoc;
-  char *s, *subdoc_str;
-  Py_ssize_t subdoc_len;
+    if (type_id == 0x05) {
+      if (!scan_int32(buf_iter, &binary_size, "binary-size"))
+        goto error;
+      if (!next(buf_iter, 1, "binary-subtype"))
+        goto error;
+      if (!next(buf_iter, binary_size, "binary-buffer"))
+        goto error;
+      if (i >= column_count)
+        continue;
+      value = convert_cell(&columns[i], PTR_AT(buf_iter, const char*),
+                           binary_size);
+    } else if (type_id == 0x0A) {
+      Py_INCREF(Py_None);
+      value = Py_None;
+    } else if ((type_id > 0 && type_id <= 0x12) || type_id == 0x3f) {
+      /* not what vttablet sends, decode it like decode_next would */
+      if (type_id == 0x3f)
+        value = decode_uint64(buf_iter);
+      else
+        value = decoders[(int)type_id](buf_iter);
+      if (value != NULL && value != Py_None && i < column_count &&
+          columns[i].kind != CELL_STR) {
+        converted = PyObject_CallFunctionObjArgs(columns[i].conversion,
+                                                 value, NULL);
+        Py_DECREF(value);
+        value = converted;
+      }
+    } else {
+      PyErr_Format(BSONError, "invalid element type id 0x%x at buffer[%d]",
+                   type_id, INDEX_OF(buf_iter));
+      goto error;
+    }
 
-  subdoc = encode_document(value, depth);
-  if (subdoc == NULL) {
-    return NULL;
+    if (value == NULL)
+      goto error;
+    if (i >= column_count) {
+      Py_DECREF(value);
+      continue;
+    }
+    if (column_lists != NULL) {
+      appended = PyList_Append(PyList_GET_ITEM(column_lists, i), value);
+      Py_DECREF(value);
+      if (appended < 0)
+        goto error;
+    } else {
+      PyTuple_SET_ITEM(row, i, value);
+    }
+    i++;
   }
-  subdoc_len = PyString_GET_SIZE(subdoc);
-  ret = _encode_key(key, &s, '\x03', subdoc_len);
-  if (ret == NULL) {
-    Py_DECREF(subdoc);
-    return NULL;
+
+  if (column_lists != NULL) {
+    if (i < column_count) {
+      PyErr_Format(PyExc_ValueError, "row has %zd values for %zd columns",
+                   i, column_count);
+      return NULL;
+    }
+    Py_RETURN_NONE;
   }
-  subdoc_str = PyString_AS_STRING(subdoc);
-  memcpy(s, subdoc_str, subdoc_len);
-  Py_DECREF(subdoc);
-  return ret;
+  if (i < column_count && _PyTuple_Resize(&row, i) < 0)
+    return NULL;
+  return row;
+
+error:
+  Py_XDECREF(row);
+  return NULL;
 }
 
 static PyObject*
-encode_array(PyObject* key, PyObject* value, int depth) {
-  PyObject *ret = NULL, *pieces;
-  PyObject *element;
-  PyObject *element_key, *element_value;
+decode_rows(PyObject *self, PyObject* args, PyObject* kwargs) {
+  static char* kwlist[] = {"buffer", "types", "conversions", "offset", "end",
+                           "columns", "date_conversion",
+                           "datetime_conversion", NULL};
+  PyObject* buffer_obj;
+  PyObject* end_obj = NULL;
+  PyObject* date_conversion = NULL;
+  PyObject* datetime_conversion = NULL;
+  PyObject* types_obj;
+  PyObject* conversions_obj;
+  PyObject* types = NULL;
+  PyObject* conversions = NULL;
+  PyObject* rows = NULL;
+  PyObject* row;
+  PyObject* column_lists = NULL;
+  PyObject* conversion;
+  Py_buffer buffer;
+  BufIter mbuf_iter;
+  Column* columns = NULL;
+  Py_ssize_t i, column_count;
+  int offset = 0;
+  int as_columns = 0;
+  uint32_t doc_size;
+  unsigned char type_id;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OOO|iOiOO:decode_rows",
+                                   kwlist, &buffer_obj, &types_obj,
+                                   &conversions_obj, &offset, &end_obj,
+                                   &as_columns, &date_conversion,
+                                   &datetime_conversion))
+    return NULL;
+
+  types = PySequence_Fast(types_obj, "types must be a sequence");
+  if (types == NULL)
+    return NULL;
+  conversions = PySequence_Fast(conversions_obj,
+                                "conversions must be a sequence");
+  if (conversions == NULL)
+    goto done;
+  column_count = PySequence_Fast_GET_SIZE(types);
+  if (PySequence_Fast_GET_SIZE(conversions) != column_count) {
+    PyErr_SetString(PyExc_ValueError,
+                    "types and conversions must have the same length");
+    goto done;
+  }
+  columns = PyMem_New(Column, column_count ? column_count : 1);
+  if (columns == NULL) {
+    PyErr_NoMemory();
+    goto done;
+  }
+  for (i = 0; i < column_count; i++) {
+    conversion = PySequence_Fast_GET_ITEM(conversions, i);
+    columns[i].conversion = conversion;
+    if (conversion == Py_None)
+      columns[i].kind = CELL_STR;
+    else if (conversion == (PyObject*)&PyInt_Type)
+      columns[i].kind = CELL_INT;
+    else if (conversion == (PyObject*)&PyLong_Type)
+      columns[i].kind = CELL_LONG;
+    else if (conversion == (PyObject*)&PyFloat_Type)
+      columns[i].kind = CELL_FLOAT;
+    else if (conversion == date_conversion)
+      columns[i].kind = CELL_DATE;
+    else if (conversion == datetime_conversion)
+      columns[i].kind = CELL_DATETIME;
+    else
+      columns[i].kind = CELL_CALL;
+  }
+
+  if (!buf_iter_from_range(buffer_obj, &mbuf_iter, &buffer, offset, end_obj))
+    goto done;
+  if (!scan_int32(&mbuf_iter, &doc_size, "rows-length"))
+    goto release;
+  if (doc_size < 5 || too_short(&mbuf_iter, doc_size - 4)) {
+    PyErr_Format(BSONError, "invalid rows size: %u", doc_size);
+    goto release;
+  }
+
+  if (as_columns) {
+    /* rows is the list of the columns, column_lists borrows it */
+    rows = PyList_New(column_count);
+    if (rows == NULL)
+      goto release;
+    for (i = 0; i < column_count; i++) {
+      row = PyList_New(0);
+      if (row == NULL)
+        goto error;
+      PyList_SET_ITEM(rows, i, row);
+    }
+    column_lists = rows;
+  } else {
+    rows = PyList_New(0);
+    if (rows == NULL)
+      goto release;
+  }
+  while (1) {
+    if (!next(&mbuf_iter, 1, "tag-id"))
+      goto error;
+    type_id = VAL_AT((&mbuf_iter), unsigned char);
+    if (type_id == 0)
+      break;
+    if (type_id != 0x04) {
+      PyErr_Format(BSONError, "invalid row type id 0x%x at buffer[%d]",
+                   type_id, INDEX_OF((&mbuf_iter)));
+      goto error;
+    }
+    if (!next_cstring(&mbuf_iter, "element-name"))
+      goto error;
+    row = decode_row(&mbuf_iter, columns, column_count, column_lists);
+    if (row == NULL)
+      goto error;
+    if (column_lists != NULL) {
+      Py_DECREF(row);
+      continue;
+    }
+    if (PyList_Append(rows, row) < 0) {
+      Py_DECREF(row);
+      goto error;
+    }
+    Py_DECREF(row);
+  }
+  goto release;
+
+error:
+  Py_CLEAR(rows);
+release:
+  PyBuffer_Release(&buffer);
+done:
+  PyMem_Free(columns);
+  Py_XDECREF(types);
+  Py_XDECREF(conversions);
+  return rows;
+}
+
+/* ----------------------------------- lazy ----------------------------------- */
+
+/* LazyDocument and LazyArray are read-only views of an encoded document
+ * or array, for decode_next(lazy=True). Elements are decoded when they
+ * are accessed, and cached. Nested documents and arrays are lazy views
+ * too, so a caller only pays for what it reads. The views keep a
+ * reference to an immutable str holding the encoding: the decoded buffer
+ * itself when it is a str, a copy of the document's bytes otherwise (a
+ * receive buffer gets reused). Their buffer api exposes the encoding,
+ * decode_rows() accepts a lazy Rows array as is. */
+
+/* fields common to both views */
+#define LAZY_FIELDS                                                     \
+  PyObject* data;     /* str holding the encoding */                    \
+  Py_ssize_t offset;  /* of the document in data */                     \
+  Py_ssize_t size;    /* of the document */                             \
+  PyObject* raw_keys; /* set of names of documents not to decode, or NULL */
+
+typedef struct {
+  PyObject_HEAD
+  LAZY_FIELDS
+} LazyBase;
+
+typedef struct {
+  PyObject_HEAD
+  LAZY_FIELDS
+  /* built on first access */
+  PyObject* index;  /* dict: name -> position of the element's type id */
+  PyObject* names;  /* list of the names, in document order */
+  PyObject* values; /* dict: name -> decoded value */
+} LazyDocument;
+
+typedef struct {
+  PyObject_HEAD
+  LAZY_FIELDS
+  /* built on first access */
+  Py_ssize_t count;     /* number of elements, -1 until indexed */
+  Py_ssize_t* elements; /* position of each element's type id */
+  PyObject** values;    /* decoded elements, NULL until accessed */
+} LazyArray;
+
+typedef struct {
+  PyObject_HEAD
+  LazyArray* array;
+  Py_ssize_t position; /* of the next element's type id */
+  Py_ssize_t i;        /* index of the next element */
+} LazyArrayIterator;
+
+static PyTypeObject LazyDocumentType;
+static PyTypeObject LazyArrayType;
+static PyTypeObject LazyArrayIteratorType;
+
+/* Sets buf_iter to read the view's document from position in data. */
+static void lazy_buf_iter(LazyBase* self, Py_ssize_t position,
+                          BufIter* buf_iter) {
+  buf_iter->start = PyString_AS_STRING(self->data);
+  buf_iter->end = buf_iter->start + self->offset + self->size - 1;
+  buf_iter->slice.start = buf_iter->start + position;
+  buf_iter->slice.size = 0;
+  buf_iter->raw_keys = self->raw_keys;
+}
+
+/* position right after the current slice */
+#define END_OF_SLICE(buf_iter) \
+  (buf_iter->slice.start + buf_iter->slice.size - buf_iter->start)
+
+static PyObject* new_lazy(PyTypeObject* type, PyObject* data,
+                          Py_ssize_t offset, Py_ssize_t size,
+                          PyObject* raw_keys) {
+  LazyBase* self;
+
+  self = (LazyBase*)type->tp_alloc(type, 0);
+  if (self == NULL)
+    return NULL;
+  Py_INCREF(data);
+  self->data = data;
+  self->offset = offset;
+  self->size = size;
+  Py_XINCREF(raw_keys);
+  self->raw_keys = raw_keys;
+  if (type == &LazyArrayType)
+    ((LazyArray*)self)->count = -1;
+  return (PyObject*)self;
+}
+
+/* Moves buf_iter over the value of an element of type type_id. */
+static int skip_value(BufIter* buf_iter, unsigned char type_id) {
+  uint32_t size;
+  PyObject* value;
+
+  switch (type_id) {
+    case 0x01: /* double */
+    case 0x09: /* utc */
+    case 0x11: /* timestamp */
+    case 0x12: /* int64 */
+    case 0x3f: /* uint64 */
+      return next(buf_iter, 8, "value");
+    case 0x02: /* string */
+    case 0x0D: /* js */
+    case 0x0E: /* symbol */
+      return scan_int32(buf_iter, &size, "string-length") &&
+          next(buf_iter, size, "string");
+    case 0x03: /* document */
+    case 0x04: /* array */
+    case 0x0F: /* js with scope */
+      if (!scan_int32(buf_iter, &size, "document-length"))
+        return 0;
+      if (size < 5) {
+        PyErr_Format(BSONError, "invalid document size: %u", size);
+        return 0;
+      }
+      return next(buf_iter, size - 4, "document");
+    case 0x05: /* binary */
+      return scan_int32(buf_iter, &size, "binary-size") &&
+          next(buf_iter, size + 1, "binary");
+    case 0x06: /* undefined */
+    case 0x0A: /* null */
+    case 0x7f: /* max */
+    case 0xff: /* min */
+      return 1;
+    case 0x07: /* object id */
+      return next(buf_iter, 12, "object-id");
+    case 0x08: /* bool */
+      return next(buf_iter, 1, "bool");
+    case 0x10: /* int32 */
+      return next(buf_iter, 4, "int32");
+    case 0x0B: /* regex */
+    case 0x0C: /* db pointer */
+      /* rare enough to decode them for nothing */
+      value = decoders[(int)type_id](buf_iter);
+      Py_XDECREF(value);
+      return value != NULL;
+  }
+  PyErr_Format(BSONError, "invalid element type id 0x%x at buffer[%d]",
+               type_id, INDEX_OF(buf_iter));
+  return 0;
+}
+
+/* Decodes the value of an element of type type_id, name is the element
+   name in a document, NULL in an array. */
+static PyObject* lazy_value(LazyBase* self, BufIter* buf_iter,
+                            unsigned char type_id, PyObject* name) {
+  uint32_t size;
+  Py_ssize_t position;
+  int raw;
+
+  switch (type_id) {
+    case 0x03:
+    case 0x04:
+      if (name != NULL && self->raw_keys != NULL) {
+        raw = PySet_Contains(self->raw_keys, name);
+        if (raw < 0)
+          return NULL;
+        if (raw)
+          return decode_raw_document(buf_iter);
+      }
+      position = END_OF_SLICE(buf_iter);
+      if (!scan_int32(buf_iter, &size, "document-length"))
+        return NULL;
+      if (size < 5) {
+        PyErr_Format(BSONError, "invalid document size: %u", size);
+        return NULL;
+      }
+      if (!next(buf_iter, size - 4, "document"))
+        return NULL;
+      return new_lazy(type_id == 0x03 ? &LazyDocumentType : &LazyArrayType,
+                      self->data, position, size, self->raw_keys);
+    case 0x3f:
+      return decode_uint64(buf_iter);
+    case 0x7f:
+      return PyTuple_Pack(1, element_types[min]);
+    case 0xff:
+      return PyTuple_Pack(1, element_types[max]);
+  }
+  if (type_id > 0 && type_id <= 0x12)
+    return decoders[(int)type_id](buf_iter);
+  PyErr_Format(BSONError, "invalid element type id 0x%x at buffer[%d]",
+               type_id, INDEX_OF(buf_iter));
+  return NULL;
+}
+
+/* Decodes the element whose type id is at position. */
+static PyObject* lazy_element(LazyBase* self, Py_ssize_t position,
+                              PyObject* name) {
+  BufIter buf_iter;
+  unsigned char type_id;
+
+  lazy_buf_iter(self, position, &buf_iter);
+  if (!next(&buf_iter, 1, "tag-id"))
+    return NULL;
+  type_id = VAL_AT((&buf_iter), unsigned char);
+  if (!next_cstring(&buf_iter, "element-name"))
+    return NULL;
+  return lazy_value(self, &buf_iter, type_id, name);
+}
+
+/* Returns the fully decoded dict or list. */
+static PyObject* lazy_decode(LazyBase* self) {
+  BufIter buf_iter;
+
+  lazy_buf_iter(self, self->offset, &buf_iter);
+  if (Py_TYPE(self) == &LazyArrayType)
+    return decode_array(&buf_iter);
+  return decode_document(&buf_iter);
+}
+
+static PyObject* lazy_decode_method(PyObject* self, PyObject* unused) {
+  return lazy_decode((LazyBase*)self);
+}
+
+static PyObject* lazy_richcompare(PyObject* self, PyObject* other, int op) {
+  PyObject* decoded;
+  PyObject* result;
+
+  decoded = lazy_decode((LazyBase*)self);
+  if (decoded == NULL)
+    return NULL;
+  result = PyObject_RichCompare(decoded, other, op);
+  Py_DECREF(decoded);
+  return result;
+}
+
+static PyObject* lazy_repr(PyObject* self) {
+  return PyString_FromFormat("<%s of %zd bytes>", Py_TYPE(self)->tp_name,
+                             ((LazyBase*)self)->size);
+}
+
+/* the buffer api exposes the encoded document */
+static int lazy_getbuffer(PyObject* self, Py_buffer* view, int flags) {
+  LazyBase* lazy = (LazyBase*)self;
+  return PyBuffer_FillInfo(view, self,
+                           PyString_AS_STRING(lazy->data) + lazy->offset,
+                           lazy->size, 1, flags);
+}
+
+static PyBufferProcs lazy_as_buffer = {
+  .bf_getbuffer = lazy_getbuffer,
+};
+
+/* Builds the index of a LazyDocument, returns 0 on error. */
+static int lazy_document_index(LazyDocument* self) {
+  BufIter buf_iter;
+  unsigned char type_id;
+  Py_ssize_t position;
+  PyObject* name = NULL;
+  PyObject* position_obj = NULL;
+  PyObject* index;
+  PyObject* names;
+
+  if (self->index != NULL)
+    return 1;
+  index = PyDict_New();
+  names = PyList_New(0);
+  if (index == NULL || names == NULL)
+    goto error;
+
+  lazy_buf_iter((LazyBase*)self, self->offset, &buf_iter);
+  next(&buf_iter, 4, "document-length");
+  while (1) {
+    position = END_OF_SLICE((&buf_iter));
+    if (!next(&buf_iter, 1, "tag-id"))
+      goto error;
+    type_id = VAL_AT((&buf_iter), unsigned char);
+    if (type_id == 0)
+      break;
+    if (!next_cstring(&buf_iter, "element-name"))
+      goto error;
+    name = decode_key(PTR_AT((&buf_iter), const char*),
+                      buf_iter.slice.size - 1);
+    if (name == NULL || !skip_value(&buf_iter, type_id))
+      goto error;
+    position_obj = PyInt_FromSsize_t(position);
+    if (position_obj == NULL)
+      goto error;
+    /* like decode_document, the last of duplicate names wins */
+    if (!PyDict_Contains(index, name) && PyList_Append(names, name) < 0)
+      goto error;
+    if (PyDict_SetItem(index, name, position_obj) < 0)
+      goto error;
+    Py_CLEAR(name);
+    Py_CLEAR(position_obj);
+  }
+
+  self->values = PyDict_New();
+  if (self->values == NULL)
+    goto error;
+  self->index = index;
+  self->names = names;
+  return 1;
+
+error:
+  Py_XDECREF(name);
+  Py_XDECREF(position_obj);
+  Py_XDECREF(index);
+  Py_XDECREF(names);
+  return 0;
+}
+
+static void lazy_document_dealloc(LazyDocument* self) {
+  Py_XDECREF(self->data);
+  Py_XDECREF(self->raw_keys);
+  Py_XDECREF(self->index);
+  Py_XDECREF(self->names);
+  Py_XDECREF(self->values);
+  Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static Py_ssize_t lazy_document_length(LazyDocument* self) {
+  if (!lazy_document_index(self))
+    return -1;
+  return PyList_GET_SIZE(self->names);
+}
+
+/* Returns a new reference to the value of key, or NULL without an
+   exception set if there is no such key. */
+static PyObject* lazy_document_lookup(LazyDocument* self, PyObject* key) {
+  PyObject* value;
+  PyObject* position;
+
+  if (!lazy_document_index(self))
+    return NULL;
+  value = PyDict_GetItem(self->values, key);
+  if (value != NULL) {
+    Py_INCREF(value);
+    return value;
+  }
+  position = PyDict_GetItem(self->index, key);
+  if (position == NULL)
+    return NULL;
+  value = lazy_element((LazyBase*)self, PyInt_AsSsize_t(position), key);
+  if (value != NULL && PyDict_SetItem(self->values, key, value) < 0)
+    Py_CLEAR(value);
+  return value;
+}
+
+static PyObject* lazy_document_subscript(LazyDocument* self, PyObject* key) {
+  PyObject* value;
+
+  value = lazy_document_lookup(self, key);
+  if (value == NULL && !PyErr_Occurred())
+    PyErr_SetObject(PyExc_KeyError, key);
+  return value;
+}
+
+static int lazy_document_contains(LazyDocument* self, PyObject* key) {
+  if (!lazy_document_index(self))
+    return -1;
+  return PyDict_Contains(self->index, key);
+}
+
+static PyObject* lazy_document_iter(LazyDocument* self) {
+  if (!lazy_document_index(self))
+    return NULL;
+  return PyObject_GetIter(self->names);
+}
+
+static PyObject* lazy_document_get(LazyDocument* self, PyObject* args) {
+  PyObject* key;
+  PyObject* default_value = Py_None;
+  PyObject* value;
+
+  if (!PyArg_UnpackTuple(args, "get", 1, 2, &key, &default_value))
+    return NULL;
+  value = lazy_document_lookup(self, key);
+  if (value == NULL && !PyErr_Occurred()) {
+    Py_INCREF(default_value);
+    value = default_value;
+  }
+  return value;
+}
+
+static PyObject* lazy_document_keys(LazyDocument* self, PyObject* unused) {
+  if (!lazy_document_index(self))
+    return NULL;
+  return PyList_GetSlice(self->names, 0, PyList_GET_SIZE(self->names));
+}
+
+/* Returns the list of values (or of (name, value) items). */
+static PyObject* lazy_document_list(LazyDocument* self, int items) {
+  PyObject* result;
+  PyObject* name;
+  PyObject* value;
+  Py_ssize_t i, count;
+
+  count = lazy_document_length(self);
+  if (count < 0)
+    return NULL;
+  result = PyList_New(count);
+  if (result == NULL)
+    return NULL;
+  for (i = 0; i < count; i++) {
+    name = PyList_GET_ITEM(self->names, i);
+    value = lazy_document_subscript(self, name);
+    if (value != NULL && items)
+      value = Py_BuildValue("ON", name, value);
+    if (value == NULL) {
+      Py_DECREF(result);
+      return NULL;
+    }
+    PyList_SET_ITEM(result, i, value);
+  }
+  return result;
+}
+
+static PyObject* lazy_document_values(LazyDocument* self, PyObject* unused) {
+  return lazy_document_list(self, 0);
+}
+
+static PyObject* lazy_document_items(LazyDocument* self, PyObject* unused) {
+  return lazy_document_list(self, 1);
+}
+
+static PyMappingMethods lazy_document_as_mapping = {
+  .mp_length = (lenfunc)lazy_document_length,
+  .mp_subscript = (binaryfunc)lazy_document_subscript,
+};
+
+static PySequenceMethods lazy_document_as_sequence = {
+  .sq_contains = (objobjproc)lazy_document_contains,
+};
+
+static PyMethodDef lazy_document_methods[] = {
+  {"get", (PyCFunction)lazy_document_get, METH_VARARGS,
+   "D.get(k[,d]) -> D[k] if k in D, else d. d defaults to None."},
+  {"keys", (PyCFunction)lazy_document_keys, METH_NOARGS,
+   "D.keys() -> list of D's keys, in document order"},
+  {"values", (PyCFunction)lazy_document_values, METH_NOARGS,
+   "D.values() -> list of D's values"},
+  {"items", (PyCFunction)lazy_document_items, METH_NOARGS,
+   "D.items() -> list of D's (key, value) pairs"},
+  {"decode", (PyCFunction)lazy_decode_method, METH_NOARGS,
+   "D.decode() -> the document fully decoded, as a dict"},
+  {NULL, NULL, 0, NULL} /* sentinel */
+};
+
+static PyTypeObject LazyDocumentType = {
+  PyObject_HEAD_INIT(NULL)
+  .tp_name = "cbson.LazyDocument",
+  .tp_basicsize = sizeof(LazyDocument),
+  .tp_dealloc = (destructor)lazy_document_dealloc,
+  .tp_repr = lazy_repr,
+  .tp_as_sequence = &lazy_document_as_sequence,
+  .tp_as_mapping = &lazy_document_as_mapping,
+  .tp_hash = PyObject_HashNotImplemented,
+  .tp_as_buffer = &lazy_as_buffer,
+  .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER,
+  .tp_doc = "Read-only mapping view of an encoded BSON document, whose "
+            "values are decoded when accessed.",
+  .tp_richcompare = lazy_richcompare,
+  .tp_iter = (getiterfunc)lazy_document_iter,
+  .tp_methods = lazy_document_methods,
+};
+
+/* Builds the index of a LazyArray, returns 0 on error. */
+static int lazy_array_index(LazyArray* self) {
+  BufIter buf_iter;
+  unsigned char type_id;
+  Py_ssize_t count, capacity;
+  Py_ssize_t* elements;
+  Py_ssize_t* grown;
+
+  if (self->count >= 0)
+    return 1;
+  count = 0;
+  capacity = 16;
+  elements = PyMem_New(Py_ssize_t, capacity);
+  if (elements == NULL) {
+    PyErr_NoMemory();
+    return 0;
+  }
+
+  lazy_buf_iter((LazyBase*)self, self->offset, &buf_iter);
+  next(&buf_iter, 4, "document-length");
+  while (1) {
+    if (count == capacity) {
+      capacity *= 2;
+      grown = PyMem_Realloc(elements, capacity * sizeof(Py_ssize_t));
+      if (grown == NULL) {
+        PyErr_NoMemory();
+        goto error;
+      }
+      elements = grown;
+    }
+    elements[count] = END_OF_SLICE((&buf_iter));
+    if (!next(&buf_iter, 1, "tag-id"))
+      goto error;
+    type_id = VAL_AT((&buf_iter), unsigned char);
+    if (type_id == 0)
+      break;
+    if (!next_cstring(&buf_iter, "element-name") ||
+        !skip_value(&buf_iter, type_id))
+      goto error;
+    count++;
+  }
+
+  self->values = PyMem_New(PyObject*, count ? count : 1);
+  if (self->values == NULL) {
+    PyErr_NoMemory();
+    goto error;
+  }
+  memset(self->values, 0, (count ? count : 1) * sizeof(PyObject*));
+  self->elements = elements;
+  self->count = count;
+  return 1;
+
+error:
+  PyMem_Free(elements);
+  return 0;
+}
+
+static void lazy_array_dealloc(LazyArray* self) {
+  Py_ssize_t i;
+
+  Py_XDECREF(self->data);
+  Py_XDECREF(self->raw_keys);
+  if (self->values != NULL) {
+    for (i = 0; i < self->count; i++)
+      Py_XDECREF(self->values[i]);
+    PyMem_Free(self->values);
+  }
+  PyMem_Free(self->elements);
+  Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static Py_ssize_t lazy_array_length(LazyArray* self) {
+  if (!lazy_array_index(self))
+    return -1;
+  return self->count;
+}
+
+static PyObject* lazy_array_item(LazyArray* self, Py_ssize_t i) {
+  PyObject* value;
+
+  if (!lazy_array_index(self))
+    return NULL;
+  if (i < 0 || i >= self->count) {
+    PyErr_SetString(PyExc_IndexError, "LazyArray index out of range");
+    return NULL;
+  }
+  value = self->values[i];
+  if (value == NULL) {
+    value = lazy_element((LazyBase*)self, self->elements[i], NULL);
+    if (value == NULL)
+      return NULL;
+    self->values[i] = value;
+  }
+  Py_INCREF(value);
+  return value;
+}
+
+static PyObject* lazy_array_slice(LazyArray* self, Py_ssize_t low,
+                                  Py_ssize_t high) {
+  PyObject* result;
+  PyObject* value;
+  Py_ssize_t i;
+
+  if (!lazy_array_index(self))
+    return NULL;
+  if (low < 0)
+    low = 0;
+  if (high > self->count)
+    high = self->count;
+  if (high < low)
+    high = low;
+  result = PyList_New(high - low);
+  if (result == NULL)
+    return NULL;
+  for (i = low; i < high; i++) {
+    value = lazy_array_item(self, i);
+    if (value == NULL) {
+      Py_DECREF(result);
+      return NULL;
+    }
+    PyList_SET_ITEM(result, i - low, value);
+  }
+  return result;
+}
+
+/* Iterating does not cache the elements: a caller reading the elements
+   once doesn't keep them all alive. */
+static PyObject* lazy_array_iter(LazyArray* self) {
+  LazyArrayIterator* it;
+
+  it = PyObject_New(LazyArrayIterator, &LazyArrayIteratorType);
+  if (it == NULL)
+    return NULL;
+  Py_INCREF(self);
+  it->array = self;
+  it->position = self->offset + 4;
+  it->i = 0;
+  return (PyObject*)it;
+}
+
+static void lazy_array_iterator_dealloc(LazyArrayIterator* self) {
+  Py_XDECREF(self->array);
+  PyObject_Del(self);
+}
+
+static PyObject* lazy_array_iterator_next(LazyArrayIterator* self) {
+  LazyArray* array = self->array;
+  BufIter buf_iter;
+  unsigned char type_id;
+  PyObject* value;
+
+  if (array == NULL)
+    return NULL;
+  lazy_buf_iter((LazyBase*)array, self->position, &buf_iter);
+  if (!next(&buf_iter, 1, "tag-id"))
+    return NULL;
+  type_id = VAL_AT((&buf_iter), unsigned char);
+  if (type_id == 0) {
+    /* exhausted */
+    Py_CLEAR(self->array);
+    return NULL;
+  }
+  if (!next_cstring(&buf_iter, "element-name"))
+    return NULL;
+  if (array->values != NULL && self->i < array->count &&
+      array->values[self->i] != NULL) {
+    if (!skip_value(&buf_iter, type_id))
+      return NULL;
+    value = array->values[self->i];
+    Py_INCREF(value);
+  } else {
+    value = lazy_value((LazyBase*)array, &buf_iter, type_id, NULL);
+    if (value == NULL)
+      return NULL;
+  }
+  self->position = END_OF_SLICE((&buf_iter));
+  self->i++;
+  return value;
+}
+
+static PySequenceMethods lazy_array_as_sequence = {
+  .sq_length = (lenfunc)lazy_array_length,
+  .sq_item = (ssizeargfunc)lazy_array_item,
+  .sq_slice = (ssizessizeargfunc)lazy_array_slice,
+};
+
+static PyMethodDef lazy_array_methods[] = {
+  {"decode", (PyCFunction)lazy_decode_method, METH_NOARGS,
+   "L.decode() -> the array fully decoded, as a list"},
+  {NULL, NULL, 0, NULL} /* sentinel */
+};
+
+static PyTypeObject LazyArrayType = {
+  PyObject_HEAD_INIT(NULL)
+  .tp_name = "cbson.LazyArray",
+  .tp_basicsize = sizeof(LazyArray),
+  .tp_dealloc = (destructor)lazy_array_dealloc,
+  .tp_repr = lazy_repr,
+  .tp_as_sequence = &lazy_array_as_sequence,
+  .tp_hash = PyObject_HashNotImplemented,
+  .tp_as_buffer = &lazy_as_buffer,
+  .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_NEWBUFFER,
+  .tp_doc = "Read-only sequence view of an encoded BSON array, whose "
+            "elements are decoded when accessed.",
+  .tp_richcompare = lazy_richcompare,
+  .tp_iter = (getiterfunc)lazy_array_iter,
+  .tp_methods = lazy_array_methods,
+};
+
+static PyTypeObject LazyArrayIteratorType = {
+  PyObject_HEAD_INIT(NULL)
+  .tp_name = "cbson.LazyArrayIterator",
+  .tp_basicsize = sizeof(LazyArrayIterator),
+  .tp_dealloc = (destructor)lazy_array_iterator_dealloc,
+  .tp_flags = Py_TPFLAGS_DEFAULT,
+  .tp_iter = PyObject_SelfIter,
+  .tp_iternext = (iternextfunc)lazy_array_iterator_next,
+};
+
+/* Returns a LazyDocument for the document at the current position of
+   buf_iter, and moves past it. */
+static PyObject* decode_lazy_document(PyObject* buffer_obj,
+                                      BufIter* buf_iter) {
+  uint32_t doc_size;
+  Py_ssize_t position;
+  PyObject* data;
+  PyObject* result;
+
+  position = END_OF_SLICE(buf_iter);
+  if (!scan_int32(buf_iter, &doc_size, "document-length"))
+    return NULL;
+  if (!check_document_size(buf_iter, doc_size))
+    return NULL;
+  if (!next(buf_iter, doc_size - 4, "document"))
+    return NULL;
+
+  if (PyString_CheckExact(buffer_obj)) {
+    return new_lazy(&LazyDocumentType, buffer_obj, position, doc_size,
+                    buf_iter->raw_keys);
+  }
+  data = PyString_FromStringAndSize(buf_iter->start + position, doc_size);
+  if (data == NULL)
+    return NULL;
+  result = new_lazy(&LazyDocumentType, data, 0, doc_size, buf_iter->raw_keys);
+  Py_DECREF(data);
+  return result;
+}
+
+/* ----------------------------------- encoders ----------------------------------- */
+/* Sizes are Py_ssize_t, 64-bit on a 64-bit Python, but BSON lengths are
+   int32: every length goes through check_bson_size() and write_int32().
+   Code will fail horribly on big-endian architecture; probably not a problem. */
+
+#define MAX_BSON_DEPTH 1000
+
+static PyObject* _encode_element(PyObject* key, PyObject* value, int depth);
+static PyObject* encode_document(PyObject* doc, int depth);
+
+/* Returns 0 and raises OverflowError if size doesn't fit a BSON length. */
+static inline int check_bson_size(Py_ssize_t size) {
+  if (size < 0 || size > INT32_MAX) {
+    PyErr_SetString(PyExc_OverflowError, "object too large to BSON encode");
+    return 0;
+  }
+  return 1;
+}
+
+/* Writes a BSON length, little-endian like the platform. */
+static inline void write_int32(char* s, Py_ssize_t value) {
+  int32_t i32 = (int32_t)value;
+  memcpy(s, &i32, 4);
+}
+
+static PyObject*
+_encode_key(PyObject* key, char** remaining, char first, Py_ssize_t extra) {
+  PyObject *ret;
+  Py_ssize_t key_len;
+  char *s, *key_str;
+
+  key_len = PyString_GET_SIZE(key);
+  if (memchr(PyString_AS_STRING(key), 0, key_len) != NULL) {
+    PyErr_SetString(PyExc_ValueError, "document keys must not contain NUL");
+    return NULL;
+  }
+  if (!check_bson_size(extra) || !check_bson_size(key_len + extra + 2))
+    return NULL;
+  ret = PyString_FromStringAndSize(NULL, key_len + extra + 2);
+  if (ret == NULL) {
+    return NULL;
+  }
+  s = PyString_AS_STRING(ret);
+  key_str = PyString_AS_STRING(key);
+  s[0] = first;
+  memcpy(s + 1, key_str, key_len);
+  s[key_len + 1] = 0;
+  *remaining = s + key_len + 2;
+  return ret;
+}
+
+static PyObject*
+encode_double(PyObject* key, PyObject* value) {
+  PyObject *ret;
+  char *s;
+  double d;
+
+  ret = _encode_key(key, &s, '\x01', 8);
+  if (ret == NULL) {
+    return NULL;
+  }
+  d = PyFloat_AS_DOUBLE(value);
+  memcpy(s, &d, 8);
+  return ret;
+}
+
+static PyObject*
+encode_string(PyObject* key, PyObject* value) {
+  PyObject *utf8_str;
+  Py_ssize_t utf8_len;
+  PyObject *ret = NULL;
+  char *s, *utf8;
+
+  utf8_str = PyUnicode_AsUTF8String(value);
+  if (utf8_str == NULL) {
+    return NULL;
+  }
+  utf8_len = PyString_GET_SIZE(utf8_str) + 1;
+  utf8 = PyString_AS_STRING(utf8_str);
+  if (!check_bson_size(utf8_len + 4)) {
+    goto Done;
+  }
+  ret = _encode_key(key, &s, '\x02', utf8_len + 4);
+  if (ret == NULL) {
+    goto Done;
+  }
+  /* BSON is little-endian, we rely on the native endianness matching */
+  write_int32(s, utf8_len);
+  memcpy(s + 4, utf8, utf8_len - 1);
+  s[utf8_len + 3] = 0;
+
+Done:
+  Py_DECREF(utf8_str);
+  return ret;
+}
+
+static PyObject*
+encode_subdocument(PyObject* key, PyObject* value, int depth) {
+  PyObject *ret, *subdoc;
+  char *s, *subdoc_str;
+  Py_ssize_t subdoc_len;
+
+  subdoc = encode_document(value, depth);
+  if (subdoc == NULL) {
+    return NULL;
+  }
+  subdoc_len = PyString_GET_SIZE(subdoc);
+  ret = _encode_key(key, &s, '\x03', subdoc_len);
+  if (ret == NULL) {
+    Py_DECREF(subdoc);
+    return NULL;
+  }
+  subdoc_str = PyString_AS_STRING(subdoc);
+  memcpy(s, subdoc_str, subdoc_len);
+  Py_DECREF(subdoc);
+  return ret;
+}
+
+static PyObject*
+encode_array(PyObject* key, PyObject* value, int depth) {
+  PyObject *ret = NULL, *pieces;
+  PyObject *element;
+  PyObject *element_key, *element_value;
   char *s, *element_buffer;
   Py_ssize_t value_len, i, total_size, element_size;
 
@@ -909,13 +2307,16 @@ encode_array(PyObject* key, PyObject* value, int depth) {
     }
     total_size += PyString_GET_SIZE(element);
     PyTuple_SET_ITEM(pieces, i, element);
+    if (!check_bson_size(total_size)) {
+      goto Done;
+    }
   }
   total_size += 5;
   ret = _encode_key(key, &s, '\x04', total_size);
   if (ret == NULL) {
     goto Done;
   }
-  memcpy(s, &total_size, 4);
+  write_int32(s, total_size);
   s += 4;
   for (i = 0; i < value_len; ++i) {
     element = PyTuple_GET_ITEM(pieces, i);
@@ -939,11 +2340,14 @@ encode_binary(PyObject* key, PyObject* value, char subtype) {
 
   value_size = PyString_GET_SIZE(value);
   value_str = PyString_AS_STRING(value);
+  if (!check_bson_size(value_size + 5)) {
+    return NULL;
+  }
   ret = _encode_key(key, &s, '\x05', value_size + 5);
   if (ret == NULL) {
     return NULL;
   }
-  memcpy(s, &value_size, 4);
+  write_int32(s, value_size);
   s[4] = subtype;
   memcpy(s + 5, value_str, value_size);
   return ret;
@@ -1104,46 +2508,62 @@ _encode_element(PyObject* key, PyObject* value, int depth) {
   return element;
 }
 
+/* Encodes the elements of doc, and returns them in a new tuple. Sets
+   *total_size to the size of the encoded document, elements plus the
+   length prefix and the trailing 0. */
 static PyObject*
-encode_document(PyObject* doc, int depth) {
+encode_document_elements(PyObject* doc, int depth, Py_ssize_t* total_size) {
   Py_ssize_t i, n, pos = 0;
-  PyObject *pieces, *result = NULL;
+  PyObject *pieces;
   PyObject *key, *value;
   PyObject *element;
-  Py_ssize_t total_size = 0, element_size;
-  char *s, *element_buffer;
 
   if (!PyDict_Check(doc)) {
     PyErr_SetString(PyExc_TypeError, "bson document must be a dict");
     return NULL;
   }
-  n = PyObject_Size(doc);
-  if (n == -1) {
-    return NULL;
-  }
+  /* not PyObject_Size(): a subclass' __len__ can't be trusted to size
+     pieces */
+  n = PyDict_Size(doc);
   pieces = PyTuple_New(n);
   if (pieces == NULL) {
     return NULL;
   }
 
+  *total_size = 0;
   i = 0;
-  while (PyDict_Next(doc, &pos, &key, &value)) {
+  while (PyDict_Next(doc, &pos, &key, &value) && i < n) {
     element = _encode_element(key, value, depth);
     if (element == NULL) {
-      goto Done;
+      Py_DECREF(pieces);
+      return NULL;
     }
-    total_size += PyString_GET_SIZE(element);
+    *total_size += PyString_GET_SIZE(element);
     PyTuple_SET_ITEM(pieces, i, element);
     ++i;
+    if (!check_bson_size(*total_size + 5)) {
+      Py_DECREF(pieces);
+      return NULL;
+    }
   }
-  total_size += 5;
-  result = PyString_FromStringAndSize(NULL, total_size);
-  if (result == NULL) {
-    goto Done;
+  if (i < n && _PyTuple_Resize(&pieces, i) < 0) {
+    return NULL;
   }
-  s = PyString_AS_STRING(result);
-  memcpy(s, &total_size, 4);
+  *total_size += 5;
+  return pieces;
+}
+
+/* Writes the document made of the encoded elements in pieces at s, and
+   returns the position right after it. */
+static char*
+write_document(char* s, PyObject* pieces, Py_ssize_t total_size) {
+  Py_ssize_t i, n, element_size;
+  PyObject *element;
+  char *element_buffer;
+
+  write_int32(s, total_size);
   s += 4;
+  n = PyTuple_GET_SIZE(pieces);
   for (i = 0; i < n; ++i) {
     element = PyTuple_GET_ITEM(pieces, i);
     element_size = PyString_GET_SIZE(element);
@@ -1152,54 +2572,377 @@ encode_document(PyObject* doc, int depth) {
     s += element_size;
   }
   s[0] = 0;
+  return s + 1;
+}
 
-Done:
+/* Flat documents, made only of exact str, int, long, float, bool and None
+   values, and of dicts and lists of those, are the common case: request
+   fields, and bind variables (see vtdb.field_types.convert_bind_vars).
+   They are sized in a first pass, then written straight into the result,
+   without the str per element of the generic encoder. Anything else
+   (unicode, subclasses, other types, errors) makes flat_value_size()
+   return -1, and goes through the generic encoder. */
+
+static Py_ssize_t index_key_size(Py_ssize_t i) {
+  Py_ssize_t size = 1;
+  while (i >= 10) {
+    i /= 10;
+    size++;
+  }
+  return size;
+}
+
+static Py_ssize_t flat_value_size(PyObject* value, int depth);
+
+/* Returns the encoded size of a dict or list, or -1. */
+static Py_ssize_t flat_container_size(PyObject* value, int depth) {
+  Py_ssize_t size = 5, pos = 0, i, n, value_size;
+  PyObject *key, *element;
+
+  if (PyDict_CheckExact(value)) {
+    while (PyDict_Next(value, &pos, &key, &element)) {
+      if (!PyString_CheckExact(key) ||
+          memchr(PyString_AS_STRING(key), 0, PyString_GET_SIZE(key)) != NULL)
+        return -1;
+      value_size = flat_value_size(element, depth);
+      if (value_size < 0)
+        return -1;
+      size += 2 + PyString_GET_SIZE(key) + value_size;
+      if (size > INT32_MAX)
+        return -1;
+    }
+    return size;
+  }
+  n = PyList_GET_SIZE(value);
+  for (i = 0; i < n; i++) {
+    value_size = flat_value_size(PyList_GET_ITEM(value, i), depth);
+    if (value_size < 0)
+      return -1;
+    size += 2 + index_key_size(i) + value_size;
+    if (size > INT32_MAX)
+      return -1;
+  }
+  return size;
+}
+
+/* Returns the encoded size of value, without its type id and name, or -1
+   if it is not flat. */
+static Py_ssize_t flat_value_size(PyObject* value, int depth) {
+  long x;
+  PY_LONG_LONG y;
+
+  if (PyString_CheckExact(value)) {
+    if (PyString_GET_SIZE(value) > INT32_MAX - 5)
+      return -1;
+    return 5 + PyString_GET_SIZE(value);
+  }
+  if (PyInt_CheckExact(value)) {
+    x = PyInt_AS_LONG(value);
+    return (x < INT32_MIN || x > INT32_MAX) ? 8 : 4;
+  }
+  if (PyLong_CheckExact(value)) {
+    y = PyLong_AsLongLong(value);
+    if (y == -1 && PyErr_Occurred()) {
+      /* the generic encoder raises the OverflowError */
+      PyErr_Clear();
+      return -1;
+    }
+    return (y < INT32_MIN || y > INT32_MAX) ? 8 : 4;
+  }
+  if (PyFloat_CheckExact(value))
+    return 8;
+  if (value == Py_None)
+    return 0;
+  if (value == Py_True || value == Py_False)
+    return 1;
+  if (PyDict_CheckExact(value) || PyList_CheckExact(value)) {
+    if (depth >= MAX_BSON_DEPTH)
+      return -1;
+    return flat_container_size(value, depth + 1);
+  }
+  return -1;
+}
+
+static char* write_flat_container(char* s, PyObject* value);
+
+/* Writes the element, returns the position right after it. */
+static char* write_flat_element(char* s, const char* key, Py_ssize_t key_len,
+                                PyObject* value) {
+  char* type_id = s;
+  PY_LONG_LONG y;
+  int64_t i64;
+  double d;
+
+  memcpy(s + 1, key, key_len);
+  s[key_len + 1] = 0;
+  s += key_len + 2;
+
+  if (PyString_CheckExact(value)) {
+    *type_id = '\x05';
+    write_int32(s, PyString_GET_SIZE(value));
+    s[4] = 0;
+    memcpy(s + 5, PyString_AS_STRING(value), PyString_GET_SIZE(value));
+    return s + 5 + PyString_GET_SIZE(value);
+  }
+  if (PyInt_CheckExact(value) || PyLong_CheckExact(value)) {
+    /* can't fail, flat_value_size() converted it already */
+    if (PyInt_CheckExact(value))
+      y = PyInt_AS_LONG(value);
+    else
+      y = PyLong_AsLongLong(value);
+    if (y < INT32_MIN || y > INT32_MAX) {
+      *type_id = '\x12';
+      i64 = y;
+      memcpy(s, &i64, 8);
+      return s + 8;
+    }
+    *type_id = '\x10';
+    write_int32(s, (Py_ssize_t)y);
+    return s + 4;
+  }
+  if (PyFloat_CheckExact(value)) {
+    *type_id = '\x01';
+    d = PyFloat_AS_DOUBLE(value);
+    memcpy(s, &d, 8);
+    return s + 8;
+  }
+  if (value == Py_None) {
+    *type_id = '\x0A';
+    return s;
+  }
+  if (value == Py_True || value == Py_False) {
+    *type_id = '\x08';
+    s[0] = value == Py_True;
+    return s + 1;
+  }
+  *type_id = PyDict_CheckExact(value) ? '\x03' : '\x04';
+  return write_flat_container(s, value);
+}
+
+static char* write_flat_container(char* s, PyObject* value) {
+  char* start = s;
+  char key[24];
+  Py_ssize_t pos = 0, i, n;
+  PyObject *dict_key, *element;
+
+  s += 4;
+  if (PyDict_CheckExact(value)) {
+    while (PyDict_Next(value, &pos, &dict_key, &element)) {
+      s = write_flat_element(s, PyString_AS_STRING(dict_key),
+                             PyString_GET_SIZE(dict_key), element);
+    }
+  } else {
+    n = PyList_GET_SIZE(value);
+    for (i = 0; i < n; i++) {
+      s = write_flat_element(s, key,
+                             PyOS_snprintf(key, sizeof(key), "%zd", i),
+                             PyList_GET_ITEM(value, i));
+    }
+  }
+  s[0] = 0;
+  s++;
+  write_int32(start, s - start);
+  return s;
+}
+
+/* Returns the encoded size of doc if it is a flat document, else -1. */
+static Py_ssize_t flat_document_size(PyObject* doc, int depth) {
+  if (!PyDict_CheckExact(doc))
+    return -1;
+  return flat_container_size(doc, depth);
+}
+
+/* Writes the flat document of the given size, returns the position right
+   after it, or NULL if the document didn't match its size. */
+static char* write_flat_document(char* s, PyObject* doc, Py_ssize_t size) {
+  char* end;
+
+  end = write_flat_container(s, doc);
+  if (end - s != size) {
+    PyErr_SetString(PyExc_SystemError, "BSON document size changed");
+    return NULL;
+  }
+  return end;
+}
+
+static PyObject*
+encode_document(PyObject* doc, int depth) {
+  PyObject *pieces, *result;
+  Py_ssize_t total_size;
+
+  total_size = flat_document_size(doc, depth);
+  if (total_size >= 0) {
+    result = PyString_FromStringAndSize(NULL, total_size);
+    if (result != NULL &&
+        write_flat_document(PyString_AS_STRING(result), doc,
+                            total_size) == NULL) {
+      Py_CLEAR(result);
+    }
+    return result;
+  }
+
+  pieces = encode_document_elements(doc, depth, &total_size);
+  if (pieces == NULL) {
+    return NULL;
+  }
+  result = PyString_FromStringAndSize(NULL, total_size);
+  if (result != NULL) {
+    write_document(PyString_AS_STRING(result), pieces, total_size);
+  }
   Py_DECREF(pieces);
   return result;
 }
 
+/* dumps(doc, ...) encodes the documents back to back into one string,
+   allocated once: a Go RPC request header and body don't need to be
+   concatenated afterwards. */
 static PyObject*
 dumps(PyObject* self, PyObject* args) {
-  PyObject *doc;
+  PyObject *all_pieces, *pieces, *result = NULL;
+  Py_ssize_t i, n, size, total_size = 0;
+  Py_ssize_t *sizes;
+  char *s;
+
+  n = PyTuple_GET_SIZE(args);
+  if (n == 0) {
+    PyErr_SetString(PyExc_TypeError, "dumps expected at least 1 argument");
+    return NULL;
+  }
+  if (n == 1) {
+    return encode_document(PyTuple_GET_ITEM(args, 0), 0);
+  }
 
-  if (!PyArg_ParseTuple(args, "O:dumps", &doc)) {
+  all_pieces = PyTuple_New(n);
+  if (all_pieces == NULL) {
     return NULL;
   }
-  
-  return encode_document(doc, 0);
+  sizes = PyMem_New(Py_ssize_t, n);
+  if (sizes == NULL) {
+    Py_DECREF(all_pieces);
+    return PyErr_NoMemory();
+  }
+  for (i = 0; i < n; ++i) {
+    /* flat documents are written directly, and keep None in all_pieces */
+    size = flat_document_size(PyTuple_GET_ITEM(args, i), 0);
+    if (size >= 0) {
+      pieces = Py_None;
+      Py_INCREF(pieces);
+    } else {
+      pieces = encode_document_elements(PyTuple_GET_ITEM(args, i), 0, &size);
+      if (pieces == NULL) {
+        goto Done;
+      }
+    }
+    PyTuple_SET_ITEM(all_pieces, i, pieces);
+    sizes[i] = size;
+    if (size > PY_SSIZE_T_MAX - total_size) {
+      PyErr_NoMemory();
+      goto Done;
+    }
+    total_size += size;
+  }
+  result = PyString_FromStringAndSize(NULL, total_size);
+  if (result == NULL) {
+    goto Done;
+  }
+  s = PyString_AS_STRING(result);
+  for (i = 0; i < n; ++i) {
+    pieces = PyTuple_GET_ITEM(all_pieces, i);
+    if (pieces == Py_None) {
+      s = write_flat_document(s, PyTuple_GET_ITEM(args, i), sizes[i]);
+      if (s == NULL) {
+        Py_CLEAR(result);
+        goto Done;
+      }
+    } else {
+      s = write_document(s, pieces, sizes[i]);
+    }
+  }
+
+Done:
+  PyMem_Free(sizes);
+  Py_DECREF(all_pieces);
+  return result;
 }
 
 /* -------------------------------------------------------------------- */
 
 PyDoc_STRVAR(loads__doc__,
-"loads(buffer) -> obj:dict\n\
+"loads(buffer, offset=0, end=None) -> obj:dict\n\
 \n\
 Decodes a BSON buffer and returns the decoded dictionary. \
-Buffer may be a string or any buffer object. \
-Left-over bytes in buffer are not reported.");
+Buffer may be a string or any buffer object (bytearray, memoryview, \
+mmap), it is never copied. Decoding starts at offset and never reads \
+past end. Left-over bytes in buffer are not reported.");
 
 PyDoc_STRVAR(decode_next__doc__,
-"decode_next(buffer, offset=0) -> (new_offset:int, obj:dict)\
+"decode_next(buffer, offset=0, raw_keys=None, end=None, lazy=False) -> (new_offset:int, obj:dict)\
 \n\
 Decodes buffer starting at offset until exactly one BSON document is \
 decoded. Returns the decoded object and the subsequent offset. \
-If the returned offset is equal to the size of the input buffer, \
-then no more input is available.\
+If the returned offset is equal to end (the size of the input buffer \
+by default), then no more input is available. Buffer may be any \
+buffer object, bytes past end are never read.\
+\n\
+Nested documents and arrays whose name is in the raw_keys set are not \
+decoded, they are returned encoded, as a str.\
+\n\
+With lazy=True, the document is returned as a read-only LazyDocument \
+mapping, whose values are only decoded when accessed. Nested documents \
+and arrays are LazyDocument and LazyArray views.\
 \n\
 When enough bytes are not available, BSONBufferTooShort is raised. The \
 second arg of BSONBufferTooShort stores the number of additional \
 bytes required for the document.");
 
+PyDoc_STRVAR(decode_rows__doc__,
+"decode_rows(buffer, types, conversions, offset=0, end=None, columns=False,\n\
+            date_conversion=None, datetime_conversion=None)\n\
+  -> list of tuples\n\
+\n\
+Decodes the BSON array of rows at offset in buffer, as found in the Rows \
+of a query result, into a list of tuples. types are the field type \
+codes of the columns, and conversions their conversion functions (or \
+None), as in vtdb.field_types. int, long and float conversions and NULL \
+values are converted in C. So are the canonical dates and datetimes of \
+the columns converted by date_conversion and datetime_conversion, which \
+must parse them like vtdb.times.DateOrNone and DateTimeOrNone. The other \
+values are passed to their conversion function. With columns=True, \
+returns instead the list of the values of each column, without building \
+the rows; every row must then have a value for every column.");
+
+PyDoc_STRVAR(frame_length__doc__,
+"frame_length(buffer, offset=0, end=None) -> (header_size, body_size)\n\
+\n\
+Reads the sizes of the header and body documents of the Go RPC frame \
+at offset, without decoding them. A size is None while buffer[offset:end] \
+is too short to hold it.");
+
+PyDoc_STRVAR(decode_stats__doc__,
+"decode_stats(reset=False) -> dict\n\
+\n\
+Returns the counts of document keys found in (key_hits) or added to \
+(key_misses) the key cache, and of shared small ints and longs handed \
+out by the decoders, so the allocations they avoided. With reset=True, \
+the counts restart from zero.");
+
 PyDoc_STRVAR(dumps__doc__,
-"dumps(dict) -> str\n\
+"dumps(dict, ...) -> str\n\
 \n\
-Encodes a dictionary and returns a BSON buffer.");
+Encodes a dictionary and returns a BSON buffer. Several dictionaries \
+are encoded back to back into the same buffer.");
 
 static struct PyMethodDef cbson_functions[] = {
-  {"loads", (PyCFunction) loads, METH_VARARGS,
+  {"loads", (PyCFunction) loads, METH_VARARGS | METH_KEYWORDS,
    loads__doc__},
-  {"decode_next", (PyCFunction) decode_next, METH_VARARGS,
+  {"decode_next", (PyCFunction) decode_next, METH_VARARGS | METH_KEYWORDS,
    decode_next__doc__},
+  {"decode_rows", (PyCFunction) decode_rows, METH_VARARGS | METH_KEYWORDS,
+   decode_rows__doc__},
+  {"frame_length", (PyCFunction) frame_length, METH_VARARGS | METH_KEYWORDS,
+   frame_length__doc__},
+  {"decode_stats", (PyCFunction) decode_stats, METH_VARARGS | METH_KEYWORDS,
+   decode_stats__doc__},
   {"dumps", (PyCFunction) dumps, METH_VARARGS,
    dumps__doc__},
   {NULL, NULL, 0, NULL} /* sentinel */
@@ -1208,11 +2951,15 @@ static struct PyMethodDef cbson_functions[] = {
 DL_EXPORT(void)
 initcbson(void) {
   PyObject *m;
-  int i;
+  size_t i;
   m = Py_InitModule("cbson", cbson_functions);
   if (m==NULL)
     return;
 
+  PyDateTime_IMPORT;
+  if (PyDateTimeAPI == NULL)
+    return;
+
   BSONError = PyErr_NewException("cbson.BSONError", NULL, NULL);
   if (BSONError == NULL)
     return;
@@ -1223,6 +2970,15 @@ initcbson(void) {
   PyModule_AddObject(m, "BSONError", BSONError);
   PyModule_AddObject(m, "BSONBufferTooShort", BSONBufferTooShort);
 
+  if (PyType_Ready(&LazyDocumentType) < 0 ||
+      PyType_Ready(&LazyArrayType) < 0 ||
+      PyType_Ready(&LazyArrayIteratorType) < 0)
+    return;
+  Py_INCREF(&LazyDocumentType);
+  PyModule_AddObject(m, "LazyDocument", (PyObject*)&LazyDocumentType);
+  Py_INCREF(&LazyArrayType);
+  PyModule_AddObject(m, "LazyArray", (PyObject*)&LazyArrayType);
+
   /* make string constants */
   for (i=0; i<sizeof(element_type_names)/sizeof(char *); i++) {
     element_types[i] = PyString_FromString(element_type_names[i]);
@@ -45,6 +45,13 @@ def test_load_int():
   '\x0e\x00\x00\x00\x10int\x006\x05\x00\x00\x00'
   >>> cbson.loads(s)
   {'int': 1334}
+  >>> s = cbson.dumps({'int': -1})
+  >>> s
+  '\x0e\x00\x00\x00\x10int\x00\xff\xff\xff\xff\x00'
+  >>> cbson.loads(s)
+  {'int': -1}
+  >>> cbson.loads(cbson.dumps({'int': -2**31}))
+  {'int': -2147483648}
   """
 
 # the library doesn't allow creation of these, so just check the unpacking
@@ -144,6 +151,99 @@ def test_decode_next():
   (44, {'c': [None]})
   """
 
+def test_dumps_many():
+  """
+  >>> s = cbson.dumps({'a': 1}, {'b': 2.0}, {'c': [None]})
+  >>> s == cbson.dumps({'a': 1}) + cbson.dumps({'b': 2.0}) + cbson.dumps({'c': [None]})
+  True
+  >>> cbson.decode_next(s, 12)
+  (28, {'b': 2.0})
+  >>> cbson.dumps({'a': 1}, [])
+  Traceback (most recent call last):
+  ...
+  TypeError: bson document must be a dict
+  >>> cbson.dumps()
+  Traceback (most recent call last):
+  ...
+  TypeError: dumps expected at least 1 argument
+  """
+
+def test_buffer_range():
+  """
+  >>> h, b = cbson.dumps({'Seq': 1}), cbson.dumps({'x': [1, 2]})
+  >>> s = 'junk' + h + b
+  >>> cbson.frame_length(s, 4)
+  (14, 27)
+  >>> cbson.frame_length(s, 4, 7)
+  (None, None)
+  >>> cbson.frame_length(bytearray(s), offset=4, end=21)
+  (14, None)
+  >>> cbson.decode_next(memoryview(s), 4, end=18)
+  (18, {'Seq': 1})
+  >>> cbson.loads(bytearray(s), 18)
+  {'x': [1, 2]}
+  >>> cbson.decode_next(s, 4, None, 17)
+  Traceback (most recent call last):
+  ...
+  BSONBufferTooShort: ('buffer too short: buffer[4:] does not contain 10 bytes for document', 1)
+  >>> cbson.decode_next(s, 4, None, 46)
+  Traceback (most recent call last):
+  ...
+  BSONError: invalid end 46 for offset 4 in buffer of 45 bytes
+  >>> cbson.frame_length(struct.pack('i', 1))
+  Traceback (most recent call last):
+  ...
+  BSONError: invalid header size: 1
+  """
+
+def test_lazy():
+  """
+  >>> s = cbson.dumps({'Result': {'Rows': [['1', None], ['2', 'x']]},
+  ...                  'Session': None})
+  >>> off, doc = cbson.decode_next(bytearray(s), lazy=True)
+  >>> off == len(s), doc
+  (True, <cbson.LazyDocument of 84 bytes>)
+  >>> sorted(doc.keys()), 'Session' in doc, len(doc)
+  (['Result', 'Session'], True, 2)
+  >>> rows = doc['Result']['Rows']
+  >>> rows, len(rows), rows[-1], rows[0][0]
+  (<cbson.LazyArray of 51 bytes>, 2, <cbson.LazyArray of 23 bytes>, '1')
+  >>> [list(row) for row in rows]
+  [['1', None], ['2', 'x']]
+  >>> rows == [['1', None], ['2', 'x']], doc.decode() == cbson.loads(s)
+  (True, True)
+  >>> cbson.decode_rows(rows, [8, 253], [long, None])
+  [(1L, None), (2L, 'x')]
+  >>> doc.get('Error', ''), doc['Error']
+  Traceback (most recent call last):
+  ...
+  KeyError: 'Error'
+  >>> rows[2]
+  Traceback (most recent call last):
+  ...
+  IndexError: LazyArray index out of range
+  """
+
+def test_decode_stats():
+  """
+  >>> s = cbson.dumps({'Fields': [{'Name': 'a', 'Type': 1000L}] * 3})
+  >>> _ = cbson.decode_stats(reset=True)
+  >>> fields = cbson.loads(s)['Fields']
+  >>> fields[0] == fields[2] == {'Name': 'a', 'Type': 1000L}
+  True
+  >>> fields[0]['Type'] is fields[2]['Type']
+  True
+  >>> [k for k in fields[0] if k == 'Name'][0] is 'Name'
+  True
+  >>> stats = cbson.decode_stats(reset=True)
+  >>> stats['key_misses'], stats['key_hits'], stats['small_int_hits']
+  (3, 4, 2)
+  >>> stats['allocations_avoided']
+  6
+  >>> cbson.decode_stats()['allocations_avoided']
+  0
+  """
+
 def test_decode_next_eob():
   """
   >>> s_full = cbson.dumps({'a': 1}) + cbson.dumps({'b': 2.0})
@@ -164,6 +264,45 @@ def test_decode_next_eob():
   BSONBufferTooShort: ('buffer too short: buffer[12:] does not contain 12 bytes for document', 2)
   """
 
+def test_decode_rows():
+  """
+  >>> import datetime, decimal
+  >>> s = cbson.dumps({'Rows': [['1', '2.5', '2015-06-01', None, '9.99'],
+  ...                           ['-3', 'x', '0000-00-00', 'a', '1']]})
+  >>> off, doc = cbson.decode_next(s, 0, frozenset(['Rows']))
+  >>> isinstance(doc['Rows'], str)
+  True
+  >>> def date_or_none(s):
+  ...   return None
+  >>> for row in cbson.decode_rows(doc['Rows'], [8, 5, 10, 253, 246],
+  ...                              [long, str, date_or_none, None,
+  ...                               decimal.Decimal],
+  ...                              date_conversion=date_or_none):
+  ...   print row
+  (1L, '2.5', datetime.date(2015, 6, 1), None, Decimal('9.99'))
+  (-3L, 'x', None, 'a', Decimal('1'))
+  >>> def custom_date(s):
+  ...   return 'custom ' + s
+  >>> cbson.decode_rows(doc['Rows'], [8, 5, 10], [long, str, custom_date],
+  ...                   date_conversion=date_or_none)
+  [(1L, '2.5', 'custom 2015-06-01'), (-3L, 'x', 'custom 0000-00-00')]
+  >>> cbson.decode_rows(doc['Rows'], [8], [float])
+  [(1.0,), (-3.0,)]
+  >>> cbson.decode_rows(doc['Rows'], [8], [float, int])
+  Traceback (most recent call last):
+  ...
+  ValueError: types and conversions must have the same length
+  >>> cbson.decode_rows(doc['Rows'], [8, 5, 253], [long, None, None],
+  ...                   columns=True)
+  [[1L, -3L], ['2.5', 'x'], ['2015-06-01', '0000-00-00']]
+  >>> s = cbson.dumps({'Rows': [['1', '2'], ['3']]})
+  >>> off, doc = cbson.decode_next(s, 0, frozenset(['Rows']))
+  >>> cbson.decode_rows(doc['Rows'], [8, 8], [long, long], columns=True)
+  Traceback (most recent call last):
+  ...
+  ValueError: row has 1 values for 2 columns
+  """
+
 def test_encode_recursive():
   """
   >>> a = []
@@ -184,6 +323,14 @@ def test_encode_invalid():
   Traceback (most recent call last):
   ...
   TypeError: unsupported type for BSON encode
+  >>> cbson.dumps({'x': 2**64})
+  Traceback (most recent call last):
+  ...
+  OverflowError: long too big to convert
+  >>> cbson.dumps({'a' + NULL_BYTE + 'b': 1})
+  Traceback (most recent call last):
+  ...
+  ValueError: document keys must not contain NUL
   """
 
 def BSON(*l):
@@ -52,6 +52,58 @@ class CbsonTest(unittest.TestCase):
         sys.stdout.write("  ERROR: %r\n" % (e,))
         sys.stdout.flush()
 
+  def test_random_encode(self):
+    # the flat and the generic encoder must agree with the decoder,
+    # on documents made of every value type they handle
+    def random_value(depth):
+      kind = random.randint(0, depth < 3 and 9 or 7)
+      if kind == 0:
+        return random.randint(-2**31, 2**31 - 1)
+      if kind == 1:
+        return random.randint(-2**63, 2**63 - 1)
+      if kind == 2:
+        return random.random() * random.choice([-1e300, 1, 1e300])
+      if kind == 3:
+        return "".join(chr(random.randint(0, 255))
+                       for _ in range(random.randint(0, 20)))
+      if kind == 4:
+        return u"\xfc%d" % random.randint(0, 100)
+      if kind == 5:
+        return random.choice([None, True, False])
+      if kind == 6:
+        return random.randint(-5, 1030)
+      if kind == 7:
+        return random.randint(2**31, 2**63 - 1)
+      if kind == 8:
+        return [random_value(depth + 1) for _ in range(random.randint(0, 12))]
+      return random_document(depth + 1)
+
+    def random_document(depth):
+      return dict(("k%d" % random.randint(0, 50), random_value(depth))
+                  for _ in range(random.randint(0, 8)))
+
+    for i in range(2000):
+      d = random_document(0)
+      self.assertEqual(cbson.loads(cbson.dumps(d)), d)
+      first, second = cbson.dumps(d, {"x": d}), cbson.dumps(d)
+      self.assertEqual(first[:len(second)], second)
+
+  def test_encode_overflow(self):
+    for value in (2**63, -2**63 - 1, 2**64, [1, 2**70], {"a": {"b": 2**64}}):
+      self.assertRaises(OverflowError, cbson.dumps, {"x": value})
+    self.assertRaises(ValueError, cbson.dumps, {"x\x00y": 1})
+    self.assertRaises(ValueError, cbson.dumps, {"x": {"\x00": 1}})
+
+  def test_encode_lying_dict(self):
+    # a dict subclass can't make the encoder write past what it sized
+    class LyingDict(dict):
+      def __len__(self):
+        return 1000
+    d = LyingDict(a=1, b="2")
+    self.assertEqual(cbson.loads(cbson.dumps({"x": d})),
+                     {"x": {"a": 1, "b": "2"}})
+    self.assertEqual(cbson.loads(cbson.dumps(d)), {"a": 1, "b": "2"})
+
 if __name__ == "__main__":
   unittest.main()
 
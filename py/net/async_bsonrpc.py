@@ -0,0 +1,745 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Non-blocking Go-style BSON RPC client.
+
+BsonRpcClient blocks the calling thread for the whole call, so running N
+concurrent queries takes N threads. AsyncBsonRpcClient speaks the same
+protocol (CONNECT handshake, header and body BSON frames, responses
+matched to their request with the echoed Seq) but never blocks: call()
+and the streaming methods return Future objects, and the socket I/O of
+every client is done by a single IOLoop thread. Thousands of requests can
+be outstanding on one connection at no extra cost.
+
+client = async_bsonrpc.AsyncBsonRpcClient(addr, timeout)
+client.dial().result()
+future = client.call('VTGate.GetSrvKeyspace', {'Keyspace': 'ks'})
+future.add_done_callback(on_keyspace)
+
+Python 2 has no asyncio, so the loop and the futures are implemented
+here. Done callbacks run on the IOLoop thread, they must not block. Any
+other thread can block on Future.result().
+"""
+
+import collections
+import errno
+import fcntl
+import heapq
+import hmac
+import itertools
+import logging
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+
+from net import bsonrpc
+from net import gorpc
+
+
+class Future(object):
+  """Result of an asynchronous operation.
+
+  The result is set exactly once, with set_result or set_exception.
+  """
+
+  def __init__(self):
+    self._cond = threading.Condition()
+    self._done = False
+    self._result = None
+    self._exception = None
+    self._callbacks = []
+
+  def done(self):
+    return self._done
+
+  def result(self, timeout=None):
+    """Waits for the operation and returns its result.
+
+    Args:
+      timeout: how long to wait in seconds, None waits forever. A wait
+        with a timeout polls, and may return up to 50ms late.
+
+    Returns:
+      The result of the operation.
+
+    Raises:
+      gorpc.TimeoutError: if the operation isn't done after timeout.
+      Exception: the exception the operation failed with.
+    """
+    self._wait(timeout)
+    if self._exception is not None:
+      raise self._exception
+    return self._result
+
+  def exception(self, timeout=None):
+    """Waits for the operation and returns its exception, or None."""
+    self._wait(timeout)
+    return self._exception
+
+  def _wait(self, timeout):
+    with self._cond:
+      if self._done:
+        return
+      if IOLoop.current() is not None:
+        raise gorpc.ProgrammingError(
+            'blocking on a Future from the IOLoop thread')
+      if timeout is None:
+        # a timed wait polls with sleeps of up to 50ms in Python 2, which
+        # would delay every result
+        while not self._done:
+          self._cond.wait()
+        return
+      deadline = time.time() + timeout
+      while not self._done:
+        time_left = deadline - time.time()
+        if time_left <= 0:
+          raise gorpc.TimeoutError('future not done', timeout)
+        self._cond.wait(time_left)
+
+  def add_done_callback(self, fn):
+    """Calls fn(future) once the future is done, or now if it is done."""
+    with self._cond:
+      if not self._done:
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+  def then(self, fn):
+    """Returns a Future for fn(result) once this one is done.
+
+    An exception of this future, or one raised by fn, is propagated to the
+    returned future. If fn returns a Future, its outcome is propagated.
+    """
+    future = Future()
+
+    def on_done(f):
+      if f._exception is not None:
+        future.set_exception(f._exception)
+        return
+      try:
+        result = fn(f._result)
+      except Exception as e:
+        future.set_exception(e)
+        return
+      if isinstance(result, Future):
+        result.add_done_callback(future._copy_from)
+      else:
+        future.set_result(result)
+
+    self.add_done_callback(on_done)
+    return future
+
+  def _copy_from(self, f):
+    if f._exception is not None:
+      self.set_exception(f._exception)
+    else:
+      self.set_result(f._result)
+
+  def set_result(self, result):
+    self._set(result, None)
+
+  def set_exception(self, exception):
+    self._set(None, exception)
+
+  def _set(self, result, exception):
+    with self._cond:
+      if self._done:
+        return
+      self._result = result
+      self._exception = exception
+      self._done = True
+      callbacks, self._callbacks = self._callbacks, []
+      self._cond.notify_all()
+    for fn in callbacks:
+      try:
+        fn(self)
+      except Exception:
+        logging.exception('exception in Future callback')
+
+
+def completed_future(result=None, exception=None):
+  """Returns a Future already done with result or exception."""
+  future = Future()
+  if exception is not None:
+    future.set_exception(exception)
+  else:
+    future.set_result(result)
+  return future
+
+
+# Cancelled timers stay in the heap of the IOLoop until their deadline,
+# unless there are more than this many, and they are over half of the
+# heap: the heap is then rebuilt without them.
+_MIN_TIMERS_TO_COMPACT = 512
+
+
+class _Timer(object):
+
+  def __init__(self, io_loop, deadline, fn, args):
+    self.io_loop = io_loop
+    self.deadline = deadline
+    self.fn = fn
+    self.args = args
+
+  def cancel(self):
+    if self.fn is not None:
+      self.fn = None
+      self.io_loop._cancelled_timers += 1
+
+
+class IOLoop(object):
+  """Single threaded poll loop running socket handlers and callbacks.
+
+  add_callback can be called from any thread. Everything else, and the
+  handlers and callbacks themselves, run on the loop thread.
+  """
+
+  _instance = None
+  _instance_lock = threading.Lock()
+  _local = threading.local()
+
+  def __init__(self):
+    self._poll = select.poll()
+    self._handlers = {}
+    self._callbacks = collections.deque()
+    self._timers = []
+    self._timer_seq = itertools.count()
+    # the cancelled timers still in _timers
+    self._cancelled_timers = 0
+    self._stopped = False
+    self._thread = None
+    # writing to the waker pipe interrupts poll() when a callback is
+    # added from another thread
+    self._waker_r, self._waker_w = os.pipe()
+    for fd in (self._waker_r, self._waker_w):
+      flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+      fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    self._poll.register(self._waker_r, select.POLLIN)
+
+  @classmethod
+  def instance(cls):
+    """Returns the process-wide IOLoop, starting it if needed."""
+    with cls._instance_lock:
+      if cls._instance is None:
+        cls._instance = IOLoop()
+        cls._instance.start()
+      return cls._instance
+
+  @classmethod
+  def current(cls):
+    """Returns the IOLoop running on this thread, or None."""
+    return getattr(cls._local, 'io_loop', None)
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run, name='IOLoop')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._stopped = True
+    self._wake()
+    if self._thread and self._thread is not threading.current_thread():
+      self._thread.join()
+
+  def add_callback(self, fn, *args):
+    self._callbacks.append((fn, args))
+    if IOLoop.current() is not self:
+      self._wake()
+
+  def call_later(self, delay, fn, *args):
+    """Calls fn(*args) after delay seconds. Returns a cancellable timer."""
+    if (self._cancelled_timers > _MIN_TIMERS_TO_COMPACT and
+        self._cancelled_timers > len(self._timers) / 2):
+      self._timers = [t for t in self._timers if t[2].fn is not None]
+      heapq.heapify(self._timers)
+      self._cancelled_timers = 0
+    timer = _Timer(self, time.time() + delay, fn, args)
+    heapq.heappush(self._timers,
+                   (timer.deadline, next(self._timer_seq), timer))
+    return timer
+
+  def add_handler(self, fd, handler, events):
+    """Calls handler(events) when fd is ready for events."""
+    self._handlers[fd] = handler
+    self._poll.register(fd, events)
+
+  def update_handler(self, fd, events):
+    self._poll.modify(fd, events)
+
+  def remove_handler(self, fd):
+    if self._handlers.pop(fd, None) is not None:
+      self._poll.unregister(fd)
+
+  def _wake(self):
+    try:
+      os.write(self._waker_w, 'x')
+    except OSError as e:
+      # the pipe is full, the loop will wake up anyway
+      if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        raise
+
+  def _run_safely(self, fn, args):
+    try:
+      fn(*args)
+    except Exception:
+      logging.exception('exception in IOLoop callback %s', fn)
+
+  def _run(self):
+    IOLoop._local.io_loop = self
+    while not self._stopped:
+      for _ in xrange(len(self._callbacks)):
+        fn, args = self._callbacks.popleft()
+        self._run_safely(fn, args)
+
+      now = time.time()
+      while self._timers and self._timers[0][0] <= now:
+        _, _, timer = heapq.heappop(self._timers)
+        if timer.fn is None:
+          self._cancelled_timers -= 1
+        else:
+          fn, timer.fn = timer.fn, None
+          self._run_safely(fn, timer.args)
+
+      if self._callbacks:
+        poll_timeout = 0
+      elif self._timers:
+        poll_timeout = max(0.0, self._timers[0][0] - time.time()) * 1000.0
+      else:
+        poll_timeout = None
+      try:
+        events = self._poll.poll(poll_timeout)
+      except select.error as e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      for fd, event in events:
+        if fd == self._waker_r:
+          try:
+            while os.read(self._waker_r, 4096):
+              pass
+          except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+              raise
+          continue
+        handler = self._handlers.get(fd)
+        if handler is not None:
+          self._run_safely(handler, (event,))
+    IOLoop._local.io_loop = None
+
+
+class _PendingCall(object):
+  """An outstanding call(), resolved by its only response."""
+
+  def __init__(self, method):
+    self.method = method
+    self.future = Future()
+    self.timer = None
+
+  def on_response(self, response):
+    if response.error:
+      self.future.set_exception(gorpc.AppError(response.error, self.method))
+    else:
+      self.future.set_result(response)
+    return True
+
+  def fail(self, exception):
+    self.future.set_exception(exception)
+
+
+class AsyncStream(object):
+  """Responses of a streaming call, see AsyncBsonRpcClient.stream_call.
+
+  Responses are queued as they arrive. Each next() returns a Future for
+  the next response, or for None once the stream is over.
+  """
+
+  def __init__(self, client, method, sequence_id):
+    self.client = client
+    self.method = method
+    self.sequence_id = sequence_id
+    self.timer = None
+    # responses nobody asked for yet, and futures waiting for one
+    self._responses = collections.deque()
+    self._waiters = collections.deque()
+    # the final outcome: None for the end of stream, or an exception
+    self._done = False
+    self._end = None
+
+  def next(self):
+    """Returns a Future for the next response, None at the end of stream."""
+    future = Future()
+    self.client.io_loop.add_callback(self._next, future)
+    return future
+
+  def close(self):
+    """Stops the stream. Responses still on the wire are dropped."""
+    self.client.io_loop.add_callback(self.client._cancel_stream, self)
+
+  def _next(self, future):
+    if self._responses:
+      future.set_result(self._responses.popleft())
+    elif self._done:
+      self._resolve(future)
+    else:
+      self._waiters.append(future)
+
+  def _resolve(self, future):
+    if isinstance(self._end, Exception):
+      future.set_exception(self._end)
+    else:
+      future.set_result(None)
+
+  def on_response(self, response):
+    if response.error:
+      if response.error == gorpc._lastStreamResponseError:
+        self._finish(None)
+      else:
+        self._finish(gorpc.AppError(response.error, self.method))
+      return True
+    if self._waiters:
+      self._waiters.popleft().set_result(response)
+    else:
+      self._responses.append(response)
+    return False
+
+  def fail(self, exception):
+    self._finish(exception)
+
+  def _finish(self, end):
+    self._done = True
+    self._end = end
+    while self._waiters:
+      self._resolve(self._waiters.popleft())
+
+
+class AsyncBsonRpcClient(object):
+  """Go-style BSON RPC client driven by an IOLoop.
+
+  timeout is the default deadline of call(), counted from the time the
+  call is made. connect_timeout bounds the CONNECT handshake in dial(),
+  and defaults to timeout. stream_idle_timeout bounds the time between
+  two packets of a stream, and defaults to 10 * timeout.
+
+  A timed out call is abandoned, but unlike with BsonRpcClient the
+  connection stays usable: its response is dropped when it shows up.
+  I/O errors fail every outstanding call and close the client.
+  """
+
+  def __init__(self, addr, timeout, user=None, password=None,
+               keyfile=None, certfile=None, connect_timeout=None,
+               stream_idle_timeout=None, io_loop=None):
+    if bool(user) != bool(password):
+      raise ValueError('You must provide either both or none of user and password.')
+    self.addr = addr
+    self.user = user
+    self.password = password
+    if self.user:
+      self.uri = 'http://%s/_bson_rpc_/auth' % self.addr
+    else:
+      self.uri = 'http://%s/_bson_rpc_' % self.addr
+    self.timeout = timeout
+    if connect_timeout is None:
+      connect_timeout = timeout
+    self.connect_timeout = connect_timeout
+    if stream_idle_timeout is None:
+      stream_idle_timeout = timeout * 10
+    self.stream_idle_timeout = stream_idle_timeout
+    self.keyfile = keyfile
+    self.certfile = certfile
+    self.io_loop = io_loop or IOLoop.instance()
+    self.conn = None
+    self._seq = itertools.count(1)
+    # the id of the dial in progress, None once the client is closed.
+    # _dial_lock orders setting conn after a dial with close().
+    self._dial_ids = itertools.count(1)
+    self._dial_id = None
+    self._dial_lock = threading.Lock()
+
+    # the fields below are only used on the IOLoop thread
+    self._conn = None
+    self._sock = None
+    self._fd = None
+    self._read_buffer = gorpc._ReadBuffer()
+    self._write_queue = collections.deque()
+    # outstanding _PendingCall or AsyncStream by sequence id
+    self._pending = {}
+    # sequence ids of closed streams, their late packets are dropped
+    self._cancelled = set()
+
+  def dial(self):
+    """Connects to the server.
+
+    The connection and the CONNECT handshake are blocking, they are done
+    within connect_timeout on a thread of their own, so dial can be
+    called from the IOLoop thread.
+
+    Returns:
+      A Future, done once the client is ready for calls.
+    """
+    if self.conn:
+      self.close()
+    future = Future()
+    with self._dial_lock:
+      dial_id = self._dial_id = next(self._dial_ids)
+    thread = threading.Thread(target=self._dial, args=(dial_id, future),
+                              name='dial-%s' % self.addr)
+    thread.daemon = True
+    thread.start()
+    return future
+
+  def _dial(self, dial_id, future):
+    """Connects to the server, on the dial thread."""
+    conn = gorpc._GoRpcConn(self.connect_timeout)
+    exception = None
+    try:
+      conn.dial(self.uri, self.keyfile, self.certfile)
+    except socket.timeout as e:
+      exception = gorpc.TimeoutError(e, self.connect_timeout, 'dial',
+                                     self.uri)
+    except (socket.error, ssl.SSLError) as e:
+      exception = gorpc.GoRpcError(e)
+    except gorpc.GoRpcError as e:
+      exception = e
+    if exception is not None:
+      conn.close()
+    self.io_loop.add_callback(self._dialed, dial_id, conn, exception, future)
+
+  def authenticate(self):
+    def send_proof(response):
+      challenge = response.reply['Challenge']
+      # CRAM-MD5 authentication.
+      proof = self.user + ' ' + hmac.HMAC(self.password, challenge).hexdigest()
+      return self.call('AuthenticatorCRAMMD5.Authenticate', {'Proof': proof})
+
+    def check(future):
+      if future.exception() is not None:
+        self.close()
+
+    future = self.call('AuthenticatorCRAMMD5.GetNewChallenge', '').then(
+        send_proof)
+    future.add_done_callback(check)
+    return future
+
+  def close(self):
+    with self._dial_lock:
+      # a dial in progress is abandoned
+      self._dial_id = None
+      conn, self.conn = self.conn, None
+    if conn:
+      self.io_loop.add_callback(self._close, conn,
+                                gorpc.GoRpcError('closed client'))
+
+  def is_closed(self):
+    return self.conn is None
+
+  def call(self, method, request, timeout=None):
+    """Sends a request.
+
+    Args:
+      method: the RPC method.
+      request: the request body.
+      timeout: overrides the client timeout for this call only.
+
+    Returns:
+      A Future for the GoRpcResponse. It fails with gorpc.AppError if the
+      response has an Error, gorpc.TimeoutError after timeout, or
+      gorpc.GoRpcError on I/O errors.
+    """
+    if timeout is None:
+      timeout = self.timeout
+    pending = _PendingCall(method)
+    self._send(method, request, pending, timeout)
+    return pending.future
+
+  def stream_call(self, method, request):
+    """Sends a streaming request.
+
+    Returns:
+      An AsyncStream to read the responses from.
+    """
+    sequence_id = next(self._seq)
+    stream = AsyncStream(self, method, sequence_id)
+    self._send(method, request, stream, self.stream_idle_timeout,
+               sequence_id=sequence_id)
+    return stream
+
+  def _send(self, method, request, pending, timeout, sequence_id=None):
+    conn = self.conn
+    if not conn:
+      pending.fail(gorpc.GoRpcError('closed client', method))
+      return
+    if sequence_id is None:
+      sequence_id = next(self._seq)
+    # the request is encoded on the calling thread, the IOLoop only
+    # does the I/O
+    try:
+      req = gorpc.GoRpcRequest(gorpc.make_header(method, sequence_id), request)
+      data = bsonrpc.encode_request(req)
+    except gorpc.GoRpcError as e:
+      pending.fail(e)
+      return
+    self.io_loop.add_callback(self._queue_request, conn, sequence_id, data,
+                              pending, timeout)
+
+  # everything below runs on the IOLoop thread
+
+  def _dialed(self, dial_id, conn, exception, future):
+    if exception is not None:
+      future.set_exception(exception)
+      return
+    with self._dial_lock:
+      closed = dial_id != self._dial_id
+      if not closed:
+        self.conn = conn
+    if closed:
+      conn.close()
+      future.set_exception(gorpc.GoRpcError('closed client', 'dial'))
+      return
+    self._register(conn)
+    if self.user:
+      self.authenticate().add_done_callback(future._copy_from)
+    else:
+      future.set_result(None)
+
+  def _register(self, conn):
+    self._conn = conn
+    self._sock = conn.conn
+    self._fd = self._sock.fileno()
+    self.io_loop.add_handler(self._fd, self._handle_events, gorpc._POLLIN)
+
+  def _queue_request(self, conn, sequence_id, data, pending, timeout):
+    if conn is not self._conn:
+      pending.fail(gorpc.GoRpcError('closed client', pending.method))
+      return
+    self._pending[sequence_id] = pending
+    pending.timer = self.io_loop.call_later(timeout, self._timeout,
+                                            sequence_id, timeout)
+    self._write_queue.append(memoryview(data))
+    try:
+      self._flush()
+    except (socket.error, ssl.SSLError) as e:
+      self._close(conn, gorpc.GoRpcError(e, pending.method))
+
+  def _timeout(self, sequence_id, timeout):
+    pending = self._pending.pop(sequence_id, None)
+    if pending is None:
+      return
+    if isinstance(pending, AsyncStream):
+      self._cancelled.add(sequence_id)
+    pending.fail(gorpc.TimeoutError('deadline exceeded', timeout,
+                                    pending.method))
+
+  def _cancel_stream(self, stream):
+    if self._pending.pop(stream.sequence_id, None) is None:
+      return
+    self._cancelled.add(stream.sequence_id)
+    if stream.timer:
+      stream.timer.cancel()
+    stream.fail(gorpc.ProgrammingError('stream closed', stream.method))
+
+  def _flush(self):
+    while self._write_queue:
+      view = self._write_queue[0]
+      try:
+        sent = self._sock.send(view)
+      except ssl.SSLError as e:
+        if e.args[0] not in gorpc._SSL_WOULD_BLOCK:
+          raise
+        break
+      except socket.error as e:
+        if e.args[0] not in gorpc._WOULD_BLOCK:
+          raise
+        break
+      if sent == len(view):
+        self._write_queue.popleft()
+      else:
+        self._write_queue[0] = view[sent:]
+    if self._write_queue:
+      self.io_loop.update_handler(self._fd, gorpc._POLLIN | gorpc._POLLOUT)
+    else:
+      self.io_loop.update_handler(self._fd, gorpc._POLLIN)
+
+  def _handle_events(self, events):
+    conn = self._conn
+    try:
+      if events & gorpc._POLLOUT:
+        self._flush()
+      if events & (gorpc._POLLIN | select.POLLHUP | select.POLLERR):
+        self._read()
+    except (socket.error, ssl.SSLError) as e:
+      self._close(conn, gorpc.GoRpcError(e))
+    except gorpc.GoRpcError as e:
+      self._close(conn, e)
+
+  def _read(self):
+    # read everything the socket has, then dispatch every complete frame
+    read_buffer = self._read_buffer
+    while True:
+      read_buffer.reserve(gorpc.default_read_buffer_size)
+      try:
+        size = self._sock.recv_into(read_buffer.writable_view())
+      except ssl.SSLError as e:
+        if e.args[0] not in gorpc._SSL_WOULD_BLOCK:
+          raise
+        break
+      except socket.error as e:
+        if e.args[0] not in gorpc._WOULD_BLOCK:
+          raise
+        break
+      if not size:
+        raise socket.error(errno.EPIPE, 'unexpected EOF in read')
+      read_buffer.end += size
+
+    while read_buffer:
+      response = gorpc.GoRpcResponse()
+      consumed, _ = bsonrpc.decode_response(
+          response, read_buffer.buf, read_buffer.start, read_buffer.end)
+      if not consumed:
+        break
+      read_buffer.consume(consumed)
+      self._dispatch(response)
+
+  def _dispatch(self, response):
+    sequence_id = response.sequence_id
+    pending = self._pending.get(sequence_id)
+    if pending is None:
+      if sequence_id in self._cancelled:
+        if response.error:
+          self._cancelled.discard(sequence_id)
+      else:
+        # the caller gave up on this one (timeout), drop it
+        logging.warning('dropping response for abandoned request %s',
+                        sequence_id)
+      return
+    if pending.on_response(response):
+      del self._pending[sequence_id]
+      pending.timer.cancel()
+    else:
+      # a stream packet, restart the idle timer
+      pending.timer.cancel()
+      pending.timer = self.io_loop.call_later(
+          self.stream_idle_timeout, self._timeout, sequence_id,
+          self.stream_idle_timeout)
+
+  def _close(self, conn, exception):
+    if conn is not self._conn:
+      conn.close()
+      return
+    self.io_loop.remove_handler(self._fd)
+    conn.close()
+    if self.conn is conn:
+      self.conn = None
+    self._conn = None
+    self._sock = None
+    self._fd = None
+    self._read_buffer = gorpc._ReadBuffer()
+    self._write_queue.clear()
+    self._cancelled.clear()
+    pending, self._pending = self._pending, {}
+    for p in pending.itervalues():
+      p.timer.cancel()
+      p.fail(exception)
@@ -11,9 +11,21 @@ try:
   # use optimized cbson which has slightly different API
   import cbson
   decode_document = cbson.decode_next
+  # cbson decodes straight out of the receive buffer
+  decode_in_place = True
+  # cbson encodes the header and the body into a single buffer
+  encode_documents = cbson.dumps
+  # cbson decodes query result rows straight into converted tuples
+  decode_rows = cbson.decode_rows
+  frame_length = cbson.frame_length
 except ImportError:
   from bson import codec
   decode_document = codec.decode_document
+  # the pure-python decoder only works on str
+  decode_in_place = False
+  encode_documents = None
+  decode_rows = None
+  frame_length = None
 
 from net import gorpc
 
@@ -21,23 +33,173 @@ from net import gorpc
 # FIXME(msolomon) abandon this - too nasty when protocol requires upgrade
 WRAPPED_FIELD = '_Val_'
 
+# Replies of a client created with raw_rows keep these arrays encoded
+RAW_ROWS_KEYS = frozenset(['Rows'])
+
 len_struct = struct.Struct('<i')
 unpack_length = len_struct.unpack_from
 len_struct_size = len_struct.size
 
+
+def _frame_length(data, offset=0, end=None):
+  """Pure-python version of cbson.frame_length."""
+  if end is None:
+    end = len(data)
+  sizes = []
+  for name in ('header', 'body'):
+    if end - offset < len_struct_size:
+      break
+    size = unpack_length(data, offset)[0]
+    if size < 5:
+      raise ValueError('invalid %s size: %d' % (name, size))
+    sizes.append(size)
+    offset += size
+  return tuple(sizes + [None] * (2 - len(sizes)))
+
+if frame_length is None:
+  frame_length = _frame_length
+
+
+# return encoded request data, including header. The codec is shared by
+# BsonRpcClient and async_bsonrpc.AsyncBsonRpcClient.
+def encode_request(req):
+  if not isinstance(req.body, dict):
+    # hack to handle simple values
+    body = {WRAPPED_FIELD: req.body}
+  else:
+    body = req.body
+  if encode_documents is not None:
+    try:
+      return encode_documents(req.header, body)
+    except (TypeError, OverflowError, ValueError):
+      # cbson doesn't know about tuples, BSONCoding objects (like
+      # keyrange.KeyRange), datetimes or values beyond int64: the
+      # pure-python encoder below handles those requests.
+      pass
+  try:
+    return bson.dumps(req.header) + bson.dumps(body)
+  except Exception as e:
+    raise gorpc.GoRpcError('encode error', e)
+
+
+# fill response with decoded data read from data[start:end], and
+# returns a tuple
+# (bytes to consume if a response was read,
+#  how many bytes are still to read if no response was read and we know)
+# data can be any buffer object (str, bytearray, memoryview, mmap), cbson
+# decodes the frame in place without copying it.
+# The reply elements named in raw_keys are left encoded, and with lazy the
+# reply is a cbson.LazyDocument (cbson only).
+def decode_response(response, data, start, end, raw_keys=None, lazy=False):
+  data_len = end - start
+
+  # read the header and payload lengths, and see if we have enough
+  try:
+    header_len, body_len = frame_length(data, start, end)
+  except Exception as e:
+    raise gorpc.GoRpcError('decode error', e)
+  if header_len is None:
+    return None, None
+  if body_len is None:
+    return None, header_len + len_struct_size - data_len
+  if data_len < header_len + body_len:
+    return None, header_len + body_len - data_len
+
+  # we have enough data, decode it all
+  try:
+    frame_end = start + header_len + body_len
+    if decode_in_place:
+      offset, response.header = decode_document(
+          data, start, None, start + header_len)
+      offset, response.reply = decode_document(
+          data, start + header_len, raw_keys, frame_end, lazy)
+    else:
+      frame = data[start:frame_end]
+      if isinstance(frame, memoryview):
+        data = frame.tobytes()
+      else:
+        data = str(frame)
+      offset, response.header = decode_document(data, 0)
+      offset, response.reply = decode_document(data, header_len)
+    # unpack primitive values
+    # FIXME(msolomon) remove this hack
+    response.reply = response.reply.get(WRAPPED_FIELD, response.reply)
+
+    # the pure-python bson library returns the offset in the buffer
+    # the cbson library returns -1 if everything was read
+    # so we cannot use the 'offset' variable. Instead use
+    # header_len + body_len for the complete length read
+
+    return header_len + body_len, None
+  except Exception as e:
+    raise gorpc.GoRpcError('decode error', e)
+
+
+def decode_frames(data, start=0, end=None, raw_keys=None):
+  """Decodes the Go RPC frames recorded back to back in a buffer.
+
+  Meant for tools reading recorded BSON streams: data can be an mmap of
+  the recording, each frame is decoded in place with cbson.
+
+  Args:
+    data: buffer object holding the frames.
+    start: offset of the first frame.
+    end: end of the last frame, the end of data by default.
+    raw_keys: names of the reply elements to leave encoded (cbson only).
+
+  Yields:
+    (offset, GoRpcResponse) for each frame.
+
+  Raises:
+    gorpc.GoRpcError: if a frame is invalid, or truncated by end.
+  """
+  if end is None:
+    end = len(data)
+  while start < end:
+    response = gorpc.GoRpcResponse()
+    consumed, _ = decode_response(response, data, start, end, raw_keys)
+    if not consumed:
+      raise gorpc.GoRpcError('truncated frame at offset %d' % start)
+    yield start, response
+    start += consumed
+
+
 class BsonRpcClient(gorpc.GoRpcClient):
+  """Go RPC client using BSON.
+
+  With raw_rows=True and cbson available, the 'Rows' arrays of query
+  results are not decoded with the reply: they stay encoded, as a str,
+  for the caller to decode them with decode_rows once it knows the
+  column types.
+
+  With lazy=True and cbson available, replies are read-only
+  cbson.LazyDocument mappings, which only decode the values the caller
+  reads. A value sent back in a request has to be decoded first, with
+  its decode() method.
+  """
+
   def __init__(self, addr, timeout, user=None, password=None,
-               keyfile=None, certfile=None):
+               keyfile=None, certfile=None, multiplexed=False,
+               connect_timeout=None, stream_idle_timeout=None,
+               raw_rows=False, lazy=False):
     if bool(user) != bool(password):
       raise ValueError("You must provide either both or none of user and password.")
     self.addr = addr
+    if raw_rows and decode_rows is not None:
+      self.raw_keys = RAW_ROWS_KEYS
+    else:
+      self.raw_keys = None
+    self.lazy = lazy and decode_in_place
     self.user = user
     self.password = password
     if self.user:
       uri = 'http://%s/_bson_rpc_/auth' % self.addr
     else:
       uri = 'http://%s/_bson_rpc_' % self.addr
-    gorpc.GoRpcClient.__init__(self, uri, timeout, keyfile=keyfile, certfile=certfile)
+    gorpc.GoRpcClient.__init__(self, uri, timeout, keyfile=keyfile,
+                               certfile=certfile, multiplexed=multiplexed,
+                               connect_timeout=connect_timeout,
+                               stream_idle_timeout=stream_idle_timeout)
 
   def dial(self):
     gorpc.GoRpcClient.dial(self)
@@ -55,47 +217,8 @@ class BsonRpcClient(gorpc.GoRpcClient):
     self.call('AuthenticatorCRAMMD5.Authenticate', {"Proof": proof})
 
   def encode_request(self, req):
-    try:
-      if not isinstance(req.body, dict):
-        # hack to handle simple values
-        body = {WRAPPED_FIELD: req.body}
-      else:
-        body = req.body
-      return bson.dumps(req.header) + bson.dumps(body)
-    except Exception as e:
-      raise gorpc.GoRpcError('encode error', e)
-
-  # fill response with decoded data, and returns a tuple
-  # (bytes to consume if a response was read,
-  #  how many bytes are still to read if no response was read and we know)
-  def decode_response(self, response, data):
-    data_len = len(data)
-
-    # decode the header length if we have enough
-    if data_len < len_struct_size:
-      return None, None
-    header_len = unpack_length(data)[0]
-    if data_len < header_len + len_struct_size:
-      return None, None
-
-    # decode the payload length and see if we have enough
-    body_len = unpack_length(data, header_len)[0]
-    if data_len < header_len + body_len:
-        return None, header_len + body_len - data_len
-
-    # we have enough data, decode it all
-    try:
-      offset, response.header = decode_document(data, 0)
-      offset, response.reply = decode_document(data, offset)
-      # unpack primitive values
-      # FIXME(msolomon) remove this hack
-      response.reply = response.reply.get(WRAPPED_FIELD, response.reply)
-
-      # the pure-python bson library returns the offset in the buffer
-      # the cbson library returns -1 if everything was read
-      # so we cannot use the 'offset' variable. Instead use
-      # header_len + body_len for the complete length read
-
-      return header_len + body_len, None
-    except Exception as e:
-      raise gorpc.GoRpcError('decode error', e)
+    return encode_request(req)
+
+  def decode_response(self, response, data, start, end):
+    return decode_response(response, data, start, end, self.raw_keys,
+                           self.lazy)
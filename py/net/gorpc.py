@@ -6,14 +6,34 @@
 #
 # This is pretty simple. The client initiates an HTTP CONNECT and then
 # hijacks the socket. The client is synchronous, but implements deadlines.
+#
+# In multiplexed mode, several threads can share the same socket: each
+# request is tagged with its own sequence id, and responses are
+# dispatched back to the waiting caller using the echoed Seq header.
+# There is no dedicated reader thread: whichever waiting caller gets
+# there first reads frames off the wire on behalf of everybody else.
+#
+# A streaming call can opt into prefetching: a background thread then
+# reads the stream packets ahead of the caller into a bounded queue, so
+# the network transfer overlaps with the processing of the rows.
+#
+# Calls and streams report their latency, sizes and outcome to the
+# registered net.rpc_instrumentation, if any.
 
+import collections
 import errno
+import logging
 import select
 import ssl
 import socket
+import sys
+import threading
 import time
 import urlparse
 
+from net import resolver
+from net import rpc_instrumentation
+
 _lastStreamResponseError = 'EOS'
 
 class GoRpcError(Exception):
@@ -59,6 +79,11 @@ class GoRpcResponse(object):
   #  'Error': error_string}
   header = None
   reply = None # the decoded object - usually a dictionary
+  # frame size, decode time and the time its first byte was received,
+  # only measured while rpc_instrumentation is enabled
+  size = 0
+  decode_time = 0.0
+  first_byte_time = None
 
   @property
   def error(self):
@@ -70,39 +95,124 @@ class GoRpcResponse(object):
 
 default_read_buffer_size = 8192
 
+# A read buffer bigger than this is released once it is drained, so one
+# huge streaming packet doesn't pin its memory for the life of the socket.
+max_idle_read_buffer_size = 1024 * 1024
+
+
+class _ReadBuffer(object):
+  """Growable receive buffer.
+
+  Data is received in place with recv_into, buf[start:end] is what was
+  received but not decoded yet. Frames are decoded straight out of buf,
+  so a frame is never copied after it is read off the socket. The only
+  copies are the leftover bytes moved to the front of the buffer when it
+  is compacted or grown, counted in moved_bytes.
+  """
+
+  def __init__(self, size=default_read_buffer_size):
+    self.buf = bytearray(size)
+    self.start = 0
+    self.end = 0
+    self.moved_bytes = 0
+
+  def __len__(self):
+    return self.end - self.start
+
+  def reserve(self, size):
+    """Makes sure at least size bytes can be received after end."""
+    if len(self.buf) - self.end >= size:
+      return
+    pending = self.end - self.start
+    if len(self.buf) - pending >= size:
+      # enough room if we move the pending bytes to the front
+      self.buf[:pending] = self.buf[self.start:self.end]
+    else:
+      buf = bytearray(max(2 * len(self.buf), pending + size))
+      buf[:pending] = self.buf[self.start:self.end]
+      self.buf = buf
+    self.moved_bytes += pending
+    self.start = 0
+    self.end = pending
+
+  def writable_view(self):
+    return memoryview(self.buf)[self.end:]
+
+  def consume(self, size):
+    self.start += size
+    if self.start == self.end:
+      self.start = 0
+      self.end = 0
+      if len(self.buf) > max_idle_read_buffer_size:
+        self.buf = bytearray(default_read_buffer_size)
+
+
+# _wait_readable and _wait_writable poll events
+_POLLIN = select.POLLIN | select.POLLPRI
+_POLLOUT = select.POLLOUT
+
+# errors a non-blocking socket returns when we need to wait for it
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+_SSL_WOULD_BLOCK = (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE)
+
+
+def deadline_after(timeout):
+  """Returns the absolute deadline for an operation taking timeout secs."""
+  return time.time() + timeout
+
+
+def _outcome(e):
+  """Returns the rpc_instrumentation outcome of a call that raised e."""
+  if isinstance(e, TimeoutError):
+    return rpc_instrumentation.TIMEOUT
+  if isinstance(e, AppError):
+    return rpc_instrumentation.APP_ERROR
+  if (isinstance(e, GoRpcError) and e.args and
+      isinstance(e.args[0], socket.error) and e.args[0].args and
+      e.args[0].args[0] == errno.EPIPE):
+    return rpc_instrumentation.EOF
+  return rpc_instrumentation.ERROR
+
+
 # A single socket wrapper to handle request/response conversation for this
 # protocol. Internal, use GoRpcClient instead.
+#
+# Every I/O method takes an absolute deadline. The socket is non-blocking
+# once dialed, and we poll for exactly the time left before the deadline,
+# so an idle reader wakes up once, when its deadline expires.
 class _GoRpcConn(object):
-  def __init__(self, timeout):
+  def __init__(self, connect_timeout):
     self.conn = None
-    # NOTE(msolomon) since the deadlines are approximate in the code, set
-    # timeout to oversample to minimize waiting in the extreme failure mode.
-    # FIXME(msolomon) reimplement using deadlines
-    self.socket_timeout = timeout / 10.0
-    self.buf = []
+    self.connect_timeout = connect_timeout
+    self.poll = None
 
-  def dial(self, uri, keyfile=None, certfile=None):
+  def dial(self, uri, keyfile=None, certfile=None, deadline=None):
+    if deadline is None:
+      deadline = deadline_after(self.connect_timeout)
     parts = urlparse.urlparse(uri)
     conhost, conport = parts.netloc.split(':')
-    try:
-      conip = socket.gethostbyname(conhost)
-    except NameError:
-      conip = socket.getaddrinfo(conhost, None)[0][4][0]
-    self.conn = socket.create_connection((conip, int(conport)), self.socket_timeout)
+    # cached, see net.resolver
+    conip = resolver.resolve(conhost)
+    self.conn = socket.create_connection((conip, int(conport)),
+                                         self._time_left(deadline))
     if parts.scheme == 'https':
+      self.conn.settimeout(self._time_left(deadline))
       self.conn = ssl.wrap_socket(self.conn, keyfile=keyfile, certfile=certfile)
-    self.conn.sendall('CONNECT %s HTTP/1.0\n\n' % parts.path)
+    self.conn.setblocking(0)
+    self.poll = select.poll()
+    self.poll.register(self.conn.fileno(), _POLLIN)
+
+    self.write_request('CONNECT %s HTTP/1.0\n\n' % parts.path, deadline)
     data = ''
+    buf = bytearray(1024)
     while True:
       try:
-        d = self.conn.recv(1024)
+        size = self.read_into(memoryview(buf), deadline)
       except socket.error as e:
-        if e.args[0] == errno.EINTR:
-          continue
+        if e.args[0] == errno.EPIPE:
+          raise GoRpcError('Unexpected EOF in handshake to %s:%s %s' % (str(conip), str(conport), parts.path))
         raise
-      if not d:
-        raise GoRpcError('Unexpected EOF in handshake to %s:%s %s' % (str(conip), str(conport), parts.path))
-      data += d
+      data += str(buf[:size])
       if '\n\n' in data:
         return
 
@@ -111,36 +221,57 @@ class _GoRpcConn(object):
       self.conn.close()
       self.conn = None
 
-  def write_request(self, request_data):
-    self.conn.sendall(request_data)
+  def _time_left(self, deadline):
+    time_left = deadline - time.time()
+    if time_left <= 0:
+      raise socket.timeout('deadline exceeded')
+    return time_left
 
-  # tries to read some bytes, returns None if it can't because of a timeout
-  def read_some(self, size=None):
-    if size is None:
-      size = default_read_buffer_size
-    try:
-      data = self.conn.recv(size)
-      if not data:
-        # We only read when we expect data - if we get nothing this probably
-        # indicates that the server hung up. This exception ensures the client
-        # tears down properly.
-        raise socket.error(errno.EPIPE, 'unexpected EOF in read')
-    except socket.timeout:
-      # catch the timeout and return empty data for now - this breaks the call
-      # and lets the deadline get caught with reasonable precision.
-      return None
-    except ssl.SSLError as e:
-      # another possible timeout condition with SSL wrapper
-      if 'timed out' in str(e):
-        return None
-      raise
-    except socket.error as e:
-      if e.args[0] == errno.EINTR:
-        # We were interrupted, let the caller retry.
-        return None
-      raise
+  # waits until the socket is ready for the poll events, or raises
+  # socket.timeout if the deadline expires first
+  def _wait(self, events, deadline):
+    self.poll.modify(self.conn.fileno(), events)
+    while True:
+      try:
+        if self.poll.poll(self._time_left(deadline) * 1000.0):
+          return
+      except select.error as e:
+        if e.args[0] != errno.EINTR:
+          raise
+
+  def write_request(self, request_data, deadline):
+    view = memoryview(request_data)
+    while len(view):
+      try:
+        view = view[self.conn.send(view):]
+        continue
+      except ssl.SSLError as e:
+        if e.args[0] not in _SSL_WOULD_BLOCK:
+          raise
+      except socket.error as e:
+        if e.args[0] not in _WOULD_BLOCK:
+          raise
+      self._wait(_POLLOUT, deadline)
 
-    return data
+  # reads some bytes into the writable buffer view, and returns the number
+  # of bytes read. Raises socket.timeout if nothing came before the deadline.
+  def read_into(self, view, deadline):
+    while True:
+      try:
+        size = self.conn.recv_into(view, len(view))
+        if not size:
+          # We only read when we expect data - if we get nothing this probably
+          # indicates that the server hung up. This exception ensures the client
+          # tears down properly.
+          raise socket.error(errno.EPIPE, 'unexpected EOF in read')
+        return size
+      except ssl.SSLError as e:
+        if e.args[0] not in _SSL_WOULD_BLOCK:
+          raise
+      except socket.error as e:
+        if e.args[0] not in _WOULD_BLOCK:
+          raise
+      self._wait(_POLLIN, deadline)
 
   def is_closed(self):
     if self.conn is None:
@@ -158,43 +289,175 @@ class _GoRpcConn(object):
     return False
 
 
+class _StreamPrefetcher(object):
+  """Reads the packets of a stream on a background thread.
+
+  The reader thread calls stream_next until the end of the stream or an
+  error, and stays at most size packets ahead of the caller. Packets,
+  the final None and exceptions are handed over in order, so the caller
+  sees exactly what stream_next would have returned or raised.
+  """
+
+  def __init__(self, client, sequence_id, size):
+    self.client = client
+    self.sequence_id = sequence_id
+    self.size = size
+    # (response, exc_info) items read but not consumed yet. The waits
+    # have no timeout: a timed Condition.wait polls with sleeps, which
+    # would add latency to every packet.
+    self._cond = threading.Condition()
+    self._items = collections.deque()
+    # done is set once the reader queued the last item of the stream,
+    # stopped when the caller gives up on the stream.
+    self.done = False
+    self.stopped = False
+    self.thread = threading.Thread(target=self._read,
+                                   name='stream-prefetch-%s' % sequence_id)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _read(self):
+    self.client._local.prefetching = True
+    while True:
+      try:
+        response = self.client._stream_next(self.sequence_id)
+        item = (response, None)
+      except Exception:
+        response = None
+        item = (None, sys.exc_info())
+      with self._cond:
+        while len(self._items) >= self.size and not self.stopped:
+          self._cond.wait()
+        if self.stopped:
+          return
+        self._items.append(item)
+        if response is None:
+          self.done = True
+        self._cond.notify_all()
+      if response is None:
+        return
+
+  # returns (response, last) for the next item of the stream, or raises
+  # the exception stream_next raised
+  def next(self):
+    with self._cond:
+      while not self._items and not self.stopped:
+        self._cond.wait()
+      if self.stopped:
+        raise GoRpcError('stream closed', self.sequence_id)
+      response, exc_info = self._items.popleft()
+      self._cond.notify_all()
+    if exc_info:
+      raise exc_info[0], exc_info[1], exc_info[2]
+    return response, response is None
+
+  def stop(self):
+    with self._cond:
+      self.stopped = True
+      self._cond.notify_all()
+
+
 class GoRpcClient(object):
-  def __init__(self, uri, timeout, certfile=None, keyfile=None):
+  """Go-style RPC client.
+
+  timeout is the default deadline for a call, counted from the time the
+  request is sent. connect_timeout bounds dial (including the CONNECT
+  handshake) and defaults to timeout. stream_idle_timeout bounds the wait
+  for each packet of a streaming call, and defaults to 10 * timeout as
+  streaming queries get their own bigger connection pool on the vttablet
+  side.
+
+  stream_call(..., prefetch=N) reads the stream up to N packets ahead on a
+  background thread. Without multiplexing, the prefetched stream owns the
+  connection: a call or stream_call made before the end of the stream
+  abandons it, which closes the connection.
+  """
+
+  def __init__(self, uri, timeout, certfile=None, keyfile=None,
+               multiplexed=False, connect_timeout=None,
+               stream_idle_timeout=None):
     self.uri = uri
+    # host:port, to report RPC stats by server
+    self.peer = urlparse.urlparse(uri).netloc
     self.timeout = timeout
-    self.start_time = None
+    if connect_timeout is None:
+      connect_timeout = timeout
+    self.connect_timeout = connect_timeout
+    if stream_idle_timeout is None:
+      stream_idle_timeout = timeout * 10
+    self.stream_idle_timeout = stream_idle_timeout
+    # True between stream_call and the end of the stream
+    self.stream_pending = False
     # FIXME(msolomon) make this random initialized?
     self.seq = 0
     self.conn = None
-    self.data = None
+    self.read_buffer = _ReadBuffer()
     self.certfile = certfile
     self.keyfile = keyfile
+    # In multiplexed mode, _pending maps the sequence id of every
+    # outstanding call or stream to the deque of responses received for
+    # it but not consumed yet. _reading is True while one of the
+    # callers is reading frames off the socket, until _read_deadline at
+    # the latest. The other callers wait without a timeout (a timed
+    # Condition.wait polls with sleeps, which would add latency to every
+    # call): _waiting maps their sequence ids to their deadlines, and the
+    # reader stops reading by the earliest one to wake them up.
+    self.multiplexed = multiplexed
+    self._cond = threading.Condition()
+    self._write_lock = threading.Lock()
+    self._pending = {}
+    self._reading = False
+    self._read_deadline = None
+    self._waiting = {}
+    self._local = threading.local()
+    # _StreamPrefetcher of prefetched streams, by sequence id
+    self._prefetchers = {}
+    # rpc_instrumentation.RpcStats of the streams in progress, by sequence
+    # id, while instrumentation is enabled
+    self._stream_stats = {}
 
   def dial(self):
     if self.conn:
       self.close()
-    conn = _GoRpcConn(self.timeout)
+    conn = _GoRpcConn(self.connect_timeout)
     try:
       conn.dial(self.uri, self.certfile, self.keyfile)
     except socket.timeout as e:
-      raise TimeoutError(e, self.timeout, 'dial', self.uri)
+      conn.close()
+      raise TimeoutError(e, self.connect_timeout, 'dial', self.uri)
     except ssl.SSLError as e:
+      conn.close()
       # another possible timeout condition with SSL wrapper
       if 'timed out' in str(e):
-        raise TimeoutError(e, self.timeout, 'ssl-dial', self.uri)
+        raise TimeoutError(e, self.connect_timeout, 'ssl-dial', self.uri)
       raise GoRpcError(e)
     except socket.error as e:
+      conn.close()
       raise GoRpcError(e)
     self.conn = conn
 
   def close(self):
+    # a prefetch thread closing the client on an error still has to hand
+    # the error over to the caller
+    if not getattr(self._local, 'prefetching', False):
+      self._stop_prefetchers()
     if self.conn:
       self.conn.close()
       self.conn = None
-    self.start_time = None
+    self.stream_pending = False
+    self.read_buffer = _ReadBuffer()
+    if self.multiplexed:
+      # wake up everybody waiting on this socket, they will notice
+      # the connection is gone
+      with self._cond:
+        self._cond.notify_all()
 
   def is_closed(self):
     if self.conn:
+      if self.multiplexed and self._pending:
+        # pending responses make the socket readable, which is
+        # what the check below uses to detect a hung up connection
+        return False
       return self.conn.is_closed()
     return True
 
@@ -208,73 +471,209 @@ class GoRpcClient(object):
   def encode_request(self, req):
     raise NotImplementedError
 
-  # fill response with decoded data, and returns a tuple
+  # fill response with decoded data read from data[start:end], and
+  # returns a tuple
   # (bytes to consume if a response was read,
   #  how many bytes are still to read if no response was read and we know)
-  def decode_response(self, response, data):
+  def decode_response(self, response, data, start, end):
     raise NotImplementedError
 
-  def _check_deadline_exceeded(self, timeout):
-    if (time.time() - self.start_time) > timeout:
-      raise socket.timeout('deadline exceeded')
-
   # logic to read the next response off the wire
-  def _read_response(self, response, timeout):
-    if self.start_time is None:
-      raise ProgrammingError('no request pending')
+  def _read_response(self, response, deadline):
     if not self.conn:
-      raise GoRpcError(
-          '_read_response - closed client: %s' %
-          (time.time() - self.start_time))
-
-    # get some data if we don't have any so we have somewhere to start
-    if self.data is None:
-      while True:
-        self.data = self.conn.read_some()
-        if self.data:
-          break
-        self._check_deadline_exceeded(timeout)
-
-    # now try to decode, and read more if we need to
+      raise GoRpcError('_read_response - closed client')
+
+    # try to decode what we have, and read more if we need to
+    read_buffer = self.read_buffer
+    timed = rpc_instrumentation.get_instrumentation() is not None
+    if timed:
+      # bytes already buffered arrived before we started waiting
+      first_byte_time = time.time() if read_buffer else None
     while True:
-      consumed, extra_needed = self.decode_response(response, self.data)
-      if consumed:
-        data_len = len(self.data)
-        if data_len > consumed:
-          # we have extra data, keep it
-          self.data = self.data[consumed:]
-        else:
-          # no extra data, nothing to keep
-          self.data = None
-        return
+      if read_buffer:
+        if timed:
+          decode_start = time.time()
+        consumed, extra_needed = self.decode_response(
+            response, read_buffer.buf, read_buffer.start, read_buffer.end)
+        if consumed:
+          if timed:
+            response.decode_time = time.time() - decode_start
+            response.size = consumed
+            response.first_byte_time = first_byte_time
+          read_buffer.consume(consumed)
+          return
       else:
-        # we don't have enough data, read more, and check the timeout
-        # every time
+        extra_needed = None
+
+      # we don't have enough data. If we know how much is missing, make
+      # room for all of it at once, so big frames are received in place.
+      read_buffer.reserve(max(extra_needed or 0, default_read_buffer_size))
+      read_buffer.end += self.conn.read_into(read_buffer.writable_view(),
+                                             deadline)
+      if timed and first_byte_time is None:
+        first_byte_time = time.time()
+
+  # Sends a request in multiplexed mode, and registers its sequence id
+  # so responses for it get queued. Returns the sequence id.
+  def _send_multiplexed(self, method, request, deadline, stats=None):
+    with self._cond:
+      if not self.conn:
+        raise GoRpcError('closed client', method)
+      sequence_id = self.next_sequence_id()
+      self._pending[sequence_id] = collections.deque()
+    try:
+      req = GoRpcRequest(make_header(method, sequence_id), request)
+      data = self.encode_request(req)
+      if stats:
+        stats.bytes_sent = len(data)
+      with self._write_lock:
+        if not self.conn:
+          raise GoRpcError('closed client', method)
+        self.conn.write_request(data, deadline)
+    except:
+      self._forget_sequence_id(sequence_id)
+      raise
+    return sequence_id
+
+  def _forget_sequence_id(self, sequence_id):
+    with self._cond:
+      self._pending.pop(sequence_id, None)
+
+  # Waits for the next response for sequence_id in multiplexed mode. If
+  # nobody is reading the socket, we become the reader and dispatch
+  # every frame we decode to its owner until our own response shows up.
+  def _wait_multiplexed(self, sequence_id, deadline):
+    while True:
+      with self._cond:
         while True:
-          more_data = self.conn.read_some(extra_needed)
-          if more_data:
+          if not self.conn:
+            raise socket.error(errno.EPIPE, 'connection closed while waiting')
+          queue = self._pending[sequence_id]
+          if queue:
+            return queue.popleft()
+          if time.time() >= deadline:
+            raise socket.timeout('deadline exceeded')
+          if not self._reading:
+            self._reading = True
+            # read until the first deadline of the callers waiting
+            self._read_deadline = min([deadline] + self._waiting.values())
             break
-          self._check_deadline_exceeded(timeout)
-        self.data += more_data
+          if self._read_deadline <= deadline:
+            # the reader wakes us up by our deadline
+            self._waiting[sequence_id] = deadline
+            try:
+              self._cond.wait()
+            finally:
+              del self._waiting[sequence_id]
+          else:
+            # our deadline is before the reader's, only a timed wait
+            # can catch it
+            self._cond.wait(deadline - time.time())
+
+      # we are the reader now, the condition is released so the
+      # other callers can keep sending requests
+      response = GoRpcResponse()
+      try:
+        self._read_response(response, self._read_deadline)
+      except socket.timeout:
+        # the deadline of a waiting caller expired, not ours: it times
+        # out when woken up, and we carry on reading
+        if time.time() >= deadline:
+          raise
+      finally:
+        with self._cond:
+          self._reading = False
+          self._read_deadline = None
+          if response.header is not None:
+            queue = self._pending.get(response.sequence_id)
+            if queue is None:
+              # the caller gave up on this one (timeout), drop it
+              logging.warning('dropping response for abandoned request %s',
+                              response.sequence_id)
+            else:
+              queue.append(response)
+          self._cond.notify_all()
+
+  def _multiplexed_call(self, method, request, response, deadline, stats):
+    sequence_id = self._send_multiplexed(method, request, deadline, stats)
+    try:
+      r = self._wait_multiplexed(sequence_id, deadline)
+    finally:
+      self._forget_sequence_id(sequence_id)
+    if response is None:
+      return r
+    response.header = r.header
+    response.reply = r.reply
+    response.size = r.size
+    response.decode_time = r.decode_time
+    response.first_byte_time = r.first_byte_time
+    return response
 
   # Perform an rpc, raising a GoRpcError, on errant situations.
   # Pass in a response object if you don't want a generic one created.
-  def call(self, method, request, response=None):
+  # timeout overrides the client timeout for this call only.
+  def call(self, method, request, response=None, timeout=None):
+    instrumentation = rpc_instrumentation.get_instrumentation()
+    if instrumentation is None:
+      return self._call(method, request, response, timeout, None)
+    if self._stream_stats and not self.multiplexed:
+      self._abandon_stream_stats(instrumentation)
+    stats = rpc_instrumentation.RpcStats(method, self.peer, time.time())
+    try:
+      return self._call(method, request, response, timeout, stats)
+    except Exception as e:
+      stats.outcome = _outcome(e)
+      raise
+    finally:
+      stats.wall_time = time.time() - stats.start_time
+      instrumentation.rpc_done(stats)
+
+  def _call(self, method, request, response, timeout, stats):
+    if self._prefetchers and not self.multiplexed:
+      self._abandon_prefetched_stream()
     if not self.conn:
       raise GoRpcError('call - closed client', method)
+    if timeout is None:
+      timeout = self.timeout
+    deadline = deadline_after(timeout)
+    if self.multiplexed:
+      try:
+        response = self._multiplexed_call(method, request, response, deadline,
+                                          stats)
+        if stats:
+          stats.add_response(response)
+      except socket.timeout as e:
+        # only this call is abandoned, its response will be dropped
+        # when it shows up, the connection is still usable.
+        raise TimeoutError(e, timeout, method)
+      except socket.error as e:
+        self.close()
+        raise GoRpcError(e, method)
+      except ssl.SSLError as e:
+        self.close()
+        if 'timed out' in str(e):
+          raise TimeoutError(e, timeout, method)
+        raise GoRpcError(e, method)
+      if response.error:
+        raise AppError(response.error, method)
+      return response
+
     try:
       h = make_header(method, self.next_sequence_id())
       req = GoRpcRequest(h, request)
-      self.start_time = time.time()
-      self.conn.write_request(self.encode_request(req))
+      data = self.encode_request(req)
+      if stats:
+        stats.bytes_sent = len(data)
+      self.conn.write_request(data, deadline)
       if response is None:
         response = GoRpcResponse()
-      self._read_response(response, self.timeout)
-      self.start_time = None
+      self._read_response(response, deadline)
+      if stats:
+        stats.add_response(response)
     except socket.timeout as e:
       # tear down - can't guarantee a clean conversation
       self.close()
-      raise TimeoutError(e, self.timeout, method)
+      raise TimeoutError(e, timeout, method)
     except socket.error as e:
       # tear down - better chance of recovery by reconnecting
       self.close()
@@ -283,7 +682,7 @@ class GoRpcClient(object):
       # tear down - better chance of recovery by reconnecting
       self.close()
       if 'timed out' in str(e):
-        raise TimeoutError(e, self.timeout, method)
+        raise TimeoutError(e, timeout, method)
       raise GoRpcError(e, method)
 
     if response.error:
@@ -297,15 +696,52 @@ class GoRpcClient(object):
     return response
 
   # Perform a streaming rpc call
-  # This method doesn't fetch any result, use stream_next to get them
-  def stream_call(self, method, request):
+  # This method doesn't fetch any result, use stream_next to get them.
+  # Returns the sequence id of the stream. In multiplexed mode, it can
+  # be passed to stream_next when a thread reads several streams.
+  # If prefetch is not 0, a background thread reads up to prefetch
+  # packets of the stream ahead of stream_next.
+  def stream_call(self, method, request, prefetch=0):
+    instrumentation = rpc_instrumentation.get_instrumentation()
+    if instrumentation is None:
+      return self._stream_call(method, request, prefetch, None)
+    if self._stream_stats and not self.multiplexed:
+      self._abandon_stream_stats(instrumentation)
+    stats = rpc_instrumentation.RpcStats(method, self.peer, time.time(),
+                                         streaming=True)
+    try:
+      sequence_id = self._stream_call(method, request, prefetch, stats)
+    except Exception as e:
+      stats.outcome = _outcome(e)
+      stats.wall_time = time.time() - stats.start_time
+      instrumentation.rpc_done(stats)
+      raise
+    self._stream_stats[sequence_id] = stats
+    return sequence_id
+
+  def _stream_call(self, method, request, prefetch, stats):
+    if self._prefetchers and not self.multiplexed:
+      self._abandon_prefetched_stream()
     if not self.conn:
       raise GoRpcError('stream_call - closed client', method)
+    deadline = deadline_after(self.timeout)
     try:
-      h = make_header(method, self.next_sequence_id())
-      req = GoRpcRequest(h, request)
-      self.start_time = time.time()
-      self.conn.write_request(self.encode_request(req))
+      if self.multiplexed:
+        sequence_id = self._send_multiplexed(method, request, deadline, stats)
+        self._local.stream_sequence_id = sequence_id
+      else:
+        h = make_header(method, self.next_sequence_id())
+        req = GoRpcRequest(h, request)
+        data = self.encode_request(req)
+        if stats:
+          stats.bytes_sent = len(data)
+        self.conn.write_request(data, deadline)
+        self.stream_pending = True
+        sequence_id = req.sequence_id
+      if prefetch:
+        self._prefetchers[sequence_id] = _StreamPrefetcher(
+            self, sequence_id, prefetch)
+      return sequence_id
     except socket.timeout as e:
       # tear down - can't guarantee a clean conversation
       self.close()
@@ -322,19 +758,104 @@ class GoRpcClient(object):
       raise GoRpcError(e, method)
 
   # Returns the next value, or None if we're done.
-  # Note the timeout is longer as we don't mind for streaming queries
-  # since they get their own bigger connection pool on the vttablet side
-  # FIXME(alainjobart) The timeout needs to be passed in, not inferred,
-  # otherwise it's going to be hard to debug... Anyway, the value
-  # for the timeout will most likely be 300s here, as timeout is usually 30s.
-  def stream_next(self):
+  # Each packet has to arrive within stream_idle_timeout.
+  def stream_next(self, sequence_id=None):
+    if not self._stream_stats:
+      return self._prefetched_stream_next(sequence_id)
+    if self.multiplexed:
+      if sequence_id is None:
+        sequence_id = getattr(self._local, 'stream_sequence_id', None)
+    else:
+      sequence_id = self.seq
+    stats = self._stream_stats.get(sequence_id)
+    if stats is None:
+      return self._prefetched_stream_next(sequence_id)
+    try:
+      response = self._prefetched_stream_next(sequence_id)
+    except Exception as e:
+      self._stream_done(rpc_instrumentation.get_instrumentation(),
+                        sequence_id, _outcome(e))
+      raise
+    if response is None:
+      self._stream_done(rpc_instrumentation.get_instrumentation(),
+                        sequence_id, rpc_instrumentation.OK)
+    else:
+      stats.add_response(response)
+    return response
+
+  # Reports the stats of a stream once it is over.
+  def _stream_done(self, instrumentation, sequence_id, outcome):
+    stats = self._stream_stats.pop(sequence_id, None)
+    if stats is None or instrumentation is None:
+      return
+    stats.outcome = outcome
+    stats.wall_time = time.time() - stats.start_time
+    instrumentation.rpc_done(stats)
+
+  # Without multiplexing, a new call means the previous stream is over,
+  # reports the ones that didn't reach their end.
+  def _abandon_stream_stats(self, instrumentation):
+    for sequence_id in self._stream_stats.keys():
+      self._stream_done(instrumentation, sequence_id,
+                        rpc_instrumentation.ABANDONED)
+
+  def _prefetched_stream_next(self, sequence_id):
+    if self._prefetchers:
+      if self.multiplexed:
+        if sequence_id is None:
+          sequence_id = getattr(self._local, 'stream_sequence_id', None)
+      else:
+        sequence_id = self.seq
+      prefetcher = self._prefetchers.get(sequence_id)
+      if prefetcher:
+        try:
+          response, last = prefetcher.next()
+        except:
+          self._prefetchers.pop(sequence_id, None)
+          raise
+        if last:
+          self._prefetchers.pop(sequence_id, None)
+        return response
+    return self._stream_next(sequence_id)
+
+  # Stops the prefetch of the current stream of a non-multiplexed client.
+  # If it didn't reach the end of the stream, the rest of the stream is
+  # still coming and the reader thread may be using the socket: the
+  # connection is closed, as it would be by the next read being out of
+  # sequence without prefetch.
+  def _abandon_prefetched_stream(self):
+    if all(p.done for p in self._prefetchers.itervalues()):
+      self._stop_prefetchers()
+      return
+    logging.warning('closing connection with an abandoned stream')
+    self.close()
+
+  def _stop_prefetchers(self):
+    prefetchers = self._prefetchers.values()
+    self._prefetchers.clear()
+    for prefetcher in prefetchers:
+      prefetcher.stop()
+    if (any(not p.done for p in prefetchers) and self.conn and
+        self.conn.conn):
+      # wake up readers blocked on the socket
+      try:
+        self.conn.conn.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+
+  def _stream_next(self, sequence_id):
+    if self.multiplexed:
+      return self._multiplexed_stream_next(sequence_id)
+
+    if not self.stream_pending:
+      raise ProgrammingError('no request pending')
     try:
       response = GoRpcResponse()
-      self._read_response(response, self.timeout * 10)
+      self._read_response(response, deadline_after(self.stream_idle_timeout))
     except socket.timeout as e:
       # tear down - can't guarantee a clean conversation
       self.close()
-      raise TimeoutError(e, self.timeout)
+      raise TimeoutError(e, self.stream_idle_timeout)
     except socket.error as e:
       # tear down - better chance of recovery by reconnecting
       self.close()
@@ -343,7 +864,7 @@ class GoRpcClient(object):
       # tear down - better chance of recovery by reconnecting
       self.close()
       if 'timed out' in str(e):
-        raise TimeoutError(e, self.timeout)
+        raise TimeoutError(e, self.stream_idle_timeout)
       raise GoRpcError(e)
 
     if response.sequence_id != self.seq:
@@ -353,12 +874,40 @@ class GoRpcClient(object):
                        self.seq)
 
     if response.error:
-      self.start_time = None
+      self.stream_pending = False
+      if response.error == _lastStreamResponseError:
+        return None
+      else:
+        raise AppError(response.error)
+
+    return response
+
+  def _multiplexed_stream_next(self, sequence_id):
+    if sequence_id is None:
+      sequence_id = getattr(self._local, 'stream_sequence_id', None)
+    if sequence_id is None or sequence_id not in self._pending:
+      raise ProgrammingError('no stream pending', sequence_id)
+
+    try:
+      response = self._wait_multiplexed(
+          sequence_id, deadline_after(self.stream_idle_timeout))
+    except socket.timeout as e:
+      self._forget_sequence_id(sequence_id)
+      raise TimeoutError(e, self.stream_idle_timeout)
+    except socket.error as e:
+      self.close()
+      raise GoRpcError(e)
+    except ssl.SSLError as e:
+      self.close()
+      if 'timed out' in str(e):
+        raise TimeoutError(e, self.stream_idle_timeout)
+      raise GoRpcError(e)
+
+    if response.error:
+      self._forget_sequence_id(sequence_id)
       if response.error == _lastStreamResponseError:
         return None
       else:
         raise AppError(response.error)
-    else:
-      self.start_time = time.time()
 
     return response
@@ -0,0 +1,172 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Process-wide DNS cache for Go RPC clients.
+
+Every _GoRpcConn.dial (bsonrpc, zkocc, tablet and vtgate clients) used to
+hit the system resolver synchronously, many times over during reconnect
+storms. The Resolver keeps the addresses of a host for ttl seconds, and a
+failed lookup for negative_ttl seconds. Concurrent lookups of the same
+host share a single resolver call.
+
+With spread=True, all the A records of a host are kept, and successive
+resolve() calls return them in turn, spreading the connections across
+them.
+
+The default resolver can be replaced for the whole process:
+
+resolver.set_default_resolver(resolver.Resolver(ttl=60, spread=True))
+"""
+
+import socket
+import threading
+import time
+
+DEFAULT_TTL = 10.0
+DEFAULT_NEGATIVE_TTL = 1.0
+
+
+class _Entry(object):
+  """Cached lookup result: addresses, or the lookup error."""
+
+  def __init__(self, addresses, error, expiry):
+    self.addresses = addresses
+    self.error = error
+    self.expiry = expiry
+    # next address to hand out with spread
+    self.next = 0
+
+
+class Resolver(object):
+  """Thread-safe caching resolver.
+
+  Attributes:
+    ttl: how long (in seconds) the addresses of a host are cached.
+    negative_ttl: how long a failed lookup is cached.
+    spread: if True, resolve() returns all the addresses of a host in
+      turn, instead of always the first one.
+  """
+
+  def __init__(self, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL,
+               spread=False):
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.spread = spread
+    self._lock = threading.Lock()
+    self._entries = {}
+    # host -> Event set when its lookup in flight completes
+    self._lookups = {}
+
+    # stats
+    self._hits = 0
+    self._negative_hits = 0
+    self._misses = 0
+    self._errors = 0
+    self._shared_lookups = 0
+
+  def resolve(self, host):
+    """Returns an IPv4 address of host.
+
+    Raises:
+      socket.gaierror: the lookup failed, now or within negative_ttl.
+    """
+    while True:
+      with self._lock:
+        entry = self._entries.get(host)
+        if entry is not None and entry.expiry > time.time():
+          if entry.error is not None:
+            self._negative_hits += 1
+            raise entry.error
+          self._hits += 1
+          return self._pick_locked(entry)
+        lookup = self._lookups.get(host)
+        if lookup is None:
+          lookup = threading.Event()
+          self._lookups[host] = lookup
+          self._misses += 1
+          break
+        self._shared_lookups += 1
+      # another thread is resolving host, use its result
+      lookup.wait()
+
+    entry = None
+    error = None
+    try:
+      entry = _Entry(self._lookup(host), None, time.time() + self.ttl)
+    except socket.error as e:
+      error = e
+      entry = _Entry(None, error, time.time() + self.negative_ttl)
+    finally:
+      # the waiting threads are woken up whatever the lookup raised, they
+      # look up host themselves if there is no entry
+      with self._lock:
+        if entry is not None:
+          if error is not None:
+            self._errors += 1
+          self._entries[host] = entry
+        del self._lookups[host]
+        lookup.set()
+    if error is not None:
+      raise error
+    with self._lock:
+      return self._pick_locked(entry)
+
+  def invalidate(self, host=None):
+    """Drops the cached lookup of host, or of all hosts."""
+    with self._lock:
+      if host is None:
+        self._entries.clear()
+      else:
+        self._entries.pop(host, None)
+
+  def stats(self):
+    """Returns a dict of cache stats.
+
+    shared_lookups counts the resolve() calls that waited for the lookup
+    of another thread instead of calling the resolver themselves.
+    """
+    with self._lock:
+      return {
+          'size': len(self._entries),
+          'hits': self._hits,
+          'negative_hits': self._negative_hits,
+          'misses': self._misses,
+          'errors': self._errors,
+          'shared_lookups': self._shared_lookups,
+      }
+
+  def _lookup(self, host):
+    # unique addresses, in resolver order
+    addresses = []
+    for _, _, _, _, sockaddr in socket.getaddrinfo(
+        host, None, socket.AF_INET, socket.SOCK_STREAM):
+      if sockaddr[0] not in addresses:
+        addresses.append(sockaddr[0])
+    if not addresses:
+      raise socket.gaierror(socket.EAI_NONAME, 'no address for %s' % host)
+    return addresses
+
+  def _pick_locked(self, entry):
+    if not self.spread:
+      return entry.addresses[0]
+    address = entry.addresses[entry.next % len(entry.addresses)]
+    entry.next += 1
+    return address
+
+
+_default_resolver = Resolver()
+
+
+def get_default_resolver():
+  return _default_resolver
+
+
+def set_default_resolver(resolver):
+  global _default_resolver
+  _default_resolver = resolver
+
+
+def resolve(host):
+  """Resolves host with the default resolver."""
+  return _default_resolver.resolve(host)
@@ -0,0 +1,212 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Instrumentation of the Go RPC transport.
+
+Once an RpcInstrumentation is registered, GoRpcClient reports an RpcStats
+for every call, and for every streaming call once its stream ends. The
+stats tell apart the time spent waiting for the server (time to first
+byte), receiving and decoding the response frames, and what is left for
+the caller. Nothing is measured while no instrumentation is registered.
+
+RpcHistogram is a ready-made in-memory implementation, to be scraped:
+
+histogram = rpc_instrumentation.RpcHistogram()
+rpc_instrumentation.register_instrumentation(histogram)
+...
+histogram.snapshot()
+"""
+
+import bisect
+import collections
+import threading
+
+# RpcStats.outcome values
+OK = 'ok'
+APP_ERROR = 'app_error'
+TIMEOUT = 'timeout'
+# the server hung up
+EOF = 'eof'
+ERROR = 'error'
+# a stream given up on before its end
+ABANDONED = 'abandoned'
+
+
+class RpcStats(object):
+  """What happened during one RPC.
+
+  Attributes:
+    method: RPC method name.
+    peer: host:port of the server.
+    streaming: True for a streaming call.
+    wall_time: seconds from the start of the call to the last response
+      (or the error). For a stream, the end of the stream, which also
+      includes the time the caller spent between packets.
+    time_to_first_byte: seconds from the start of the call until the
+      first byte of the first response frame was received, None if no
+      response frame arrived, or if it was read before instrumentation
+      was registered.
+    bytes_sent: size of the encoded request.
+    bytes_received: total size of the response frames.
+    frames: number of response frames decoded.
+    decode_time: seconds spent decoding the response frames.
+    outcome: one of OK, APP_ERROR, TIMEOUT, EOF, ERROR or ABANDONED.
+  """
+
+  __slots__ = ('method', 'peer', 'streaming', 'start_time', 'wall_time',
+               'time_to_first_byte', 'bytes_sent', 'bytes_received', 'frames',
+               'decode_time', 'outcome')
+
+  def __init__(self, method, peer, start_time, streaming=False):
+    self.method = method
+    self.peer = peer
+    self.streaming = streaming
+    self.start_time = start_time
+    self.wall_time = None
+    self.time_to_first_byte = None
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.frames = 0
+    self.decode_time = 0.0
+    self.outcome = OK
+
+  def add_response(self, response):
+    """Accounts for a decoded GoRpcResponse."""
+    self.frames += 1
+    self.bytes_received += response.size
+    self.decode_time += response.decode_time
+    # a multiplexed reader that started before instrumentation was
+    # registered doesn't time its frames
+    if (self.time_to_first_byte is None and
+        response.first_byte_time is not None):
+      self.time_to_first_byte = max(
+          response.first_byte_time - self.start_time, 0.0)
+
+
+# RpcInstrumentation's methods are called by GoRpcClient. The default
+# implementation does nothing, registering a subclass reports the stats
+# to any custom mechanism. The methods are called from the thread that
+# made the call (or read the stream), and must be thread-safe.
+class RpcInstrumentation(object):
+
+  # rpc_done is called once per call, or per stream when it ends.
+  def rpc_done(self, stats):
+    pass
+
+
+class _Histogram(object):
+  """Counts of values in fixed exponential buckets."""
+
+  # bucket upper bounds, in seconds: 100us to ~105s
+  BOUNDS = [0.0001 * 2 ** i for i in xrange(21)]
+
+  def __init__(self):
+    self.counts = [0] * (len(self.BOUNDS) + 1)
+    self.count = 0
+    self.total = 0.0
+
+  def add(self, value):
+    self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+    self.count += 1
+    self.total += value
+
+  def percentile(self, p):
+    """Returns the upper bound of the bucket holding the p-th percentile."""
+    if not self.count:
+      return None
+    rank = p / 100.0 * self.count
+    seen = 0
+    for i, count in enumerate(self.counts):
+      seen += count
+      if seen >= rank and count:
+        if i == len(self.BOUNDS):
+          return float('inf')
+        return self.BOUNDS[i]
+    return float('inf')
+
+  def snapshot(self):
+    return {
+        'count': self.count,
+        'total': self.total,
+        'buckets': zip(self.BOUNDS + [float('inf')], self.counts),
+        'p50': self.percentile(50),
+        'p90': self.percentile(90),
+        'p99': self.percentile(99),
+    }
+
+
+class _MethodStats(object):
+
+  def __init__(self):
+    self.outcomes = collections.defaultdict(int)
+    self.wall_time = _Histogram()
+    self.time_to_first_byte = _Histogram()
+    self.bytes_sent = 0
+    self.bytes_received = 0
+    self.frames = 0
+    self.decode_time = 0.0
+
+  def add(self, stats):
+    self.outcomes[stats.outcome] += 1
+    self.wall_time.add(stats.wall_time)
+    if stats.time_to_first_byte is not None:
+      self.time_to_first_byte.add(stats.time_to_first_byte)
+    self.bytes_sent += stats.bytes_sent
+    self.bytes_received += stats.bytes_received
+    self.frames += stats.frames
+    self.decode_time += stats.decode_time
+
+  def snapshot(self):
+    return {
+        'outcomes': dict(self.outcomes),
+        'wall_time': self.wall_time.snapshot(),
+        'time_to_first_byte': self.time_to_first_byte.snapshot(),
+        'bytes_sent': self.bytes_sent,
+        'bytes_received': self.bytes_received,
+        'frames': self.frames,
+        'decode_time': self.decode_time,
+    }
+
+
+class RpcHistogram(RpcInstrumentation):
+  """In-memory latency histograms and counters, per method and peer.
+
+  Adding stats costs a lock and a bisect on the bucket bounds.
+  """
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._stats = {}
+
+  def rpc_done(self, stats):
+    key = (stats.method, stats.peer)
+    with self._lock:
+      method_stats = self._stats.get(key)
+      if method_stats is None:
+        method_stats = self._stats[key] = _MethodStats()
+      method_stats.add(stats)
+
+  def snapshot(self):
+    """Returns {(method, peer): stats dict} for everything reported so far."""
+    with self._lock:
+      return dict((key, method_stats.snapshot())
+                  for key, method_stats in self._stats.iteritems())
+
+  def reset(self):
+    with self._lock:
+      self._stats = {}
+
+
+# registration mechanism for RpcInstrumentation
+__instrumentation = None
+
+
+def register_instrumentation(instrumentation):
+  """Registers instrumentation for all GoRpcClients, None disables it."""
+  global __instrumentation
+  __instrumentation = instrumentation
+
+
+def get_instrumentation():
+  return __instrumentation
@@ -0,0 +1,372 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Non-blocking vtgatev2 connection.
+
+AsyncVTGateConnection is the async_bsonrpc counterpart of
+vtgatev2.VTGateConnection: every query method returns an
+async_bsonrpc.Future instead of blocking, so one thread can drive
+thousands of concurrent queries over a single connection.
+
+conn = async_vtgatev2.connect(vtgate_addrs, timeout).result()
+futures = [conn.execute(sql, {'id': i}, 'ks', 'replica', keyspace_ids=[kid])
+           for i in ids]
+for future in futures:
+  results, rowcount, lastrowid, fields = future.result()
+
+Transactions get their own object, so statements of a transaction are
+never mixed up with the concurrent queries sharing the connection:
+
+def do_update(txn):
+  return txn.execute(sql, bind_vars, 'ks', 'master',
+                     keyspace_ids=[kid]).then(lambda _: txn.commit())
+conn.begin().then(do_update).result()
+
+Results are vtgatev2 style, as returned by VTGateConnection._execute.
+Unlike VTGateConnection, RequestBacklog errors are not retried.
+"""
+
+import logging
+
+from net import async_bsonrpc
+from net import gorpc
+from vtdb import dbapi
+from vtdb import dbexceptions
+from vtdb import field_types
+from vtdb import keyspace
+from vtdb import row_converter
+from vtdb import vtdb_logger
+from vtdb import vtgate_dialer
+from vtdb import vtgatev2
+
+
+def _convert_result(res):
+  """Converts a vtgate QueryResult to (results, rowcount, lastrowid, fields)."""
+  fields = []
+  for field in res['Fields']:
+    fields.append((field['Name'], field['Type']))
+  results = vtgatev2._make_rows(res['Rows'], fields)
+  return results, res['RowsAffected'], res['InsertId'], fields
+
+
+class AsyncStreamResult(object):
+  """Rows of a stream_execute, read one packet at a time.
+
+  Attributes:
+    fields: list of (name, type) of the result columns.
+  """
+
+  def __init__(self, conn, stream, fields):
+    self.conn = conn
+    self.stream = stream
+    self.fields = fields
+    self._converter = row_converter.get([t for _, t in fields])
+
+  def next_rows(self):
+    """Returns a Future for the list of rows of the next packet.
+
+    The Future result is None once all the rows have been read.
+    """
+    return self.conn._convert_future(
+        self.stream.next().then(self._on_response))
+
+  def _on_response(self, response):
+    if response is None:
+      return None
+    # a session message, if any, comes separately with no rows
+    if 'Session' in response.reply and response.reply['Session']:
+      return []
+    return vtgatev2._make_rows(response.reply['Result']['Rows'],
+                               converter=self._converter)
+
+  def close(self):
+    """Stops reading the stream."""
+    self.stream.close()
+
+
+class AsyncTransaction(object):
+  """A transaction started by AsyncVTGateConnection.begin.
+
+  The statements of a transaction have to be run one at a time: wait for
+  the Future of a statement before sending the next one.
+  """
+
+  def __init__(self, conn, session):
+    self.conn = conn
+    self.session = session
+    self._in_flight = False
+
+  def execute(self, sql, bind_variables, keyspace, tablet_type,
+              keyspace_ids=None, keyranges=None):
+    return self._run(self.conn._execute, sql, bind_variables, keyspace,
+                     tablet_type, keyspace_ids, keyranges, False, self)
+
+  def execute_batch(self, sql_list, bind_variables_list, keyspace_list,
+                    keyspace_ids_list, tablet_type):
+    return self._run(self.conn._execute_batch, sql_list, bind_variables_list,
+                     keyspace_list, keyspace_ids_list, tablet_type, False,
+                     self)
+
+  def commit(self):
+    return self._run(self._finish, 'VTGate.Commit')
+
+  def rollback(self):
+    return self._run(self._finish, 'VTGate.Rollback')
+
+  def _finish(self, method):
+    session, self.session = self.session, None
+    if session is None:
+      return async_bsonrpc.completed_future(
+          exception=dbexceptions.ProgrammingError('transaction is over',
+                                                  method))
+    return self.conn._call(method, session).then(lambda _: None)
+
+  def _run(self, fn, *args):
+    if self._in_flight:
+      return async_bsonrpc.completed_future(
+          exception=dbexceptions.ProgrammingError(
+              'a statement of this transaction is still running'))
+    self._in_flight = True
+    future = fn(*args)
+
+    def done(_):
+      self._in_flight = False
+    future.add_done_callback(done)
+    return future
+
+  def _update_session(self, response):
+    if 'Session' in response.reply and response.reply['Session']:
+      self.session = response.reply['Session']
+
+
+class AsyncVTGateConnection(object):
+  """Non-blocking connection to a vtgate.
+
+  Every query method returns an async_bsonrpc.Future, failed with the
+  same dbexceptions VTGateConnection raises. Done callbacks run on the
+  IOLoop thread and must not block.
+  """
+
+  def __init__(self, addr, timeout, user=None, password=None,
+               keyfile=None, certfile=None, io_loop=None):
+    self.addr = addr
+    self.timeout = timeout
+    self.client = async_bsonrpc.AsyncBsonRpcClient(
+        addr, timeout, user, password, keyfile=keyfile, certfile=certfile,
+        io_loop=io_loop)
+    self.logger_object = vtdb_logger.get_logger()
+
+  def __str__(self):
+    return '<AsyncVTGateConnection %s >' % self.addr
+
+  def dial(self):
+    """Returns a Future, done once the connection is ready."""
+    if not self.is_closed():
+      self.close()
+    return self._convert_future(self.client.dial())
+
+  def close(self):
+    self.client.close()
+
+  def is_closed(self):
+    return self.client.is_closed()
+
+  def begin(self):
+    """Returns a Future for a new AsyncTransaction."""
+    return self._call('VTGate.Begin', None).then(
+        lambda response: AsyncTransaction(self, response.reply))
+
+  def execute(self, sql, bind_variables, keyspace, tablet_type,
+              keyspace_ids=None, keyranges=None, not_in_transaction=False):
+    """Returns a Future for (results, rowcount, lastrowid, fields)."""
+    return self._execute(sql, bind_variables, keyspace, tablet_type,
+                         keyspace_ids, keyranges, not_in_transaction, None)
+
+  def execute_batch(self, sql_list, bind_variables_list, keyspace_list,
+                    keyspace_ids_list, tablet_type, as_transaction=False):
+    """Returns a Future for the list of (results, rowcount, lastrowid, fields).
+    """
+    return self._execute_batch(sql_list, bind_variables_list, keyspace_list,
+                               keyspace_ids_list, tablet_type, as_transaction,
+                               None)
+
+  def stream_execute(self, sql, bind_variables, keyspace, tablet_type,
+                     keyspace_ids=None, keyranges=None,
+                     not_in_transaction=False):
+    """Returns a Future for an AsyncStreamResult.
+
+    The Future is done once the fields are known. The rows are then read
+    with AsyncStreamResult.next_rows.
+    """
+    try:
+      exec_method, req = self._create_req(
+          'VTGate.StreamExecute', sql, bind_variables, keyspace, tablet_type,
+          keyspace_ids, keyranges, not_in_transaction)
+    except dbexceptions.Error as e:
+      return async_bsonrpc.completed_future(exception=e)
+    stream = self.client.stream_call(exec_method, req)
+
+    def on_first_response(response):
+      if response is None:
+        raise gorpc.GoRpcError('stream ended before the fields', exec_method)
+      fields = []
+      for field in response.reply['Result']['Fields']:
+        fields.append((field['Name'], field['Type']))
+      return AsyncStreamResult(self, stream, fields)
+
+    return self._convert_future(
+        stream.next().then(on_first_response), bind_variables, sql,
+        keyspace_ids, keyranges, keyspace=keyspace, tablet_type=tablet_type)
+
+  def get_srv_keyspace(self, name):
+    """Returns a Future for the keyspace.Keyspace called name."""
+    return self._convert_future(
+        self.client.call('VTGate.GetSrvKeyspace', {'Keyspace': name}).then(
+            lambda response: keyspace.Keyspace(name, response.reply)),
+        None, keyspace=name)
+
+  def _create_req(self, method_prefix, sql, bind_variables, keyspace,
+                  tablet_type, keyspace_ids, keyranges, not_in_transaction):
+    if keyspace_ids is not None:
+      req = vtgatev2._create_req_with_keyspace_ids(
+          sql, bind_variables, keyspace, tablet_type, keyspace_ids,
+          not_in_transaction)
+      return method_prefix + 'KeyspaceIds', req
+    if keyranges is not None:
+      req = vtgatev2._create_req_with_keyranges(
+          sql, bind_variables, keyspace, tablet_type, keyranges,
+          not_in_transaction)
+      return method_prefix + 'KeyRanges', req
+    raise dbexceptions.ProgrammingError(
+        'called without specifying keyspace_ids or keyranges')
+
+  def _execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids,
+               keyranges, not_in_transaction, transaction):
+    try:
+      exec_method, req = self._create_req(
+          'VTGate.Execute', sql, bind_variables, keyspace, tablet_type,
+          keyspace_ids, keyranges, not_in_transaction)
+    except dbexceptions.Error as e:
+      return async_bsonrpc.completed_future(exception=e)
+    if transaction:
+      req['Session'] = transaction.session
+
+    def on_response(response):
+      if transaction:
+        transaction._update_session(response)
+      reply = response.reply
+      if 'Error' in reply and reply['Error']:
+        raise gorpc.AppError(reply['Error'], exec_method)
+      if 'Result' in reply:
+        return _convert_result(reply['Result'])
+      return [], 0, 0, []
+
+    return self._convert_future(
+        self.client.call(exec_method, req).then(on_response), bind_variables,
+        sql, keyspace_ids, keyranges, keyspace=keyspace,
+        tablet_type=tablet_type)
+
+  def _execute_batch(self, sql_list, bind_variables_list, keyspace_list,
+                     keyspace_ids_list, tablet_type, as_transaction,
+                     transaction):
+    query_list = []
+    for sql, bind_vars, keyspace, keyspace_ids in zip(
+        sql_list, bind_variables_list, keyspace_list, keyspace_ids_list):
+      sql, bind_vars = dbapi.prepare_query_bind_vars(sql, bind_vars)
+      query_list.append({
+          'Sql': sql,
+          'BindVariables': field_types.convert_bind_vars(bind_vars),
+          'Keyspace': keyspace,
+          'KeyspaceIds': keyspace_ids,
+          })
+    req = {
+        'Queries': query_list,
+        'TabletType': tablet_type,
+        'AsTransaction': as_transaction,
+        }
+    if transaction:
+      req['Session'] = transaction.session
+
+    def on_response(response):
+      if transaction:
+        transaction._update_session(response)
+      if 'Error' in response.reply and response.reply['Error']:
+        raise gorpc.AppError(response.reply['Error'],
+                             'VTGate.ExecuteBatchKeyspaceIds')
+      return [_convert_result(reply) for reply in response.reply['List']]
+
+    return self._convert_future(
+        self.client.call('VTGate.ExecuteBatchKeyspaceIds', req).then(
+            on_response),
+        bind_variables_list, sql_list, keyspace_ids_list, keyspace='',
+        tablet_type=tablet_type)
+
+  def _call(self, method, request):
+    return self._convert_future(self.client.call(method, request))
+
+  def _convert_future(self, future, bind_variables=None, *args, **kwargs):
+    """Returns a Future converting gorpc errors of future to dbexceptions."""
+    converted = async_bsonrpc.Future()
+
+    def on_done(f):
+      e = f.exception()
+      if e is None:
+        converted.set_result(f.result())
+      elif isinstance(e, gorpc.GoRpcError):
+        if bind_variables is not None:
+          self.logger_object.log_private_data(bind_variables)
+        converted.set_exception(
+            vtgatev2.convert_exception(e, str(self), *args, **kwargs))
+      else:
+        if not isinstance(e, dbexceptions.Error):
+          logging.error('gorpc low-level error: %r', e)
+        converted.set_exception(e)
+
+    future.add_done_callback(on_done)
+    return converted
+
+
+def connect(vtgate_addrs, timeout, user=None, password=None, io_loop=None):
+  """Returns a Future for an AsyncVTGateConnection to one of vtgate_addrs.
+
+  The addresses are dialed one at a time, until one of them works, the
+  ones that recently failed (see vtgate_dialer.failed_addresses) last.
+  """
+  db_params_list = vtgate_dialer.failed_addresses.order(
+      vtgatev2.get_params_for_vtgate_conn(
+          vtgate_addrs, timeout, user=user, password=password))
+  if not db_params_list:
+    return async_bsonrpc.completed_future(
+        exception=dbexceptions.OperationalError(
+            'empty db params list - no db instance available for '
+            'vtgate_addrs %s' % vtgate_addrs))
+
+  result = async_bsonrpc.Future()
+  params_iter = iter(db_params_list)
+  state = {'host_addr': None, 'exception': None}
+
+  def dial_next():
+    for params in params_iter:
+      state['host_addr'] = params['addr']
+      conn = AsyncVTGateConnection(io_loop=io_loop, **params)
+      conn.dial().add_done_callback(
+          lambda f, conn=conn: on_dialed(f, conn))
+      return
+    result.set_exception(dbexceptions.OperationalError(
+        'unable to create vt connection', state['host_addr'],
+        state['exception']))
+
+  def on_dialed(f, conn):
+    e = f.exception()
+    if e is None:
+      vtgate_dialer.failed_addresses.record_success(conn.addr)
+      result.set_result(conn)
+      return
+    vtgate_dialer.failed_addresses.record_failure(conn.addr)
+    state['exception'] = e
+    logging.warning('db connection failed: %s, %s', state['host_addr'], e)
+    dial_next()
+
+  dial_next()
+  return result
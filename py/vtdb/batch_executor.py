@@ -0,0 +1,184 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Sends the keyspace id reads of many callers as batches.
+
+A page render often reads N rows by keyspace id, one
+VTGate.ExecuteKeyspaceIds round trip each. A BatchExecutor collects the
+reads submitted within a short window, or up to a maximum count, and
+sends them as one VTGate.ExecuteBatchKeyspaceIds call. Each read gets a
+Future of its own result.
+
+executor = batch_executor.BatchExecutor(
+    vtgatev2.connect(vtgate_addrs, timeout), 'replica', window=0.002)
+futures = [executor.execute(sql, {'id': i}, 'user', [keyspace_id(i)])
+           for i in ids]
+for future in futures:
+  results, rowcount, lastrowid, fields = future.result()
+executor.close()
+
+Reads are submitted from any thread. The batches are sent by a thread
+of the executor, over its connection, outside of a transaction. The
+connection must not be used for anything else.
+
+vtgate fails a whole batch on the error of one of its queries, and so
+does the executor: every read of the batch gets its error. Sending the
+reads again one by one would hold up all the later batches on the
+executor thread, and its connection can't send them in parallel. A
+caller can retry a failed read with a connection of its own.
+
+result() on the returned futures doesn't poll, callers get their rows
+as soon as the batch reply is decoded.
+"""
+
+import logging
+import threading
+import time
+
+from net import async_bsonrpc
+from vtdb import dbexceptions
+
+
+class BatchExecutor(object):
+  """Collects keyspace id reads, and sends them as batches.
+
+  Attributes:
+    connection: the vtgatev2.VTGateConnection the batches are sent over.
+    tablet_type: the tablet type of the reads.
+    window: the seconds a read waits for others to join its batch.
+    max_batch_size: the maximum number of reads in a batch. A full batch
+      is sent without waiting for the end of the window.
+  """
+
+  def __init__(self, connection, tablet_type, window=0.002,
+               max_batch_size=100):
+    self.connection = connection
+    self.tablet_type = tablet_type
+    self.window = window
+    self.max_batch_size = max_batch_size
+    self._cond = threading.Condition()
+    # list of (sql, bind_variables, keyspace, keyspace_ids, future)
+    self._pending = []
+    self._batch_start = None
+    self._flush_now = False
+    self._closed = False
+    self._queries = 0
+    self._batches = 0
+    self._failed_batches = 0
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def execute(self, sql, bind_variables, keyspace, keyspace_ids):
+    """Submits a read, to be sent with the next batch.
+
+    Args:
+      sql: the query.
+      bind_variables: dict of the bind variables of the query.
+      keyspace: the keyspace of the query.
+      keyspace_ids: the keyspace ids the query is routed to.
+
+    Returns:
+      An async_bsonrpc.Future of the (results, rowcount, lastrowid,
+      fields) of the query.
+
+    Raises:
+      dbexceptions.ProgrammingError: the executor is closed.
+    """
+    future = async_bsonrpc.Future()
+    with self._cond:
+      if self._closed:
+        raise dbexceptions.ProgrammingError('BatchExecutor is closed')
+      if not self._pending:
+        self._batch_start = time.time()
+      self._pending.append(
+          (sql, bind_variables, keyspace, keyspace_ids, future))
+      if len(self._pending) == 1 or len(self._pending) >= self.max_batch_size:
+        self._cond.notify()
+    return future
+
+  def flush(self):
+    """Sends the pending reads now, without waiting for the window."""
+    with self._cond:
+      if self._pending:
+        self._flush_now = True
+        self._cond.notify()
+
+  def close(self):
+    """Sends the pending reads, and stops the executor thread.
+
+    The connection is left open.
+    """
+    with self._cond:
+      self._closed = True
+      self._cond.notify()
+    self._thread.join()
+
+  def stats(self):
+    """Returns a dict of the executor counters.
+
+    queries: the reads sent.
+    batches: the ExecuteBatchKeyspaceIds calls sent for them.
+    failed_batches: the batches that failed, with all their reads.
+    pending: the reads waiting for their batch.
+    """
+    with self._cond:
+      return {
+          'queries': self._queries,
+          'batches': self._batches,
+          'failed_batches': self._failed_batches,
+          'pending': len(self._pending),
+      }
+
+  def _run(self):
+    """Sends the batches, in the executor thread."""
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      self._send(batch)
+
+  def _next_batch(self):
+    """Waits for the next batch to send, None once closed and done."""
+    with self._cond:
+      while not self._pending:
+        if self._closed:
+          return None
+        self._cond.wait()
+      deadline = self._batch_start + self.window
+      while (len(self._pending) < self.max_batch_size and
+             not self._flush_now and not self._closed):
+        time_left = deadline - time.time()
+        if time_left <= 0:
+          break
+        self._cond.wait(time_left)
+      batch = self._pending[:self.max_batch_size]
+      del self._pending[:self.max_batch_size]
+      if self._pending:
+        # the reads left over start the window of the next batch
+        self._batch_start = time.time()
+      else:
+        self._flush_now = False
+      self._queries += len(batch)
+      self._batches += 1
+      return batch
+
+  def _send(self, batch):
+    """Sends a batch, and sets the future of each of its reads."""
+    sql_list, bind_variables_list, keyspace_list, keyspace_ids_list, futures = (
+        zip(*batch))
+    try:
+      rowsets = self.connection._execute_batch(
+          list(sql_list), list(bind_variables_list), list(keyspace_list),
+          list(keyspace_ids_list), self.tablet_type, False)
+    except Exception as e:
+      if not isinstance(e, dbexceptions.DatabaseError):
+        logging.exception('sending a batch of %d reads', len(batch))
+      with self._cond:
+        self._failed_batches += 1
+      for future in futures:
+        future.set_exception(e)
+      return
+    for future, rowset in zip(futures, rowsets):
+      future.set_result(rowset)
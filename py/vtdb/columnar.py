@@ -0,0 +1,105 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Column-oriented query results.
+
+VTGateCursor.fetch_columns and StreamVTGateCursor.fetch_column_batches
+return a list of Column, one per column of the cursor description.
+Integer and floating point columns without NULLs are packed in typed
+array.array buffers (or numpy arrays, if requested and numpy is
+installed), the other columns are lists of their converted values.
+
+columns = cursor.fetch_columns()
+total = sum(columns[1].values)
+"""
+
+import array
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+from vtdb import dbexceptions
+from vtdb import field_types
+
+# array typecodes of the numeric columns. A C long holds any signed
+# BIGINT on the 64-bit platforms we run on.
+_TYPECODES = {
+    field_types.VT_TINY: 'l',
+    field_types.VT_SHORT: 'l',
+    field_types.VT_LONG: 'l',
+    field_types.VT_INT24: 'l',
+    field_types.VT_LONGLONG: 'l',
+    field_types.VT_YEAR: 'l',
+    field_types.VT_FLOAT: 'd',
+    field_types.VT_DOUBLE: 'd',
+}
+
+
+class Column(object):
+  """The values of one column of a query result.
+
+  Attributes:
+    name: the name of the column, from the cursor description.
+    type: its field_types type, from the cursor description.
+    values: an array.array (or numpy array) for the integer and
+      floating point columns without NULL values, that fit in 64 bits.
+      A list of the converted values, with None for NULL, otherwise.
+  """
+
+  def __init__(self, name, field_type, values):
+    self.name = name
+    self.type = field_type
+    self.values = values
+
+  def __len__(self):
+    return len(self.values)
+
+  def __iter__(self):
+    return iter(self.values)
+
+  def __getitem__(self, index):
+    return self.values[index]
+
+  def __repr__(self):
+    return '<Column %s: %d values>' % (self.name, len(self.values))
+
+
+def make_columns(fields, column_values, use_numpy=False):
+  """Returns the Columns of a result.
+
+  Args:
+    fields: list of (name, type) of the columns, as in the cursor
+      description.
+    column_values: list of the list of the converted values of each
+      column. The lists may be packed in place.
+    use_numpy: pack the numeric columns in numpy arrays instead of
+      array.array.
+
+  Returns:
+    A list of Column.
+
+  Raises:
+    dbexceptions.NotSupportedError: use_numpy without numpy installed.
+  """
+  if use_numpy and numpy is None:
+    raise dbexceptions.NotSupportedError('numpy is not installed')
+  return [Column(name, field_type, _pack(field_type, values, use_numpy))
+          for (name, field_type), values in zip(fields, column_values)]
+
+
+def _pack(field_type, values, use_numpy):
+  """Returns the values of a column in a typed buffer, if they fit one."""
+  typecode = _TYPECODES.get(field_type)
+  if typecode is None:
+    return values
+  try:
+    packed = array.array(typecode, values)
+  except (TypeError, OverflowError):
+    # NULL values, or an unsigned BIGINT beyond a C long
+    return values
+  if use_numpy:
+    return numpy.frombuffer(packed, dtype=typecode)
+  return packed
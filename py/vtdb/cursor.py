@@ -164,29 +164,54 @@ class StreamCursor(object):
    # than what we asked for is also an indication we ran out, but the cursor
    # API in PEP249 is silent about that.
   def fetchmany(self, size=None):
+    if self.description is None:
+      raise dbexceptions.ProgrammingError('fetch called before execute')
     if size is None:
       size = self.arraysize
     result = []
     if self.fetchmany_done:
       self.fetchmany_done = False
       return result
-    for i in xrange(size):
-      row = self.fetchone()
-      if row is None:
+    while len(result) < size:
+      rows = self.connection._stream_next_batch(size - len(result))
+      if rows is None:
         self.fetchmany_done = True
         break
-      result.append(row)
+      if result:
+        result.extend(rows)
+      else:
+        result = rows
+    self.index += len(result)
     return result
 
   def fetchall(self):
     result = []
-    while True:
-      row = self.fetchone()
-      if row is None:
-        break
-      result.append(row)
+    for rows in self.fetch_batches():
+      result.extend(rows)
     return result
 
+  def fetch_batches(self):
+    """Returns an iterator over the rows of the stream, a packet at a time.
+
+    Each batch is the list of the rows of a packet of the stream, all
+    converted at once (the rest of the packet, after fetchone or
+    fetchmany). It is the fastest way to read a large stream.
+
+    Returns:
+      An iterator of non-empty lists of rows.
+    """
+    if self.description is None:
+      raise dbexceptions.ProgrammingError('fetch called before execute')
+    return self._batches()
+
+  def _batches(self):
+    while True:
+      rows = self.connection._stream_next_batch()
+      if rows is None:
+        return
+      self.index += len(rows)
+      yield rows
+
   def callproc(self):
     raise dbexceptions.NotSupportedError
 
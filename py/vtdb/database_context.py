@@ -17,6 +17,7 @@ management.
 
 import contextlib
 import functools
+import logging
 
 from vtdb import dbexceptions
 from vtdb import shard_constants
@@ -53,12 +54,17 @@ class DatabaseContext(object):
     transaction_stack_depth: This allows nesting of transactions and makes
     commit rpc to VTGate when the outer-most commits.
     vtgate_connection: Connection to VTGate.
+    connection_pool: optional vtgate_connection_pool.VTGateConnectionPool.
+    If set, vtgate_connection is borrowed from it for the duration of each
+    db operation or transaction, instead of being cached for the process.
   """
 
-  def __init__(self, vtgate_addrs=None, lag_tolerant_mode=False, master_access_disabled=False):
+  def __init__(self, vtgate_addrs=None, lag_tolerant_mode=False,
+               master_access_disabled=False, connection_pool=None):
     self.vtgate_addrs = vtgate_addrs
     self.lag_tolerant_mode = lag_tolerant_mode
     self.master_access_disabled = master_access_disabled
+    self.connection_pool = connection_pool
     self.vtgate_connection = None
     self.change_master_read_to_replica = False
     self._transaction_stack_depth = 0
@@ -83,16 +89,62 @@ class DatabaseContext(object):
 
     Transactions and some of the consistency guarantees rely on vtgate
     connections being sticky hence this class caches the connection.
+    With a connection pool, the connection is only cached until the end
+    of the db operation or transaction.
     """
     if self.vtgate_connection is not None and not self.vtgate_connection.is_closed():
       return self.vtgate_connection
 
+    if self.connection_pool is not None:
+      if self.vtgate_connection is not None:
+        # the connection died, maybe in a transaction: it is lost, but
+        # its slot goes back to the pool
+        self.discard_vtgate_connection()
+      self.vtgate_connection = self.connection_pool.get()
+      return self.vtgate_connection
+
     #TODO: the connect method needs to be extended to include query n txn timeouts as well
     #FIXME: what is the best way of passing other params ?
     connect_method = get_vtgate_connect_method()
     self.vtgate_connection = connect_method(self.vtgate_addrs, self.connection_timeout)
     return self.vtgate_connection
 
+  def release_vtgate_connection(self):
+    """Gives the vtgate connection back to the pool, if we use one.
+
+    The connection is kept while a transaction is in progress.
+    """
+    if (self.connection_pool is None or self.vtgate_connection is None or
+        self.in_transaction):
+      return
+    conn = self.vtgate_connection
+    self.vtgate_connection = None
+    self.connection_pool.put(conn)
+
+  def discard_vtgate_connection(self):
+    """Closes the vtgate connection after an operational error.
+
+    Any transaction in progress is lost with the connection.
+    """
+    self._transaction_stack_depth = 0
+    if self.vtgate_connection is None:
+      return
+    conn = self.vtgate_connection
+    self.vtgate_connection = None
+    try:
+      try:
+        conn.close()
+      except Exception as e:
+        # the client is usually broken by then, and the rollback of the
+        # transaction fails: it is lost with the connection anyway
+        logging.warning('error closing vtgate connection %s: %s', conn, e)
+        conn.session = None
+        conn.client.close()
+    finally:
+      if self.connection_pool is not None:
+        # the pool drops closed connections
+        self.connection_pool.put(conn)
+
   def degrade_master_read_to_replica(self):
     self.change_master_read_to_replica = True
 
@@ -111,7 +163,10 @@ class DatabaseContext(object):
 
     if self.vtgate_connection is None:
       return
-    self.vtgate_connection.commit()
+    try:
+      self.vtgate_connection.commit()
+    finally:
+      self.release_vtgate_connection()
 
   def rollback(self):
     self._transaction_stack_depth = 0
@@ -119,15 +174,20 @@ class DatabaseContext(object):
       if self.vtgate_connection is not None:
         self.vtgate_connection.rollback()
     except dbexceptions.OperationalError:
-      self.vtgate_connection.close()
-      self.vtgate_connection = None
+      self.discard_vtgate_connection()
     except Exception as e:
       raise
+    finally:
+      self.release_vtgate_connection()
 
   def close(self):
     if self._transaction_stack_depth:
       self.rollback()
-    self.vtgate_connection.close()
+    if self.connection_pool is not None:
+      # the pool may be shared with other contexts, and stays open
+      self.release_vtgate_connection()
+    elif self.vtgate_connection is not None:
+      self.vtgate_connection.close()
 
   def read_from_master_setup(self):
     self._tablet_type = shard_constants.TABLET_TYPE_MASTER
@@ -153,6 +213,7 @@ class DatabaseContext(object):
 
   def close_db_operation(self):
     self._tablet_type = None
+    self.release_vtgate_connection()
 
   def create_cursor(self, writable, table_class, **cursor_kargs):
     if not self.in_db_operation:
@@ -197,8 +258,7 @@ class ReadFromMaster(DBOperationBase):
       return True
     if isinstance(exc_type, dbexceptions.OperationalError):
       self.dc.event_logger.vtgatev2_exception(exc_value)
-      self.dc.vtgate_connection.close()
-      self.dc.vtgate_connection = None
+      self.dc.discard_vtgate_connection()
 
 
 class ReadFromReplica(DBOperationBase):
@@ -213,8 +273,7 @@ class ReadFromReplica(DBOperationBase):
       return True
     if isinstance(exc_type, dbexceptions.OperationalError):
       self.dc.event_logger.vtgatev2_exception(exc_value)
-      self.dc.vtgate_connection.close()
-      self.dc.vtgate_connection = None
+      self.dc.discard_vtgate_connection()
 
 
 class WriteTransaction(DBOperationBase):
@@ -232,8 +291,7 @@ class WriteTransaction(DBOperationBase):
       return True
 
     if isinstance(exc_type, dbexceptions.OperationalError):
-      self.dc.vtgate_connection.close()
-      self.dc.vtgate_connection = None
+      self.dc.discard_vtgate_connection()
     else:
       if self.dc.vtgate_connection is not None:
         self.dc.rollback()
@@ -268,7 +268,8 @@ class DBObjectBase(object):
 
     rowcount = cursor.execute(query, bind_vars)
     rows = cursor.fetchall()
-    return [sql_builder.DBRow(columns_list, row) for row in rows]
+    row_class = sql_builder.row_class(columns_list)
+    return [row_class(row) for row in rows]
 
   @classmethod
   def create_insert_query(class_, **bind_vars):
@@ -355,6 +356,7 @@ class DBObjectBase(object):
   def _stream_fetch(class_, cursor, query, bind_vars, fetch_size=100):
     stream_cursor = create_stream_cursor_from_cursor(cursor)
     stream_cursor.execute(query, bind_vars)
+    row_class = sql_builder.row_class(class_.columns_list)
     while True:
       rows = stream_cursor.fetchmany(size=fetch_size)
 
@@ -364,7 +366,7 @@ class DBObjectBase(object):
       i = 0
       for r in rows:
         i += 1
-        yield sql_builder.DBRow(class_.columns_list, r)
+        yield row_class(r)
       if i == 0:
         break
     stream_cursor.close()
@@ -255,7 +255,8 @@ class DBObjectRangeSharded(db_object.DBObjectBase):
                                          entity_id_keyspace_id_map,
                                          entity_col_name)
     rows = cursor.fetchall()
-    return [sql_builder.DBRow(columns_list, row) for row in rows]
+    row_class = sql_builder.row_class(columns_list)
+    return [row_class(row) for row in rows]
 
   @classmethod
   def is_sharding_key_valid(class_, sharding_key):
@@ -94,10 +94,14 @@ def convert_bind_vars(bind_variables):
     elif isinstance(val, datetime.date):
       new_vars[key] = times.DateToString(val)
     elif isinstance(val, set):
-      new_vars[key] = sorted(val)
-    elif isinstance(val, tuple):
-      new_vars[key] = list(val)
-    elif isinstance(val, (int, long, float, str, list, NoneType)):
+      new_vars[key] = _convert_list(sorted(val))
+    elif isinstance(val, (tuple, list)):
+      new_vars[key] = _convert_list(val)
+    elif isinstance(val, bool):
+      # bool is an int, but cbson would encode it as a BSON boolean,
+      # which vttablet doesn't accept as a bind variable.
+      new_vars[key] = int(val)
+    elif isinstance(val, (int, long, float, str, NoneType)):
       new_vars[key] = val
     else:
       # NOTE(msolomon) begrudgingly I allow this - we just have too much code
@@ -105,3 +109,11 @@ def convert_bind_vars(bind_variables):
       # This accidentally solves our hideous dependency on mx.DateTime.
       new_vars[key] = str(val)
   return new_vars
+
+
+def _convert_list(values):
+  """Returns a list bind variable, with its bools as ints."""
+  for value in values:
+    if isinstance(value, bool):
+      return [int(v) if isinstance(v, bool) else v for v in values]
+  return list(values)
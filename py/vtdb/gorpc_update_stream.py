@@ -2,29 +2,15 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
-from itertools import izip
 import logging
 
 from net import gorpc
 from net import bsonrpc
 from vtdb import dbexceptions
-from vtdb import field_types
+from vtdb import row_converter
 from vtdb import update_stream
 
 
-def _make_row(row, conversions):
-  converted_row = []
-  for conversion_func, field_data in izip(conversions, row):
-    if field_data is None:
-      v = None
-    elif conversion_func:
-      v = conversion_func(field_data)
-    else:
-      v = field_data
-    converted_row.append(v)
-  return converted_row
-
-
 class GoRpcUpdateStreamConnection(update_stream.UpdateStreamConnection):
   """GoRpcUpdateStreamConnection is the go rpc implementation of
   UpdateStreamConnection.
@@ -81,16 +67,16 @@ class GoRpcUpdateStreamConnection(update_stream.UpdateStreamConnection):
         fields = []
         rows = []
         if reply['PrimaryKeyFields']:
-          conversions = []
+          types = []
           for field in reply['PrimaryKeyFields']:
             fields.append(field['Name'])
-            conversions.append(field_types.conversions.get(field['Type']))
+            types.append(field['Type'])
 
+          converter = row_converter.get(types)
           for pk_list in reply['PrimaryKeyValues']:
             if not pk_list:
               continue
-            row = tuple(_make_row(pk_list, conversions))
-            rows.append(row)
+            rows.append(converter.convert_row(pk_list))
 
         yield update_stream.StreamEvent(category=category,
                                         table_name=reply['TableName'],
@@ -2,30 +2,17 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
-from itertools import izip
 import logging
 from urlparse import urlparse
 
 from vtdb import dbexceptions
-from vtdb import field_types
+from vtdb import row_converter
 from vtdb import update_stream
 
 from vtproto import binlogdata_pb2
 from vtproto import binlogservice_pb2
 from vtproto import replicationdata_pb2
 
-def _make_row(row, conversions):
-  converted_row = []
-  for conversion_func, field_data in izip(conversions, row):
-    if field_data is None:
-      v = None
-    elif conversion_func:
-      v = conversion_func(field_data)
-    else:
-      v = field_data
-    converted_row.append(v)
-  return converted_row
-
 
 class GRPCUpdateStreamConnection(update_stream.UpdateStreamConnection):
   """GRPCUpdateStreamConnection is the gRPC implementation of
@@ -62,14 +49,14 @@ class GRPCUpdateStreamConnection(update_stream.UpdateStreamConnection):
         fields = []
         rows = []
         if stream_event.primary_key_fields:
-          conversions = []
+          types = []
           for field in stream_event.primary_key_fields:
             fields.append(field.name)
-            conversions.append(field_types.conversions.get(field.type))
+            types.append(field.type)
 
+          converter = row_converter.get(types)
           for r in stream_event.primary_key_values:
-            row = tuple(_make_row(r.values, conversions))
-            rows.append(row)
+            rows.append(converter.convert_row(r.values))
 
         try:
           yield update_stream.StreamEvent(category=int(stream_event.category),
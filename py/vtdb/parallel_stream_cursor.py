@@ -0,0 +1,371 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Streams a query over parallel task keyranges, and merges the rows.
+
+A full table export splits the keyspace in task keyranges (see
+vtrouting), and streams the query over each of them. A
+ParallelStreamCursor runs those streams at the same time, one thread
+and one connection per task, and returns their rows as one cursor.
+
+cursor = parallel_stream_cursor.ParallelStreamCursor(
+    lambda: vtgatev2.connect(vtgate_addrs, timeout), 'user', 'rdonly',
+    num_tasks=16)
+cursor.execute('SELECT id, name FROM user', {})
+for rows in cursor.fetch_batches():
+  export(rows)
+cursor.close()
+
+Each task reads ahead a few packets at most, so a slow reader holds up
+the streams instead of buffering the table. With order_by, the sorted
+streams are merged into one sorted result.
+"""
+
+import heapq
+import logging
+import Queue
+import sys
+import threading
+
+from vtdb import dbexceptions
+from vtdb import keyrange
+from vtdb import sql_builder
+from vtdb import vtgate_cursor
+from vtdb import vtrouting
+
+# The number of rows per batch of an ordered merge.
+_MERGE_BATCH_SIZE = 1000
+
+
+class ParallelStreamCursor(object):
+  """A streaming cursor over the task keyranges of a keyspace.
+
+  Attributes:
+    keyspace: the keyspace of the query.
+    tablet_type: the tablet type to stream from.
+    keyrange_list: the keyrange of each task, as str.
+    description: the fields of the query, set by execute.
+    errors: list of (keyrange, exception) of the task that failed. The
+      first error stops all the tasks, and is raised by execute or by the
+      fetch methods, so there is one at most.
+  """
+  arraysize = 1
+
+  def __init__(self, connect, keyspace, tablet_type, num_tasks,
+               shard_count=None, queue_size=4):
+    """Creates a cursor for num_tasks parallel streams.
+
+    Args:
+      connect: function returning a new connection to vtgate. It is
+        called in each task thread, and the connection is closed at the
+        end of the task.
+      keyspace: the keyspace of the query.
+      tablet_type: the tablet type to stream from.
+      num_tasks: the number of parallel streams.
+      shard_count: the shard count of the keyspace, for
+        vtrouting.create_parallel_task_keyrange_map. num_tasks must be a
+        multiple of it, so each task keyrange is within one shard.
+        Required by execute with order_by. Defaults to num_tasks.
+      queue_size: the number of packets a task can read ahead.
+    """
+    self._connect = connect
+    self.keyspace = keyspace
+    self.tablet_type = tablet_type
+    self.shard_count = shard_count
+    self.keyrange_list = vtrouting.create_parallel_task_keyrange_map(
+        num_tasks, shard_count or num_tasks).keyrange_list
+    self.queue_size = queue_size
+    self.description = None
+    self.errors = []
+    self.index = None
+    self._cancelled = threading.Event()
+    self._queues = []
+    self._batches = None
+    self._batch = None
+    self._batch_index = 0
+
+  def close(self):
+    """Stops the streams that are still running."""
+    self._cancel()
+    self._batches = None
+    self._batch = None
+
+  def _cancel(self):
+    """Stops the tasks, and releases those blocked on a full queue."""
+    self._cancelled.set()
+    # the task threads put without a timeout (a timed put polls with
+    # sleeps, which would stall the streams), emptying the queues lets
+    # them see they were cancelled. Each task puts one item at most
+    # after that, which the queues have room for.
+    for queue in self._queues:
+      try:
+        while True:
+          queue.get_nowait()
+      except Queue.Empty:
+        pass
+
+  def execute(self, sql, bind_variables, where_clause='', order_by=None):
+    """Starts streaming the query over every task keyrange.
+
+    The query of each task adds the keyspace id bounds of its keyrange
+    to where_clause (see vtrouting.VTRoutingInfo.update_where_clause).
+
+    Args:
+      sql: the query up to its WHERE clause, 'SELECT ... FROM table'.
+      bind_variables: dict of the bind variables of the query.
+      where_clause: the conditions of the query, if any.
+      order_by: a str or a list of columns to sort the rows on, where a
+        column is a str or a (str, 'ASC' or 'DESC') pair. The columns
+        must be selected. Each stream is sorted by the vttablet of its
+        shard, and the streams are merged: the cursor needs the
+        shard_count of the keyspace, as a task keyrange covering several
+        shards streams unsorted rows.
+
+    Returns:
+      0, like the other streaming cursors.
+
+    Raises:
+      dbexceptions.ProgrammingError: an order_by column is not selected,
+        or order_by is used without shard_count.
+      The error of a task that failed to start its stream.
+    """
+    if order_by and self.shard_count is None:
+      raise dbexceptions.ProgrammingError(
+          'order_by needs the shard_count of the keyspace')
+    if self._batches is not None:
+      self.close()
+    self._cancelled = threading.Event()
+    self.description = None
+    self.errors = []
+    self._batch = None
+    self._batch_index = 0
+
+    if order_by:
+      if not isinstance(order_by, (tuple, list)):
+        order_by = [order_by]
+      queues = [Queue.Queue(self.queue_size) for _ in self.keyrange_list]
+    else:
+      queues = ([Queue.Queue(self.queue_size * len(self.keyrange_list))] *
+                len(self.keyrange_list))
+    self._queues = queues
+    task_queries = []
+    for task_keyrange in self.keyrange_list:
+      routing = vtrouting.create_vt_routing_info(task_keyrange, self.keyspace)
+      task_where_clause, task_bind_variables = routing.update_where_clause(
+          where_clause, dict(bind_variables))
+      query = sql
+      if task_where_clause:
+        query += ' WHERE ' + task_where_clause
+      if order_by:
+        query += ' ' + sql_builder.build_order_clause(order_by)
+      task_queries.append((query, task_bind_variables))
+
+    started = Queue.Queue()
+    for task_index, (query, task_bind_variables) in enumerate(task_queries):
+      thread = threading.Thread(
+          target=self._run_task,
+          args=(task_index, query, task_bind_variables, started,
+                queues[task_index], self._cancelled))
+      thread.daemon = True
+      thread.start()
+
+    for _ in self.keyrange_list:
+      task_index, description, exc_info = started.get()
+      if exc_info is not None:
+        self._fail(task_index, exc_info)
+      if self.description is None:
+        self.description = description
+
+    if order_by:
+      sort_key = self._sort_key(order_by)
+      self._batches = self._merged_batches(queues, sort_key)
+    else:
+      self._batches = self._task_batches(queues[0], len(queues))
+    self.index = 0
+    return 0
+
+  def _run_task(self, task_index, sql, bind_variables, started, queue,
+                cancelled):
+    """Streams the query of a task into its queue, in a task thread."""
+    conn = None
+    is_started = False
+    try:
+      conn = self._connect()
+      cursor = conn.cursor(
+          self.keyspace, self.tablet_type,
+          keyranges=[keyrange.KeyRange(self.keyrange_list[task_index])],
+          cursorclass=vtgate_cursor.StreamVTGateCursor)
+      cursor.execute(sql, bind_variables)
+      started.put((task_index, cursor.description, None))
+      is_started = True
+      for rows in cursor.fetch_batches():
+        if not _put(queue, (task_index, rows, None), cancelled):
+          return
+      _put(queue, (task_index, None, None), cancelled)
+    except:
+      if cancelled.is_set():
+        return
+      if is_started:
+        _put(queue, (task_index, None, sys.exc_info()), cancelled)
+      else:
+        started.put((task_index, None, sys.exc_info()))
+    finally:
+      if conn is not None:
+        try:
+          conn.close()
+        except:
+          logging.exception('closing the connection of task %s',
+                            self.keyrange_list[task_index])
+
+  def _fail(self, task_index, exc_info):
+    """Stops all the tasks, and raises the error of a task."""
+    self._cancel()
+    self.errors.append((self.keyrange_list[task_index], exc_info[1]))
+    raise exc_info[0], exc_info[1], exc_info[2]
+
+  def _task_batches(self, queue, task_count):
+    """Yields the batches of rows of the tasks, as they come."""
+    done = 0
+    while done < task_count:
+      task_index, rows, exc_info = queue.get()
+      if exc_info is not None:
+        self._fail(task_index, exc_info)
+      if rows is None:
+        done += 1
+      else:
+        yield rows
+
+  def _merged_batches(self, queues, sort_key):
+    """Yields the batches of rows of the sorted tasks, merged in order."""
+    heap = []
+    for task_index, queue in enumerate(queues):
+      rows = _iter_rows(self._task_batches(queue, 1))
+      for row in rows:
+        heap.append((sort_key(row), task_index, row, rows))
+        break
+    heapq.heapify(heap)
+    batch = []
+    while heap:
+      _, task_index, row, rows = heap[0]
+      batch.append(row)
+      if len(batch) == _MERGE_BATCH_SIZE:
+        yield batch
+        batch = []
+      for row in rows:
+        heapq.heapreplace(heap, (sort_key(row), task_index, row, rows))
+        break
+      else:
+        heapq.heappop(heap)
+    if batch:
+      yield batch
+
+  def _sort_key(self, order_by):
+    """Returns the function returning the sort key of a row."""
+    names = [name for name, _ in self.description]
+    indexes = []
+    descending = []
+    for column in order_by:
+      direction = 'ASC'
+      if isinstance(column, (tuple, list)):
+        column, direction = column
+      if column not in names:
+        self.close()
+        raise dbexceptions.ProgrammingError(
+            'order_by column %s is not selected' % column)
+      indexes.append(names.index(column))
+      descending.append(direction.upper() == 'DESC')
+    return vtgate_cursor.row_sort_key(indexes, descending)
+
+  def _next_batch(self, size=None):
+    """Returns the next rows, at most size of them, None if done."""
+    if self._batches is None:
+      raise dbexceptions.ProgrammingError('fetch called before execute')
+    if self._batch is None:
+      self._batch = next(self._batches, None)
+      self._batch_index = 0
+      if self._batch is None:
+        return None
+    start = self._batch_index
+    end = len(self._batch) if size is None else min(start + size,
+                                                    len(self._batch))
+    if start == 0 and end == len(self._batch):
+      rows = self._batch
+    else:
+      rows = self._batch[start:end]
+    if end == len(self._batch):
+      self._batch = None
+    else:
+      self._batch_index = end
+    self.index += len(rows)
+    return rows
+
+  def fetchone(self):
+    rows = self._next_batch(1)
+    if rows is None:
+      return None
+    return rows[0]
+
+  def fetchmany(self, size=None):
+    if size is None:
+      size = self.arraysize
+    result = []
+    while len(result) < size:
+      rows = self._next_batch(size - len(result))
+      if rows is None:
+        break
+      result.extend(rows)
+    return result
+
+  def fetchall(self):
+    result = []
+    for rows in self.fetch_batches():
+      result.extend(rows)
+    return result
+
+  def fetch_batches(self):
+    """Returns an iterator over the rows, a batch at a time.
+
+    Unordered, a batch is a packet of one of the streams.
+
+    Returns:
+      An iterator of non-empty lists of rows.
+    """
+    if self._batches is None:
+      raise dbexceptions.ProgrammingError('fetch called before execute')
+    return iter(self._next_batch, None)
+
+  @property
+  def rownumber(self):
+    return self.index
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    val = self.fetchone()
+    if val is None:
+      raise StopIteration
+    return val
+
+
+def _put(queue, item, cancelled):
+  """Puts an item in a bounded queue, unless cancelled.
+
+  A put blocked on a full queue is released when the cursor is
+  cancelled, by ParallelStreamCursor._cancel.
+
+  Returns:
+    False if cancelled.
+  """
+  if cancelled.is_set():
+    return False
+  queue.put(item)
+  return True
+
+
+def _iter_rows(batches):
+  """Yields the rows of an iterator of batches."""
+  for rows in batches:
+    for row in rows:
+      yield row
@@ -0,0 +1,243 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""A client-side cache of the results of replica reads.
+
+Small replica SELECTs (config tables, lookup rows) can be served from
+memory for a short while instead of going to vtgate every time. A
+ResultCache given to a VTGateConnection keeps their results for the TTL
+of their table, within a bound on their total size, evicting the least
+recently used ones first. Master reads, reads in a transaction and
+anything but a SELECT always go to vtgate.
+
+cache = result_cache.ResultCache(max_bytes=16 << 20, default_ttl=0,
+                                 table_ttls={'config': 30, 'user': 1})
+conn = vtgatev2.connect(vtgate_addrs, timeout, result_cache=cache)
+
+The cache can be shared by the connections of several threads. Cached
+results are shared by the callers, and must not be modified.
+"""
+
+import collections
+import re
+import sys
+import threading
+import time
+
+from vtdb import keyrange
+
+# Whitespace outside of quoted strings and names is collapsed, so
+# formatting doesn't split the cache entries of a query.
+_whitespace_pattern = re.compile(
+    r"""('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|`[^`]*`)|\s+""")
+
+_select_pattern = re.compile(
+    r'^select\s.*?\sfrom\s+`?(\w+)`?(?:\.`?(\w+)`?)?', re.IGNORECASE)
+
+_for_update_pattern = re.compile(
+    r'\s(for\s+update|lock\s+in\s+share\s+mode)$', re.IGNORECASE)
+
+# The (table, normalized sql) of the queries seen so far. Applications
+# only run a limited set of queries, the bound is only a safety net.
+_MAX_PARSED_QUERIES = 1000
+
+_queries = {}
+
+
+class ResultCache(object):
+  """An LRU cache of query results, with per-table TTLs.
+
+  Attributes:
+    max_bytes: the bound on the estimated size of the cached results.
+    default_ttl: the seconds a result is cached for, for the tables not
+      in table_ttls. 0 doesn't cache them.
+    table_ttls: dict of table name to the seconds its results are cached
+      for, 0 for the tables that are never cached.
+  """
+
+  def __init__(self, max_bytes=16 << 20, default_ttl=1.0, table_ttls=None):
+    self.max_bytes = max_bytes
+    self.default_ttl = default_ttl
+    self.table_ttls = table_ttls or {}
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+    self._bytes = 0
+    self._hits = 0
+    self._misses = 0
+    self._evictions = 0
+    self._expirations = 0
+
+  def key(self, sql, bind_variables, keyspace, tablet_type,
+          keyspace_ids=None, keyranges=None):
+    """Returns the cache key of a query, None if it is not cached.
+
+    Args are the same as query_key.
+
+    Returns:
+      The query_key of the query, or None for the queries that are not
+      cached, including the queries of the tables with a TTL of 0.
+    """
+    key = query_key(sql, bind_variables, keyspace, tablet_type,
+                    keyspace_ids, keyranges)
+    if key is None or not self.ttl(key[0]):
+      return None
+    return key
+
+  def ttl(self, table):
+    """Returns the seconds the results of a table are cached for."""
+    return self.table_ttls.get(table, self.default_ttl)
+
+  def get(self, key):
+    """Returns the cached result of a query_key, None if there is none."""
+    if not self.ttl(key[0]):
+      return None
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None:
+        self._misses += 1
+        return None
+      expiry, size, value = entry
+      if expiry <= time.time():
+        self._bytes -= size
+        self._expirations += 1
+        self._misses += 1
+        return None
+      # the most recently used entries are last
+      self._entries[key] = entry
+      self._hits += 1
+      return value
+
+  def put(self, key, value):
+    """Caches the result of a query_key, for the TTL of its table.
+
+    Args:
+      key: the query_key of the query.
+      value: the (results, rowcount, lastrowid, fields) of the query.
+    """
+    ttl = self.ttl(key[0])
+    if not ttl:
+      return
+    size = _result_size(value)
+    if size > self.max_bytes:
+      return
+    with self._lock:
+      old_entry = self._entries.pop(key, None)
+      if old_entry is not None:
+        self._bytes -= old_entry[1]
+      self._entries[key] = (time.time() + ttl, size, value)
+      self._bytes += size
+      while self._bytes > self.max_bytes:
+        _, (_, evicted_size, _) = self._entries.popitem(last=False)
+        self._bytes -= evicted_size
+        self._evictions += 1
+
+  def clear(self):
+    """Drops all the cached results."""
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self):
+    """Returns a dict of the cache counters.
+
+    hits, misses: the get calls that did and didn't find a result.
+    evictions: the results dropped to stay within max_bytes.
+    expirations: the results found expired, included in misses.
+    entries, bytes: the number of cached results, and their size.
+    """
+    with self._lock:
+      return {
+          'hits': self._hits,
+          'misses': self._misses,
+          'evictions': self._evictions,
+          'expirations': self._expirations,
+          'entries': len(self._entries),
+          'bytes': self._bytes,
+      }
+
+
+def query_key(sql, bind_variables, keyspace, tablet_type, keyspace_ids=None,
+              keyranges=None):
+  """Returns a key identifying a replica read, None for other queries.
+
+  Two queries with the same key return the same rows, unless the
+  data changed in between.
+
+  Args:
+    sql: the query.
+    bind_variables: dict of the bind variables of the query.
+    keyspace: the keyspace of the query.
+    tablet_type: the tablet type of the query. Master reads get no key.
+    keyspace_ids: the keyspace ids the query is routed to, if any.
+    keyranges: the keyranges the query is routed to, if any.
+
+  Returns:
+    A hashable tuple starting with the table of the query, or None.
+  """
+  if tablet_type.lower() == 'master':
+    return None
+  query = _queries.get(sql)
+  if query is None:
+    if len(_queries) >= _MAX_PARSED_QUERIES:
+      _queries.clear()
+    query = _queries[sql] = _parse(sql)
+  table, sql = query
+  if table is None:
+    return None
+  try:
+    bind_variables = tuple(sorted(
+        (name, _freeze(value))
+        for name, value in (bind_variables or {}).iteritems()))
+    keyspace_ids = _freeze(keyspace_ids)
+  except TypeError:
+    # a value we can't hash
+    return None
+  if keyranges is not None:
+    keyranges = tuple(
+        str(kr) if isinstance(kr, keyrange.KeyRange) else kr
+        for kr in keyranges)
+  return (table, sql, bind_variables, keyspace, tablet_type, keyspace_ids,
+          keyranges)
+
+
+def _parse(sql):
+  """Returns the (table, normalized sql) of a query.
+
+  The table is None for the queries that are never cached.
+  """
+  sql = _whitespace_pattern.sub(_collapse_whitespace, sql).strip()
+  match = _select_pattern.match(sql)
+  if match is None or _for_update_pattern.search(sql):
+    return None, sql
+  return match.group(2) or match.group(1), sql
+
+
+def _collapse_whitespace(match):
+  return match.group(1) or ' '
+
+
+def _freeze(value):
+  """Returns a hashable copy of a bind variable value.
+
+  Raises:
+    TypeError: for a value that can't be hashed.
+  """
+  if isinstance(value, (list, tuple)):
+    return tuple(_freeze(v) for v in value)
+  if isinstance(value, (set, frozenset)):
+    return frozenset(value)
+  # 1, 1.0 and True are equal, but not the same bind variable
+  hash(value)
+  return value.__class__, value
+
+
+def _result_size(value):
+  """Returns an estimate of the bytes used by a query result."""
+  results, _, _, fields = value
+  size = sys.getsizeof(results) + sys.getsizeof(fields)
+  for row in results:
+    size += sys.getsizeof(row)
+    for cell in row:
+      size += sys.getsizeof(cell)
+  return size
@@ -0,0 +1,165 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Converts the rows of query results to tuples of Python values.
+
+The column types of a result set are fixed, so instead of looking up
+and testing the conversion of every cell, a RowConverter compiles one
+function per list of column types (the way collections.namedtuple
+does), that converts a whole row in a single tuple expression. Columns
+without a conversion (strings, blobs...) are copied as they are, and
+a result set with no conversion at all is just turned into tuples.
+
+converter = row_converter.get([field['Type'] for field in res['Fields']])
+results = converter.convert_rows(res['Rows'])
+"""
+
+from itertools import izip
+
+from vtdb import field_types
+
+# Converters are compiled once per list of column types, and reused for
+# every result set with the same types. Applications only see a handful
+# of those, this is only a safety net.
+_MAX_CACHED_CONVERTERS = 1000
+
+_converters = {}
+
+
+class RowConverter(object):
+  """Converts the rows of result sets with the given column types.
+
+  Attributes:
+    types: list of the field_types of the columns.
+    conversions: list of the conversion function of each column,
+      None for the columns that are returned as they are.
+    passthrough: True if no column needs a conversion.
+    convert_row: function converting one row (a sequence of
+      values, None for NULL) to a tuple. Like cbson.decode_rows, a
+      row with fewer cells than columns is converted as far as it goes.
+  """
+
+  def __init__(self, types):
+    self.types = list(types)
+    self.conversions = [field_types.conversions.get(t) for t in self.types]
+    self.passthrough = not any(self.conversions)
+    if self.passthrough:
+      self.convert_row = tuple
+    else:
+      self.convert_row = _compile(self.conversions)
+
+  def convert_rows(self, rows):
+    """Returns the list of converted tuples of a list of rows."""
+    return map(self.convert_row, rows)
+
+  def convert_columns(self, rows):
+    """Returns the list of the converted values of each column of rows.
+
+    Like cbson.decode_rows(columns=True), every row must have a value
+    for every column.
+    """
+    columns = []
+    try:
+      for i, conversion in enumerate(self.conversions):
+        values = [row[i] for row in rows]
+        if conversion is not None:
+          values = [conversion(value) if value is not None else None
+                    for value in values]
+        columns.append(values)
+    except IndexError:
+      raise ValueError('row has %d values for %d columns' %
+                       (min(len(row) for row in rows), len(self.types)))
+    return columns
+
+
+class LazyRows(object):
+  """The rows of a result, converted when they are read.
+
+  For len, indexing, slicing and iteration, it behaves like the list
+  that RowConverter.convert_rows returns, but a row is only converted
+  the first time it is read.
+
+  convert_all, if given, returns the list of all the converted rows,
+  faster than converting them one by one (cbson.decode_rows on the
+  encoded rows). It is used when a slice reads most of the rows.
+  """
+
+  def __init__(self, rows, converter, convert_all=None):
+    self._rows = rows
+    self._converter = converter
+    self._convert_all = convert_all
+    self._converted = [None] * len(rows)
+
+  def __len__(self):
+    return len(self._rows)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      indices = xrange(*index.indices(len(self._rows)))
+      if self._convert_all is not None and len(indices) * 2 > len(self._rows):
+        self._converted = self._convert_all()
+        self._convert_all = None
+      return [self._get(i) for i in indices]
+    if index < 0:
+      index += len(self._rows)
+    if not 0 <= index < len(self._rows):
+      raise IndexError('list index out of range')
+    return self._get(index)
+
+  def __iter__(self):
+    for i in xrange(len(self._rows)):
+      yield self._get(i)
+
+  def _get(self, i):
+    row = self._converted[i]
+    if row is None:
+      row = self._converted[i] = self._converter.convert_row(self._rows[i])
+    return row
+
+
+def _compile(conversions):
+  """Returns a function converting a row with the given conversions."""
+  namespace = {'_conversions': conversions, '_convert_short': _convert_short}
+  cells = []
+  for i, conversion in enumerate(conversions):
+    if conversion is None:
+      cells.append('row[%d]' % i)
+    else:
+      namespace['_conv%d' % i] = conversion
+      cells.append('_conv%d(row[%d]) if row[%d] is not None else None' %
+                   (i, i, i))
+  source = ('def convert_row(row):\n'
+            '  try:\n'
+            '    return (%s,)\n'
+            '  except IndexError:\n'
+            '    return _convert_short(row, _conversions)\n' %
+            ', '.join(cells))
+  exec source in namespace
+  return namespace['convert_row']
+
+
+def _convert_short(row, conversions):
+  """Converts a row with fewer cells than columns, as far as it goes."""
+  return tuple(
+      conversion(cell) if conversion is not None and cell is not None
+      else cell
+      for conversion, cell in izip(conversions, row))
+
+
+def get(types):
+  """Returns the RowConverter for a list of column types.
+
+  Args:
+    types: list of the field_types of the columns.
+
+  Returns:
+    A RowConverter, shared by all the callers with the same types.
+  """
+  key = tuple(types)
+  converter = _converters.get(key)
+  if converter is None:
+    if len(_converters) >= _MAX_CACHED_CONVERTERS:
+      _converters.clear()
+    converter = _converters[key] = RowConverter(key)
+  return converter
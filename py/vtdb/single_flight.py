@@ -0,0 +1,117 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Shares one RPC between identical concurrent reads.
+
+When many threads read the same hot row at the same time, a
+SingleFlight shared by their connections lets the first thread send the
+query, and the others wait for its result instead of sending their
+own. VTGateConnection only shares the replica reads outside of a
+transaction, identified by their result_cache.query_key.
+
+flight = single_flight.SingleFlight()
+pool = vtgate_connection_pool.VTGateConnectionPool(
+    vtgate_addrs, timeout, single_flight=flight)
+
+The shared results must not be modified.
+
+The waiting threads don't poll: a timed threading.Event.wait sleeps in
+steps of up to 50ms in Python 2, which would cost more than the shared
+call saves. Their deadline is enforced by the timeout of the call
+instead: a thread only waits for a call that ends before its own
+deadline, and makes its own call otherwise.
+"""
+
+import sys
+import threading
+import time
+
+
+class _Call(object):
+  """A call in progress, and its outcome once done is set."""
+
+  def __init__(self, deadline):
+    # the time the call times out by, None if it has no timeout
+    self.deadline = deadline
+    self.done = threading.Event()
+    self.result = None
+    self.exc_info = None
+
+
+class SingleFlight(object):
+  """Runs one call at a time per key, across threads."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._calls = {}
+    self._rpcs = 0
+    self._shared = 0
+
+  def do(self, key, function, timeout=None):
+    """Returns function(), or the result of the same call in progress.
+
+    Args:
+      key: a hashable key of the call.
+      function: the call, without arguments.
+      timeout: the timeout of function(), in seconds, None if it has
+        none. The call in progress is only waited for if it times out
+        first.
+
+    Returns:
+      The result of function(), maybe called by another thread.
+
+    Raises:
+      The exception raised by function(), maybe in another thread.
+    """
+    deadline = None
+    if timeout is not None:
+      deadline = time.time() + timeout
+    with self._lock:
+      call = self._calls.get(key)
+      if call is None:
+        call = self._calls[key] = _Call(deadline)
+        self._rpcs += 1
+        leader = True
+      elif deadline is not None and (call.deadline is None or
+                                     call.deadline > deadline):
+        # the call in progress may outlast our own timeout
+        self._rpcs += 1
+        call = None
+        leader = False
+      else:
+        self._shared += 1
+        leader = False
+
+    if call is None:
+      return function()
+    if not leader:
+      call.done.wait()
+      if call.exc_info is not None:
+        raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+      return call.result
+
+    try:
+      call.result = function()
+    except:
+      call.exc_info = sys.exc_info()
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+    return call.result
+
+  def stats(self):
+    """Returns a dict of the counters.
+
+    rpcs: the calls that were made.
+    shared: the calls that were saved, waiting for one of those instead.
+    in_flight: the calls in progress.
+    """
+    with self._lock:
+      return {
+          'rpcs': self._rpcs,
+          'shared': self._shared,
+          'in_flight': len(self._calls),
+      }
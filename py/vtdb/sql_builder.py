@@ -4,7 +4,9 @@ Helper classes and fucntions for building queries.
 """
 
 import itertools
+import keyword
 import pprint
+import re
 import time
 
 # TODO(dumbunny): integration with SQL Alchemy ?
@@ -34,6 +36,97 @@ class DBRow(object):
     return pprint.pformat(self.__dict__, 4)
 
 
+class CompactDBRow(object):
+  """Base class of the row classes returned by row_class.
+
+  The values are kept in slots instead of a per-row dict. __dict__
+  returns a new dict of the columns, for vars(row) and the like.
+  """
+
+  __slots__ = ()
+
+  @property
+  def __dict__(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+  def __repr__(self):
+    return pprint.pformat(self.__dict__, 4)
+
+  def __reduce__(self):
+    return (_make_row,
+            (self.__slots__, tuple(getattr(self, n) for n in self.__slots__)))
+
+
+# Row classes are generated once per list of column names.
+_MAX_ROW_CLASSES = 1000
+
+_row_classes = {}
+
+_identifier_pattern = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def row_class(column_names):
+  """Returns the class of the rows of a query with the given columns.
+
+  Its instances are built from a row tuple, and have an attribute per
+  column, like DBRow(column_names, row_tuple). With column names that
+  are valid slot names, it is a CompactDBRow subclass with __slots__, a
+  few times smaller and faster to build than a DBRow. Otherwise, it is
+  a DBRow subclass. Classes are cached, so every query of a DB class
+  shares the same one.
+
+  Args:
+    column_names: List or tuple of str column names.
+
+  Returns:
+    A class, instantiated with a list or tuple of column values. It
+    raises ValueError if their number doesn't match the columns.
+  """
+  column_names = tuple(column_names)
+  cls = _row_classes.get(column_names)
+  if cls is None:
+    if len(_row_classes) >= _MAX_ROW_CLASSES:
+      _row_classes.clear()
+    cls = _row_classes[column_names] = _generate_row_class(column_names)
+  return cls
+
+
+def _generate_row_class(column_names):
+  """Returns a new row class for the column names."""
+  if (len(set(column_names)) != len(column_names) or
+      not all(_identifier_pattern.match(name) and
+              not name.startswith('__') and not keyword.iskeyword(name)
+              for name in column_names)):
+    class Row(DBRow):
+      def __init__(self, row_tuple):
+        DBRow.__init__(self, column_names, row_tuple)
+    return Row
+
+  # one unpacking assignment sets all the slots, and checks the length
+  if column_names:
+    assignment = '%s, = row_tuple' % ', '.join(
+        'self.%s' % name for name in column_names)
+  else:
+    assignment = '[] = row_tuple'
+  namespace = {}
+  source = ('def __init__(self, row_tuple):\n'
+            '  try:\n'
+            '    %s\n'
+            '  except ValueError:\n'
+            '    raise ValueError(\'column_names / row_tuple mismatch.\')\n' %
+            assignment)
+  exec source in namespace
+  return type('CompactDBRow', (CompactDBRow,), {
+      '__slots__': column_names,
+      '__init__': namespace['__init__'],
+  })
+
+
+def _make_row(column_names, row_tuple):
+  """Rebuilds a pickled CompactDBRow."""
+  return row_class(column_names)(row_tuple)
+
+
 def select_clause(
     select_columns, table_name, alias=None, order_by=None):
   """Build the select clause for a query.
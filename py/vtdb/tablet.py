@@ -2,7 +2,6 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
-from itertools import izip
 import logging
 import re
 
@@ -10,6 +9,7 @@ from net import bsonrpc
 from net import gorpc
 from vtdb import dbexceptions
 from vtdb import field_types
+from vtdb import row_converter
 from vtdb import vtdb_logger
 
 
@@ -67,16 +67,19 @@ class TabletConnection(object):
   transaction_id = 0
   session_id = 0
   _stream_fields = None
-  _stream_conversions = None
+  _stream_converter = None
   _stream_result = None
   _stream_result_index = None
 
-  def __init__(self, addr, tablet_type, keyspace, shard, timeout, user=None, password=None, keyfile=None, certfile=None):
+  # stream_prefetch is the number of streaming query packets read ahead
+  # of the application on a background thread, 0 disables prefetching.
+  def __init__(self, addr, tablet_type, keyspace, shard, timeout, user=None, password=None, keyfile=None, certfile=None, stream_prefetch=0):
     self.addr = addr
     self.tablet_type = tablet_type
     self.keyspace = keyspace
     self.shard = shard
     self.timeout = timeout
+    self.stream_prefetch = stream_prefetch
     self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password,
                                         keyfile=keyfile, certfile=certfile)
     self.logger_object = vtdb_logger.get_logger()
@@ -191,7 +194,6 @@ class TabletConnection(object):
     req['BindVariables'] = new_binds
 
     fields = []
-    conversions = []
     results = []
     try:
       response = self.rpc_call_and_extract_error('SqlQuery.Execute', req)
@@ -199,10 +201,9 @@ class TabletConnection(object):
 
       for field in reply['Fields']:
         fields.append((field['Name'], field['Type']))
-        conversions.append(field_types.conversions.get(field['Type']))
 
-      for row in reply['Rows']:
-        results.append(tuple(_make_row(row, conversions)))
+      converter = row_converter.get([t for _, t in fields])
+      results = converter.convert_rows(reply['Rows'])
 
       rowcount = reply['RowsAffected']
       lastrowid = reply['InsertId']
@@ -231,16 +232,14 @@ class TabletConnection(object):
       response = self.rpc_call_and_extract_error('SqlQuery.ExecuteBatch', req)
       for reply in response.reply['List']:
         fields = []
-        conversions = []
         results = []
         rowcount = 0
 
         for field in reply['Fields']:
           fields.append((field['Name'], field['Type']))
-          conversions.append(field_types.conversions.get(field['Type']))
 
-        for row in reply['Rows']:
-          results.append(tuple(_make_row(row, conversions)))
+        converter = row_converter.get([t for _, t in fields])
+        results = converter.convert_rows(reply['Rows'])
 
         rowcount = reply['RowsAffected']
         lastrowid = reply['InsertId']
@@ -253,8 +252,8 @@ class TabletConnection(object):
       raise
     return rowsets
 
-  # we return the fields for the response, and the column conversions
-  # the conversions will need to be passed back to _stream_next
+  # we return the fields for the response, and keep the row converter
+  # for _stream_next
   # (that way we avoid using a member variable here for such a corner case)
   def _stream_execute(self, sql, bind_variables):
     new_binds = field_types.convert_bind_vars(bind_variables)
@@ -263,11 +262,12 @@ class TabletConnection(object):
     req['BindVariables'] = new_binds
 
     self._stream_fields = []
-    self._stream_conversions = []
+    self._stream_converter = None
     self._stream_result = None
     self._stream_result_index = 0
     try:
-      self.client.stream_call('SqlQuery.StreamExecute', req)
+      self.client.stream_call('SqlQuery.StreamExecute', req,
+                              prefetch=self.stream_prefetch)
       first_response = self.client.stream_next()
       reply = first_response.reply
       if reply.get('Err'):
@@ -276,7 +276,8 @@ class TabletConnection(object):
 
       for field in reply['Fields']:
         self._stream_fields.append((field['Name'], field['Type']))
-        self._stream_conversions.append(field_types.conversions.get(field['Type']))
+      self._stream_converter = row_converter.get(
+          [t for _, t in self._stream_fields])
     except gorpc.GoRpcError as e:
       self.logger_object.log_private_data(bind_variables)
       raise convert_exception(e, str(self), sql)
@@ -285,8 +286,8 @@ class TabletConnection(object):
       raise
     return None, 0, 0, self._stream_fields
 
-  # we return the fields for the response, and the column conversions
-  # the conversions will need to be passed back to _stream_next
+  # we return the fields for the response, and keep the row converter
+  # for _stream_next
   # (that way we avoid using a member variable here for such a corner case)
   def _stream_execute2(self, sql, bind_variables):
     new_binds = field_types.convert_bind_vars(bind_variables)
@@ -296,11 +297,12 @@ class TabletConnection(object):
     req = {'Query': query}
 
     self._stream_fields = []
-    self._stream_conversions = []
+    self._stream_converter = None
     self._stream_result = None
     self._stream_result_index = 0
     try:
-      self.client.stream_call('SqlQuery.StreamExecute2', req)
+      self.client.stream_call('SqlQuery.StreamExecute2', req,
+                              prefetch=self.stream_prefetch)
       first_response = self.client.stream_next()
       reply = first_response.reply
       if reply.get('Err'):
@@ -309,7 +311,8 @@ class TabletConnection(object):
 
       for field in reply['Fields']:
         self._stream_fields.append((field['Name'], field['Type']))
-        self._stream_conversions.append(field_types.conversions.get(field['Type']))
+      self._stream_converter = row_converter.get(
+          [t for _, t in self._stream_fields])
     except gorpc.GoRpcError as e:
       self.logger_object.log_private_data(bind_variables)
       raise convert_exception(e, str(self), sql)
@@ -324,30 +327,70 @@ class TabletConnection(object):
       return None
 
     # See if we need to read more or whether we just pop the next row.
-    if self._stream_result is None :
+    if self._stream_result is None and not self._stream_read_packet():
+      return None
+
+    rows = self._stream_result.reply['Rows']
+    row = self._stream_converter.convert_row(rows[self._stream_result_index])
+    # If we are reading the last row, set us up to read more data.
+    self._stream_result_index += 1
+    if self._stream_result_index == len(rows):
+      self._stream_result = None
+      self._stream_result_index = 0
+
+    return row
+
+  def _stream_next_batch(self, size=None):
+    # Terminating condition
+    if self._stream_result_index is None:
+      return None
+
+    if self._stream_result is None and not self._stream_read_packet():
+      return None
+
+    rows = self._stream_result.reply['Rows']
+    start = self._stream_result_index
+    packet_size = len(rows)
+    end = packet_size if size is None else min(start + size, packet_size)
+    if start or end < packet_size:
+      rows = rows[start:end]
+    batch = self._stream_converter.convert_rows(rows)
+
+    # If we read the end of the packet, set us up to read more data.
+    if end == packet_size:
+      self._stream_result = None
+      self._stream_result_index = 0
+    else:
+      self._stream_result_index = end
+
+    return batch
+
+  def _stream_read_packet(self):
+    """Reads the next packet of the stream that holds rows.
+
+    Returns:
+      False at the end of the stream.
+    """
+    while True:
       try:
         self._stream_result = self.client.stream_next()
         if self._stream_result is None:
           self._stream_result_index = None
-          return None
+          return False
         if self._stream_result.reply.get('Err'):
+          err = self._stream_result.reply['Err']
+          self._stream_result = None
           self.__drain_conn_after_streaming_app_error()
-          raise gorpc.AppError(self._stream_result.reply['Err'].get('Message', 'Missing error message'))
+          raise gorpc.AppError(err.get('Message', 'Missing error message'))
+        if self._stream_result.reply['Rows']:
+          return True
+        self._stream_result = None
       except gorpc.GoRpcError as e:
         raise convert_exception(e, str(self))
       except:
         logging.exception('gorpc low-level error')
         raise
 
-    row = tuple(_make_row(self._stream_result.reply['Rows'][self._stream_result_index], self._stream_conversions))
-    # If we are reading the last row, set us up to read more data.
-    self._stream_result_index += 1
-    if self._stream_result_index == len(self._stream_result.reply['Rows']):
-      self._stream_result = None
-      self._stream_result_index = 0
-
-    return row
-
   def __drain_conn_after_streaming_app_error(self):
     """Drains the connection of all incoming streaming packets (ignoring them).
 
@@ -367,19 +410,6 @@ class TabletConnection(object):
       raise gorpc.GoRpcError("Connection should only have one packet remaining"
         " after streaming app error in RPC response.")
 
-def _make_row(row, conversions):
-  converted_row = []
-  for conversion_func, field_data in izip(conversions, row):
-    if field_data is None:
-      v = None
-    elif conversion_func:
-      v = conversion_func(field_data)
-    else:
-      v = field_data
-    converted_row.append(v)
-  return converted_row
-
-
 def connect(*pargs, **kargs):
   conn = TabletConnection(*pargs, **kargs)
   conn.dial()
@@ -181,6 +181,9 @@ class VtOCCConnection(object):
   def _stream_next(self):
     return self.conn._stream_next()
 
+  def _stream_next_batch(self, size=None):
+    return self.conn._stream_next_batch(size)
+
   # This function clears the cached value for the keyspace
   # and re-reads it from the toposerver once per 'n' secs.
   def resolve_topology(self):
@@ -172,7 +172,7 @@ class VTGateClient(object):
                keyspace_ids=None,
                keyranges=None,
                entity_keyspace_id_map=None, entity_column_name=None,
-               not_in_transaction=False):
+               not_in_transaction=False, columns=False, lazy_rows=False):
     """Executes the given sql.
 
     FIXME(alainjobart): should take the session in.
@@ -204,9 +204,14 @@ class VTGateClient(object):
         Requires keyspace, entity_keyspace_id_map.
       not_in_transaction: force this execute to be outside the current
         transaction, if any.
+      columns: return the results as columns, built straight from the
+        reply instead of from the rows.
+      lazy_rows: return the rows as a sequence that only converts the
+        values of a row the first time it is read.
 
     Returns:
-      results: list of rows.
+      results: list of rows, or with columns, list of the values of each
+        column.
       rowcount: how many rows were affected.
       lastrowid: auto-increment value for the last row inserted.
       fields: describes the field names and types.
@@ -335,6 +340,39 @@ class VTGateClient(object):
     """
     pass
 
+  def _stream_next_batch(self, size=None):
+    """Returns the next rows of a streaming query.
+
+    The rows are the rest of the current packet of the stream, or the
+    next packet, converted at once.
+
+    Args:
+      size: the maximum number of rows to return, None for the rest of
+        the packet.
+
+    Returns:
+      rows: a list of rows, never empty, or None if done.
+
+    Raises:
+      Same as _stream_next.
+    """
+    pass
+
+  def _stream_next_columns(self, size):
+    """Returns the next results of a streaming query, as columns.
+
+    Args:
+      size: the maximum number of rows to return.
+
+    Returns:
+      columns: the list of the values of each column of the next rows,
+        up to size of them, or None if done.
+
+    Raises:
+      Same as _stream_next.
+    """
+    pass
+
   def get_srv_keyspace(self, keyspace):
     """Returns a SrvKeyspace object.
 
@@ -0,0 +1,268 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Thread-safe pool of vtgatev2 connections.
+
+A single VTGateConnection can only serve one request at a time, so
+multi-threaded processes either serialize on it or dial one per request.
+VTGateConnectionPool keeps a bounded set of dialed connections that
+threads borrow and return:
+
+pool = vtgate_connection_pool.VTGateConnectionPool(vtgate_addrs, timeout,
+                                                   max_size=16)
+with pool.connection() as conn:
+  cursor = conn.cursor(keyspace, tablet_type, keyspace_ids=[kid])
+  cursor.execute(sql, bind_vars)
+
+A connection returned while its Session is open (a transaction is in
+progress) stays pinned to the returning thread: it is not handed out to
+anybody else, and the next get() from the same thread returns it. A
+thread can have several connections pinned, get() returns the last one
+first.
+"""
+
+import collections
+import contextlib
+import logging
+import threading
+import time
+
+from vtdb import dbexceptions
+from vtdb import vtgatev2
+
+
+class VTGateConnectionPool(object):
+  """Pool of vtgatev2.VTGateConnection, spread across all vtgate_addrs.
+
+  Attributes:
+    min_size: idle eviction never shrinks the pool below this size.
+    max_size: maximum number of live connections, idle or borrowed.
+    idle_timeout: idle connections older than this (in seconds) are closed.
+    wait_timeout: how long get() waits for a connection when the pool is
+      exhausted, None waits forever.
+    result_cache: the result_cache.ResultCache of the connections, if any.
+    single_flight: the single_flight.SingleFlight of the connections, if
+      any.
+  """
+
+  def __init__(self, vtgate_addrs, timeout, min_size=0, max_size=8,
+               idle_timeout=300.0, wait_timeout=None, user=None,
+               password=None, result_cache=None, single_flight=None):
+    if min_size > max_size:
+      raise ValueError('min_size %d is greater than max_size %d' %
+                       (min_size, max_size))
+    self.db_params_list = vtgatev2.get_params_for_vtgate_conn(
+        vtgate_addrs, timeout, user=user, password=password)
+    if not self.db_params_list:
+      raise dbexceptions.OperationalError(
+          'empty db params list - no db instance available for vtgate_addrs %s'
+          % vtgate_addrs)
+    self.min_size = min_size
+    self.max_size = max_size
+    self.idle_timeout = idle_timeout
+    self.wait_timeout = wait_timeout
+    self.result_cache = result_cache
+    self.single_flight = single_flight
+
+    self._cond = threading.Condition()
+    self._local = threading.local()
+    # idle connections as (conn, time returned), most recent last
+    self._idle = []
+    # live connections, idle or borrowed, total and per vtgate address
+    self._size = 0
+    self._addr_size = collections.defaultdict(int)
+    self._in_use = 0
+    self._closed = False
+
+    # stats
+    self._wait_count = 0
+    self._wait_time = 0.0
+    self._dial_count = 0
+    self._evict_count = 0
+
+  def open(self):
+    """Dials min_size connections up front."""
+    conns = [self.get() for _ in xrange(self.min_size)]
+    for conn in conns:
+      self.put(conn)
+
+  def close(self):
+    """Closes all idle connections. Borrowed ones are closed when returned."""
+    with self._cond:
+      self._closed = True
+      discarded = [self._remove_locked(conn) for conn, _ in self._idle]
+      del self._idle[:]
+      self._cond.notify_all()
+    self._close_connections(discarded)
+
+  def get(self):
+    """Borrows a connection, dialing a new one if needed.
+
+    Returns:
+      A dialed VTGateConnection, to be given back with put().
+
+    Raises:
+      dbexceptions.OperationalError: if the pool is exhausted for more than
+        wait_timeout, or if no vtgate could be dialed.
+    """
+    pinned = getattr(self._local, 'pinned', None)
+    if pinned:
+      return pinned.pop()
+
+    start = time.time()
+    waited = False
+    # the connections dropped from the pool, closed outside the lock:
+    # closing may roll back a transaction over the network
+    discarded = []
+    try:
+      with self._cond:
+        try:
+          while True:
+            if self._closed:
+              raise dbexceptions.OperationalError(
+                  'vtgate connection pool closed')
+            discarded.extend(self._evict_idle_locked())
+            while self._idle:
+              conn, _ = self._idle.pop()
+              if conn.is_closed():
+                discarded.append(self._remove_locked(conn))
+                continue
+              self._in_use += 1
+              return conn
+            if self._size < self.max_size:
+              # reserve the slot, and dial outside the lock
+              self._size += 1
+              self._in_use += 1
+              break
+            if self.wait_timeout is None:
+              time_left = None
+            else:
+              time_left = start + self.wait_timeout - time.time()
+              if time_left <= 0:
+                raise dbexceptions.OperationalError(
+                    'vtgate connection pool exhausted', self.max_size)
+            waited = True
+            self._cond.wait(time_left)
+        finally:
+          if waited:
+            self._wait_count += 1
+            self._wait_time += time.time() - start
+    finally:
+      self._close_connections(discarded)
+
+    try:
+      return self._dial()
+    except:
+      with self._cond:
+        self._size -= 1
+        self._in_use -= 1
+        self._cond.notify()
+      raise
+
+  def put(self, conn):
+    """Returns a borrowed connection to the pool.
+
+    If conn is in a transaction, it stays pinned to the calling thread
+    until it is returned again with no open Session.
+    """
+    if conn.session:
+      if not hasattr(self._local, 'pinned'):
+        self._local.pinned = []
+      self._local.pinned.append(conn)
+      return
+    with self._cond:
+      self._in_use -= 1
+      if self._closed or conn.is_closed():
+        self._remove_locked(conn)
+        discarded = True
+      else:
+        self._idle.append((conn, time.time()))
+        discarded = False
+      self._cond.notify()
+    if discarded:
+      self._close_connections([conn])
+
+  @contextlib.contextmanager
+  def connection(self):
+    """Context manager borrowing a connection for the with block."""
+    conn = self.get()
+    try:
+      yield conn
+    finally:
+      self.put(conn)
+
+  def stats(self):
+    """Returns a dict of pool stats, to size the pool.
+
+    wait_count and wait_time (in seconds) are the number of get() calls that
+    had to wait for a connection, and the total time they waited.
+    """
+    with self._cond:
+      return {
+          'size': self._size,
+          'in_use': self._in_use,
+          'idle': len(self._idle),
+          'max_size': self.max_size,
+          'utilization': float(self._in_use) / self.max_size,
+          'wait_count': self._wait_count,
+          'wait_time': self._wait_time,
+          'dial_count': self._dial_count,
+          'evict_count': self._evict_count,
+      }
+
+  def _dial(self):
+    # try the least used vtgate first, so connections spread evenly.
+    # The address is accounted for before dialing, so concurrent dials
+    # pick different vtgates.
+    with self._cond:
+      params_list = sorted(self.db_params_list,
+                           key=lambda p: self._addr_size[p['addr']])
+    db_exception = None
+    host_addr = None
+    for params in params_list:
+      host_addr = params['addr']
+      with self._cond:
+        self._addr_size[host_addr] += 1
+      try:
+        conn = vtgatev2.VTGateConnection(result_cache=self.result_cache,
+                                         single_flight=self.single_flight,
+                                         **params)
+        conn.dial()
+      except Exception as e:
+        with self._cond:
+          self._addr_size[host_addr] -= 1
+        db_exception = e
+        logging.warning('db connection failed: %s, %s', host_addr, e)
+        continue
+      with self._cond:
+        self._dial_count += 1
+      return conn
+    raise dbexceptions.OperationalError(
+        'unable to create vt connection', host_addr, db_exception)
+
+  def _remove_locked(self, conn):
+    # frees the slot of conn, which the caller closes after releasing
+    # the lock
+    self._size -= 1
+    self._addr_size[conn.addr] -= 1
+    return conn
+
+  def _close_connections(self, conns):
+    for conn in conns:
+      try:
+        conn.close()
+      except Exception as e:
+        logging.warning('error closing vtgate connection %s: %s', conn, e)
+
+  def _evict_idle_locked(self):
+    # _idle is sorted by return time, the oldest connections are first.
+    # Returns the evicted connections, to be closed outside the lock.
+    expiry = time.time() - self.idle_timeout
+    evicted = []
+    while (self._idle and self._size > self.min_size and
+           self._idle[0][1] < expiry):
+      conn, _ = self._idle.pop(0)
+      evicted.append(self._remove_locked(conn))
+      self._evict_count += 1
+    return evicted
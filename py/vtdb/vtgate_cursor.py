@@ -2,9 +2,12 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
+import heapq
 import itertools
+import operator
 import re
 
+from vtdb import columnar
 from vtdb import cursor
 from vtdb import dbexceptions
 from vtdb import keyrange_constants
@@ -27,20 +30,30 @@ class VTGateCursor(object):
   keyranges = None
   _writable = None
   routing = None
-
-  def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None, keyranges=None, writable=False):
+  # With columnar, execute gets the results as columns (see
+  # fetch_columns), rows are only built if they are fetched.
+  columnar = False
+  _columns = None
+  # With lazy_rows, the values of a row are converted when it is fetched,
+  # instead of all the rows in execute.
+  lazy_rows = False
+
+  def __init__(self, connection, keyspace, tablet_type, keyspace_ids=None, keyranges=None, writable=False, columnar=False, lazy_rows=False):
     self._conn = connection
     self.keyspace = keyspace
     self.tablet_type = tablet_type
     self.keyspace_ids = keyspace_ids
     self.keyranges = keyranges
     self._writable = writable
+    self.columnar = columnar
+    self.lazy_rows = lazy_rows
 
   def connection_list(self):
     return [self._conn]
 
   def close(self):
     self.results = None
+    self._columns = None
 
   def is_writable(self):
     return self._writable
@@ -59,6 +72,7 @@ class VTGateCursor(object):
   def execute(self, sql, bind_variables, **kargs):
     self.rowcount = 0
     self.results = None
+    self._columns = None
     self.description = None
     self.lastrowid = None
 
@@ -79,20 +93,27 @@ class VTGateCursor(object):
       if not self.is_writable():
         raise dbexceptions.DatabaseError('DML on a non-writable cursor', sql)
 
-    self.results, self.rowcount, self.lastrowid, self.description = self._conn._execute(
+    results, self.rowcount, self.lastrowid, self.description = self._conn._execute(
         sql,
         bind_variables,
         self.keyspace,
         self.tablet_type,
         keyspace_ids=self.keyspace_ids,
         keyranges=self.keyranges,
-        not_in_transaction=(not self.is_writable()))
+        not_in_transaction=(not self.is_writable()),
+        columns=self.columnar,
+        lazy_rows=self.lazy_rows)
+    if self.columnar:
+      self._columns = results
+    else:
+      self.results = results
     self.index = 0
     return self.rowcount
 
   def execute_entity_ids(self, sql, bind_variables, entity_keyspace_id_map, entity_column_name):
     self.rowcount = 0
     self.results = None
+    self._columns = None
     self.description = None
     self.lastrowid = None
 
@@ -113,18 +134,24 @@ class VTGateCursor(object):
     return self.rowcount
 
 
-  def fetchone(self):
+  def _check_results(self):
+    if self._columns is not None:
+      # a columnar cursor only builds the rows when they are fetched
+      self.results = zip(*self._columns)
+      self._columns = None
     if self.results is None:
       raise dbexceptions.ProgrammingError('fetch called before execute')
 
+  def fetchone(self):
+    self._check_results()
+
     if self.index >= len(self.results):
       return None
     self.index += 1
     return self.results[self.index-1]
 
   def fetchmany(self, size=None):
-    if self.results is None:
-      raise dbexceptions.ProgrammingError('fetch called before execute')
+    self._check_results()
 
     if self.index >= len(self.results):
       return []
@@ -135,31 +162,55 @@ class VTGateCursor(object):
     return res
 
   def fetchall(self):
-    if self.results is None:
-      raise dbexceptions.ProgrammingError('fetch called before execute')
+    self._check_results()
     return self.fetchmany(len(self.results)-self.index)
 
+  def fetch_columns(self, use_numpy=False):
+    """Returns the rows not fetched yet as columns.
+
+    A columnar cursor builds them straight from the decoded reply, without
+    ever making rows. Other cursors transpose the rows.
+
+    Args:
+      use_numpy: pack the numeric columns in numpy arrays instead of
+        array.array (see columnar.make_columns).
+
+    Returns:
+      A list of columnar.Column, one per column of description.
+    """
+    if self._columns is not None:
+      values = self._columns
+      self._columns = None
+      self.results = []
+      self.index = len(values[0]) if values else 0
+    else:
+      rows = self.fetchall()
+      if rows:
+        values = map(list, zip(*rows))
+      else:
+        values = [[] for _ in self.description or ()]
+    return columnar.make_columns(self.description, values, use_numpy)
+
   def fetch_aggregate_function(self, func):
     return func(row[0] for row in self.fetchall())
 
   def fetch_aggregate(self, order_by_columns, limit):
-    sort_columns = []
-    desc_columns = []
-    for order_clause in order_by_columns:
-      if type(order_clause) in (tuple, list):
-        sort_columns.append(order_clause[0])
-        if ascii_lower(order_clause[1]) == 'desc':
-          desc_columns.append(order_clause[0])
-      else:
-        sort_columns.append(order_clause)
-    # sort the rows and then trim off the prepended sort columns
+    """Returns the first rows of a scatter query, in order.
 
-    if sort_columns:
-      sorted_rows = list(sort_row_list_by_columns(self.fetchall(), sort_columns, desc_columns))[:limit]
-    else:
-      sorted_rows = itertools.islice(self.fetchall(), limit)
-    neutered_rows = [row[len(order_by_columns):] for row in sorted_rows]
-    return neutered_rows
+    select_by_columns_query(client_aggregate=True) prepends the order by
+    columns to the selected ones. The rows are sorted on them, and they
+    are stripped from the returned rows.
+
+    Args:
+      order_by_columns: the order_by of the query. A str or a list of
+        columns, where a column is a str or a (str, 'ASC' or 'DESC')
+        pair, like sql_builder.build_order_clause.
+      limit: the number of rows to return, None for all of them.
+
+    Returns:
+      The list of the first limit rows, without the order by columns.
+    """
+    return top_rows(self.fetchall(), order_by_columns, limit)
 
   def callproc(self):
     raise dbexceptions.NotSupportedError
@@ -198,6 +249,7 @@ class BatchVTGateCursor(VTGateCursor):
   to only execute against one keyspace_id.
   This only supports keyspace_ids right now since that is what
   the underlying vtgate server supports.
+  batch_executor.BatchExecutor batches the reads of concurrent callers.
   """
   def __init__(self, connection, tablet_type, writable=False):
     # rowset is [(results, rowcount, lastrowid, fields),]
@@ -263,33 +315,99 @@ class StreamVTGateCursor(VTGateCursor):
     self.index += 1
     return self._conn._stream_next()
 
+  def fetch_column_batches(self, size, use_numpy=False):
+    """Returns an iterator over the rows of the stream, as columns.
+
+    Each batch is built straight from the decoded packets, without
+    making rows.
+
+    Args:
+      size: the number of rows per batch. The last one may be smaller.
+      use_numpy: pack the numeric columns in numpy arrays instead of
+        array.array (see columnar.make_columns).
+
+    Returns:
+      An iterator of lists of columnar.Column, one per column of
+      description.
+    """
+    if self.description is None:
+      raise dbexceptions.ProgrammingError('fetch called before execute')
+    return self._column_batches(size, use_numpy)
+
+  def _column_batches(self, size, use_numpy):
+    while True:
+      values = self._conn._stream_next_columns(size)
+      if values is None:
+        return
+      self.index += len(values[0]) if values else 0
+      yield columnar.make_columns(self.description, values, use_numpy)
+
   # fetchmany can be called until it returns no rows. Returning less rows
   # than what we asked for is also an indication we ran out, but the cursor
   # API in PEP249 is silent about that.
   def fetchmany(self, size=None):
+    if self.description is None:
+      raise dbexceptions.ProgrammingError('fetch called before execute')
     if size is None:
       size = self.arraysize
     result = []
     if self.fetchmany_done:
       self.fetchmany_done = False
       return result
-    for i in xrange(size):
-      row = self.fetchone()
-      if row is None:
+    while len(result) < size:
+      rows = self._conn._stream_next_batch(size - len(result))
+      if rows is None:
         self.fetchmany_done = True
         break
-      result.append(row)
+      if result:
+        result.extend(rows)
+      else:
+        result = rows
+    self.index += len(result)
     return result
 
   def fetchall(self):
     result = []
-    while True:
-      row = self.fetchone()
-      if row is None:
-        break
-      result.append(row)
+    for rows in self.fetch_batches():
+      result.extend(rows)
     return result
 
+  def fetch_aggregate(self, order_by_columns, limit):
+    """Returns the first rows of a scatter query, in order.
+
+    Same as VTGateCursor.fetch_aggregate, but the stream is read a packet
+    at a time, and only the first limit rows are kept.
+    """
+    batches = self.fetch_batches()
+    rows = top_rows(itertools.chain.from_iterable(batches), order_by_columns,
+                    limit)
+    # read the rest of the stream, if the rows were not sorted
+    for _ in batches:
+      pass
+    return rows
+
+  def fetch_batches(self):
+    """Returns an iterator over the rows of the stream, a packet at a time.
+
+    Each batch is the list of the rows of a packet of the stream, all
+    converted at once (the rest of the packet, after fetchone or
+    fetchmany). It is the fastest way to read a large stream.
+
+    Returns:
+      An iterator of non-empty lists of rows.
+    """
+    if self.description is None:
+      raise dbexceptions.ProgrammingError('fetch called before execute')
+    return self._batches()
+
+  def _batches(self):
+    while True:
+      rows = self._conn._stream_next_batch()
+      if rows is None:
+        return
+      self.index += len(rows)
+      yield rows
+
   def callproc(self):
     raise dbexceptions.NotSupportedError
 
@@ -319,13 +437,77 @@ class StreamVTGateCursor(VTGateCursor):
     return val
 
 
-# assumes the leading columns are used for sorting
-def sort_row_list_by_columns(row_list, sort_columns=(), desc_columns=()):
-  for column_index, column_name in reversed([x for x in enumerate(sort_columns)]):
-    og = operator.itemgetter(column_index)
-    if type(row_list) != list:
-      row_list = sorted(
-          row_list, key=og, reverse=bool(column_name in desc_columns))
+def top_rows(rows, order_by_columns, limit):
+  """Returns the first rows, sorted on their leading order by columns.
+
+  Only the first limit rows are kept while rows is read, in a heap, so
+  rows can be an iterator over a stream.
+
+  Args:
+    rows: the rows, with the order by columns first.
+    order_by_columns: see VTGateCursor.fetch_aggregate.
+    limit: the number of rows to return, None for all of them.
+
+  Returns:
+    The list of the first rows, without the order by columns.
+  """
+  if not isinstance(order_by_columns, (tuple, list)):
+    order_by_columns = [order_by_columns]
+  descending = []
+  for order_clause in order_by_columns:
+    if not isinstance(order_clause, (tuple, list)):
+      order_clause = [order_clause]
+    words = ' '.join(order_clause).split()
+    descending.append(len(words) > 1 and words[1].lower() == 'desc')
+  if not descending:
+    top = itertools.islice(rows, limit)
+  elif all(descending):
+    key = operator.itemgetter(*range(len(descending)))
+    if limit is None:
+      top = sorted(rows, key=key, reverse=True)
     else:
-      row_list.sort(key=og, reverse=bool(column_name in desc_columns))
-  return row_list
+      top = heapq.nlargest(limit, rows, key=key)
+  else:
+    key = row_sort_key(range(len(descending)), descending)
+    if limit is None:
+      top = sorted(rows, key=key)
+    else:
+      top = heapq.nsmallest(limit, rows, key=key)
+  return [row[len(descending):] for row in top]
+
+
+def row_sort_key(indexes, descending):
+  """Returns the function returning the sort key of a row.
+
+  Args:
+    indexes: the indexes of the sort columns in the rows.
+    descending: a bool per sort column, True to sort it in descending
+      order.
+
+  Returns:
+    A function of a row, returning a key that sorts in ascending order.
+  """
+  if not any(descending):
+    return operator.itemgetter(*indexes)
+  if all(descending):
+    get_values = operator.itemgetter(*indexes)
+    return lambda row: _Descending(get_values(row))
+  def sort_key(row):
+    return tuple(_Descending(row[i]) if desc else row[i]
+                 for i, desc in zip(indexes, descending))
+  return sort_key
+
+
+class _Descending(object):
+  """Reverses the order of a value, for the descending sort columns."""
+
+  __slots__ = ('value',)
+
+  def __init__(self, value):
+    self.value = value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+  def __eq__(self, other):
+    return self.value == other.value
@@ -0,0 +1,174 @@
+# Copyright 2015, Google Inc. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can
+# be found in the LICENSE file.
+
+"""Staggered parallel dial across vtgate addresses ("happy eyeballs").
+
+Dialing vtgates one at a time stalls for the whole connect timeout on
+every black-holed address. dial_first starts dialing the first address,
+and moves on to the next one after a short stagger delay, or right away
+if the attempt fails, without giving up on the attempts in flight. The
+first connection to complete its dial wins, the others are closed when
+they complete.
+
+Failed addresses are remembered in a FailedAddresses tracker with a
+penalty that decays over time, and the next dials try them last:
+
+conn = vtgate_dialer.dial_first(db_params_list, dial)
+"""
+
+import logging
+import threading
+import time
+
+from vtdb import dbexceptions
+
+# delay before dialing the next address while an attempt is in flight
+DEFAULT_STAGGER = 0.25
+# time for the penalty of a failed address to halve
+DEFAULT_PENALTY_HALF_LIFE = 30.0
+
+
+class FailedAddresses(object):
+  """Thread-safe record of recently failed addresses.
+
+  Every failure adds 1 to the penalty of the address, and the penalty
+  halves every half_life seconds. A successful dial clears it.
+  """
+
+  def __init__(self, half_life=DEFAULT_PENALTY_HALF_LIFE):
+    self.half_life = half_life
+    self._lock = threading.Lock()
+    # addr -> (penalty, time it was computed)
+    self._penalties = {}
+
+  def penalty(self, addr, now=None):
+    """Returns the current, decayed penalty of addr."""
+    with self._lock:
+      return self._penalty_locked(addr, now or time.time())
+
+  def record_failure(self, addr):
+    now = time.time()
+    with self._lock:
+      self._penalties[addr] = (self._penalty_locked(addr, now) + 1.0, now)
+
+  def record_success(self, addr):
+    with self._lock:
+      self._penalties.pop(addr, None)
+
+  def order(self, db_params_list):
+    """Returns db_params_list sorted by increasing penalty.
+
+    The sort is stable, so addresses without a penalty keep their order
+    (vtgatev2.get_params_for_vtgate_conn shuffles them).
+    """
+    now = time.time()
+    with self._lock:
+      return sorted(db_params_list,
+                    key=lambda p: self._penalty_locked(p['addr'], now))
+
+  def _penalty_locked(self, addr, now):
+    entry = self._penalties.get(addr)
+    if entry is None:
+      return 0.0
+    penalty, when = entry
+    penalty *= 0.5 ** (max(now - when, 0.0) / self.half_life)
+    if penalty < 0.01:
+      del self._penalties[addr]
+      return 0.0
+    return penalty
+
+
+# shared by all the dials of the process
+failed_addresses = FailedAddresses()
+
+
+class _Dial(object):
+  """State shared between dial_first and its dialing threads."""
+
+  def __init__(self):
+    self.cond = threading.Condition()
+    self.conn = None
+    self.in_flight = 0
+    self.host_addr = None
+    self.exception = None
+
+
+def _close(conn):
+  try:
+    conn.close()
+  except Exception as e:
+    logging.warning('error closing vtgate connection %s: %s', conn, e)
+
+
+def _dial_one(state, dial, params, tracker):
+  addr = params['addr']
+  try:
+    conn = dial(params)
+  except Exception as e:
+    tracker.record_failure(addr)
+    logging.warning('db connection failed: %s, %s', addr, e)
+    with state.cond:
+      state.in_flight -= 1
+      state.host_addr = addr
+      state.exception = e
+      state.cond.notify()
+    return
+  tracker.record_success(addr)
+  with state.cond:
+    state.in_flight -= 1
+    if state.conn is None:
+      state.conn = conn
+      state.cond.notify()
+      return
+  # another address won the race
+  _close(conn)
+
+
+def dial_first(db_params_list, dial, stagger=DEFAULT_STAGGER, tracker=None):
+  """Dials the addresses of db_params_list, and returns the first connection.
+
+  Args:
+    db_params_list: list of connection params dicts, with an 'addr' key,
+      as returned by vtgatev2.get_params_for_vtgate_conn.
+    dial: function taking one params dict, and returning a dialed
+      connection, or raising an exception.
+    stagger: delay in seconds before starting to dial the next address,
+      while the previous attempts are still in flight.
+    tracker: FailedAddresses used to order the addresses and to record
+      the failures, defaults to the process-wide failed_addresses.
+
+  Returns:
+    The first connection returned by dial.
+
+  Raises:
+    dbexceptions.OperationalError: if dialing all the addresses failed.
+  """
+  if tracker is None:
+    tracker = failed_addresses
+  pending = tracker.order(db_params_list)
+  pending.reverse()
+  state = _Dial()
+  next_start = time.time()
+  with state.cond:
+    while True:
+      if state.conn is not None:
+        return state.conn
+      if not pending and not state.in_flight:
+        raise dbexceptions.OperationalError(
+            'unable to create vt connection', state.host_addr,
+            state.exception)
+      now = time.time()
+      if pending and (not state.in_flight or now >= next_start):
+        params = pending.pop()
+        state.in_flight += 1
+        thread = threading.Thread(target=_dial_one,
+                                  args=(state, dial, params, tracker))
+        thread.daemon = True
+        thread.start()
+        next_start = now + stagger
+        continue
+      if pending:
+        state.cond.wait(next_start - now)
+      else:
+        state.cond.wait()
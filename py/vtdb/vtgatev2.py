@@ -2,7 +2,6 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
-from itertools import izip
 import logging
 import random
 import re
@@ -14,9 +13,13 @@ from vtdb import dbexceptions
 from vtdb import field_types
 from vtdb import keyrange
 from vtdb import keyspace
+from vtdb import result_cache as result_cache_module
+from vtdb import row_converter
+from vtdb import times
 from vtdb import vtdb_logger
 from vtdb import vtgate_client
 from vtdb import vtgate_cursor
+from vtdb import vtgate_dialer
 from vtdb import vtgate_utils
 
 _errno_pattern = re.compile('\(errno (\d+)\)')
@@ -110,15 +113,30 @@ def _create_req_with_keyranges(sql, new_binds, keyspace, tablet_type, keyranges,
 class VTGateConnection(vtgate_client.VTGateClient):
   session = None
   _stream_fields = None
-  _stream_conversions = None
+  _stream_converter = None
   _stream_result = None
+  _stream_rows = None
+  _stream_columns = None
   _stream_result_index = None
 
+  # stream_prefetch is the number of streaming query packets read ahead
+  # of the application on a background thread, 0 disables prefetching.
+  # result_cache is an optional result_cache.ResultCache, and
+  # single_flight an optional single_flight.SingleFlight, for the replica
+  # reads of _execute. Both can be shared by several connections.
+  # With multiplexed, the calls of several threads share the socket (see
+  # gorpc.GoRpcClient), so threads can share the connection for queries
+  # outside of a transaction. Streaming queries and transactions still
+  # need a connection of their own.
   def __init__(self, addr, timeout, user=None, password=None,
-               keyfile=None, certfile=None):
+               keyfile=None, certfile=None, stream_prefetch=0,
+               result_cache=None, single_flight=None, multiplexed=False):
     self.addr = addr
     self.timeout = timeout
-    self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password, keyfile=keyfile, certfile=certfile)
+    self.stream_prefetch = stream_prefetch
+    self.result_cache = result_cache
+    self.single_flight = single_flight
+    self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password, keyfile=keyfile, certfile=certfile, multiplexed=multiplexed, raw_rows=True)
     self.logger_object = vtdb_logger.get_logger()
 
   def __str__(self):
@@ -184,7 +202,35 @@ class VTGateConnection(vtgate_client.VTGateClient):
       self.session = response.reply['Session']
 
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
-  def _execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False):
+  def _execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False, columns=False, lazy_rows=False):
+    # only the rows of replica reads outside of a transaction are cached,
+    # or shared with the same reads of other threads
+    query_key = None
+    if ((self.result_cache is not None or self.single_flight is not None) and
+        not self.session and not columns and not lazy_rows):
+      query_key = result_cache_module.query_key(
+          sql, bind_variables, keyspace, tablet_type, keyspace_ids, keyranges)
+    if query_key is None:
+      return self._execute_call(sql, bind_variables, keyspace, tablet_type,
+                                keyspace_ids, keyranges, not_in_transaction,
+                                columns, lazy_rows)
+
+    if self.result_cache is not None:
+      result = self.result_cache.get(query_key)
+      if result is not None:
+        return result
+    execute_call = lambda: self._execute_call(
+        sql, bind_variables, keyspace, tablet_type, keyspace_ids, keyranges,
+        not_in_transaction)
+    if self.single_flight is not None:
+      result = self.single_flight.do(query_key, execute_call, self.timeout)
+    else:
+      result = execute_call()
+    if self.result_cache is not None:
+      self.result_cache.put(query_key, result)
+    return result
+
+  def _execute_call(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids, keyranges, not_in_transaction, columns=False, lazy_rows=False):
     exec_method = None
     req = None
     if keyspace_ids is not None:
@@ -199,7 +245,6 @@ class VTGateConnection(vtgate_client.VTGateClient):
     self._add_session(req)
 
     fields = []
-    conversions = []
     results = []
     rowcount = 0
     lastrowid = 0
@@ -214,10 +259,13 @@ class VTGateConnection(vtgate_client.VTGateClient):
         res = reply['Result']
         for field in res['Fields']:
           fields.append((field['Name'], field['Type']))
-          conversions.append(field_types.conversions.get(field['Type']))
 
-        for row in res['Rows']:
-          results.append(tuple(_make_row(row, conversions)))
+        if columns:
+          results = _make_columns(res['Rows'], fields)
+        elif lazy_rows:
+          results = _make_lazy_rows(res['Rows'], fields)
+        else:
+          results = _make_rows(res['Rows'], fields)
 
         rowcount = res['RowsAffected']
         lastrowid = res['InsertId']
@@ -249,7 +297,6 @@ class VTGateConnection(vtgate_client.VTGateClient):
     self._add_session(req)
 
     fields = []
-    conversions = []
     results = []
     try:
       response = self.client.call('VTGate.ExecuteEntityIds', req)
@@ -262,10 +309,8 @@ class VTGateConnection(vtgate_client.VTGateClient):
         res = reply['Result']
         for field in res['Fields']:
           fields.append((field['Name'], field['Type']))
-          conversions.append(field_types.conversions.get(field['Type']))
 
-        for row in res['Rows']:
-          results.append(tuple(_make_row(row, conversions)))
+        results = _make_rows(res['Rows'], fields)
 
         rowcount = res['RowsAffected']
         lastrowid = res['InsertId']
@@ -306,16 +351,13 @@ class VTGateConnection(vtgate_client.VTGateClient):
         raise gorpc.AppError(response.reply['Error'], 'VTGate.ExecuteBatchKeyspaceIds')
       for reply in response.reply['List']:
         fields = []
-        conversions = []
         results = []
         rowcount = 0
 
         for field in reply['Fields']:
           fields.append((field['Name'], field['Type']))
-          conversions.append(field_types.conversions.get(field['Type']))
 
-        for row in reply['Rows']:
-          results.append(tuple(_make_row(row, conversions)))
+        results = _make_rows(reply['Rows'], fields)
 
         rowcount = reply['RowsAffected']
         lastrowid = reply['InsertId']
@@ -329,8 +371,8 @@ class VTGateConnection(vtgate_client.VTGateClient):
       raise
     return rowsets
 
-  # we return the fields for the response, and the column conversions
-  # the conversions will need to be passed back to _stream_next
+  # we return the fields for the response, and keep the row converter
+  # for _stream_next
   # (that way we avoid using a member variable here for such a corner case)
   @vtgate_utils.exponential_backoff_retry((dbexceptions.RequestBacklog))
   def _stream_execute(self, sql, bind_variables, keyspace, tablet_type, keyspace_ids=None, keyranges=None, not_in_transaction=False):
@@ -348,17 +390,20 @@ class VTGateConnection(vtgate_client.VTGateClient):
     self._add_session(req)
 
     self._stream_fields = []
-    self._stream_conversions = []
+    self._stream_converter = None
     self._stream_result = None
+    self._stream_rows = None
+    self._stream_columns = None
     self._stream_result_index = 0
     try:
-      self.client.stream_call(exec_method, req)
+      self.client.stream_call(exec_method, req, prefetch=self.stream_prefetch)
       first_response = self.client.stream_next()
       reply = first_response.reply['Result']
 
       for field in reply['Fields']:
         self._stream_fields.append((field['Name'], field['Type']))
-        self._stream_conversions.append(field_types.conversions.get(field['Type']))
+      self._stream_converter = row_converter.get(
+          [t for _, t in self._stream_fields])
     except gorpc.GoRpcError as e:
       self.logger_object.log_private_data(bind_variables)
       raise convert_exception(e, str(self), sql, keyspace_ids, keyranges,
@@ -373,8 +418,117 @@ class VTGateConnection(vtgate_client.VTGateClient):
     if self._stream_result_index is None:
       return None
 
-    # See if we need to read more or whether we just pop the next row.
-    while self._stream_result is None:
+    if self._stream_columns is not None:
+      # the rest of a packet read by _stream_next_columns
+      self._stream_rows = zip(*[values[self._stream_result_index:]
+                                for values in self._stream_columns])
+      self._stream_columns = None
+      self._stream_result_index = 0
+    if self._stream_rows is None:
+      self._stream_rows = self._stream_read_packet(columns=False)
+      if self._stream_rows is None:
+        return None
+
+    row = self._stream_rows[self._stream_result_index]
+
+    # If we are reading the last row, set us up to read more data.
+    self._stream_result_index += 1
+    if self._stream_result_index == len(self._stream_rows):
+      self._stream_result = None
+      self._stream_rows = None
+      self._stream_result_index = 0
+
+    return row
+
+  def _stream_next_batch(self, size=None):
+    # Terminating condition
+    if self._stream_result_index is None:
+      return None
+
+    if self._stream_columns is not None:
+      # the rest of a packet read by _stream_next_columns
+      self._stream_rows = zip(*[values[self._stream_result_index:]
+                                for values in self._stream_columns])
+      self._stream_columns = None
+      self._stream_result_index = 0
+    if self._stream_rows is None:
+      self._stream_rows = self._stream_read_packet(columns=False)
+      if self._stream_rows is None:
+        return None
+
+    start = self._stream_result_index
+    packet_size = len(self._stream_rows)
+    end = packet_size if size is None else min(start + size, packet_size)
+    if start == 0 and end == packet_size:
+      # the whole packet, no need to copy it
+      batch = self._stream_rows
+    else:
+      batch = self._stream_rows[start:end]
+
+    # If we read the end of the packet, set us up to read more data.
+    if end == packet_size:
+      self._stream_result = None
+      self._stream_rows = None
+      self._stream_result_index = 0
+    else:
+      self._stream_result_index = end
+
+    return batch
+
+  def _stream_next_columns(self, size):
+    # Terminating condition
+    if self._stream_result_index is None:
+      return None
+
+    batch = None
+    count = 0
+    while count < size:
+      if self._stream_rows is not None:
+        # the rest of a packet read by _stream_next
+        self._stream_columns = map(
+            list, zip(*self._stream_rows[self._stream_result_index:]))
+        self._stream_rows = None
+        self._stream_result_index = 0
+      if self._stream_columns is None:
+        self._stream_columns = self._stream_read_packet(columns=True)
+        if self._stream_columns is None:
+          break
+
+      start = self._stream_result_index
+      packet_size = len(self._stream_columns[0])
+      end = min(start + size - count, packet_size)
+      if batch is None and start == 0 and end == packet_size:
+        # the whole packet, no need to copy it
+        batch = self._stream_columns
+      else:
+        if batch is None:
+          batch = [[] for _ in self._stream_columns]
+        for values, packet_values in zip(batch, self._stream_columns):
+          values.extend(packet_values[start:end])
+      count += end - start
+
+      # If we read the end of the packet, set us up to read more data.
+      if end == packet_size:
+        self._stream_result = None
+        self._stream_columns = None
+        self._stream_result_index = 0
+      else:
+        self._stream_result_index = end
+
+    return batch
+
+  def _stream_read_packet(self, columns):
+    """Reads the next packet of the stream that holds rows.
+
+    Args:
+      columns: convert the rows to columns, as _make_columns does,
+        instead of tuples.
+
+    Returns:
+      The converted rows or columns of the packet, None at the end of
+      the stream.
+    """
+    while True:
       try:
         self._stream_result = self.client.stream_next()
         if self._stream_result is None:
@@ -383,24 +537,24 @@ class VTGateConnection(vtgate_client.VTGateClient):
         # A session message, if any comes separately with no rows
         if 'Session' in self._stream_result.reply and self._stream_result.reply['Session']:
           self.session = self._stream_result.reply['Session']
-          self._stream_result = None
           continue
+        # convert the whole packet at once
+        rows = self._stream_result.reply['Result']['Rows']
+        if columns:
+          converted = _make_columns(rows, converter=self._stream_converter)
+          row_count = len(converted[0]) if converted else 0
+        else:
+          converted = _make_rows(rows, converter=self._stream_converter)
+          row_count = len(converted)
+        if row_count:
+          self._stream_result_index = 0
+          return converted
       except gorpc.GoRpcError as e:
         raise convert_exception(e, str(self))
       except:
         logging.exception('gorpc low-level error')
         raise
 
-    row = tuple(_make_row(self._stream_result.reply['Result']['Rows'][self._stream_result_index], self._stream_conversions))
-
-    # If we are reading the last row, set us up to read more data.
-    self._stream_result_index += 1
-    if self._stream_result_index == len(self._stream_result.reply['Result']['Rows']):
-      self._stream_result = None
-      self._stream_result_index = 0
-
-    return row
-
   def get_srv_keyspace(self, name):
     try:
       response = self.client.call('VTGate.GetSrvKeyspace', {
@@ -414,17 +568,81 @@ class VTGateConnection(vtgate_client.VTGateClient):
       raise
 
 
-def _make_row(row, conversions):
-  converted_row = []
-  for conversion_func, field_data in izip(conversions, row):
-    if field_data is None:
-      v = None
-    elif conversion_func:
-      v = conversion_func(field_data)
-    else:
-      v = field_data
-    converted_row.append(v)
-  return converted_row
+def _decode_rows(rows, converter, conversions=None, columns=False):
+  """Decodes and converts rows left encoded by the client, in C.
+
+  Args:
+    rows: the encoded Rows of the result.
+    converter: the row_converter.RowConverter of the columns.
+    conversions: the conversions to use instead of those of converter.
+    columns: True to return the list of the values of each column.
+
+  Returns:
+    The list of the converted rows, or of the columns.
+  """
+  # only the dates and datetimes converted by vtdb.times are parsed in C,
+  # a custom conversion is always called
+  if conversions is None:
+    conversions = converter.conversions
+  return bsonrpc.decode_rows(rows, converter.types, conversions,
+                             columns=columns,
+                             date_conversion=times.DateOrNone,
+                             datetime_conversion=times.DateTimeOrNone)
+
+
+def _make_rows(rows, fields=None, converter=None):
+  """Returns the rows of a query result as a list of converted tuples.
+
+  Args:
+    rows: the Rows of the result.
+    fields: list of (name, type) of the columns.
+    converter: the row_converter.RowConverter of the columns, used
+      instead of fields.
+
+  Returns:
+    The list of the converted rows.
+  """
+  if converter is None:
+    converter = row_converter.get([t for _, t in fields])
+  if not isinstance(rows, list):
+    # left encoded by the client, as a str or a cbson.LazyArray (see
+    # bsonrpc.BsonRpcClient raw_rows and lazy), decoded and converted in C
+    return _decode_rows(rows, converter)
+  return converter.convert_rows(rows)
+
+
+def _make_lazy_rows(rows, fields):
+  """Returns the rows of a query result, converted when they are read.
+
+  Args:
+    rows: the Rows of the result.
+    fields: list of (name, type) of the columns.
+
+  Returns:
+    A row_converter.LazyRows.
+  """
+  converter = row_converter.get([t for _, t in fields])
+  if isinstance(rows, list):
+    return row_converter.LazyRows(rows, converter)
+  # decoded in C without converting the values, unless most of the rows
+  # are read at once
+  encoded = rows
+  return row_converter.LazyRows(
+      _decode_rows(encoded, converter, [None] * len(converter.types)),
+      converter,
+      lambda: _decode_rows(encoded, converter))
+
+
+def _make_columns(rows, fields=None, converter=None):
+  """Returns the rows of a query result as the list of each column values.
+
+  Args are the same as _make_rows.
+  """
+  if converter is None:
+    converter = row_converter.get([t for _, t in fields])
+  if not isinstance(rows, list):
+    return _decode_rows(rows, converter, columns=True)
+  return converter.convert_columns(rows)
 
 
 def get_params_for_vtgate_conn(vtgate_addrs, timeout, user=None, password=None):
@@ -451,27 +669,29 @@ def get_params_for_vtgate_conn(vtgate_addrs, timeout, user=None, password=None):
   return db_params_list
 
 
-def connect(vtgate_addrs, timeout, user=None, password=None):
+def connect(vtgate_addrs, timeout, user=None, password=None,
+            stream_prefetch=0, dial_stagger=vtgate_dialer.DEFAULT_STAGGER,
+            result_cache=None, single_flight=None, multiplexed=False):
+  """Returns a VTGateConnection dialed to one of vtgate_addrs.
+
+  The addresses are dialed in parallel, dial_stagger seconds apart (see
+  vtgate_dialer.dial_first), recently failed ones last. result_cache,
+  single_flight and multiplexed are passed to the connection.
+  """
   db_params_list = get_params_for_vtgate_conn(vtgate_addrs, timeout,
                                               user=user, password=password)
 
   if not db_params_list:
    raise dbexceptions.OperationalError("empty db params list - no db instance available for vtgate_addrs %s" % vtgate_addrs)
 
-  db_exception = None
-  host_addr = None
-  for params in db_params_list:
-    try:
-      db_params = params.copy()
-      host_addr = db_params['addr']
-      conn = VTGateConnection(**db_params)
-      conn.dial()
-      return conn
-    except Exception as e:
-      db_exception = e
-      logging.warning('db connection failed: %s, %s', host_addr, e)
-
-  raise dbexceptions.OperationalError(
-    'unable to create vt connection', host_addr, db_exception)
+  def dial(params):
+    conn = VTGateConnection(stream_prefetch=stream_prefetch,
+                            result_cache=result_cache,
+                            single_flight=single_flight,
+                            multiplexed=multiplexed, **params)
+    conn.dial()
+    return conn
+
+  return vtgate_dialer.dial_first(db_params_list, dial, stagger=dial_stagger)
 
 vtgate_client.register_conn_class('gorpc', VTGateConnection)
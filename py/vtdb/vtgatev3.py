@@ -2,7 +2,6 @@
 # Use of this source code is governed by a BSD-style license that can
 # be found in the LICENSE file.
 
-from itertools import izip
 import logging
 import random
 import re
@@ -11,6 +10,7 @@ from net import bsonrpc
 from net import gorpc
 from vtdb import dbexceptions
 from vtdb import field_types
+from vtdb import row_converter
 from vtdb import vtdb_logger
 from vtdb import cursorv3
 
@@ -91,14 +91,17 @@ def _create_req(sql, new_binds, tablet_type, not_in_transaction):
 class VTGateConnection(object):
   session = None
   _stream_fields = None
-  _stream_conversions = None
+  _stream_converter = None
   _stream_result = None
   _stream_result_index = None
 
+  # stream_prefetch is the number of streaming query packets read ahead
+  # of the application on a background thread, 0 disables prefetching.
   def __init__(self, addr, timeout, user=None, password=None,
-               keyfile=None, certfile=None):
+               keyfile=None, certfile=None, stream_prefetch=0):
     self.addr = addr
     self.timeout = timeout
+    self.stream_prefetch = stream_prefetch
     self.client = bsonrpc.BsonRpcClient(addr, timeout, user, password,
                                         keyfile=keyfile, certfile=certfile)
     self.logger_object = vtdb_logger.get_logger()
@@ -168,7 +171,6 @@ class VTGateConnection(object):
     self._add_session(req)
 
     fields = []
-    conversions = []
     results = []
     rowcount = 0
     lastrowid = 0
@@ -183,10 +185,9 @@ class VTGateConnection(object):
         res = reply['Result']
         for field in res['Fields']:
           fields.append((field['Name'], field['Type']))
-          conversions.append(field_types.conversions.get(field['Type']))
 
-        for row in res['Rows']:
-          results.append(tuple(_make_row(row, conversions)))
+        converter = row_converter.get([t for _, t in fields])
+        results = converter.convert_rows(res['Rows'])
 
         rowcount = res['RowsAffected']
         lastrowid = res['InsertId']
@@ -222,16 +223,14 @@ class VTGateConnection(object):
         raise gorpc.AppError(response.reply['Error'], 'VTGate.ExecuteBatch')
       for reply in response.reply['List']:
         fields = []
-        conversions = []
         results = []
         rowcount = 0
 
         for field in reply['Fields']:
           fields.append((field['Name'], field['Type']))
-          conversions.append(field_types.conversions.get(field['Type']))
 
-        for row in reply['Rows']:
-          results.append(tuple(_make_row(row, conversions)))
+        converter = row_converter.get([t for _, t in fields])
+        results = converter.convert_rows(reply['Rows'])
 
         rowcount = reply['RowsAffected']
         lastrowid = reply['InsertId']
@@ -244,25 +243,27 @@ class VTGateConnection(object):
       raise
     return rowsets
 
-  # we return the fields for the response, and the column conversions
-  # the conversions will need to be passed back to _stream_next
+  # we return the fields for the response, and keep the row converter
+  # for _stream_next
   # (that way we avoid using a member variable here for such a corner case)
   def _stream_execute(self, sql, bind_variables, tablet_type, not_in_transaction=False):
     req = _create_req(sql, bind_variables, tablet_type, not_in_transaction)
     self._add_session(req)
 
     self._stream_fields = []
-    self._stream_conversions = []
+    self._stream_converter = None
     self._stream_result = None
     self._stream_result_index = 0
     try:
-      self.client.stream_call('VTGate.StreamExecute', req)
+      self.client.stream_call('VTGate.StreamExecute', req,
+                              prefetch=self.stream_prefetch)
       first_response = self.client.stream_next()
       reply = first_response.reply['Result']
 
       for field in reply['Fields']:
         self._stream_fields.append((field['Name'], field['Type']))
-        self._stream_conversions.append(field_types.conversions.get(field['Type']))
+      self._stream_converter = row_converter.get(
+          [t for _, t in self._stream_fields])
     except gorpc.GoRpcError as e:
       self.logger_object.log_private_data(bind_variables)
       raise convert_exception(e, str(self), sql)
@@ -277,50 +278,72 @@ class VTGateConnection(object):
       return None
 
     # See if we need to read more or whether we just pop the next row.
-    while self._stream_result is None:
+    if self._stream_result is None and not self._stream_read_packet():
+      return None
+
+    rows = self._stream_result.reply['Result']['Rows']
+    row = self._stream_converter.convert_row(rows[self._stream_result_index])
+
+    # If we are reading the last row, set us up to read more data.
+    self._stream_result_index += 1
+    if self._stream_result_index == len(rows):
+      self._stream_result = None
+      self._stream_result_index = 0
+
+    return row
+
+  def _stream_next_batch(self, size=None):
+    # Terminating condition
+    if self._stream_result_index is None:
+      return None
+
+    if self._stream_result is None and not self._stream_read_packet():
+      return None
+
+    rows = self._stream_result.reply['Result']['Rows']
+    start = self._stream_result_index
+    packet_size = len(rows)
+    end = packet_size if size is None else min(start + size, packet_size)
+    if start or end < packet_size:
+      rows = rows[start:end]
+    batch = self._stream_converter.convert_rows(rows)
+
+    # If we read the end of the packet, set us up to read more data.
+    if end == packet_size:
+      self._stream_result = None
+      self._stream_result_index = 0
+    else:
+      self._stream_result_index = end
+
+    return batch
+
+  def _stream_read_packet(self):
+    """Reads the next packet of the stream that holds rows.
+
+    Returns:
+      False at the end of the stream.
+    """
+    while True:
       try:
         self._stream_result = self.client.stream_next()
         if self._stream_result is None:
           self._stream_result_index = None
-          return None
+          return False
         # A session message, if any comes separately with no rows
         if 'Session' in self._stream_result.reply and self._stream_result.reply['Session']:
           self.session = self._stream_result.reply['Session']
           self._stream_result = None
           continue
         # An extra fields message if it is scatter over streaming, ignore it
-        if not self._stream_result.reply['Result']['Rows']:
-          self._stream_result = None
-          continue
+        if self._stream_result.reply['Result']['Rows']:
+          return True
+        self._stream_result = None
       except gorpc.GoRpcError as e:
         raise convert_exception(e, str(self))
       except:
         logging.exception('gorpc low-level error')
         raise
 
-    row = tuple(_make_row(self._stream_result.reply['Result']['Rows'][self._stream_result_index], self._stream_conversions))
-
-    # If we are reading the last row, set us up to read more data.
-    self._stream_result_index += 1
-    if self._stream_result_index == len(self._stream_result.reply['Result']['Rows']):
-      self._stream_result = None
-      self._stream_result_index = 0
-
-    return row
-
-
-def _make_row(row, conversions):
-  converted_row = []
-  for conversion_func, field_data in izip(conversions, row):
-    if field_data is None:
-      v = None
-    elif conversion_func:
-      v = conversion_func(field_data)
-    else:
-      v = field_data
-    converted_row.append(v)
-  return converted_row
-
 
 def connect(*pargs, **kwargs):
   conn = VTGateConnection(*pargs, **kwargs)
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""Unit tests for vtdb.async_vtgatev2, against a fake vtgate."""
+
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import bson
+
+import utils
+from net import async_bsonrpc
+from net import gorpc
+from vtdb import async_vtgatev2
+from vtdb import dbexceptions
+
+
+class FakeVTGate(object):
+  """Fake Go BSON RPC server, answering every request on its own thread.
+
+  handler(method, body) returns the list of (delay, reply, error) to send
+  back for the request.
+  """
+
+  def __init__(self, handler):
+    self.handler = handler
+    self.sock = socket.socket()
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(5)
+    self.addr = '127.0.0.1:%d' % self.sock.getsockname()[1]
+    self._start(self._serve)
+
+  def _start(self, target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+
+  def _serve(self):
+    while True:
+      conn, _ = self.sock.accept()
+      self._start(self._serve_conn, conn)
+
+  def _serve_conn(self, conn):
+    data = ''
+    while '\n\n' not in data:
+      data += conn.recv(1024)
+    conn.sendall('HTTP/1.0 200 Connected to Go RPC\n\n')
+    data = data[data.index('\n\n') + 2:]
+    write_lock = threading.Lock()
+    while True:
+      while True:
+        if len(data) >= 4:
+          header_len = struct.unpack('<i', data[:4])[0]
+          if len(data) >= header_len + 4:
+            body_len = struct.unpack(
+                '<i', data[header_len:header_len + 4])[0]
+            if len(data) >= header_len + body_len:
+              break
+        chunk = conn.recv(65536)
+        if not chunk:
+          return
+        data += chunk
+      header = bson.loads(data[:header_len])
+      body = bson.loads(data[header_len:header_len + body_len])
+      data = data[header_len + body_len:]
+      self._start(self._respond, conn, write_lock, header, body)
+
+  def _respond(self, conn, write_lock, header, body):
+    method = header['ServiceMethod']
+    for delay, reply, error in self.handler(method, body.get('_Val_', body)):
+      time.sleep(delay)
+      header = {'ServiceMethod': method, 'Seq': header['Seq'], 'Error': error}
+      with write_lock:
+        try:
+          conn.sendall(bson.dumps(header) + bson.dumps(reply))
+        except socket.error:
+          # the client hung up
+          return
+
+
+def _result(rows):
+  return {'Fields': [{'Name': 'id', 'Type': 8}],
+          'Rows': [[str(r)] for r in rows],
+          'RowsAffected': len(rows), 'InsertId': 0}
+
+
+def handle_request(method, body):
+  if method == 'VTGate.Begin':
+    return [(0, {'InTransaction': True}, '')]
+  if method in ('VTGate.Commit', 'VTGate.Rollback'):
+    return [(0, {}, '')]
+  if method == 'VTGate.ExecuteKeyspaceIds':
+    sql = body['Sql']
+    if sql == 'slow':
+      return [(1.0, {}, '')]
+    if sql == 'dup':
+      return [(0, {'Error': 'duplicate (errno 1062) key', 'Session': None},
+               '')]
+    reply = {'Result': _result([body['BindVariables']['id']])}
+    if 'Session' in body:
+      reply['Session'] = {'InTransaction': True, 'ShardSessions': ['s']}
+    return [(0, reply, '')]
+  if method == 'VTGate.ExecuteBatchKeyspaceIds':
+    return [(0, {'List': [_result([i]) for i in range(len(body['Queries']))]},
+             '')]
+  if method == 'VTGate.StreamExecuteKeyspaceIds':
+    packets = [(0, {'Result': _result([])}, '')]
+    for i in range(3):
+      packets.append((0.01, {'Result': _result([i, i + 10])}, ''))
+    packets.append((0, {}, 'EOS'))
+    return packets
+  return [(0, {}, 'unknown method %s' % method)]
+
+
+class TestAsyncVTGateConnection(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.vtgate = FakeVTGate(handle_request)
+
+  def setUp(self):
+    self.conn = async_vtgatev2.connect([self.vtgate.addr], 0.5).result(5)
+
+  def tearDown(self):
+    self.conn.close()
+
+  def execute(self, sql, bind_vars, target=None):
+    target = target or self.conn
+    return target.execute(sql, bind_vars, 'ks', 'replica',
+                          keyspace_ids=['\x80'])
+
+  def test_concurrent_execute(self):
+    futures = [self.execute('select %(id)s', {'id': i}) for i in xrange(200)]
+    for i, future in enumerate(futures):
+      results, rowcount, _, fields = future.result(5)
+      self.assertEqual(results, [(i,)])
+      self.assertEqual(rowcount, 1)
+      self.assertEqual(fields, [('id', 8)])
+
+  def test_errors(self):
+    with self.assertRaises(dbexceptions.IntegrityError):
+      self.execute('dup', {}).result(5)
+    with self.assertRaises(dbexceptions.TimeoutError):
+      self.execute('slow', {}).result(5)
+    with self.assertRaises(dbexceptions.ProgrammingError):
+      self.conn.execute('select', {}, 'ks', 'replica').result(5)
+    # the connection survives a timed out call
+    self.assertEqual(self.execute('select %(id)s', {'id': 1}).result(5)[0],
+                     [(1,)])
+
+  def test_execute_batch(self):
+    rowsets = self.conn.execute_batch(
+        ['select 1', 'select 2'], [{}, {}], ['ks', 'ks'], [['\x80'], ['\x81']],
+        'master').result(5)
+    self.assertEqual([rowset[0] for rowset in rowsets], [[(0,)], [(1,)]])
+
+  def test_stream_execute(self):
+    stream = self.conn.stream_execute(
+        'select', {}, 'ks', 'rdonly', keyspace_ids=['\x80']).result(5)
+    self.assertEqual(stream.fields, [('id', 8)])
+    rows = []
+    while True:
+      packet = stream.next_rows().result(5)
+      if packet is None:
+        break
+      rows.extend(packet)
+    self.assertEqual(rows, [(0,), (10,), (1,), (11,), (2,), (12,)])
+
+  def test_transaction(self):
+    txn = self.conn.begin().result(5)
+    future = self.execute('select %(id)s', {'id': 1}, txn)
+    with self.assertRaises(dbexceptions.ProgrammingError):
+      self.execute('select %(id)s', {'id': 2}, txn).result(5)
+    future.result(5)
+    self.assertEqual(txn.session['ShardSessions'], ['s'])
+    txn.commit().result(5)
+    self.assertIsNone(txn.session)
+    with self.assertRaises(dbexceptions.ProgrammingError):
+      txn.rollback().result(5)
+
+  def test_closed(self):
+    self.conn.close()
+    with self.assertRaises(dbexceptions.FatalError):
+      self.execute('select %(id)s', {'id': 1}).result(5)
+
+
+class SlowListener(object):
+  """Accepts connections, and answers their CONNECT after delay seconds."""
+
+  def __init__(self, delay):
+    self.delay = delay
+    self.sock = socket.socket()
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(5)
+    self.addr = '127.0.0.1:%d' % self.sock.getsockname()[1]
+    self.conns = []
+    thread = threading.Thread(target=self._serve)
+    thread.daemon = True
+    thread.start()
+
+  def _serve(self):
+    while True:
+      try:
+        conn, _ = self.sock.accept()
+      except socket.error:
+        return
+      self.conns.append(conn)
+      time.sleep(self.delay)
+      try:
+        conn.sendall('HTTP/1.0 200 Connected to Go RPC\n\n')
+      except socket.error:
+        pass
+
+  def close(self):
+    self.sock.close()
+    for conn in self.conns:
+      conn.close()
+
+
+class TestAsyncBsonRpcClient(unittest.TestCase):
+
+  def listener(self, delay):
+    listener = SlowListener(delay)
+    self.addCleanup(listener.close)
+    return listener
+
+  def test_dial_off_io_loop(self):
+    # a slow handshake doesn't block the callbacks of the IOLoop
+    client = async_bsonrpc.AsyncBsonRpcClient(
+        self.listener(60).addr, 5, connect_timeout=0.3)
+    io_loop = client.io_loop
+    dialed = async_bsonrpc.Future()
+    io_loop.add_callback(lambda: client.dial().add_done_callback(
+        dialed._copy_from))
+    start = time.time()
+    ran = async_bsonrpc.Future()
+    io_loop.add_callback(ran.set_result, None)
+    ran.result(5)
+    self.assertLess(time.time() - start, 0.2)
+    self.assertIsInstance(dialed.exception(5), gorpc.TimeoutError)
+    self.assertTrue(client.is_closed())
+
+  def test_close_during_dial(self):
+    client = async_bsonrpc.AsyncBsonRpcClient(self.listener(0.1).addr, 5)
+    future = client.dial()
+    client.close()
+    self.assertIsInstance(future.exception(5), gorpc.GoRpcError)
+    self.assertTrue(client.is_closed())
+
+  def test_dial(self):
+    client = async_bsonrpc.AsyncBsonRpcClient(self.listener(0).addr, 5)
+    self.addCleanup(client.close)
+    client.dial().result(5)
+    self.assertFalse(client.is_closed())
+
+  def test_cancelled_timers_compacted(self):
+    io_loop = async_bsonrpc.IOLoop()
+    timer = io_loop.call_later(60, lambda: None)
+    for _ in xrange(5000):
+      io_loop.call_later(60, lambda: None).cancel()
+    self.assertLess(len(io_loop._timers),
+                    2 * async_bsonrpc._MIN_TIMERS_TO_COMPACT)
+    self.assertIn(timer, [t for _, _, t in io_loop._timers])
+
+
+class TestFuture(unittest.TestCase):
+
+  def test_then(self):
+    future = async_bsonrpc.Future()
+    chained = future.then(lambda x: x + 1).then(
+        lambda x: async_bsonrpc.completed_future(x * 2))
+    future.set_result(1)
+    self.assertEqual(chained.result(1), 4)
+
+  def test_then_exception(self):
+    future = async_bsonrpc.Future()
+    chained = future.then(lambda x: x + 1)
+    future.set_exception(ValueError('bad'))
+    self.assertIsInstance(chained.exception(1), ValueError)
+
+  def test_result_timeout(self):
+    with self.assertRaises(gorpc.TimeoutError):
+      async_bsonrpc.Future().result(0.01)
+
+  def test_result_promptly(self):
+    # a result() with no timeout doesn't poll
+    future = async_bsonrpc.Future()
+    timer = threading.Timer(0.2, lambda: future.set_result(time.time()))
+    timer.start()
+    set_time = future.result()
+    self.assertLess(time.time() - set_time, 0.005)
+    timer.join()
+
+  def test_result_on_io_loop(self):
+    # blocking the IOLoop thread would deadlock, result() refuses it
+    outcome = async_bsonrpc.Future()
+
+    def block():
+      try:
+        async_bsonrpc.Future().result()
+      except gorpc.ProgrammingError as e:
+        outcome.set_result(e)
+    async_bsonrpc.IOLoop.instance().add_callback(block)
+    self.assertIsInstance(outcome.result(1), gorpc.ProgrammingError)
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for vtdb.batch_executor, with a fake vtgate client."""
+
+import threading
+import time
+import unittest
+
+import utils
+from net import gorpc
+from vtdb import batch_executor
+from vtdb import dbexceptions
+from vtdb import field_types
+from vtdb import vtgatev2
+
+FIELDS = [{'Name': 'id', 'Type': field_types.VT_LONGLONG}]
+
+
+def query_result(bind_variables):
+  return {'Fields': FIELDS, 'RowsAffected': 1, 'InsertId': 0,
+          'Rows': [[str(bind_variables['id'])]]}
+
+
+class FakeClient(object):
+  """Replies the id bind variable of each query as its row.
+
+  Queries with an id in bad_ids fail, and fail their whole batch.
+  """
+
+  def __init__(self):
+    self.calls = []
+    self.bad_ids = set()
+    self.error = None
+    self.reply_time = None
+    self.lock = threading.Lock()
+
+  def call(self, method, req):
+    with self.lock:
+      self.calls.append((method, req))
+    if self.error is not None:
+      raise self.error
+    response = gorpc.GoRpcResponse()
+    if method == 'VTGate.ExecuteBatchKeyspaceIds':
+      queries = req['Queries']
+    else:
+      queries = [req]
+    for query in queries:
+      if query['BindVariables']['id'] in self.bad_ids:
+        raise gorpc.AppError('bad id', method)
+    results = [query_result(query['BindVariables']) for query in queries]
+    if method == 'VTGate.ExecuteBatchKeyspaceIds':
+      response.reply = {'List': results, 'Session': None, 'Error': ''}
+    else:
+      response.reply = {'Result': results[0], 'Session': None, 'Error': ''}
+    self.reply_time = time.time()
+    return response
+
+  def methods(self):
+    return [method for method, _ in self.calls]
+
+
+class TestBatchExecutor(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = vtgatev2.VTGateConnection('addr', 1.0)
+    self.client = self.conn.client = FakeClient()
+
+  def executor(self, **kwargs):
+    executor = batch_executor.BatchExecutor(self.conn, 'replica', **kwargs)
+    self.addCleanup(executor.close)
+    return executor
+
+  def execute(self, executor, i):
+    return executor.execute('select id from t where id = %(id)s', {'id': i},
+                            'ks', ['\x80'])
+
+  def test_batched(self):
+    executor = self.executor(window=10)
+    futures = [self.execute(executor, i) for i in xrange(5)]
+    executor.flush()
+    self.assertEqual([f.result(5)[0] for f in futures],
+                     [[(i,)] for i in xrange(5)])
+    self.assertEqual(self.client.methods(),
+                     ['VTGate.ExecuteBatchKeyspaceIds'])
+    req = self.client.calls[0][1]
+    self.assertEqual(req['TabletType'], 'replica')
+    self.assertFalse(req['AsTransaction'])
+    self.assertEqual(len(req['Queries']), 5)
+    self.assertEqual(executor.stats(), {
+        'queries': 5, 'batches': 1, 'failed_batches': 0, 'pending': 0})
+
+  def test_window(self):
+    executor = self.executor(window=0.01)
+    futures = [self.execute(executor, i) for i in xrange(3)]
+    self.assertEqual([f.result(5)[0] for f in futures],
+                     [[(i,)] for i in xrange(3)])
+    self.assertEqual(executor.stats()['batches'], 1)
+
+  def test_result_promptly(self):
+    # the callers get their rows as soon as the batch reply is decoded
+    executor = self.executor(window=0.2)
+    future = self.execute(executor, 1)
+    self.assertEqual(future.result()[0], [(1,)])
+    self.assertLess(time.time() - self.client.reply_time, 0.005)
+
+  def test_max_batch_size(self):
+    executor = self.executor(window=10, max_batch_size=2)
+    futures = [self.execute(executor, i) for i in xrange(5)]
+    # the full batches are sent without waiting for the window
+    for future in futures[:4]:
+      future.result(5)
+    self.assertFalse(futures[4].done())
+    executor.close()
+    self.assertEqual(futures[4].result(5)[0], [(4,)])
+    self.assertEqual([len(req['Queries']) for _, req in self.client.calls],
+                     [2, 2, 1])
+
+  def test_concurrent_callers(self):
+    executor = self.executor(window=0.05)
+    results = {}
+
+    def read(i):
+      results[i] = self.execute(executor, i).result(5)[0]
+
+    threads = [threading.Thread(target=read, args=(i,)) for i in xrange(10)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, dict((i, [(i,)]) for i in xrange(10)))
+    self.assertLess(executor.stats()['batches'], 10)
+
+  def test_query_error(self):
+    # vtgate fails the whole batch, and so do its reads
+    self.client.bad_ids.add(1)
+    executor = self.executor(window=10)
+    futures = [self.execute(executor, i) for i in xrange(3)]
+    executor.flush()
+    for future in futures:
+      self.assertIsInstance(future.exception(5), dbexceptions.DatabaseError)
+    self.assertEqual(self.client.methods(),
+                     ['VTGate.ExecuteBatchKeyspaceIds'])
+    self.assertEqual(executor.stats()['failed_batches'], 1)
+    # the next batches are sent
+    future = self.execute(executor, 2)
+    executor.flush()
+    self.assertEqual(future.result(5)[0], [(2,)])
+
+  def test_batch_error(self):
+    self.client.error = gorpc.TimeoutError('slow')
+    executor = self.executor(window=10)
+    futures = [self.execute(executor, i) for i in xrange(3)]
+    executor.flush()
+    for future in futures:
+      self.assertIsInstance(future.exception(5), dbexceptions.TimeoutError)
+    self.assertEqual(len(self.client.calls), 1)
+
+  def test_closed(self):
+    executor = self.executor()
+    executor.close()
+    self.assertRaises(dbexceptions.ProgrammingError, self.execute, executor, 1)
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for the framing of net.bsonrpc."""
+
+import mmap
+import tempfile
+import unittest
+
+import bson
+
+import utils
+from net import bsonrpc
+from net import gorpc
+from vtdb import field_types
+
+
+def frame(seq, reply):
+  return (bson.dumps({'ServiceMethod': 'M', 'Seq': seq, 'Error': ''}) +
+          bson.dumps(reply))
+
+
+class TestFrames(unittest.TestCase):
+
+  def setUp(self):
+    self.data = ''.join(frame(i, {'Value': i}) for i in xrange(3))
+
+  def check_frames(self, data):
+    decoded = [(r.sequence_id, r.reply) for _, r in bsonrpc.decode_frames(data)]
+    self.assertEqual(decoded, [(i, {'Value': i}) for i in xrange(3)])
+
+  def test_buffers(self):
+    self.check_frames(self.data)
+    self.check_frames(bytearray(self.data))
+    self.check_frames(memoryview(self.data))
+
+  def test_mmap(self):
+    with tempfile.TemporaryFile() as f:
+      f.write(self.data)
+      f.flush()
+      m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+        self.check_frames(m)
+      finally:
+        m.close()
+
+  def test_truncated(self):
+    with self.assertRaises(gorpc.GoRpcError):
+      list(bsonrpc.decode_frames(self.data, end=len(self.data) - 1))
+
+  def test_decode_response(self):
+    frame_size = len(self.data) / 3
+    for end in (0, 3, 10, frame_size - 1):
+      consumed, _ = bsonrpc.decode_response(
+          gorpc.GoRpcResponse(), self.data, frame_size, frame_size + end)
+      self.assertIsNone(consumed)
+    response = gorpc.GoRpcResponse()
+    consumed, _ = bsonrpc.decode_response(
+        response, self.data, frame_size, 2 * frame_size)
+    self.assertEqual(consumed, frame_size)
+    self.assertEqual(response.reply, {'Value': 1})
+
+  def test_lazy(self):
+    response = gorpc.GoRpcResponse()
+    consumed, _ = bsonrpc.decode_response(
+        response, bytearray(self.data), 0, len(self.data), lazy=True)
+    self.assertEqual(consumed, len(self.data) / 3)
+    self.assertEqual(response.reply['Value'], 0)
+    self.assertEqual(dict(response.reply.items()), {'Value': 0})
+
+  def test_frame_length(self):
+    sizes = (len(bson.dumps({'ServiceMethod': 'M', 'Seq': 0, 'Error': ''})),
+             len(bson.dumps({'Value': 0})))
+    for frame_length in (bsonrpc.frame_length, bsonrpc._frame_length):
+      self.assertEqual(frame_length(self.data), sizes)
+      self.assertEqual(frame_length(self.data, 0, 3), (None, None))
+      self.assertEqual(frame_length(self.data, 0, sizes[0]), (sizes[0], None))
+
+
+class TestEncodeRequest(unittest.TestCase):
+
+  def test_bool_bind_variables(self):
+    # BSON booleans are rejected as bind values, in lists too
+    bind_vars = field_types.convert_bind_vars(
+        {'flag': True, 'flags': [True, False, 2], 'ids': (1, True)})
+    req = gorpc.GoRpcRequest(gorpc.make_header('M', 1),
+                             {'BindVariables': bind_vars})
+    (_, response), = bsonrpc.decode_frames(bsonrpc.encode_request(req))
+    body = response.reply
+    self.assertEqual(body['BindVariables'],
+                     {'flag': 1, 'flags': [1, 0, 2], 'ids': [1, 1]})
+    for value in (body['BindVariables']['flag'],
+                  body['BindVariables']['flags'][0],
+                  body['BindVariables']['ids'][1]):
+      self.assertIs(type(value), int)
+
+
+if __name__ == '__main__':
+  utils.main()
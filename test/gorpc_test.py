@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for net.gorpc, with a fake server at the other end of a socket."""
+
+import itertools
+import random
+import select
+import socket
+import threading
+import time
+import unittest
+
+import bson
+import mock
+
+import utils
+from net import bsonrpc
+from net import gorpc
+from vtdb import field_types
+from vtdb import vtgatev2
+
+
+class FakeServer(object):
+  """The server end of a socket pair, reading and answering the requests."""
+
+  def __init__(self, sock):
+    self.sock = sock
+    self.sock.settimeout(5)
+    self.data = ''
+
+  def read_request(self):
+    """Returns the (sequence id, method, body) of the next request."""
+    while True:
+      if self.data:
+        request = gorpc.GoRpcResponse()
+        consumed, _ = bsonrpc.decode_response(request, self.data, 0,
+                                              len(self.data))
+        if consumed:
+          self.data = self.data[consumed:]
+          return (request.header['Seq'], request.header['ServiceMethod'],
+                  request.reply)
+      data = self.sock.recv(65536)
+      if not data:
+        raise socket.error('client hung up')
+      self.data += data
+
+  def reply(self, sequence_id, reply, error='', method='M'):
+    self.sock.sendall(frame(sequence_id, reply, error, method))
+
+  def close(self):
+    self.sock.close()
+
+
+def frame(sequence_id, reply, error='', method='M'):
+  header = {'ServiceMethod': method, 'Seq': sequence_id, 'Error': error}
+  return bson.dumps(header) + bson.dumps(reply)
+
+
+def connect(client):
+  """Connects client to a socket pair, and returns the FakeServer end."""
+  client_sock, server_sock = socket.socketpair()
+  conn = gorpc._GoRpcConn(client.connect_timeout)
+  conn.conn = client_sock
+  client_sock.setblocking(0)
+  conn.poll = select.poll()
+  conn.poll.register(client_sock.fileno(), gorpc._POLLIN)
+  client.conn = conn
+  return FakeServer(server_sock)
+
+
+def run_threads(count, target):
+  """Runs target(i) in count threads, returns their threads and results.
+
+  The result of each thread is a (result, exception) pair.
+  """
+  results = [None] * count
+
+  def run(i):
+    try:
+      results[i] = (target(i), None)
+    except Exception as e:
+      results[i] = (None, e)
+
+  threads = [threading.Thread(target=run, args=(i,)) for i in xrange(count)]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  return threads, results
+
+
+def join(threads):
+  for thread in threads:
+    thread.join(5)
+    if thread.is_alive():
+      raise AssertionError('thread still running')
+
+
+def send_slowly(sock, data, chunk_sizes):
+  """Sends data in chunks, so the client receives partial frames.
+
+  The chunks cycle through chunk_sizes.
+  """
+  def send():
+    offset = 0
+    for chunk_size in itertools.cycle(chunk_sizes):
+      if offset >= len(data):
+        return
+      sock.sendall(data[offset:offset + chunk_size])
+      offset += chunk_size
+      time.sleep(0.0005)
+  thread = threading.Thread(target=send)
+  thread.daemon = True
+  thread.start()
+  return thread
+
+
+class TestReadBuffer(unittest.TestCase):
+
+  def test_compaction(self):
+    buf = gorpc._ReadBuffer(16)
+    buf.buf[0:10] = 'x' * 6 + 'abcd'
+    buf.end = 10
+    buf.consume(6)
+    # the 4 pending bytes are moved to the front to make room
+    buf.reserve(10)
+    self.assertEqual(len(buf.buf), 16)
+    self.assertEqual((buf.start, buf.end), (0, 4))
+    self.assertEqual(str(buf.buf[:4]), 'abcd')
+    self.assertEqual(buf.moved_bytes, 4)
+    # there is room already, nothing moves
+    buf.reserve(12)
+    self.assertEqual(buf.moved_bytes, 4)
+
+  def test_growth(self):
+    buf = gorpc._ReadBuffer(16)
+    buf.buf[0:10] = 'abcdefghij'
+    buf.end = 10
+    buf.consume(2)
+    buf.reserve(100)
+    self.assertEqual(len(buf.buf), 108)
+    self.assertEqual(str(buf.buf[buf.start:buf.end]), 'cdefghij')
+    buf.reserve(120)
+    self.assertEqual(len(buf.buf), 216)
+    self.assertEqual(len(buf.writable_view()), 208)
+
+  def test_release(self):
+    buf = gorpc._ReadBuffer(16)
+    with mock.patch.object(gorpc, 'max_idle_read_buffer_size', 64):
+      buf.reserve(100)
+      buf.end = 100
+      buf.consume(50)
+      self.assertEqual(len(buf.buf), 100)
+      # a big buffer is released once drained
+      buf.consume(50)
+      self.assertEqual(len(buf), 0)
+      self.assertEqual(len(buf.buf), gorpc.default_read_buffer_size)
+
+  def test_partial_reads(self):
+    # frames split across reads, and frames bigger than the buffer
+    client = bsonrpc.BsonRpcClient('server:1', 5)
+    server = connect(client)
+    self.addCleanup(client.close)
+    self.addCleanup(server.close)
+    sequence_id = client.stream_call('S', {})
+    server.read_request()
+    values = ['a' * 10, 'b' * 20000, 'c', 'd' * 100000]
+    data = ''.join(frame(sequence_id, {'Value': value}) for value in values)
+    data += frame(sequence_id, {}, error=gorpc._lastStreamResponseError)
+    sender = send_slowly(server.sock, data, [7, 3001])
+    received = []
+    while True:
+      response = client.stream_next()
+      if response is None:
+        break
+      received.append(response.reply['Value'])
+    sender.join(5)
+    self.assertEqual(received, values)
+    self.assertEqual(len(client.read_buffer), 0)
+    # partial frames were moved to make room for the rest
+    self.assertGreater(client.read_buffer.moved_bytes, 0)
+
+
+class FakeListener(object):
+  """Accepts one connection, and answers its CONNECT with handshake."""
+
+  def __init__(self, handshake):
+    self.sock = socket.socket()
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(1)
+    self.uri = 'http://127.0.0.1:%d/_bson_rpc_' % self.sock.getsockname()[1]
+    self.handshake = handshake
+    self.conn = None
+    self.thread = threading.Thread(target=self._accept)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _accept(self):
+    self.conn, _ = self.sock.accept()
+    data = ''
+    while '\n\n' not in data:
+      data += self.conn.recv(1024)
+    if self.handshake is None:
+      self.conn.close()
+    elif self.handshake:
+      self.conn.sendall(self.handshake)
+
+  def close(self):
+    self.thread.join(5)
+    if self.conn:
+      self.conn.close()
+    self.sock.close()
+
+
+class TestDeadlines(unittest.TestCase):
+
+  def test_time_left(self):
+    conn = gorpc._GoRpcConn(1.0)
+    deadline = gorpc.deadline_after(10)
+    self.assertTrue(9 < conn._time_left(deadline) <= 10)
+    with self.assertRaises(socket.timeout):
+      conn._time_left(time.time() - 0.001)
+
+  def test_read_timeout(self):
+    client = bsonrpc.BsonRpcClient('server:1', 5)
+    server = connect(client)
+    self.addCleanup(client.close)
+    self.addCleanup(server.close)
+    start = time.time()
+    with self.assertRaises(socket.timeout):
+      client.conn.read_into(memoryview(bytearray(16)),
+                            gorpc.deadline_after(0.05))
+    self.assertTrue(0.04 < time.time() - start < 1)
+
+  def test_write_timeout(self):
+    # the server doesn't read, the socket buffers fill up
+    client = bsonrpc.BsonRpcClient('server:1', 5)
+    server = connect(client)
+    self.addCleanup(client.close)
+    self.addCleanup(server.close)
+    with self.assertRaises(socket.timeout):
+      client.conn.write_request('x' * (16 << 20), gorpc.deadline_after(0.05))
+
+  def test_call_timeout(self):
+    # without multiplexing, a call that timed out closes the connection
+    client = bsonrpc.BsonRpcClient('server:1', 0.05)
+    server = connect(client)
+    self.addCleanup(server.close)
+    start = time.time()
+    with self.assertRaises(gorpc.TimeoutError):
+      client.call('M', {})
+    self.assertTrue(0.04 < time.time() - start < 1)
+    self.assertTrue(client.is_closed())
+
+  def test_stream_idle_timeout(self):
+    client = bsonrpc.BsonRpcClient('server:1', 5, stream_idle_timeout=0.05)
+    server = connect(client)
+    self.addCleanup(server.close)
+    sequence_id = client.stream_call('S', {})
+    server.reply(sequence_id, {'Value': 0})
+    self.assertEqual(client.stream_next().reply['Value'], 0)
+    with self.assertRaises(gorpc.TimeoutError):
+      client.stream_next()
+    self.assertTrue(client.is_closed())
+
+  def dial(self, handshake, connect_timeout=5):
+    listener = FakeListener(handshake)
+    self.addCleanup(listener.close)
+    client = gorpc.GoRpcClient(listener.uri, 5,
+                               connect_timeout=connect_timeout)
+    self.addCleanup(client.close)
+    client.dial()
+    return client
+
+  def test_dial(self):
+    client = self.dial('HTTP/1.0 200 Connected to Go RPC\n\n')
+    self.assertFalse(client.is_closed())
+
+  def test_handshake_timeout(self):
+    # the server accepts the connection, but never answers CONNECT
+    start = time.time()
+    with self.assertRaises(gorpc.TimeoutError):
+      self.dial('', connect_timeout=0.05)
+    self.assertTrue(0.04 < time.time() - start < 1)
+
+  def test_partial_handshake_timeout(self):
+    with self.assertRaises(gorpc.TimeoutError):
+      self.dial('HTTP/1.0 200 Connected', connect_timeout=0.05)
+
+  def test_handshake_eof(self):
+    with self.assertRaises(gorpc.GoRpcError):
+      self.dial(None)
+
+
+class TestMultiplexed(unittest.TestCase):
+
+  def setUp(self):
+    self.client = bsonrpc.BsonRpcClient('server:1', 5, multiplexed=True)
+    self.server = connect(self.client)
+    self.addCleanup(self.client.close)
+    self.addCleanup(self.server.close)
+
+  def read_requests(self, count):
+    return dict((body['Value'], seq) for seq, _, body in
+                (self.server.read_request() for _ in xrange(count)))
+
+  def test_concurrent_calls(self):
+    # the replies come back in another order than the requests
+    threads, results = run_threads(
+        8, lambda i: self.client.call('M', {'Value': i}).reply['Value'])
+    requests = self.read_requests(8)
+    values = requests.keys()
+    random.Random(1).shuffle(values)
+    for value in values:
+      self.server.reply(requests[value], {'Value': value})
+    join(threads)
+    self.assertEqual(results, [(i, None) for i in xrange(8)])
+    self.assertFalse(self.client.is_closed())
+
+  def test_app_error(self):
+    threads, results = run_threads(
+        2, lambda i: self.client.call('M', {'Value': i}).reply['Value'])
+    requests = self.read_requests(2)
+    self.server.reply(requests[1], {}, error='bad request')
+    self.server.reply(requests[0], {'Value': 0})
+    join(threads)
+    self.assertEqual(results[0], (0, None))
+    self.assertIsInstance(results[1][1], gorpc.AppError)
+
+  def test_timeout(self):
+    # only the call that timed out is abandoned, its late reply is dropped
+    with self.assertRaises(gorpc.TimeoutError):
+      self.client.call('M', {'Value': 0}, timeout=0.05)
+    seq, _, _ = self.server.read_request()
+    self.server.reply(seq, {'Value': 0})
+    threads, results = run_threads(
+        1, lambda i: self.client.call('M', {'Value': 1}).reply['Value'])
+    seq, _, _ = self.server.read_request()
+    self.server.reply(seq, {'Value': 1})
+    join(threads)
+    self.assertEqual(results, [(1, None)])
+
+  def test_waiters_woken_promptly(self):
+    # the callers waiting for the reader don't poll
+    done_times = {}
+
+    def call(i):
+      value = self.client.call('M', {'Value': i}).reply['Value']
+      done_times[i] = time.time()
+      return value
+    threads, results = run_threads(4, call)
+    requests = self.read_requests(4)
+    time.sleep(0.17)
+    reply_time = time.time()
+    for value in (3, 2, 1, 0):
+      self.server.reply(requests[value], {'Value': value})
+    join(threads)
+    self.assertEqual(results, [(i, None) for i in xrange(4)])
+    self.assertLess(max(done_times.values()) - reply_time, 0.01)
+
+  def test_waiter_deadline(self):
+    # the reader stops reading by the deadline of a waiting caller
+    def call(i, timeout):
+      start = time.time()
+      try:
+        return self.client.call('M', {'Value': i}, timeout=timeout)
+      finally:
+        elapsed[i] = time.time() - start
+    elapsed = {}
+    threads, results = run_threads(1, lambda i: call(0, 0.2))
+    seq0, _, _ = self.server.read_request()
+    threads1, results1 = run_threads(1, lambda i: call(1, 0.3))
+    threads2, results2 = run_threads(
+        1, lambda i: call(2, 5).reply['Value'])
+    requests = self.read_requests(2)
+    self.server.reply(seq0, {'Value': 0})
+    join(threads + threads1)
+    self.assertEqual(results[0][1], None)
+    self.assertIsInstance(results1[0][1], gorpc.TimeoutError)
+    self.assertLess(elapsed[1], 0.35)
+    self.server.reply(requests[2], {'Value': 2})
+    join(threads2)
+    self.assertEqual(results2, [(2, None)])
+
+  def test_reader_failure(self):
+    # the server hangs up while calls are waiting: they all fail
+    threads, results = run_threads(
+        4, lambda i: self.client.call('M', {'Value': i}))
+    self.read_requests(4)
+    self.server.close()
+    join(threads)
+    for _, error in results:
+      self.assertIsInstance(error, gorpc.GoRpcError)
+    self.assertTrue(self.client.is_closed())
+
+  def test_streams(self):
+    # two streams and a call share the socket
+    def read_stream(i):
+      sequence_id = self.client.stream_call('S', {'Value': i})
+      values = []
+      while True:
+        response = self.client.stream_next(sequence_id)
+        if response is None:
+          return values
+        values.append(response.reply['Value'])
+    threads, results = run_threads(2, read_stream)
+    streams = self.read_requests(2)
+    call_threads, call_results = run_threads(
+        1, lambda i: self.client.call('M', {'Value': 10}).reply['Value'])
+    seq, _, _ = self.server.read_request()
+    for value in xrange(3):
+      for stream in (1, 0):
+        self.server.reply(streams[stream], {'Value': stream * 100 + value})
+      if value == 1:
+        self.server.reply(seq, {'Value': 10})
+    for stream in (0, 1):
+      self.server.reply(streams[stream], {},
+                        error=gorpc._lastStreamResponseError)
+    join(threads + call_threads)
+    self.assertEqual(results, [([0, 1, 2], None), ([100, 101, 102], None)])
+    self.assertEqual(call_results, [(10, None)])
+
+
+class TestStreamPrefetch(unittest.TestCase):
+
+  def setUp(self):
+    self.client = bsonrpc.BsonRpcClient('server:1', 5)
+    self.server = connect(self.client)
+    self.addCleanup(self.client.close)
+    self.addCleanup(self.server.close)
+
+  def stream_call(self, prefetch=2):
+    sequence_id = self.client.stream_call('S', {}, prefetch=prefetch)
+    self.assertEqual(self.server.read_request()[0], sequence_id)
+    return sequence_id
+
+  def stream_values(self, count):
+    return [self.client.stream_next().reply['Value'] for _ in xrange(count)]
+
+  def prefetcher(self, sequence_id):
+    return self.client._prefetchers[sequence_id]
+
+  def wait_prefetched(self, sequence_id, count):
+    prefetcher = self.prefetcher(sequence_id)
+    for _ in xrange(500):
+      with prefetcher._cond:
+        if len(prefetcher._items) >= count:
+          return
+      threading.Event().wait(0.01)
+    self.fail('packets not prefetched')
+
+  def test_eos(self):
+    # the stream is drained up to its end, then the connection is reused
+    sequence_id = self.stream_call()
+    for value in xrange(3):
+      self.server.reply(sequence_id, {'Value': value})
+    self.server.reply(sequence_id, {}, error=gorpc._lastStreamResponseError)
+    self.assertEqual(self.stream_values(3), [0, 1, 2])
+    self.assertIsNone(self.client.stream_next())
+    self.assertEqual(self.client._prefetchers, {})
+
+    threads, results = run_threads(
+        1, lambda i: self.client.call('M', {}).reply['Value'])
+    seq, _, _ = self.server.read_request()
+    self.server.reply(seq, {'Value': 'ok'})
+    join(threads)
+    self.assertEqual(results, [('ok', None)])
+
+  def test_bounded(self):
+    sequence_id = self.stream_call(prefetch=2)
+    for value in xrange(5):
+      self.server.reply(sequence_id, {'Value': value})
+    self.wait_prefetched(sequence_id, 2)
+    threading.Event().wait(0.05)
+    # one more packet is read, waiting for room in the queue
+    self.assertEqual(len(self.prefetcher(sequence_id)._items), 2)
+    self.assertEqual(self.stream_values(5), range(5))
+
+  def test_error_after_packets(self):
+    # the packets read before the error are returned first
+    sequence_id = self.stream_call(prefetch=4)
+    self.server.reply(sequence_id, {'Value': 0})
+    self.server.reply(sequence_id, {'Value': 1})
+    self.server.reply(sequence_id, {}, error='stream failed')
+    self.wait_prefetched(sequence_id, 3)
+    self.assertEqual(self.stream_values(2), [0, 1])
+    with self.assertRaises(gorpc.AppError):
+      self.client.stream_next()
+    self.assertEqual(self.client._prefetchers, {})
+
+  def test_connection_error_after_packets(self):
+    sequence_id = self.stream_call(prefetch=4)
+    self.server.reply(sequence_id, {'Value': 0})
+    self.server.close()
+    self.assertEqual(self.stream_values(1), [0])
+    with self.assertRaises(gorpc.GoRpcError):
+      self.client.stream_next()
+    self.assertTrue(self.client.is_closed())
+
+  def test_abandoned(self):
+    # a call in the middle of a prefetched stream closes the connection
+    sequence_id = self.stream_call(prefetch=1)
+    for value in xrange(3):
+      self.server.reply(sequence_id, {'Value': value})
+    self.assertEqual(self.stream_values(1), [0])
+    prefetcher = self.prefetcher(sequence_id)
+    with self.assertRaises(gorpc.GoRpcError) as cm:
+      self.client.call('M', {})
+    self.assertEqual(cm.exception.args[0], 'call - closed client')
+    self.assertTrue(self.client.is_closed())
+    prefetcher.thread.join(5)
+    self.assertFalse(prefetcher.thread.is_alive())
+
+  def test_close(self):
+    # closing the client stops the reader thread, blocked on the socket
+    sequence_id = self.stream_call()
+    prefetcher = self.prefetcher(sequence_id)
+    self.client.close()
+    prefetcher.thread.join(5)
+    self.assertFalse(prefetcher.thread.is_alive())
+    with self.assertRaises(gorpc.GoRpcError):
+      prefetcher.next()
+
+
+class TestVTGateConnectionMultiplexed(unittest.TestCase):
+
+  def test_shared_connection(self):
+    conn = vtgatev2.VTGateConnection('server:1', 5, multiplexed=True)
+    self.assertTrue(conn.client.multiplexed)
+    server = connect(conn.client)
+    self.addCleanup(conn.client.close)
+    self.addCleanup(server.close)
+
+    threads, results = run_threads(
+        4, lambda i: conn._execute('select %(id)s', {'id': i}, 'ks',
+                                   'replica', keyspace_ids=['\x80'])[0])
+    requests = [server.read_request() for _ in xrange(4)]
+    for seq, method, body in reversed(requests):
+      self.assertEqual(method, 'VTGate.ExecuteKeyspaceIds')
+      result = {
+          'Fields': [{'Name': 'id', 'Type': field_types.VT_LONGLONG}],
+          'Rows': [[str(body['BindVariables']['id'])]],
+          'RowsAffected': 1,
+          'InsertId': 0,
+      }
+      server.reply(seq, {'Result': result, 'Session': None, 'Error': ''})
+    join(threads)
+    self.assertEqual(results, [([(i,)], None) for i in xrange(4)])
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for vtdb.parallel_stream_cursor, with fake vtgate connections."""
+
+import threading
+import time
+import unittest
+
+import mock
+
+import utils
+from vtdb import dbexceptions
+from vtdb import field_types
+from vtdb import keyrange_constants
+from vtdb import parallel_stream_cursor
+from vtdb import topology
+
+FIELDS = [
+    ('id', field_types.VT_LONGLONG),
+    ('name', field_types.VT_VAR_STRING),
+]
+
+KEYRANGES = ['-40', '40-80', '80-c0', 'c0-']
+
+# the sorted rows of each task keyrange, in packets of 2 rows
+TASK_ROWS = dict(
+    (kr, [(i + 4 * j, 'name%d' % (j % 3)) for j in xrange(5)])
+    for i, kr in enumerate(KEYRANGES))
+
+ALL_ROWS = sorted(sum(TASK_ROWS.values(), []))
+
+
+class FakeStreamCursor(object):
+  """Streams the rows of TASK_ROWS for the keyrange of the cursor."""
+
+  def __init__(self, connections, keyspace, tablet_type, keyranges=None):
+    self.conn = connections
+    self.keyrange = str(keyranges[0])
+
+  def execute(self, sql, bind_variables):
+    self.conn.queries.append((self.keyrange, sql, bind_variables))
+    if self.keyrange in self.conn.execute_errors:
+      raise self.conn.execute_errors[self.keyrange]
+    self.description = FIELDS
+
+  def fetch_batches(self):
+    rows = TASK_ROWS[self.keyrange]
+    if self.conn.reverse:
+      rows = rows[::-1]
+    for i in xrange(0, len(rows), 2):
+      if i and self.keyrange in self.conn.fetch_errors:
+        raise self.conn.fetch_errors[self.keyrange]
+      self.conn.packets_sent += 1
+      yield rows[i:i + 2]
+
+
+class FakeConnections(object):
+  """Creates the connections of the tasks, and records their use."""
+
+  def __init__(self):
+    self.queries = []
+    self.execute_errors = {}
+    self.fetch_errors = {}
+    self.reverse = False
+    self.packets_sent = 0
+    self.open = 0
+    self.lock = threading.Lock()
+
+  def connect(self):
+    with self.lock:
+      self.open += 1
+    return FakeConnection(self)
+
+  def wait_closed(self):
+    deadline = time.time() + 5
+    while self.open and time.time() < deadline:
+      time.sleep(0.01)
+    return self.open == 0
+
+
+class FakeConnection(object):
+
+  def __init__(self, connections):
+    self.connections = connections
+
+  def cursor(self, *pargs, **kwargs):
+    del kwargs['cursorclass']
+    return FakeStreamCursor(self.connections, *pargs, **kwargs)
+
+  def close(self):
+    with self.connections.lock:
+      self.connections.open -= 1
+
+
+class TestParallelStreamCursor(unittest.TestCase):
+
+  def setUp(self):
+    self.connections = FakeConnections()
+    patcher = mock.patch.object(
+        topology, 'get_sharding_col',
+        return_value=('keyspace_id', keyrange_constants.KIT_UINT64))
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def execute(self, *pargs, **kwargs):
+    cursor = parallel_stream_cursor.ParallelStreamCursor(
+        self.connections.connect, 'ks', 'rdonly', num_tasks=4,
+        shard_count=kwargs.pop('shard_count', 4),
+        queue_size=kwargs.pop('queue_size', 4))
+    self.addCleanup(cursor.close)
+    cursor.execute(*pargs, **kwargs)
+    return cursor
+
+  def test_fetchall(self):
+    cursor = self.execute('SELECT id, name FROM t', {})
+    self.assertEqual(cursor.keyrange_list, KEYRANGES)
+    self.assertEqual(cursor.description, FIELDS)
+    self.assertEqual(sorted(cursor.fetchall()), ALL_ROWS)
+    self.assertEqual(cursor.rownumber, 20)
+    self.assertEqual(cursor.fetchone(), None)
+    self.assertTrue(self.connections.wait_closed())
+
+  def test_task_queries(self):
+    bind_variables = {'name': 'name1'}
+    cursor = self.execute('SELECT id, name FROM t', bind_variables,
+                          where_clause='name = %(name)s')
+    cursor.fetchall()
+    queries = dict((kr, (sql, bind_vars))
+                   for kr, sql, bind_vars in self.connections.queries)
+    self.assertEqual(
+        queries['40-80'],
+        ('SELECT id, name FROM t WHERE name = %(name)s AND '
+         'keyspace_id >= %(keyspace_id0)s AND keyspace_id < %(keyspace_id1)s',
+         {'name': 'name1', 'keyspace_id0': 0x4000000000000000,
+          'keyspace_id1': 0x8000000000000000}))
+    self.assertEqual(
+        queries['-40'],
+        ('SELECT id, name FROM t WHERE name = %(name)s AND '
+         'keyspace_id < %(keyspace_id0)s',
+         {'name': 'name1', 'keyspace_id0': 0x4000000000000000}))
+    self.assertEqual(bind_variables, {'name': 'name1'})
+
+  def test_fetch_batches(self):
+    cursor = self.execute('SELECT id, name FROM t', {})
+    self.assertEqual(len(cursor.fetchone()), 2)
+    self.assertEqual(len(cursor.fetchmany(3)), 3)
+    batches = list(cursor.fetch_batches())
+    self.assertTrue(all(0 < len(batch) <= 2 for batch in batches))
+    self.assertEqual(sum(len(batch) for batch in batches), 16)
+    self.assertEqual(cursor.fetchmany(3), [])
+
+  def test_order_by(self):
+    cursor = self.execute('SELECT id, name FROM t', {}, order_by='id')
+    self.assertEqual(list(cursor), ALL_ROWS)
+    sql = self.connections.queries[0][1]
+    self.assertTrue(sql.endswith(' ORDER BY id'), sql)
+
+  def test_order_by_desc(self):
+    self.connections.reverse = True
+    cursor = self.execute('SELECT id, name FROM t', {},
+                          order_by=[('id', 'DESC')])
+    self.assertEqual(cursor.fetchall(), ALL_ROWS[::-1])
+
+  def test_order_by_columns(self):
+    # each task streams its rows in the order of the query
+    task_rows = dict(
+        (kr, sorted(rows, key=lambda row: (row[1], -row[0])))
+        for kr, rows in TASK_ROWS.iteritems())
+    with mock.patch.dict(TASK_ROWS, task_rows):
+      cursor = self.execute('SELECT id, name FROM t', {},
+                            order_by=['name', ('id', 'DESC')])
+      self.assertEqual(cursor.fetchall(),
+                       sorted(ALL_ROWS, key=lambda row: (row[1], -row[0])))
+
+  def test_order_by_without_shard_count(self):
+    # a task keyrange may cover several shards, its rows are not sorted
+    self.assertRaises(dbexceptions.ProgrammingError, self.execute,
+                      'SELECT id, name FROM t', {}, order_by='id',
+                      shard_count=None)
+    self.assertEqual(self.connections.queries, [])
+
+  def test_order_by_not_selected(self):
+    self.assertRaises(dbexceptions.ProgrammingError, self.execute,
+                      'SELECT id, name FROM t', {}, order_by='other')
+    self.assertTrue(self.connections.wait_closed())
+
+  def test_execute_error(self):
+    self.connections.execute_errors['80-c0'] = dbexceptions.DatabaseError(
+        'bad query')
+    cursor = parallel_stream_cursor.ParallelStreamCursor(
+        self.connections.connect, 'ks', 'rdonly', num_tasks=4)
+    self.assertRaises(dbexceptions.DatabaseError, cursor.execute,
+                      'SELECT id, name FROM t', {})
+    self.assertEqual([kr for kr, _ in cursor.errors], ['80-c0'])
+    self.assertTrue(self.connections.wait_closed())
+
+  def test_fetch_error(self):
+    self.connections.fetch_errors['c0-'] = dbexceptions.TimeoutError('slow')
+    cursor = self.execute('SELECT id, name FROM t', {})
+    self.assertRaises(dbexceptions.TimeoutError, cursor.fetchall)
+    self.assertEqual([kr for kr, _ in cursor.errors], ['c0-'])
+    self.assertIsInstance(cursor.errors[0][1], dbexceptions.TimeoutError)
+    self.assertTrue(self.connections.wait_closed())
+
+  def test_close(self):
+    # the tasks wait for the reader, and stop when the cursor is closed
+    cursor = self.execute('SELECT id, name FROM t', {}, queue_size=1)
+    self.assertEqual(len(cursor.fetchmany(2)), 2)
+    time.sleep(0.05)
+    self.assertLess(self.connections.packets_sent, 12)
+    self.assertGreater(self.connections.open, 0)
+    cursor.close()
+    self.assertTrue(self.connections.wait_closed())
+    self.assertRaises(dbexceptions.ProgrammingError, cursor.fetchone)
+
+  def test_blocked_tasks_resume_promptly(self):
+    # the tasks waiting for room in their queue don't poll
+    cursor = self.execute('SELECT id, name FROM t', {}, order_by='id',
+                          queue_size=1)
+    time.sleep(0.17)
+    start = time.time()
+    self.assertEqual(cursor.fetchall(), ALL_ROWS)
+    self.assertLess(time.time() - start, 0.01)
+
+  def test_fetch_before_execute(self):
+    cursor = parallel_stream_cursor.ParallelStreamCursor(
+        self.connections.connect, 'ks', 'rdonly', num_tasks=4)
+    self.assertRaises(dbexceptions.ProgrammingError, cursor.fetchone)
+    self.assertRaises(dbexceptions.ProgrammingError, cursor.fetch_batches)
+
+
+if __name__ == '__main__':
+  utils.main()
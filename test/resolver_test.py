@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for net.resolver."""
+
+import socket
+import threading
+import time
+import unittest
+
+import mock
+
+import utils
+from net import resolver
+
+
+def addrinfo(*addresses):
+  return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (address, 0))
+          for address in addresses]
+
+
+class TestResolver(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(socket, 'getaddrinfo')
+    self.getaddrinfo = patcher.start()
+    self.addCleanup(patcher.stop)
+    self.getaddrinfo.return_value = addrinfo('10.0.0.1', '10.0.0.2',
+                                             '10.0.0.1')
+
+  def test_cache(self):
+    r = resolver.Resolver(ttl=0.05)
+    self.assertEqual(r.resolve('vtgate'), '10.0.0.1')
+    self.assertEqual(r.resolve('vtgate'), '10.0.0.1')
+    self.assertEqual(self.getaddrinfo.call_count, 1)
+    time.sleep(0.06)
+    r.resolve('vtgate')
+    self.assertEqual(self.getaddrinfo.call_count, 2)
+    stats = r.stats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 2)
+
+  def test_negative_cache(self):
+    self.getaddrinfo.side_effect = socket.gaierror(socket.EAI_NONAME, 'nope')
+    r = resolver.Resolver(negative_ttl=60)
+    for _ in xrange(2):
+      with self.assertRaises(socket.gaierror):
+        r.resolve('nowhere')
+    self.assertEqual(self.getaddrinfo.call_count, 1)
+    self.assertEqual(r.stats()['negative_hits'], 1)
+    r.invalidate('nowhere')
+    self.getaddrinfo.side_effect = None
+    self.assertEqual(r.resolve('nowhere'), '10.0.0.1')
+
+  def test_spread(self):
+    r = resolver.Resolver(spread=True)
+    self.assertEqual([r.resolve('vtgate') for _ in xrange(3)],
+                     ['10.0.0.1', '10.0.0.2', '10.0.0.1'])
+
+  def test_shared_lookup(self):
+    # concurrent lookups of the same host call the system resolver once
+    release = threading.Event()
+
+    def slow_getaddrinfo(*args):
+      release.wait()
+      return addrinfo('10.0.0.3')
+    self.getaddrinfo.side_effect = slow_getaddrinfo
+    r = resolver.Resolver()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(
+        r.resolve('vtgate'))) for _ in xrange(4)]
+    for thread in threads:
+      thread.start()
+    while r.stats()['shared_lookups'] < 3:
+      time.sleep(0.01)
+    release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, ['10.0.0.3'] * 4)
+    self.assertEqual(self.getaddrinfo.call_count, 1)
+
+
+  def test_unexpected_lookup_error(self):
+    # an error that is not a socket.error is not cached, and doesn't
+    # leave the next lookups of the host waiting forever
+    release = threading.Event()
+
+    def bad_getaddrinfo(*args):
+      release.wait()
+      raise UnicodeError('label empty or too long')
+    self.getaddrinfo.side_effect = bad_getaddrinfo
+    r = resolver.Resolver()
+    errors = []
+
+    def resolve():
+      try:
+        r.resolve('bad..host')
+      except UnicodeError as e:
+        errors.append(e)
+    thread = threading.Thread(target=resolve)
+    thread.start()
+    while r.stats()['misses'] < 1:
+      time.sleep(0.01)
+    waiter = threading.Thread(target=resolve)
+    waiter.start()
+    while r.stats()['shared_lookups'] < 1:
+      time.sleep(0.01)
+    release.set()
+    thread.join(5)
+    waiter.join(5)
+    self.assertFalse(thread.is_alive() or waiter.is_alive())
+    self.assertEqual(len(errors), 2)
+    self.getaddrinfo.side_effect = None
+    self.assertEqual(r.resolve('bad..host'), '10.0.0.1')
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for vtdb.result_cache, and its use by vtgatev2."""
+
+import unittest
+
+import mock
+
+import utils
+from net import gorpc
+from vtdb import field_types
+from vtdb import keyrange
+from vtdb import result_cache
+from vtdb import vtgate_cursor
+from vtdb import vtgatev2
+
+RESULT = {
+    'Fields': [{'Name': 'id', 'Type': field_types.VT_LONGLONG},
+               {'Name': 'name', 'Type': field_types.VT_VAR_STRING}],
+    'RowsAffected': 2,
+    'InsertId': 0,
+    'Rows': [['1', 'a'], ['2', 'b']],
+}
+
+
+class FakeClient(object):
+  """Replies RESULT to every call, and records them."""
+
+  def __init__(self):
+    self.calls = []
+
+  def call(self, method, req):
+    self.calls.append(req['Sql'])
+    response = gorpc.GoRpcResponse()
+    response.reply = {'Result': RESULT, 'Session': None, 'Error': ''}
+    return response
+
+
+class TestResultCache(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = result_cache.ResultCache(
+        max_bytes=1000, default_ttl=10, table_ttls={'t_short': 1, 't_no': 0})
+    patcher = mock.patch.object(result_cache.time, 'time', return_value=100)
+    self.time = patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def key(self, sql, bind_variables=None, tablet_type='replica', **kwargs):
+    return self.cache.key(sql, bind_variables or {}, 'ks', tablet_type,
+                          **kwargs)
+
+  def test_key(self):
+    key = self.key('select * from t where id = %(id)s', {'id': 1},
+                   keyspace_ids=['\x10'])
+    self.assertEqual(
+        self.key('  SELECT *\n  FROM t\tWHERE id = %(id)s ', {'id': 1},
+                 keyspace_ids=['\x10'])[2:],
+        key[2:])
+    self.assertNotEqual(
+        self.key('select * from t where id = %(id)s', {'id': 2},
+                 keyspace_ids=['\x10']),
+        key)
+    self.assertNotEqual(
+        self.key('select * from t where id = %(id)s', {'id': True},
+                 keyspace_ids=['\x10']),
+        key)
+    self.assertNotEqual(
+        self.key('select * from t where id = %(id)s', {'id': 1},
+                 keyspace_ids=['\x20']),
+        key)
+    # whitespace in strings matters
+    self.assertNotEqual(self.key("select * from t where a = 'x  y'"),
+                        self.key("select * from t where a = 'x y'"))
+    self.assertEqual(
+        self.key('select * from t', keyranges=[keyrange.KeyRange('10-20')]),
+        self.key('select * from t', keyranges=['10-20']))
+    self.assertIsNotNone(self.key('select * from t where id in %(ids)s',
+                                  {'ids': [1, 2]}))
+
+  def test_not_cached(self):
+    self.assertIsNone(self.key('select * from t', tablet_type='master'))
+    self.assertIsNone(self.key('update t set a = 1'))
+    self.assertIsNone(self.key('select * from t for update'))
+    self.assertIsNone(self.key('select * from t_no'))
+    self.assertIsNone(self.key('select * from t where a = %(a)s',
+                               {'a': bytearray('x')}))
+
+  def test_ttl(self):
+    key = self.key('select * from ks.t_short where id = 1')
+    self.cache.put(key, ([(1,)], 1, 0, []))
+    self.assertEqual(self.cache.get(key), ([(1,)], 1, 0, []))
+    self.time.return_value = 101
+    self.assertIsNone(self.cache.get(key))
+    key = self.key('select * from t')
+    self.cache.put(key, ([], 0, 0, []))
+    self.time.return_value = 111
+    self.assertIsNone(self.cache.get(key))
+    self.assertEqual(self.cache.stats(), {
+        'hits': 1, 'misses': 2, 'evictions': 0, 'expirations': 2,
+        'entries': 0, 'bytes': 0})
+
+  def test_lru(self):
+    keys = [self.key('select * from t where id = %d' % i) for i in xrange(3)]
+    value = ([('x' * 200,)], 1, 0, [])
+    self.cache.put(keys[0], value)
+    self.cache.put(keys[1], value)
+    self.assertEqual(self.cache.get(keys[0]), value)
+    # evicts keys[1], the least recently used
+    self.cache.put(keys[2], value)
+    self.assertIsNone(self.cache.get(keys[1]))
+    self.assertEqual(self.cache.get(keys[0]), value)
+    self.assertEqual(self.cache.get(keys[2]), value)
+    stats = self.cache.stats()
+    self.assertEqual(stats['evictions'], 1)
+    self.assertEqual(stats['entries'], 2)
+    self.assertLessEqual(stats['bytes'], 1000)
+    # too big to be cached
+    self.cache.put(keys[1], ([('x' * 2000,)], 1, 0, []))
+    self.assertIsNone(self.cache.get(keys[1]))
+    self.cache.clear()
+    self.assertEqual(self.cache.stats()['bytes'], 0)
+
+
+class TestVTGateConnectionCache(unittest.TestCase):
+
+  def setUp(self):
+    self.cache = result_cache.ResultCache()
+    self.conn = vtgatev2.VTGateConnection('addr', 1.0,
+                                          result_cache=self.cache)
+    self.conn.client = FakeClient()
+
+  def fetchall(self, tablet_type='replica', **kwargs):
+    cursor = vtgate_cursor.VTGateCursor(
+        self.conn, 'ks', tablet_type, keyspace_ids=['\x80'], **kwargs)
+    cursor.execute('select id, name from t', {})
+    return cursor.fetchall()
+
+  def test_cached(self):
+    self.assertEqual(self.fetchall(), [(1L, 'a'), (2L, 'b')])
+    self.assertEqual(self.fetchall(), [(1L, 'a'), (2L, 'b')])
+    self.assertEqual(len(self.conn.client.calls), 1)
+    self.assertEqual(self.cache.stats()['hits'], 1)
+
+  def test_bypassed(self):
+    self.fetchall(tablet_type='master')
+    self.fetchall(tablet_type='master')
+    self.fetchall(columnar=True)
+    self.conn.session = {'InTransaction': True}
+    self.fetchall()
+    self.fetchall()
+    self.assertEqual(len(self.conn.client.calls), 5)
+    self.assertEqual(self.cache.stats()['entries'], 0)
+
+
+if __name__ == '__main__':
+  utils.main()
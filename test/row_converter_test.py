@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for vtdb.row_converter."""
+
+import datetime
+import decimal
+import unittest
+
+import utils
+from vtdb import field_types
+from vtdb import row_converter
+
+
+class TestRowConverter(unittest.TestCase):
+
+  def test_convert(self):
+    converter = row_converter.get([
+        field_types.VT_LONGLONG, field_types.VT_VAR_STRING,
+        field_types.VT_DATETIME, field_types.VT_NEWDECIMAL,
+        field_types.VT_BLOB])
+    self.assertFalse(converter.passthrough)
+    self.assertEqual(
+        converter.convert_rows([
+            ['1', 'a', '2015-06-01 12:34:56', '1.25', 'x'],
+            [None, None, None, None, None],
+        ]),
+        [(1L, 'a', datetime.datetime(2015, 6, 1, 12, 34, 56),
+          decimal.Decimal('1.25'), 'x'),
+         (None, None, None, None, None)])
+
+  def test_passthrough(self):
+    converter = row_converter.get([field_types.VT_VAR_STRING,
+                                   field_types.VT_BLOB])
+    self.assertTrue(converter.passthrough)
+    self.assertIs(converter.convert_row, tuple)
+    self.assertEqual(converter.convert_rows([['a', None]]), [('a', None)])
+    self.assertEqual(row_converter.get([]).convert_rows([[]]), [()])
+
+  def test_shared(self):
+    types = [field_types.VT_LONG, field_types.VT_STRING]
+    converter = row_converter.get(types)
+    self.assertIs(row_converter.get(tuple(types)), converter)
+    self.assertIsNot(row_converter.get([field_types.VT_LONG]), converter)
+
+  def test_short_row(self):
+    # converted as far as it goes, like cbson.decode_rows does
+    converter = row_converter.get([field_types.VT_LONG,
+                                   field_types.VT_VAR_STRING,
+                                   field_types.VT_LONG])
+    self.assertEqual(converter.convert_row(['1', 'a']), (1L, 'a'))
+    self.assertEqual(converter.convert_row([]), ())
+
+  def test_lazy_rows(self):
+    converter = row_converter.get([field_types.VT_LONG])
+    rows = row_converter.LazyRows([['1'], ['2'], ['3']], converter)
+    self.assertEqual(len(rows), 3)
+    self.assertEqual(rows[-1], (3L,))
+    self.assertIs(rows[2], rows[-1])
+    self.assertEqual(rows[0:2], [(1L,), (2L,)])
+    self.assertEqual(list(rows), [(1L,), (2L,), (3L,)])
+    self.assertRaises(IndexError, rows.__getitem__, 3)
+
+  def test_lazy_rows_convert_all(self):
+    # used for the slices reading most of the rows
+    converter = row_converter.get([field_types.VT_LONG])
+    calls = []
+    def convert_all():
+      calls.append(1)
+      return [(1L,), (2L,), (3L,)]
+    rows = row_converter.LazyRows([['1'], ['2'], ['3']], converter,
+                                  convert_all)
+    self.assertEqual(rows[0:1], [(1L,)])
+    self.assertEqual(calls, [])
+    self.assertEqual(rows[1:], [(2L,), (3L,)])
+    self.assertEqual(rows[:], [(1L,), (2L,), (3L,)])
+    self.assertEqual(calls, [1])
+
+  def test_unknown_type(self):
+    # types without a conversion are returned as they are
+    converter = row_converter.get([field_types.VT_LONG, 1000])
+    self.assertEqual(converter.convert_row(['3', 'v']), (3L, 'v'))
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for net.rpc_instrumentation, against a fake vtgate."""
+
+import time
+import unittest
+
+import utils
+from async_vtgatev2_test import FakeVTGate
+from async_vtgatev2_test import handle_request
+from net import bsonrpc
+from net import gorpc
+from net import rpc_instrumentation
+
+
+class RecordingInstrumentation(rpc_instrumentation.RpcInstrumentation):
+
+  def __init__(self):
+    self.stats = []
+
+  def rpc_done(self, stats):
+    self.stats.append(stats)
+
+
+def query(sql, i=0):
+  return {'Sql': sql, 'BindVariables': {'id': i}, 'Keyspace': 'ks',
+          'KeyspaceIds': ['\x80'], 'TabletType': 'replica'}
+
+
+class TestRpcInstrumentation(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.vtgate = FakeVTGate(handle_request)
+
+  def setUp(self):
+    self.instrumentation = RecordingInstrumentation()
+    rpc_instrumentation.register_instrumentation(self.instrumentation)
+    self.addCleanup(rpc_instrumentation.register_instrumentation, None)
+    self.client = bsonrpc.BsonRpcClient(self.vtgate.addr, 0.5)
+    self.client.dial()
+    self.addCleanup(self.client.close)
+
+  def test_call(self):
+    self.client.call('VTGate.ExecuteKeyspaceIds', query('select'))
+    stats, = self.instrumentation.stats
+    self.assertEqual(stats.method, 'VTGate.ExecuteKeyspaceIds')
+    self.assertEqual(stats.peer, self.vtgate.addr)
+    self.assertEqual(stats.outcome, rpc_instrumentation.OK)
+    self.assertEqual(stats.frames, 1)
+    self.assertGreater(stats.bytes_sent, 0)
+    self.assertGreater(stats.bytes_received, 0)
+    self.assertLessEqual(stats.time_to_first_byte, stats.wall_time)
+
+  def test_errors(self):
+    with self.assertRaises(gorpc.AppError):
+      self.client.call('VTGate.Unknown', {})
+    with self.assertRaises(gorpc.TimeoutError):
+      self.client.call('VTGate.ExecuteKeyspaceIds', query('slow'),
+                       timeout=0.05)
+    self.assertEqual([s.outcome for s in self.instrumentation.stats],
+                     [rpc_instrumentation.APP_ERROR,
+                      rpc_instrumentation.TIMEOUT])
+    # the error came in a response frame
+    self.assertEqual(self.instrumentation.stats[0].frames, 1)
+
+  def test_stream(self):
+    self.client.stream_call('VTGate.StreamExecuteKeyspaceIds', query('select'))
+    while self.client.stream_next() is not None:
+      pass
+    stats, = self.instrumentation.stats
+    self.assertTrue(stats.streaming)
+    self.assertEqual(stats.outcome, rpc_instrumentation.OK)
+    self.assertEqual(stats.frames, 4)
+
+  def test_abandoned_stream(self):
+    self.client.stream_call('VTGate.StreamExecuteKeyspaceIds', query('select'))
+    self.client.stream_next()
+    self.client.close()
+    self.client.dial()
+    self.client.call('VTGate.ExecuteKeyspaceIds', query('select'))
+    self.assertEqual([s.outcome for s in self.instrumentation.stats],
+                     [rpc_instrumentation.ABANDONED, rpc_instrumentation.OK])
+    self.assertEqual(self.instrumentation.stats[0].frames, 1)
+
+  def test_disabled(self):
+    rpc_instrumentation.register_instrumentation(None)
+    response = self.client.call('VTGate.ExecuteKeyspaceIds', query('select'))
+    self.assertEqual(self.instrumentation.stats, [])
+    self.assertEqual(response.size, 0)
+
+  def test_untimed_response(self):
+    # a frame read before instrumentation was registered has no timing
+    stats = rpc_instrumentation.RpcStats('M', 'peer', time.time())
+    stats.add_response(gorpc.GoRpcResponse())
+    self.assertEqual(stats.frames, 1)
+    self.assertIsNone(stats.time_to_first_byte)
+
+
+class TestRpcHistogram(unittest.TestCase):
+
+  def test_snapshot(self):
+    histogram = rpc_instrumentation.RpcHistogram()
+    for wall_time in (0.001, 0.001, 0.001, 0.5):
+      stats = rpc_instrumentation.RpcStats('M', 'host:1', 0)
+      stats.wall_time = wall_time
+      stats.bytes_sent = 10
+      histogram.rpc_done(stats)
+    snapshot = histogram.snapshot()[('M', 'host:1')]
+    self.assertEqual(snapshot['outcomes'], {rpc_instrumentation.OK: 4})
+    self.assertEqual(snapshot['bytes_sent'], 40)
+    self.assertEqual(snapshot['wall_time']['count'], 4)
+    self.assertAlmostEqual(snapshot['wall_time']['p50'], 0.0016)
+    self.assertAlmostEqual(snapshot['wall_time']['p99'], 0.8192)
+    self.assertEqual(snapshot['time_to_first_byte']['count'], 0)
+    histogram.reset()
+    self.assertEqual(histogram.snapshot(), {})
+
+
+if __name__ == '__main__':
+  utils.main()
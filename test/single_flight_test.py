@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for vtdb.single_flight, and its use by vtgatev2."""
+
+import threading
+import time
+import unittest
+
+import utils
+from net import gorpc
+from vtdb import dbexceptions
+from vtdb import field_types
+from vtdb import single_flight
+from vtdb import vtgate_cursor
+from vtdb import vtgatev2
+
+RESULT = {
+    'Fields': [{'Name': 'id', 'Type': field_types.VT_LONGLONG}],
+    'RowsAffected': 1,
+    'InsertId': 0,
+    'Rows': [['1']],
+}
+
+
+class BlockingCall(object):
+  """A call that blocks until released, and counts how often it ran."""
+
+  def __init__(self, result=None, error=None):
+    self.result = result
+    self.error = error
+    self.started = threading.Event()
+    self.release = threading.Event()
+    self.count = 0
+
+  def __call__(self):
+    self.count += 1
+    self.started.set()
+    self.release.wait()
+    if self.error is not None:
+      raise self.error
+    return self.result
+
+
+class FakeClient(object):
+  """Replies RESULT to every call once released, and records them."""
+
+  def __init__(self, call):
+    self.blocking_call = call
+
+  def call(self, method, req):
+    self.blocking_call()
+    response = gorpc.GoRpcResponse()
+    response.reply = {'Result': RESULT, 'Session': None, 'Error': ''}
+    return response
+
+
+def run_threads(count, target):
+  """Starts count threads running target, and returns them and their results.
+
+  The result of each thread is a (result, exception) pair.
+  """
+  results = [None] * count
+
+  def run(i):
+    try:
+      results[i] = (target(), None)
+    except Exception as e:
+      results[i] = (None, e)
+
+  threads = [threading.Thread(target=run, args=(i,)) for i in xrange(count)]
+  for thread in threads:
+    thread.start()
+  return threads, results
+
+
+class TestSingleFlight(unittest.TestCase):
+
+  def setUp(self):
+    self.flight = single_flight.SingleFlight()
+
+  def wait_in_flight(self, count):
+    for _ in xrange(500):
+      stats = self.flight.stats()
+      if stats['rpcs'] + stats['shared'] >= count:
+        return
+      threading.Event().wait(0.01)
+    self.fail('calls not started: %s' % self.flight.stats())
+
+  def test_shared(self):
+    call = BlockingCall(result=[(1,)])
+    threads, results = run_threads(
+        5, lambda: self.flight.do('key', call))
+    call.started.wait(5)
+    self.wait_in_flight(5)
+    call.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(call.count, 1)
+    self.assertEqual(results, [([(1,)], None)] * 5)
+    self.assertEqual(self.flight.stats(),
+                     {'rpcs': 1, 'shared': 4, 'in_flight': 0})
+
+  def test_error_shared(self):
+    call = BlockingCall(error=dbexceptions.TimeoutError('slow'))
+    threads, results = run_threads(
+        3, lambda: self.flight.do('key', call))
+    call.started.wait(5)
+    self.wait_in_flight(3)
+    call.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(call.count, 1)
+    for _, error in results:
+      self.assertIsInstance(error, dbexceptions.TimeoutError)
+    self.assertEqual(self.flight.stats()['in_flight'], 0)
+
+  def test_shared_promptly(self):
+    # the waiting threads get the result as soon as the call is done
+    call = BlockingCall(result=[(1,)])
+    done_times = []
+
+    def read():
+      result = self.flight.do('key', call, 10)
+      done_times.append(time.time())
+      return result
+
+    threads, results = run_threads(3, read)
+    call.started.wait(5)
+    self.wait_in_flight(3)
+    time.sleep(0.2)
+    release_time = time.time()
+    call.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, [([(1,)], None)] * 3)
+    self.assertLess(max(done_times) - release_time, 0.005)
+
+  def test_shorter_timeout_not_shared(self):
+    # a call that may outlast the timeout of the caller isn't waited for
+    call = BlockingCall(result=[(1,)])
+    threads, results = run_threads(
+        1, lambda: self.flight.do('key', call, 10))
+    call.started.wait(5)
+    self.assertEqual(self.flight.do('key', lambda: [(2,)], 1), [(2,)])
+    call.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, [([(1,)], None)])
+    self.assertEqual(self.flight.stats(),
+                     {'rpcs': 2, 'shared': 0, 'in_flight': 0})
+
+  def test_sequential_calls_not_shared(self):
+    self.assertEqual(self.flight.do('key', lambda: 1), 1)
+    self.assertEqual(self.flight.do('key', lambda: 2), 2)
+    self.assertEqual(self.flight.do('other', lambda: 3), 3)
+    self.assertEqual(self.flight.stats(),
+                     {'rpcs': 3, 'shared': 0, 'in_flight': 0})
+
+
+class TestVTGateConnectionSingleFlight(unittest.TestCase):
+
+  def setUp(self):
+    self.flight = single_flight.SingleFlight()
+    self.call = BlockingCall()
+
+  def connection(self):
+    conn = vtgatev2.VTGateConnection('addr', 1.0, single_flight=self.flight)
+    conn.client = FakeClient(self.call)
+    return conn
+
+  def fetchall(self, tablet_type='replica', session=None):
+    conn = self.connection()
+    conn.session = session
+    cursor = vtgate_cursor.VTGateCursor(
+        conn, 'ks', tablet_type, keyspace_ids=['\x80'])
+    cursor.execute('select id from t where id = %(id)s', {'id': 1})
+    return cursor.fetchall()
+
+  def test_shared(self):
+    threads, results = run_threads(4, self.fetchall)
+    self.call.started.wait(5)
+    for _ in xrange(500):
+      if self.flight.stats()['shared'] == 3:
+        break
+      threading.Event().wait(0.01)
+    self.call.release.set()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(self.call.count, 1)
+    self.assertEqual(results, [([(1L,)], None)] * 4)
+    self.assertEqual(self.flight.stats()['shared'], 3)
+
+  def test_bypassed(self):
+    self.call.release.set()
+    self.fetchall(tablet_type='master')
+    self.fetchall(session={'InTransaction': True})
+    self.assertEqual(self.call.count, 2)
+    self.assertEqual(self.flight.stats()['rpcs'], 0)
+
+
+if __name__ == '__main__':
+  utils.main()
@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import copy
 import itertools
+import pickle
 import unittest
 
 from vtdb import sql_builder
@@ -220,6 +222,50 @@ class TestDBRow(unittest.TestCase):
         ValueError, sql_builder.DBRow, ['col_a', 'col_b'], ['val_1'])
 
 
+class TestRowClass(unittest.TestCase):
+  """Test sql_builder.row_class."""
+
+  def test_compact(self):
+    row_class = sql_builder.row_class(['col_a', 'col_b'])
+    self.assertTrue(issubclass(row_class, sql_builder.CompactDBRow))
+    self.assertIs(sql_builder.row_class(('col_a', 'col_b')), row_class)
+    db_row = row_class(['val_1', 'val_2'])
+    self.assertEqual(db_row.col_a, 'val_1')
+    self.assertEqual(db_row.col_b, 'val_2')
+    self.assertFalse(hasattr(db_row, 'col_c'))
+    self.assertEqual(vars(db_row), {'col_a': 'val_1', 'col_b': 'val_2'})
+    self.assertEqual(
+        repr(db_row), "{   'col_a': 'val_1', 'col_b': 'val_2'}")
+    db_row.col_b = 22
+    self.assertEqual(db_row.col_b, 22)
+
+  def test_pickle(self):
+    db_row = sql_builder.row_class(['col_a', 'col_b'])((1, 'x'))
+    for protocol in (0, 2):
+      unpickled = pickle.loads(pickle.dumps(db_row, protocol))
+      self.assertIs(type(unpickled), type(db_row))
+      self.assertEqual(vars(unpickled), vars(db_row))
+    self.assertEqual(vars(copy.copy(db_row)), vars(db_row))
+
+  def test_mismatch(self):
+    row_class = sql_builder.row_class(['col_a', 'col_b'])
+    self.assertRaises(ValueError, row_class, ['val_1'])
+    self.assertRaises(ValueError, row_class, ['val_1', 'val_2', 'val_3'])
+    self.assertRaises(ValueError, sql_builder.row_class([]), ['val_1'])
+    self.assertEqual(vars(sql_builder.row_class([])(())), {})
+
+  def test_not_identifiers(self):
+    # columns that can't be slots get DBRow instances
+    for columns_list in (['count(*)', 'col_a'], ['class'], ['__x'],
+                         ['col_a', 'col_a']):
+      row_class = sql_builder.row_class(columns_list)
+      self.assertTrue(issubclass(row_class, sql_builder.DBRow))
+      db_row = row_class(range(len(columns_list)))
+      self.assertEqual(getattr(db_row, columns_list[-1]),
+                       len(columns_list) - 1)
+      self.assertRaises(ValueError, row_class, [])
+
+
 class TestDeleteByColumnsQuery(unittest.TestCase):
   """Test sql_builder.delete_by_columns_query."""
 
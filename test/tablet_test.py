@@ -8,6 +8,9 @@ import mock
 
 from net import gorpc
 import utils
+from vtdb import dbexceptions
+from vtdb import field_types
+from vtdb import row_converter
 from vtdb import tablet
 
 
@@ -66,5 +69,41 @@ class TestRPCCallAndExtract(unittest.TestCase):
       with self.assertRaisesRegexp(gorpc.AppError, "'bar', 'method'"):
         self.tablet_conn.rpc_call_and_extract_error('method', 'req')
 
+
+def stream_response(reply):
+  response = gorpc.GoRpcResponse()
+  response.reply = reply
+  return response
+
+
+class TestStreamNext(unittest.TestCase):
+  """Tests _stream_next keeps no stale packet after an error."""
+
+  def setUp(self):
+    self.tablet_conn = tablet.TabletConnection(
+        'addr', 'type', 'keyspace', 'shard', 30)
+    self.tablet_conn._stream_converter = row_converter.get(
+        [field_types.VT_LONGLONG])
+    self.tablet_conn._stream_result = None
+    self.tablet_conn._stream_result_index = 0
+
+  def test_error_after_empty_packet(self):
+    with mock.patch.object(self.tablet_conn, 'client', autospec=True) as mock_client:
+      mock_client.stream_next.side_effect = [
+          stream_response({'Rows': []}), gorpc.GoRpcError('broken'),
+          stream_response({'Rows': [['1']]})]
+      with self.assertRaises(dbexceptions.DatabaseError):
+        self.tablet_conn._stream_next()
+      self.assertEqual(self.tablet_conn._stream_next(), (1L,))
+
+  def test_app_error_packet(self):
+    with mock.patch.object(self.tablet_conn, 'client', autospec=True) as mock_client:
+      mock_client.stream_next.side_effect = [
+          stream_response({'Err': {'Message': 'bar'}}), None,
+          stream_response({'Rows': [['2']]})]
+      with self.assertRaises(dbexceptions.DatabaseError):
+        self.tablet_conn._stream_next()
+      self.assertEqual(self.tablet_conn._stream_next(), (2L,))
+
 if __name__ == '__main__':
   utils.main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for vtgate_connection_pool."""
+
+import threading
+import time
+import unittest
+
+import mock
+
+import utils
+from vtdb import database_context
+from vtdb import dbexceptions
+from vtdb import vtgate_connection_pool
+from vtdb import vtgatev2
+
+
+class FakeRpcClient(object):
+
+  def __init__(self):
+    self.closed = True
+
+  def dial(self):
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+class FakeVTGateConnection(object):
+  """Closes like vtgatev2.VTGateConnection, rolling back its Session."""
+
+  def __init__(self, addr, timeout, user=None, password=None, keyfile=None,
+               certfile=None, result_cache=None, single_flight=None):
+    self.addr = addr
+    self.single_flight = single_flight
+    self.session = None
+    self.rollback_error = None
+    self.client = FakeRpcClient()
+
+  def dial(self):
+    self.client.dial()
+
+  def rollback(self):
+    if self.rollback_error is not None:
+      raise self.rollback_error
+    self.session = None
+
+  def close(self):
+    if self.session:
+      self.rollback()
+    self.client.close()
+
+  def is_closed(self):
+    return self.client.closed
+
+
+class TestVTGateConnectionPool(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(
+        vtgatev2, 'VTGateConnection', FakeVTGateConnection)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.addrs = {'vt': ['host1:1', 'host2:2']}
+
+  def test_reuse(self):
+    pool = vtgate_connection_pool.VTGateConnectionPool(self.addrs, 1.0)
+    conn = pool.get()
+    pool.put(conn)
+    self.assertIs(pool.get(), conn)
+    stats = pool.stats()
+    self.assertEqual(stats['size'], 1)
+    self.assertEqual(stats['in_use'], 1)
+    self.assertEqual(stats['dial_count'], 1)
+
+  def test_spread_across_addrs(self):
+    pool = vtgate_connection_pool.VTGateConnectionPool(self.addrs, 1.0)
+    conns = [pool.get() for _ in xrange(4)]
+    self.assertEqual(sorted(c.addr for c in conns),
+                     ['host1:1', 'host1:1', 'host2:2', 'host2:2'])
+
+  def test_shared_single_flight(self):
+    flight = object()
+    pool = vtgate_connection_pool.VTGateConnectionPool(
+        self.addrs, 1.0, single_flight=flight)
+    conns = [pool.get() for _ in xrange(2)]
+    self.assertIs(conns[0].single_flight, flight)
+    self.assertIs(conns[1].single_flight, flight)
+
+  def test_closed_connection_is_replaced(self):
+    pool = vtgate_connection_pool.VTGateConnectionPool(self.addrs, 1.0)
+    conn = pool.get()
+    pool.put(conn)
+    conn.close()
+    new_conn = pool.get()
+    self.assertIsNot(new_conn, conn)
+    self.assertFalse(new_conn.is_closed())
+    self.assertEqual(pool.stats()['size'], 1)
+
+  def test_exhausted(self):
+    pool = vtgate_connection_pool.VTGateConnectionPool(
+        self.addrs, 1.0, max_size=1, wait_timeout=0.05)
+    pool.get()
+    with self.assertRaises(dbexceptions.OperationalError):
+      pool.get()
+    self.assertEqual(pool.stats()['wait_count'], 1)
+
+  def test_wait_for_put(self):
+    pool = vtgate_connection_pool.VTGateConnectionPool(
+        self.addrs, 1.0, max_size=1, wait_timeout=5.0)
+    conn = pool.get()
+    timer = threading.Timer(0.05, pool.put, [conn])
+    timer.start()
+    self.assertIs(pool.get(), conn)
+    timer.join()
+
+  def test_transaction_is_pinned(self):
+    pool = vtgate_connection_pool.VTGateConnectionPool(self.addrs, 1.0)
+    conn = pool.get()
+    conn.session = {'InTransaction': True}
+    pool.put(conn)
+    self.assertEqual(pool.stats()['idle'], 0)
+
+    other = []
+    thread = threading.Thread(target=lambda: other.append(pool.get()))
+    thread.start()
+    thread.join()
+    self.assertIsNot(other[0], conn)
+
+    self.assertIs(pool.get(), conn)
+    conn.session = None
+    pool.put(conn)
+    self.assertEqual(pool.stats()['idle'], 1)
+
+  def test_several_transactions_pinned(self):
+    pool = vtgate_connection_pool.VTGateConnectionPool(self.addrs, 1.0)
+    conns = [pool.get() for _ in xrange(2)]
+    for conn in conns:
+      conn.session = {'InTransaction': True}
+      pool.put(conn)
+    self.assertIs(pool.get(), conns[1])
+    self.assertIs(pool.get(), conns[0])
+    self.assertEqual(pool.stats()['in_use'], 2)
+
+  def test_close_outside_lock(self):
+    # closing a connection may roll back its transaction over the network
+    pool = vtgate_connection_pool.VTGateConnectionPool(self.addrs, 1.0)
+    conns = [pool.get() for _ in xrange(2)]
+    pool.put(conns[0])
+    locked = []
+    with mock.patch.object(FakeVTGateConnection, 'close',
+                           lambda conn: locked.append(pool._cond._is_owned())):
+      pool.close()
+      pool.put(conns[1])
+    self.assertEqual(locked, [False, False])
+    self.assertEqual(pool.stats()['size'], 0)
+
+  def test_idle_eviction(self):
+    pool = vtgate_connection_pool.VTGateConnectionPool(
+        self.addrs, 1.0, min_size=1, idle_timeout=0.01)
+    conns = [pool.get() for _ in xrange(3)]
+    for conn in conns:
+      pool.put(conn)
+    time.sleep(0.02)
+    pool.get()
+    stats = pool.stats()
+    self.assertEqual(stats['size'], 1)
+    self.assertEqual(stats['evict_count'], 2)
+
+
+
+class TestDatabaseContextPool(unittest.TestCase):
+
+  def setUp(self):
+    patcher = mock.patch.object(
+        vtgatev2, 'VTGateConnection', FakeVTGateConnection)
+    patcher.start()
+    self.addCleanup(patcher.stop)
+    self.pool = vtgate_connection_pool.VTGateConnectionPool(
+        {'vt': ['host1:1']}, 1.0, max_size=1, wait_timeout=0.05)
+    self.dc = database_context.DatabaseContext(connection_pool=self.pool)
+
+  def test_discard_after_failed_rollback(self):
+    # the client is broken after an operational error, so is the rollback
+    for _ in xrange(3):
+      conn = self.dc.get_vtgate_connection()
+      conn.session = {'InTransaction': True}
+      conn.rollback_error = dbexceptions.OperationalError('broken client')
+      self.dc.discard_vtgate_connection()
+      self.assertTrue(conn.is_closed())
+      self.assertIsNone(conn.session)
+      self.assertEqual(self.pool.stats()['in_use'], 0)
+    self.assertEqual(self.pool.stats()['size'], 0)
+
+  def test_dead_connection_in_transaction(self):
+    conn = self.dc.get_vtgate_connection()
+    conn.session = {'InTransaction': True}
+    self.dc._transaction_stack_depth = 1
+    conn.client.close()
+    new_conn = self.dc.get_vtgate_connection()
+    self.assertIsNot(new_conn, conn)
+    self.assertFalse(self.dc.in_transaction)
+    stats = self.pool.stats()
+    self.assertEqual(stats['size'], 1)
+    self.assertEqual(stats['in_use'], 1)
+
+  def test_close_leaves_pool_open(self):
+    # the pool may be shared with other contexts
+    self.dc.get_vtgate_connection()
+    self.dc.close()
+    self.assertEqual(self.pool.stats()['in_use'], 0)
+    self.pool.put(self.pool.get())
+
+
+if __name__ == '__main__':
+  utils.main()
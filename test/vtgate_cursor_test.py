@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for vtgate_cursor, over a vtgatev2 connection with a fake client."""
+
+import array
+import datetime
+import unittest
+
+import bson
+import mock
+
+import utils
+from net import bsonrpc
+from net import gorpc
+from vtdb import columnar
+from vtdb import dbexceptions
+from vtdb import field_types
+from vtdb import row_converter
+from vtdb import vtgate_cursor
+from vtdb import vtgatev2
+
+FIELDS = [
+    ('id', field_types.VT_LONGLONG),
+    ('name', field_types.VT_VAR_STRING),
+    ('score', field_types.VT_DOUBLE),
+    ('count', field_types.VT_LONG),
+]
+
+ROWS = [
+    ['1', 'a', '1.5', '10'],
+    ['2', 'b', '2.5', None],
+    ['3', None, '3.5', '30'],
+    ['4', 'd', '4.5', '40'],
+    ['5', 'e', '5.5', '50'],
+    ['6', 'f', '6.5', '60'],
+    ['7', 'g', '7.5', '70'],
+]
+
+CONVERTED_ROWS = [
+    (1L, 'a', 1.5, 10L),
+    (2L, 'b', 2.5, None),
+    (3L, None, 3.5, 30L),
+    (4L, 'd', 4.5, 40L),
+    (5L, 'e', 5.5, 50L),
+    (6L, 'f', 6.5, 60L),
+    (7L, 'g', 7.5, 70L),
+]
+
+
+def make_result(rows, fields=FIELDS):
+  return {
+      'Fields': [{'Name': name, 'Type': t} for name, t in fields],
+      'RowsAffected': len(rows),
+      'InsertId': 0,
+      'Rows': rows,
+  }
+
+
+class FakeClient(object):
+  """Replies to the calls of a VTGateConnection with canned results.
+
+  Like BsonRpcClient(raw_rows=True), the Rows of the replies are left
+  encoded when cbson is available.
+  """
+
+  def __init__(self, result, packets=()):
+    self.result = result
+    self.packets = packets
+    self.stream = None
+
+  def _response(self, reply):
+    data = (bson.dumps({'ServiceMethod': 'M', 'Seq': 1, 'Error': ''}) +
+            bson.dumps(reply))
+    response = gorpc.GoRpcResponse()
+    raw_keys = None
+    if bsonrpc.decode_rows is not None:
+      raw_keys = bsonrpc.RAW_ROWS_KEYS
+    bsonrpc.decode_response(response, data, 0, len(data), raw_keys)
+    return response
+
+  def call(self, method, req):
+    return self._response({'Result': self.result, 'Session': None,
+                           'Error': ''})
+
+  def stream_call(self, method, req, prefetch=0):
+    self.stream = [self._response({'Result': make_result([])})]
+    for packet in self.packets:
+      if packet is None:
+        self.stream.append(self._response({'Session': {'InTransaction': 0}}))
+      else:
+        self.stream.append(self._response({'Result': make_result(packet)}))
+
+  def stream_next(self):
+    if not self.stream:
+      return None
+    return self.stream.pop(0)
+
+
+class TestVTGateCursor(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = vtgatev2.VTGateConnection('addr', 1.0)
+    self.conn.client = FakeClient(make_result(ROWS))
+
+  def execute(self, **kwargs):
+    cursor = vtgate_cursor.VTGateCursor(
+        self.conn, 'ks', 'replica', keyspace_ids=['\x80'], **kwargs)
+    cursor.execute('select * from t', {})
+    return cursor
+
+  def check_columns(self, columns, rows):
+    self.assertEqual([(c.name, c.type) for c in columns], FIELDS)
+    self.assertEqual(zip(*[c.values for c in columns]), rows)
+
+  def test_fetch_columns(self):
+    cursor = self.execute(columnar=True)
+    self.assertEqual(cursor.rowcount, 7)
+    columns = cursor.fetch_columns()
+    self.check_columns(columns, CONVERTED_ROWS)
+    self.assertEqual(columns[0].values, array.array('l', range(1, 8)))
+    self.assertEqual(columns[2].values.typecode, 'd')
+    # the NULLs keep the other columns lists
+    self.assertIsInstance(columns[1].values, list)
+    self.assertIsInstance(columns[3].values, list)
+    self.assertEqual(cursor.rownumber, 7)
+    self.assertEqual(cursor.fetchall(), [])
+    self.check_columns(cursor.fetch_columns(), [])
+
+  def test_columnar_rows(self):
+    cursor = self.execute(columnar=True)
+    self.assertEqual(cursor.fetchone(), CONVERTED_ROWS[0])
+    self.assertEqual(cursor.fetchall(), CONVERTED_ROWS[1:])
+
+  def test_fetch_columns_from_rows(self):
+    cursor = self.execute()
+    self.assertEqual(cursor.fetchone(), CONVERTED_ROWS[0])
+    self.check_columns(cursor.fetch_columns(), CONVERTED_ROWS[1:])
+
+  def test_fetch_columns_before_execute(self):
+    cursor = vtgate_cursor.VTGateCursor(self.conn, 'ks', 'replica',
+                                        columnar=True)
+    self.assertRaises(dbexceptions.ProgrammingError, cursor.fetch_columns)
+
+  def test_lazy_rows(self):
+    cursor = self.execute(lazy_rows=True)
+    self.assertEqual(cursor.rowcount, 7)
+    self.assertEqual(cursor.fetchone(), CONVERTED_ROWS[0])
+    self.assertEqual(cursor.fetchmany(2), CONVERTED_ROWS[1:3])
+    self.assertEqual(list(cursor), CONVERTED_ROWS[3:])
+    self.assertEqual(cursor.fetchone(), None)
+    self.assertEqual(self.execute(lazy_rows=True).fetchall(), CONVERTED_ROWS)
+
+  def test_lazy_rows_conversions(self):
+    # only the fetched rows are converted, once
+    converted = []
+    def convert(value):
+      converted.append(value)
+      return int(value)
+    with mock.patch.dict(field_types.conversions, {1000: convert}):
+      self.conn.client = FakeClient(
+          make_result(ROWS, [('id', 1000), ('name', field_types.VT_BLOB)]))
+      cursor = self.execute(lazy_rows=True)
+      self.assertEqual(converted, [])
+      self.assertEqual(cursor.fetchone(), (1, 'a'))
+      self.assertEqual(cursor.results[0], (1, 'a'))
+      self.assertEqual(cursor.results[-1], (7, 'g'))
+      self.assertEqual(converted, ['1', '7'])
+      self.assertEqual(cursor.fetchmany(2), [(2, 'b'), (3, None)])
+      self.assertEqual(converted, ['1', '7', '2', '3'])
+      self.assertRaises(IndexError, cursor.results.__getitem__, 7)
+      self.assertEqual(cursor.fetchall(), [(i, chr(ord('a') + i - 1))
+                                           for i in xrange(4, 8)])
+
+  def test_date_conversions(self):
+    fields = [('d', field_types.VT_DATE), ('dt', field_types.VT_DATETIME)]
+    rows = [['2015-06-01', '2015-06-01 12:30:00'], ['0000-00-00', None]]
+    self.conn.client = FakeClient(make_result(rows, fields))
+    self.assertEqual(self.execute().fetchall(), [
+        (datetime.date(2015, 6, 1), datetime.datetime(2015, 6, 1, 12, 30)),
+        (None, None)])
+    # a custom conversion is called, even for the canonical values
+    with mock.patch.dict(row_converter._converters, clear=True):
+      with mock.patch.dict(field_types.conversions, {
+          field_types.VT_DATE: lambda value: 'date ' + value,
+          field_types.VT_DATETIME: lambda value: 'datetime ' + value}):
+        self.assertEqual(self.execute().fetchall(), [
+            ('date 2015-06-01', 'datetime 2015-06-01 12:30:00'),
+            ('date 0000-00-00', None)])
+
+  def test_fetch_aggregate(self):
+    # the leading order by columns are stripped
+    self.assertEqual(self.execute().fetch_aggregate(['id'], 2),
+                     [row[1:] for row in CONVERTED_ROWS[:2]])
+    self.assertEqual(self.execute().fetch_aggregate([('id', 'DESC')], 3),
+                     [row[1:] for row in CONVERTED_ROWS[:-4:-1]])
+    self.assertEqual(self.execute().fetch_aggregate('id desc', None),
+                     [row[1:] for row in CONVERTED_ROWS[::-1]])
+    self.assertEqual(self.execute().fetch_aggregate([], 2),
+                     CONVERTED_ROWS[:2])
+
+  def test_top_rows(self):
+    rows = [(1, 'b', 'r1'), (2, 'a', 'r2'), (1, 'a', 'r3'), (2, None, 'r4'),
+            (1, 'b', 'r5')]
+    self.assertEqual(
+        vtgate_cursor.top_rows(rows, ['c1', ('c2', 'DESC')], 3),
+        [('r1',), ('r5',), ('r3',)])
+    self.assertEqual(
+        vtgate_cursor.top_rows(iter(rows), [('c1', 'DESC'), 'c2'], None),
+        [('r4',), ('r2',), ('r3',), ('r1',), ('r5',)])
+    self.assertEqual(
+        vtgate_cursor.top_rows(rows, [('c1', 'DESC'), ('c2', 'DESC')], 2),
+        [('r2',), ('r4',)])
+    self.assertEqual(vtgate_cursor.top_rows(rows, ['c1'], 0), [])
+
+  def test_numpy(self):
+    cursor = self.execute(columnar=True)
+    if columnar.numpy is None:
+      self.assertRaises(dbexceptions.NotSupportedError,
+                        cursor.fetch_columns, use_numpy=True)
+      return
+    columns = cursor.fetch_columns(use_numpy=True)
+    self.assertEqual(list(columns[0].values), range(1, 8))
+    self.assertEqual(columns[0].values.dtype, columnar.numpy.dtype('l'))
+
+
+class TestStreamVTGateCursor(unittest.TestCase):
+
+  def setUp(self):
+    self.conn = vtgatev2.VTGateConnection('addr', 1.0)
+    # a session packet, and an empty packet, between the rows
+    self.conn.client = FakeClient(
+        None, [ROWS[:3], None, [], ROWS[3:6], ROWS[6:]])
+    self.cursor = vtgate_cursor.StreamVTGateCursor(
+        self.conn, 'ks', 'replica', keyspace_ids=['\x80'])
+    self.cursor.execute('select * from t', {})
+
+  def test_fetch_column_batches(self):
+    batches = list(self.cursor.fetch_column_batches(2))
+    self.assertEqual([len(batch[0]) for batch in batches], [2, 2, 2, 1])
+    self.assertEqual(sum([zip(*[c.values for c in batch])
+                          for batch in batches], []), CONVERTED_ROWS)
+    self.assertEqual(batches[0][0].values, array.array('l', [1, 2]))
+    self.assertEqual(self.cursor.rownumber, 7)
+    self.assertEqual(self.cursor.fetchone(), None)
+
+  def test_whole_packets(self):
+    batches = list(self.cursor.fetch_column_batches(100))
+    self.assertEqual([len(batch[0]) for batch in batches], [7])
+
+  def test_fetch_batches(self):
+    # one batch per packet with rows
+    batches = list(self.cursor.fetch_batches())
+    self.assertEqual(batches, [CONVERTED_ROWS[:3], CONVERTED_ROWS[3:6],
+                               CONVERTED_ROWS[6:]])
+    self.assertEqual(self.cursor.rownumber, 7)
+    self.assertEqual(self.cursor.fetchone(), None)
+
+  def test_fetch_batches_after_fetchone(self):
+    self.assertEqual(self.cursor.fetchone(), CONVERTED_ROWS[0])
+    batches = self.cursor.fetch_batches()
+    self.assertEqual(batches.next(), CONVERTED_ROWS[1:3])
+    self.assertEqual(self.cursor.fetchmany(2), CONVERTED_ROWS[3:5])
+    self.assertEqual(list(batches), [CONVERTED_ROWS[5:6], CONVERTED_ROWS[6:]])
+
+  def test_fetchmany(self):
+    # batches are sliced and joined across packets
+    self.assertEqual(self.cursor.fetchmany(2), CONVERTED_ROWS[:2])
+    self.assertEqual(self.cursor.fetchmany(3), CONVERTED_ROWS[2:5])
+    self.assertEqual(self.cursor.fetchmany(3), CONVERTED_ROWS[5:])
+    self.assertEqual(self.cursor.rownumber, 7)
+    self.assertEqual(self.cursor.fetchmany(3), [])
+    self.assertEqual(self.cursor.fetchall(), [])
+
+  def test_fetchall(self):
+    self.assertEqual(self.cursor.fetchmany(), CONVERTED_ROWS[:1])
+    self.assertEqual(self.cursor.fetchall(), CONVERTED_ROWS[1:])
+
+  def test_fetch_before_execute(self):
+    cursor = vtgate_cursor.StreamVTGateCursor(self.conn, 'ks', 'replica')
+    self.assertRaises(dbexceptions.ProgrammingError, cursor.fetch_batches)
+    self.assertRaises(dbexceptions.ProgrammingError, cursor.fetchmany)
+
+  def test_fetch_aggregate(self):
+    self.assertEqual(self.cursor.fetch_aggregate([('id', 'DESC')], 2),
+                     [row[1:] for row in CONVERTED_ROWS[:-3:-1]])
+    self.assertEqual(self.cursor.rownumber, 7)
+
+  def test_fetch_aggregate_reads_the_stream(self):
+    self.assertEqual(self.cursor.fetch_aggregate([], 2), CONVERTED_ROWS[:2])
+    self.assertEqual(self.cursor.fetchone(), None)
+    self.assertEqual(self.conn.client.stream, [])
+
+  def test_mixed_with_fetchone(self):
+    self.assertEqual(self.cursor.fetchone(), CONVERTED_ROWS[0])
+    batches = self.cursor.fetch_column_batches(4)
+    batch = batches.next()
+    self.assertEqual(zip(*[c.values for c in batch]), CONVERTED_ROWS[1:5])
+    self.assertEqual(self.cursor.fetchone(), CONVERTED_ROWS[5])
+    self.assertEqual(self.cursor.fetchall(), CONVERTED_ROWS[6:])
+    self.assertRaises(StopIteration, batches.next)
+
+
+if __name__ == '__main__':
+  utils.main()
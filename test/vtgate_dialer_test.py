@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Tests for vtgate_dialer."""
+
+import threading
+import time
+import unittest
+
+import utils
+from vtdb import dbexceptions
+from vtdb import vtgate_dialer
+
+
+class FakeConnection(object):
+
+  def __init__(self, addr):
+    self.addr = addr
+    self.closed = False
+
+  def close(self):
+    self.closed = True
+
+
+class FakeDialer(object):
+  """dial function for dial_first, following a script per address.
+
+  Addresses in blocked wait for release() before connecting, the ones in
+  failing raise an exception.
+  """
+
+  def __init__(self, blocked=(), failing=()):
+    self.blocked = blocked
+    self.failing = failing
+    self.released = threading.Event()
+    self.dialed = []
+    self.conns = []
+
+  def release(self):
+    self.released.set()
+
+  def __call__(self, params):
+    addr = params['addr']
+    self.dialed.append(addr)
+    if addr in self.blocked:
+      self.released.wait()
+    if addr in self.failing:
+      raise dbexceptions.OperationalError('dial failed', addr)
+    conn = FakeConnection(addr)
+    self.conns.append(conn)
+    return conn
+
+
+def params_list(*addrs):
+  return [{'addr': addr, 'timeout': 1} for addr in addrs]
+
+
+class TestDialFirst(unittest.TestCase):
+
+  def setUp(self):
+    self.tracker = vtgate_dialer.FailedAddresses()
+
+  def dial_first(self, dialer, *addrs):
+    return vtgate_dialer.dial_first(params_list(*addrs), dialer, stagger=0.05,
+                                    tracker=self.tracker)
+
+  def test_black_holed_address(self):
+    dialer = FakeDialer(blocked=['a'])
+    start = time.time()
+    conn = self.dial_first(dialer, 'a', 'b')
+    self.assertEqual(conn.addr, 'b')
+    self.assertLess(time.time() - start, 0.5)
+    # the losing attempt is closed once it connects
+    dialer.release()
+    for _ in xrange(100):
+      if len(dialer.conns) == 2:
+        break
+      time.sleep(0.01)
+    self.assertTrue(dialer.conns[1].closed)
+    self.assertFalse(conn.closed)
+
+  def test_failure_dials_next_address(self):
+    dialer = FakeDialer(failing=['a'])
+    self.assertEqual(self.dial_first(dialer, 'a', 'b', 'c').addr, 'b')
+    self.assertEqual(dialer.dialed, ['a', 'b'])
+    self.assertGreater(self.tracker.penalty('a'), 0)
+
+    # a is now tried last
+    dialer = FakeDialer()
+    self.assertEqual(self.dial_first(dialer, 'a', 'b').addr, 'b')
+    self.assertEqual(dialer.dialed, ['b'])
+
+  def test_all_addresses_fail(self):
+    dialer = FakeDialer(failing=['a', 'b'])
+    with self.assertRaises(dbexceptions.OperationalError):
+      self.dial_first(dialer, 'a', 'b')
+    self.assertEqual(sorted(dialer.dialed), ['a', 'b'])
+
+
+class TestFailedAddresses(unittest.TestCase):
+
+  def test_penalty_decays(self):
+    tracker = vtgate_dialer.FailedAddresses(half_life=10.0)
+    tracker.record_failure('a')
+    tracker.record_failure('a')
+    now = time.time()
+    self.assertAlmostEqual(tracker.penalty('a', now), 2.0, places=2)
+    self.assertAlmostEqual(tracker.penalty('a', now + 10.0), 1.0, places=2)
+    self.assertEqual(tracker.penalty('a', now + 1000.0), 0.0)
+
+  def test_success_clears_penalty(self):
+    tracker = vtgate_dialer.FailedAddresses()
+    tracker.record_failure('a')
+    tracker.record_success('a')
+    self.assertEqual(tracker.penalty('a'), 0.0)
+
+  def test_order(self):
+    tracker = vtgate_dialer.FailedAddresses()
+    tracker.record_failure('a')
+    tracker.record_failure('a')
+    tracker.record_failure('c')
+    ordered = tracker.order(params_list('a', 'b', 'c', 'd'))
+    self.assertEqual([p['addr'] for p in ordered], ['b', 'd', 'c', 'a'])
+
+
+if __name__ == '__main__':
+  utils.main()